@@ -0,0 +1,73 @@
+"""
+Mede o tempo de downloads comprimidos repetidos do mesmo arquivo, com o
+cache de blocos comprimidos do servidor desligado (--cache-size '0 B') e
+ligado: o primeiro download comprime, os seguintes saem do cache.
+
+Uso: python -m benchmarks.bench_cache [-m TAMANHO_MB] [-r REPETIÇÕES] [-n STREAMS]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.common import start_server
+from ccp.client import run_client
+
+
+def measure(port, source_path, target_path, streams) -> float:
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        run_client(
+            '127.0.0.1',
+            port,
+            target_path,
+            source_path,
+            streams,
+            True,
+            decompress=True,
+            ask_confirmation=False
+        )
+    return time.perf_counter() - start
+
+
+def run():
+    parser = argparse.ArgumentParser(prog='bench_cache')
+    parser.add_argument('-m', dest='size_mb', type=int, default=64)
+    parser.add_argument('-r', dest='repetitions', type=int, default=5)
+    parser.add_argument('-n', dest='streams', type=int, default=4)
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, 'source.bin')
+        with open(source_path, 'wb') as file:
+            for _ in range(parsed_args.size_mb):
+                file.write(os.urandom(2 ** 19) + bytes(2 ** 19))
+        target_path = os.path.join(directory, 'target.bin')
+
+        for description, extra_args in (
+                ('sem cache', ('--cache-size', '0 B')),
+                ('com cache', ())
+        ):
+            server, port = start_server(*extra_args)
+            try:
+                times = [
+                    measure(port, source_path, target_path, parsed_args.streams)
+                    for _ in range(parsed_args.repetitions)
+                ]
+            finally:
+                server.terminate()
+                server.wait()
+            print(
+                f'{description}: primeiro {times[0]:.3f} s, '
+                f'seguintes {sum(times[1:]) / max(len(times) - 1, 1):.3f} s '
+                f'({parsed_args.size_mb * 2 ** 20 / min(times) / 2 ** 20:.1f} MB/s no melhor)')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,89 @@
+"""
+Mede o tempo e os bytes baixados ao pegar versões sucessivas de um
+artefato que muda pouco (trechos inseridos, removidos e trocados), sem e
+com o cache de pedaços do cliente (--chunk-cache).
+
+Uso: python -m benchmarks.bench_dedup [-m TAMANHO_MB] [-v VERSÕES] [-n STREAMS]
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.common import start_server
+from ccp.client import run_client
+from ccp.chunking import ChunkStore
+
+
+def next_version(data: bytearray) -> bytearray:
+    # Um trecho inserido, um removido e um trocado, em lugares aleatórios.
+    data = bytearray(data)
+    position = random.randrange(len(data))
+    data[position:position] = os.urandom(random.randrange(1, 4096))
+    position = random.randrange(len(data) - 4096)
+    del data[position:position + random.randrange(1, 4096)]
+    position = random.randrange(len(data) - 4096)
+    data[position:position + 4096] = os.urandom(4096)
+    return data
+
+
+def measure(port, source_path, target_path, streams, chunk_cache) -> float:
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        run_client(
+            '127.0.0.1',
+            port,
+            target_path,
+            source_path,
+            streams,
+            False,
+            ask_confirmation=False,
+            chunk_cache=chunk_cache
+        )
+    return time.perf_counter() - start
+
+
+def run():
+    parser = argparse.ArgumentParser(prog='bench_dedup')
+    parser.add_argument('-m', dest='size_mb', type=int, default=64)
+    parser.add_argument('-v', dest='versions', type=int, default=5)
+    parser.add_argument('-n', dest='streams', type=int, default=4)
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, 'source.bin')
+        target_path = os.path.join(directory, 'target.bin')
+        chunk_cache = os.path.join(directory, 'chunks')
+        versions = [bytearray(os.urandom(parsed_args.size_mb * 2 ** 20))]
+        for _ in range(parsed_args.versions - 1):
+            versions.append(next_version(versions[-1]))
+
+        server, port = start_server()
+        try:
+            for description, cache in (('sem cache', None), ('com cache', chunk_cache)):
+                times = []
+                for data in versions:
+                    with open(source_path, 'wb') as file:
+                        file.write(data)
+                    store_size = ChunkStore(cache).size if cache else 0
+                    times.append(measure(
+                        port, source_path, target_path, parsed_args.streams, cache))
+                    new_bytes = (ChunkStore(cache).size - store_size) if cache else len(data)
+                print(
+                    f'{description}: primeira versão {times[0]:.3f} s, '
+                    f'seguintes {sum(times[1:]) / max(len(times) - 1, 1):.3f} s '
+                    f'(última baixou {new_bytes / 2 ** 20:.2f} MB)')
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,127 @@
+"""
+Compara os motores do servidor (threads e asyncio): tempo de um download
+sozinho e o mesmo download com N clientes parados conectados ao servidor,
+além das threads que o processo precisou para atendê-los.
+
+Uso: python -m benchmarks.bench_engines [-s TAMANHO_MB] [-n STREAMS] [-i PARADOS] [-c]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from ccp.argparsers import ASYNCIO_ENGINE, THREADED_ENGINE
+from ccp.async_server import AsyncFileServer, raise_open_file_limit
+from ccp.client import run_client
+from ccp.server import ThreadedFileServer, ThreadedFileServerRequestHandler
+
+
+def start_threaded():
+    server = ThreadedFileServer(('localhost', 0), ThreadedFileServerRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+    return server.server_address[1], stop
+
+
+def start_asyncio():
+    server = AsyncFileServer(('localhost', 0))
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    async def serve():
+        await server.start()
+        ready.set()
+        with contextlib.suppress(asyncio.CancelledError):
+            await server.serve_forever()
+
+    task = loop.create_task(serve())
+    thread = threading.Thread(target=loop.run_until_complete, args=(task,), daemon=True)
+    thread.start()
+    ready.wait()
+
+    def stop():
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join()
+        server.server_close()
+    return server.server_address[1], stop
+
+
+def download(port, source_path, target_path, streams, compressed):
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        run_client(
+            '127.0.0.1',
+            port,
+            target_path,
+            source_path,
+            streams,
+            compressed,
+            decompress=compressed,
+            ask_confirmation=False
+        )
+    return time.perf_counter() - start
+
+
+def measure(engine, source_path, target_path, parsed_args):
+    port, stop = start_asyncio() if engine == ASYNCIO_ENGINE else start_threaded()
+    size_mb = parsed_args.size_mb
+    alone = download(
+        port, source_path, target_path, parsed_args.streams, parsed_args.compressed)
+
+    threads_before = threading.active_count()
+    idle_clients = [
+        socket.create_connection(('127.0.0.1', port))
+        for _ in range(parsed_args.idle_clients)
+    ]
+    # Dá tempo ao servidor de aceitar todas as conexões.
+    time.sleep(1)
+    server_threads = threading.active_count() - threads_before
+    crowded = download(
+        port, source_path, target_path, parsed_args.streams, parsed_args.compressed)
+    print(
+        f'{engine:<9} sozinho: {size_mb / alone:8.1f} MB/s   '
+        f'com {len(idle_clients)} parados: {size_mb / crowded:8.1f} MB/s   '
+        f'threads para os parados: {server_threads}'
+    )
+
+    # Os handlers dos parados reclamam da conexão fechada sem pedido.
+    with contextlib.redirect_stderr(io.StringIO()):
+        for client in idle_clients:
+            client.close()
+        time.sleep(1)
+        stop()
+
+
+def run():
+    parser = argparse.ArgumentParser(prog='bench_engines')
+    parser.add_argument('-s', dest='size_mb', type=int, default=256)
+    parser.add_argument('-n', dest='streams', type=int, default=4)
+    parser.add_argument('-i', dest='idle_clients', type=int, default=1000)
+    parser.add_argument('-c', dest='compressed', action='store_true')
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    raise_open_file_limit()
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, 'source.bin')
+        target_path = os.path.join(directory, 'target.bin')
+        with open(source_path, 'wb') as file:
+            file.write(os.urandom(parsed_args.size_mb * 2 ** 20))
+
+        for engine in (THREADED_ENGINE, ASYNCIO_ENGINE):
+            measure(engine, source_path, target_path, parsed_args)
+
+
+if __name__ == '__main__':
+    run()
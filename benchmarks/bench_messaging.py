@@ -0,0 +1,75 @@
+"""
+Micro-benchmark do custo de codificar/decodificar mensagens de controle:
+protocolo binário (ccp.messaging) contra o antigo pickle em 512 bytes.
+
+Uso: python -m benchmarks.bench_messaging [-n REPETIÇÕES]
+"""
+import argparse
+import pickle
+import sys
+import timeit
+
+from ccp.messaging import MessageType, decode_message, encode_message
+
+
+DOWNLOAD_REQUEST = {
+    'path': '/srv/dados/backups/2020-11-30/banco_de_dados.sql',
+    'streams': 8,
+    'compressed': True,
+    'codecs': ['gzip', 'zstd', 'lz4', 'bz2', 'lzma'],
+    'level': None,
+    'adaptive': False,
+}
+
+DOWNLOAD_RESPONSE = {
+    'size': 53687091200,
+    'streams': 8,
+    'token': '9f86d081884c7d659a2feaa0c55ad015',
+    'codec': 'gzip',
+}
+
+
+def pickle_encode(message):
+    message_sendbuf = bytearray(512)
+    request_bytes = pickle.dumps(message)
+    message_sendbuf[:len(request_bytes)] = request_bytes
+    return message_sendbuf
+
+
+def pickle_decode(message_bytes):
+    return pickle.loads(message_bytes)
+
+
+def run_benchmark(repetitions):
+    for name, message_type, message in (
+            ('download_request', MessageType.DOWNLOAD_REQUEST, DOWNLOAD_REQUEST),
+            ('download_response', MessageType.DOWNLOAD_RESPONSE, DOWNLOAD_RESPONSE),
+    ):
+        pickled = pickle_encode(message)
+        encoded = encode_message(message_type, message)
+
+        timings = {
+            'pickle encode': timeit.timeit(
+                lambda: pickle_encode(message), number=repetitions),
+            'pickle decode': timeit.timeit(
+                lambda: pickle_decode(pickled), number=repetitions),
+            'binary encode': timeit.timeit(
+                lambda: encode_message(message_type, message), number=repetitions),
+            'binary decode': timeit.timeit(
+                lambda: decode_message(encoded), number=repetitions),
+        }
+
+        print(f'{name}: pickle = {len(pickled)} B, binário = {len(encoded)} B')
+        for label, total in timings.items():
+            print(f'  {label:<14} {1e6 * total / repetitions:8.2f} us/msg')
+
+
+def run():
+    parser = argparse.ArgumentParser(prog='bench_messaging')
+    parser.add_argument('-n', dest='repetitions', type=int, default=100000)
+    parsed_args = parser.parse_args(sys.argv[1:])
+    run_benchmark(parsed_args.repetitions)
+
+
+if __name__ == '__main__':
+    run()
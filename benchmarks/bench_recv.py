@@ -0,0 +1,78 @@
+"""
+Compara o laço de recebimento antigo (recv de bytes novos a cada
+chamada) com o atual (recv_into em buffers do pool + memoryview),
+medindo CPU por GB recebido e memória alocada durante o recebimento.
+
+Uso: python -m benchmarks.bench_recv [-s TAMANHO_MB]
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+from ccp.buffers import RECV_BUFFER_SIZE, recv_to_file
+
+
+def old_recv_to_file(connection, file, n_bytes):
+    total_data_written = 0
+    while total_data_written < n_bytes:
+        recv_bytes = connection.recv(RECV_BUFFER_SIZE)
+        if not recv_bytes:
+            raise RuntimeError('Broken connection')
+        total_data_written += file.write(recv_bytes)
+    return total_data_written
+
+
+def send_bytes(connection, n_bytes):
+    block = memoryview(bytearray(RECV_BUFFER_SIZE))
+    total_bytes_sent = 0
+    while total_bytes_sent < n_bytes:
+        size = min(n_bytes - total_bytes_sent, len(block))
+        connection.sendall(block[:size])
+        total_bytes_sent += size
+    connection.close()
+
+
+def measure(recv_function, n_bytes, trace):
+    sender, receiver = socket.socketpair()
+    thread = threading.Thread(target=send_bytes, args=(sender, n_bytes))
+    thread.start()
+    if trace:
+        tracemalloc.start()
+    cpu_start = time.process_time()
+    with open(os.devnull, 'wb') as devnull:
+        recv_function(receiver, devnull, n_bytes)
+    cpu_time = time.process_time() - cpu_start
+    allocated = 0
+    if trace:
+        _, allocated = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    thread.join()
+    receiver.close()
+    return cpu_time, allocated
+
+
+def run():
+    parser = argparse.ArgumentParser(prog='bench_recv')
+    parser.add_argument('-s', dest='size_mb', type=int, default=1024)
+    parsed_args = parser.parse_args(sys.argv[1:])
+    n_bytes = parsed_args.size_mb * 2 ** 20
+    gigabytes = n_bytes / 2 ** 30
+
+    for name, recv_function in (
+            ('antigo (recv + bytes)', old_recv_to_file),
+            ('atual (recv_into + pool)', recv_to_file),
+    ):
+        cpu_time, _ = measure(recv_function, n_bytes, trace=False)
+        _, peak = measure(recv_function, min(n_bytes, 64 * 2 ** 20), trace=True)
+        print(
+            f'{name:<26} CPU: {cpu_time / gigabytes:6.3f} s/GB   '
+            f'pico de alocações (64 MB): {peak / 2 ** 20:6.2f} MB'
+        )
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,91 @@
+"""
+Compara a distribuição estática (uma faixa fixa por stream) com a
+dinâmica (pedaços sob demanda + duplicação no fim), medindo o tempo total
+e a diferença entre a primeira e a última stream a terminar.
+
+O arquivo de teste tem uma metade muito compressível (zeros) e outra
+incompressível (aleatória): com compressão, as streams da metade
+aleatória demoram bem mais na distribuição estática.
+
+Uso: python -m benchmarks.bench_schedule [-s TAMANHO_MB] [-n STREAMS] [-c]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from ccp.client import run_client
+from ccp.scheduling import DYNAMIC_SCHEDULE, STATIC_SCHEDULE
+from ccp.server import ThreadedFileServer, ThreadedFileServerRequestHandler
+
+
+def create_source(path, n_bytes):
+    half = n_bytes // 2
+    with open(path, 'wb') as file:
+        file.write(bytes(half))
+        file.write(os.urandom(n_bytes - half))
+
+
+def measure(port, source_path, target_path, streams, compressed, schedule):
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    start = time.perf_counter()
+    # A saída de cliente e servidor (barras de progresso) só atrapalharia
+    # a tabela.
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        finish_times = run_client(
+            '127.0.0.1',
+            port,
+            target_path,
+            source_path,
+            streams,
+            compressed,
+            decompress=compressed,
+            ask_confirmation=False,
+            schedule=schedule
+        )
+    total_time = time.perf_counter() - start
+    return total_time, finish_times[-1] - finish_times[0]
+
+
+def run():
+    parser = argparse.ArgumentParser(prog='bench_schedule')
+    parser.add_argument('-s', dest='size_mb', type=int, default=256)
+    parser.add_argument('-n', dest='streams', type=int, default=4)
+    parser.add_argument('-c', dest='compressed', action='store_true')
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    server = ThreadedFileServer(('localhost', 0), ThreadedFileServerRequestHandler)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, 'source.bin')
+        target_path = os.path.join(directory, 'target.bin')
+        create_source(source_path, parsed_args.size_mb * 2 ** 20)
+
+        for schedule in (STATIC_SCHEDULE, DYNAMIC_SCHEDULE):
+            total_time, spread = measure(
+                port,
+                source_path,
+                target_path,
+                parsed_args.streams,
+                parsed_args.compressed,
+                schedule
+            )
+            print(
+                f'{schedule:<8} tempo total: {total_time:7.3f} s   '
+                f'diferença entre streams: {spread:7.3f} s'
+            )
+
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,86 @@
+"""
+Mede o tempo por arquivo de baixar arquivos pequenos: um de cada vez,
+com o conteúdo na própria resposta e com streams de dados
+(--inline-threshold '0 B'), e todos numa sessão só (-B).
+
+Uso: python -m benchmarks.bench_small [-f ARQUIVOS] [-k TAMANHO_KB] [-n STREAMS]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.common import start_server
+from ccp.client import run_batch_client, run_client
+
+
+def measure(port, source_paths, target_path, streams) -> float:
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        for source_path in source_paths:
+            run_client(
+                '127.0.0.1',
+                port,
+                target_path,
+                source_path,
+                streams,
+                False,
+                ask_confirmation=False
+            )
+    return (time.perf_counter() - start) / len(source_paths)
+
+
+def measure_batch(port, source_paths, target_path, streams) -> float:
+    list_path = target_path + '.lst'
+    target_path += '.d'
+    with open(list_path, 'w', encoding='utf-8') as list_file:
+        list_file.writelines(f'{source_path}\n' for source_path in source_paths)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        run_batch_client('127.0.0.1', port, target_path, list_path, streams, False)
+    return (time.perf_counter() - start) / len(source_paths)
+
+
+def run():
+    parser = argparse.ArgumentParser(prog='bench_small')
+    parser.add_argument('-f', dest='files', type=int, default=200)
+    parser.add_argument('-k', dest='size_kb', type=int, default=4)
+    parser.add_argument('-n', dest='streams', type=int, default=4)
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as directory:
+        source_paths = []
+        for i in range(parsed_args.files):
+            source_path = os.path.join(directory, f'f{i}')
+            with open(source_path, 'wb') as file:
+                file.write(os.urandom(parsed_args.size_kb * 2 ** 10))
+            source_paths.append(source_path)
+
+        for description, extra_args, function in (
+                ('na resposta', (), measure),
+                ('com streams', ('--inline-threshold', '0 B'), measure),
+                ('numa sessão', (), measure_batch)
+        ):
+            server, port = start_server(*extra_args)
+            try:
+                latency = function(
+                    port,
+                    source_paths,
+                    os.path.join(directory, 'target'),
+                    parsed_args.streams
+                )
+            finally:
+                server.terminate()
+                server.wait()
+            print(
+                f'{parsed_args.size_kb} KB {description:<12} '
+                f'{latency * 1000:8.2f} ms por arquivo')
+
+
+if __name__ == '__main__':
+    run()
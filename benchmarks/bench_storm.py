@@ -0,0 +1,81 @@
+"""
+Mede o tempo de muitos clientes baixando o mesmo arquivo comprimido ao
+mesmo tempo, com o cache de blocos desligado (--cache-size '0 B'): os
+pedidos simultâneos esperam a mesma leitura e compressão de cada bloco,
+então a rajada deve custar perto de um download e não de N.
+
+Uso: python -m benchmarks.bench_storm [-m TAMANHO_MB] [-c CLIENTES] [-n STREAMS]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.common import start_server
+from ccp.client import run_client
+
+
+def download(port, source_path, target_path, streams):
+    run_client(
+        '127.0.0.1',
+        port,
+        target_path,
+        source_path,
+        streams,
+        True,
+        decompress=True,
+        ask_confirmation=False
+    )
+    os.remove(target_path)
+
+
+def measure(port, source_path, directory, clients, streams) -> float:
+    threads = [
+        threading.Thread(
+            target=download,
+            args=(port, source_path, os.path.join(directory, f'target{i}.bin'), streams)
+        )
+        for i in range(clients)
+    ]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return time.perf_counter() - start
+
+
+def run():
+    parser = argparse.ArgumentParser(prog='bench_storm')
+    parser.add_argument('-m', dest='size_mb', type=int, default=32)
+    parser.add_argument('-c', dest='clients', type=int, default=8)
+    parser.add_argument('-n', dest='streams', type=int, default=2)
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, 'source.bin')
+        with open(source_path, 'wb') as file:
+            for _ in range(parsed_args.size_mb):
+                file.write(os.urandom(2 ** 19) + bytes(2 ** 19))
+
+        server, port = start_server('--cache-size', '0 B')
+        try:
+            single = measure(port, source_path, directory, 1, parsed_args.streams)
+            storm = measure(
+                port, source_path, directory, parsed_args.clients, parsed_args.streams)
+        finally:
+            server.terminate()
+            server.wait()
+        print(
+            f'1 cliente: {single:.3f} s; {parsed_args.clients} clientes juntos: '
+            f'{storm:.3f} s ({storm / single:.1f}x o tempo de um)')
+
+
+if __name__ == '__main__':
+    run()
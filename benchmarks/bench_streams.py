@@ -0,0 +1,103 @@
+"""
+Compara os motores do cliente (uma thread por stream e um laço de
+eventos) com cada vez mais streams no loopback: vazão e quantas threads
+o cliente chegou a ter.
+
+Uso: python -m benchmarks.bench_streams [-s TAMANHO_MB] [-n STREAMS ...] [-c]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.common import start_server
+from ccp.argparsers import ASYNCIO_ENGINE, THREADED_ENGINE
+from ccp.client import run_client
+
+
+class ThreadCounter:
+    """
+    Amostra threading.active_count() numa thread, guardando o máximo.
+    """
+
+    def __init__(self):
+        self.peak = 0
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def __run(self):
+        while not self.__stop.wait(0.01):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__stop.set()
+        self.__thread.join()
+
+
+def measure(port, source_path, target_path, streams, compressed, engine):
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()), \
+            ThreadCounter() as counter:
+        run_client(
+            '127.0.0.1',
+            port,
+            target_path,
+            source_path,
+            streams,
+            compressed,
+            decompress=compressed,
+            ask_confirmation=False,
+            engine=engine
+        )
+    return time.perf_counter() - start, counter.peak
+
+
+def run():
+    parser = argparse.ArgumentParser(prog='bench_streams')
+    parser.add_argument('-s', dest='size_mb', type=int, default=256)
+    parser.add_argument('-n', dest='streams', type=int, nargs='+', default=[4, 64, 256])
+    parser.add_argument('-c', dest='compressed', action='store_true')
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    # Servidor noutro processo: as threads contadas são só as do cliente.
+    server, port = start_server('-E', ASYNCIO_ENGINE)
+
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, 'source.bin')
+        target_path = os.path.join(directory, 'target.bin')
+        with open(source_path, 'wb') as file:
+            file.write(os.urandom(parsed_args.size_mb * 2 ** 20))
+
+        for streams in parsed_args.streams:
+            for engine in (THREADED_ENGINE, ASYNCIO_ENGINE):
+                total_time, peak_threads = measure(
+                    port,
+                    source_path,
+                    target_path,
+                    streams,
+                    parsed_args.compressed,
+                    engine
+                )
+                print(
+                    f'{streams:4d} streams  {engine:<9} '
+                    f'{parsed_args.size_mb / total_time:8.1f} MB/s   '
+                    f'threads no processo: {peak_threads}'
+                )
+
+    server.terminate()
+    server.wait()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,87 @@
+"""
+Compara a vazão de um diretório com muitos arquivos pequenos (-R) com a
+de um arquivo só do mesmo tamanho total, no loopback.
+
+Uso: python -m benchmarks.bench_tree [-f ARQUIVOS] [-k TAMANHO_KB] [-n STREAMS] [-c]
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.common import start_server
+from ccp.client import run_client, run_directory_client
+
+
+def measure(function, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def run():
+    parser = argparse.ArgumentParser(prog='bench_tree')
+    parser.add_argument('-f', dest='files', type=int, default=20000)
+    parser.add_argument('-k', dest='size_kb', type=int, default=4)
+    parser.add_argument('-n', dest='streams', type=int, default=4)
+    parser.add_argument('-c', dest='compressed', action='store_true')
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    server, port = start_server()
+    with tempfile.TemporaryDirectory() as directory:
+        tree_path = os.path.join(directory, 'tree')
+        file_size = parsed_args.size_kb * 2 ** 10
+        for i in range(parsed_args.files):
+            subdirectory = os.path.join(tree_path, f'd{i // 1000}')
+            os.makedirs(subdirectory, exist_ok=True)
+            with open(os.path.join(subdirectory, f'f{i}'), 'wb') as file:
+                file.write(os.urandom(file_size // 2) + bytes(file_size - file_size // 2))
+        total_size = parsed_args.files * file_size
+        single_path = os.path.join(directory, 'single.bin')
+        with open(single_path, 'wb') as file:
+            for _ in range(parsed_args.files):
+                file.write(os.urandom(file_size // 2) + bytes(file_size - file_size // 2))
+
+        target_path = os.path.join(directory, 'target')
+        single_time = measure(
+            run_client,
+            '127.0.0.1',
+            port,
+            target_path,
+            single_path,
+            parsed_args.streams,
+            parsed_args.compressed,
+            decompress=parsed_args.compressed,
+            ask_confirmation=False
+        )
+        os.remove(target_path)
+        tree_time = measure(
+            run_directory_client,
+            '127.0.0.1',
+            port,
+            target_path,
+            tree_path,
+            parsed_args.streams,
+            parsed_args.compressed,
+            ask_confirmation=False
+        )
+        shutil.rmtree(target_path)
+
+    server.terminate()
+    server.wait()
+    size_mb = total_size / 2 ** 20
+    print(f'arquivo único:   {size_mb / single_time:8.1f} MB/s')
+    print(
+        f'{parsed_args.files} arquivos de {parsed_args.size_kb} KB: '
+        f'{size_mb / tree_time:8.1f} MB/s '
+        f'({parsed_args.files / tree_time:.0f} arquivos/s)')
+
+
+if __name__ == '__main__':
+    run()
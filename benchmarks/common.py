@@ -0,0 +1,49 @@
+"""
+Partes compartilhadas pelos benchmarks.
+"""
+import socket
+import subprocess
+import sys
+import time
+from typing import Tuple
+
+
+# Segundos que start_server espera o servidor aceitar conexões.
+SERVER_START_TIMEOUT = 10.0
+
+
+def start_server(
+        *extra_args: str,
+        timeout: float = SERVER_START_TIMEOUT
+) -> Tuple[subprocess.Popen, int]:
+    """
+    Sobe o servidor noutro processo (não disputa o GIL com o cliente)
+    numa porta livre e espera ele aceitar conexões.
+    :param extra_args: Argumentos extras de ccp.server
+    :param timeout: Segundos de espera
+    :return: (processo do servidor, porta)
+    """
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        port = probe.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'ccp.server', '-p', str(port), *extra_args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(('localhost', port), timeout=1):
+                return server, port
+        except OSError:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError(
+                f'Servidor terminou (código {server.returncode}) antes de aceitar conexões.')
+        if time.monotonic() > deadline:
+            server.terminate()
+            server.wait()
+            raise TimeoutError(
+                f'Servidor não aceitou conexões na porta {port} em {timeout:g} s.')
+        time.sleep(0.1)
@@ -1,5 +1,22 @@
 import argparse
 
+from ccp.cache import DEFAULT_CACHE_SIZE, DEFAULT_DISK_CACHE_SIZE
+from ccp.chunking import DEFAULT_CHUNK_STORE_SIZE
+from ccp.compression import available_codecs
+from ccp.messaging import DEFAULT_INLINE_THRESHOLD
+from ccp.resources import (
+    DEFAULT_IDLE_TIMEOUT,
+    DEFAULT_MAX_CLIENT_CONNECTIONS,
+    DEFAULT_MAX_STREAMS
+)
+from ccp.scheduling import DYNAMIC_SCHEDULE, STATIC_SCHEDULE
+from ccp.singleflight import DEFAULT_REPLAY_SIZE
+
+
+# Motores do servidor: uma thread por conexão ou um laço do asyncio.
+THREADED_ENGINE = 'threaded'
+ASYNCIO_ENGINE = 'asyncio'
+
 
 def get_client_parser() -> argparse.ArgumentParser:
     """
@@ -8,6 +25,20 @@ def get_client_parser() -> argparse.ArgumentParser:
      - local: Caminho do arquivo-destino (local)
      - remote: Caminho do arquivo-fonte (remoto)
      - compressed: Ativa compressão de envio, mas não descomprime no recebimento.
+     - codecs: Codecs aceitos, em ordem de preferência.
+     - level: Nível de compressão.
+     - adaptive: Compressão adaptativa.
+     - use_partitions: Baixa para arquivos .partN em vez do arquivo final.
+     - verify: Checksum por pedaço, com novo pedido dos corrompidos.
+     - sha256: Confere o SHA-256 do arquivo inteiro.
+     - delta: Atualiza a cópia local só com o que mudou.
+     - chunk_cache: Diretório dos pedaços guardados de downloads anteriores.
+     - chunk_cache_size: Espaço dos pedaços guardados.
+     - schedule: Distribuição das faixas entre as streams.
+     - engine: Uma thread por stream ou todas num laço de eventos.
+     - recursive: Baixa um diretório inteiro.
+     - batch: Baixa uma lista de arquivos numa sessão só.
+     - upload: Envia o arquivo local (ou a entrada padrão) ao servidor.
      - streams: Quantidade de conexões paralelas de envio/recebimento.
      - debug_mode: Ativa mensagens de depuração.
 
@@ -49,6 +80,36 @@ def get_client_parser() -> argparse.ArgumentParser:
         help='Ativa compressão no envio, mas não descomprime no recebimento.'
     )
 
+    parser.add_argument(
+        '-C', '--codec',
+        action='append',
+        choices=available_codecs(),
+        default=None,
+        dest='codecs',
+        help=(
+            'Codec aceito na compressão; pode ser repetido em ordem de '
+            f'preferência (padrão: {", ".join(available_codecs())})'
+        )
+    )
+
+    parser.add_argument(
+        '-L', '--level',
+        type=int,
+        default=None,
+        dest='level',
+        help='Nível de compressão (padrão: o do codec escolhido)'
+    )
+
+    parser.add_argument(
+        '-a', '--adaptive',
+        action='store_true',
+        dest='adaptive',
+        help=(
+            'Compressão adaptativa: arquivos e blocos incompressíveis vão sem '
+            'compressão, e o nível acompanha a velocidade da rede'
+        )
+    )
+
     parser.add_argument(
         '-s', '--streams',
         type=int,
@@ -78,13 +139,141 @@ def get_client_parser() -> argparse.ArgumentParser:
         help='Mantém partições após junção'
     )
 
+    parser.add_argument(
+        '-P', '--partitions',
+        dest='use_partitions',
+        action='store_true',
+        help=(
+            'Baixa cada stream para um arquivo .partN e junta no fim, em vez '
+            'de escrever direto no arquivo local pré-alocado'
+        )
+    )
+
+    parser.add_argument(
+        '-V', '--verify',
+        dest='verify',
+        action='store_true',
+        help=(
+            'Verifica cada pedaço com checksum e pede de novo só os '
+            'pedaços corrompidos'
+        )
+    )
+
+    parser.add_argument(
+        '--sha256',
+        dest='sha256',
+        action='store_true',
+        help='Compara o SHA-256 do arquivo baixado com o do servidor'
+    )
+
+    parser.add_argument(
+        '--delta',
+        dest='delta',
+        action='store_true',
+        help=(
+            'Se o arquivo local já existe, baixa só os trechos que mudaram '
+            '(delta estilo rsync)'
+        )
+    )
+
+    parser.add_argument(
+        '--chunk-cache',
+        type=str,
+        default=None,
+        dest='chunk_cache',
+        help=(
+            'Diretório de pedaços guardados: baixa só os pedaços (definidos '
+            'pelo conteúdo) que nenhum download anterior trouxe'
+        )
+    )
+
+    parser.add_argument(
+        '--chunk-cache-size',
+        type=str,
+        default=f'{DEFAULT_CHUNK_STORE_SIZE // 2 ** 30} G',
+        dest='chunk_cache_size',
+        help=(
+            'Espaço dos pedaços guardados; os usados há mais tempo são '
+            f'descartados (padrão: {DEFAULT_CHUNK_STORE_SIZE // 2 ** 30} G)'
+        )
+    )
+
+    parser.add_argument(
+        '-S', '--schedule',
+        dest='schedule',
+        choices=[DYNAMIC_SCHEDULE, STATIC_SCHEDULE],
+        default=DYNAMIC_SCHEDULE,
+        help=(
+            'dynamic: streams pegam pedaços sob demanda e duplicam os '
+            'últimos; static: uma faixa fixa por stream'
+        )
+    )
+
+    parser.add_argument(
+        '-E', '--engine',
+        dest='engine',
+        choices=[THREADED_ENGINE, ASYNCIO_ENGINE],
+        default=THREADED_ENGINE,
+        help=(
+            'threaded: uma thread e uma barra de progresso por stream; '
+            'asyncio: todas as streams num laço só (para centenas de streams)'
+        )
+    )
+
+    parser.add_argument(
+        '-R', '--recursive',
+        dest='recursive',
+        action='store_true',
+        help=(
+            'Baixa o diretório remoto inteiro para o diretório local, com '
+            'arquivos pequenos juntados em lotes'
+        )
+    )
+
+    parser.add_argument(
+        '-B', '--batch',
+        dest='batch',
+        action='store_true',
+        help=(
+            'O caminho remoto é uma lista local de arquivos remotos (um por '
+            'linha, opcionalmente seguido de TAB e do caminho local); todos '
+            'são baixados para o diretório local numa conexão só'
+        )
+    )
+
+    parser.add_argument(
+        '-U', '--upload',
+        dest='upload',
+        action='store_true',
+        help=(
+            'Envia o arquivo local para o caminho remoto, em faixas paralelas '
+            '(com -l -, envia a entrada padrão; o servidor precisa de '
+            '--upload-root)'
+        )
+    )
+
     return parser
 
 
 def get_server_parser():
     """
     Leitor de argumentos da aplicação servidor.
-     - max_streams: Quantidade máxima de conexões paralelas por pedido.
+     - max_streams: Streams de dados ativas no servidor, somando os pedidos.
+     - max_memory: Memória dos blocos lidos à frente do envio.
+     - max_compressions: Streams comprimindo ao mesmo tempo.
+     - max_client_connections: Conexões abertas por cliente (IP).
+     - idle_timeout: Segundos sem tráfego antes de fechar uma conexão.
+     - inline_threshold: Arquivos até este tamanho vão na própria resposta.
+     - cache_size: Memória do cache de blocos comprimidos.
+     - cache_dir: Diretório da camada em disco do cache.
+     - cache_disk_size: Espaço da camada em disco do cache.
+     - replay_size: Buffer de blocos recentes para pedidos simultâneos.
+     - upload_root: Diretório que recebe uploads (sem ele, são recusados).
+     - max_upload_size: Maior upload aceito.
+     - compression_workers: Threads de compressão em paralelo.
+     - compression_block_size: Tamanho de cada bloco comprimido.
+     - engine: Motor do servidor (threads ou asyncio).
+     - io_workers: Threads de leitura do motor asyncio.
      - debug_mode: Ativa mensagens de depuração.
 
     :return: Leitor de argumentos.
@@ -104,6 +293,166 @@ def get_server_parser():
         help=f'A porta do servidor (padrão: {default_port})'
     )
 
+    parser.add_argument(
+        '-w', '--compression-workers',
+        type=int,
+        default=None,
+        dest='compression_workers',
+        help='Threads de compressão compartilhadas (padrão: núcleos da máquina)'
+    )
+
+    parser.add_argument(
+        '-b', '--compression-block-size',
+        type=str,
+        default='1 M',
+        dest='compression_block_size',
+        help='Tamanho de cada bloco comprimido em paralelo (padrão: 1 M)'
+    )
+
+    parser.add_argument(
+        '-E', '--engine',
+        choices=(THREADED_ENGINE, ASYNCIO_ENGINE),
+        default=THREADED_ENGINE,
+        dest='engine',
+        help=(
+            'Motor do servidor: uma thread por conexão, ou um laço do asyncio '
+            'para milhares de clientes (padrão: threaded)'
+        )
+    )
+
+    parser.add_argument(
+        '--io-workers',
+        type=int,
+        default=None,
+        dest='io_workers',
+        help='Threads de leitura e hash do motor asyncio (padrão: núcleos + 4)'
+    )
+
+    parser.add_argument(
+        '--max-streams',
+        type=int,
+        default=DEFAULT_MAX_STREAMS,
+        dest='max_streams',
+        help=(
+            'Streams de dados ativas no servidor; pedidos além disso esperam '
+            f'na fila ou são mandados tentar depois (padrão: {DEFAULT_MAX_STREAMS})'
+        )
+    )
+
+    parser.add_argument(
+        '--max-memory',
+        type=str,
+        default=None,
+        dest='max_memory',
+        help=(
+            'Memória dos blocos lidos e comprimidos à frente do envio '
+            '(padrão: 1/4 da RAM, até 2 G)'
+        )
+    )
+
+    parser.add_argument(
+        '--max-compressions',
+        type=int,
+        default=None,
+        dest='max_compressions',
+        help='Streams comprimindo ao mesmo tempo (padrão: 2 por núcleo)'
+    )
+
+    parser.add_argument(
+        '--max-client-connections',
+        type=int,
+        default=DEFAULT_MAX_CLIENT_CONNECTIONS,
+        dest='max_client_connections',
+        help=(
+            'Conexões abertas por cliente (IP) '
+            f'(padrão: {DEFAULT_MAX_CLIENT_CONNECTIONS})'
+        )
+    )
+
+    parser.add_argument(
+        '--idle-timeout',
+        type=float,
+        default=DEFAULT_IDLE_TIMEOUT,
+        dest='idle_timeout',
+        help=(
+            'Segundos sem tráfego antes de fechar uma conexão '
+            f'(padrão: {DEFAULT_IDLE_TIMEOUT:g}; 0 desliga)'
+        )
+    )
+
+    parser.add_argument(
+        '--inline-threshold',
+        type=str,
+        default=f'{DEFAULT_INLINE_THRESHOLD // 2 ** 10} K',
+        dest='inline_threshold',
+        help=(
+            'Arquivos até este tamanho vão na própria resposta, sem streams '
+            f'de dados (padrão: {DEFAULT_INLINE_THRESHOLD // 2 ** 10} K; 0 B desliga)'
+        )
+    )
+
+    parser.add_argument(
+        '--cache-size',
+        type=str,
+        default=f'{DEFAULT_CACHE_SIZE // 2 ** 20} M',
+        dest='cache_size',
+        help=(
+            'Memória do cache de blocos comprimidos, reaproveitados por '
+            'downloads do mesmo arquivo com o mesmo codec e nível '
+            f'(padrão: {DEFAULT_CACHE_SIZE // 2 ** 20} M; 0 B desliga)'
+        )
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        default=None,
+        dest='cache_dir',
+        help='Diretório da camada em disco do cache (padrão: só memória)'
+    )
+
+    parser.add_argument(
+        '--cache-disk-size',
+        type=str,
+        default=f'{DEFAULT_DISK_CACHE_SIZE // 2 ** 30} G',
+        dest='cache_disk_size',
+        help=(
+            'Espaço da camada em disco do cache '
+            f'(padrão: {DEFAULT_DISK_CACHE_SIZE // 2 ** 30} G)'
+        )
+    )
+
+    parser.add_argument(
+        '--replay-size',
+        type=str,
+        default=f'{DEFAULT_REPLAY_SIZE // 2 ** 20} M',
+        dest='replay_size',
+        help=(
+            'Blocos recém-comprimidos guardados para pedidos simultâneos do '
+            'mesmo arquivo, que esperam a mesma leitura e compressão '
+            f'(padrão: {DEFAULT_REPLAY_SIZE // 2 ** 20} M)'
+        )
+    )
+
+    parser.add_argument(
+        '--upload-root',
+        type=str,
+        default=None,
+        dest='upload_root',
+        help=(
+            'Aceita uploads, só para dentro deste diretório '
+            '(padrão: uploads recusados)'
+        )
+    )
+
+    parser.add_argument(
+        '--max-upload-size',
+        type=str,
+        default=None,
+        dest='max_upload_size',
+        help='Maior upload aceito (padrão: só o espaço livre limita)'
+    )
+
     parser.add_argument(
         '-D', '--debug-mode',
         action='store_true',
@@ -0,0 +1,377 @@
+import asyncio
+import logging
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+import tqdm
+
+from ccp.buffers import RECV_BUFFER_SIZE, BufferPool
+from ccp.messaging import (
+    CHUNK_HEADER,
+    CHUNKED_PARTITION_SIZE,
+    FRAME_HEADER,
+    PARTITION_HEADER,
+    SCHEDULED_PARTITION_SIZE,
+    STREAMED_PARTITION_SIZE,
+    MessageType,
+    encode_message,
+    raw_writer
+)
+
+
+# Buffers em uso ao mesmo tempo, somando todas as streams (do tamanho de
+# RECV_BUFFER_SIZE, que cabe um bloco comprimido do servidor).
+MAX_ASYNC_BUFFERS = 64
+
+# Threads que escrevem no disco (e descomprimem e conferem checksums).
+DISK_WRITE_WORKERS = 4
+
+
+class SharedBuffers:
+    """
+    Buffers de recebimento compartilhados por todas as streams do laço:
+    uma stream pega um para receber e o devolve depois de escrever o que
+    recebeu. Com tudo em uso, as streams esperam.
+    """
+
+    def __init__(
+            self,
+            buffer_size: int = RECV_BUFFER_SIZE,
+            max_buffers: int = MAX_ASYNC_BUFFERS
+    ):
+        self.buffer_size = buffer_size
+        self.__pool = BufferPool(buffer_size, max_buffers)
+        self.__slots = asyncio.Semaphore(max_buffers)
+
+    @property
+    def exhausted(self) -> bool:
+        """
+        True se não há buffer livre: a stream deve esperar o socket ter
+        dados antes de pegar um, para não segurá-lo à toa.
+        """
+        return self.__slots.locked()
+
+    async def acquire(self, size: int = 0) -> bytearray:
+        """
+        :param size: Bytes necessários; acima de buffer_size, o buffer é
+            alocado só para este uso
+        """
+        await self.__slots.acquire()
+        if size > self.buffer_size:
+            return bytearray(size)
+        return self.__pool.acquire()
+
+    def release(self, buffer: bytearray):
+        self.__pool.release(buffer)
+        self.__slots.release()
+
+
+def _set_ready(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+async def wait_readable(loop: asyncio.AbstractEventLoop, sock: socket.socket):
+    future = loop.create_future()
+    loop.add_reader(sock.fileno(), _set_ready, future)
+    try:
+        await future
+    finally:
+        loop.remove_reader(sock.fileno())
+
+
+async def recv_available(
+        loop: asyncio.AbstractEventLoop,
+        sock: socket.socket,
+        view: memoryview
+) -> int:
+    """
+    Recebe o que o socket já tiver, até encher <view>; espera só se não
+    houver nada.
+    :return: Bytes recebidos (ao menos 1)
+    """
+    total_bytes_received = 0
+    while total_bytes_received < len(view):
+        try:
+            bytes_received = sock.recv_into(view[total_bytes_received:])
+        except BlockingIOError:
+            if total_bytes_received:
+                break
+            await wait_readable(loop, sock)
+            continue
+        if bytes_received == 0:
+            raise RuntimeError('Broken connection.')
+        total_bytes_received += bytes_received
+    return total_bytes_received
+
+
+async def recv_into_exactly_async(
+        loop: asyncio.AbstractEventLoop,
+        sock: socket.socket,
+        view: memoryview
+):
+    total_bytes_received = 0
+    while total_bytes_received < len(view):
+        total_bytes_received += await recv_available(
+            loop, sock, view[total_bytes_received:])
+
+
+async def recv_exactly_async(
+        loop: asyncio.AbstractEventLoop,
+        sock: socket.socket,
+        n_bytes: int
+) -> bytearray:
+    buffer = bytearray(n_bytes)
+    await recv_into_exactly_async(loop, sock, memoryview(buffer))
+    return buffer
+
+
+def write_verified(
+        writer,
+        payload,
+        checksum,
+        expected_checksum,
+        offset,
+        size,
+        raw=False
+) -> bool:
+    """
+    Confere o checksum e escreve o pedaço (ChunkWriter) ou pula a faixa
+    (RangeWriter, DecodingWriter). Roda nas threads de disco.
+    :return: False se o pedaço estava corrompido
+    """
+    valid = checksum is None or checksum(payload) == expected_checksum
+    if hasattr(writer, 'write_chunk'):
+        if valid:
+            writer.write_chunk(offset, size, payload, raw)
+    elif valid:
+        (raw_writer(writer) if raw else writer).write(payload)
+    else:
+        writer.skip(size)
+    if not valid:
+        logging.debug('Pedaço [%d, %d) corrompido.', offset, offset + size)
+    return valid
+
+
+class StreamReceiver:
+    """
+    Recebe as streams de um download num laço de eventos só: os sockets
+    de dados são não bloqueantes, os buffers vêm de SharedBuffers e as
+    escritas (com descompressão e checksum) vão para poucas threads de
+    disco. O protocolo de cada stream é o mesmo de client.start_download.
+    """
+
+    def __init__(
+            self,
+            loop: asyncio.AbstractEventLoop,
+            disk_executor: ThreadPoolExecutor,
+            buffers: SharedBuffers,
+            on_progress: Callable[[int], object]
+    ):
+        self.loop = loop
+        self.disk_executor = disk_executor
+        self.buffers = buffers
+        self.on_progress = on_progress
+
+    def write_on_disk(self, buffer: bytearray, function, *args) -> asyncio.Future:
+        """
+        Roda a escrita nas threads de disco sem esperá-la; o buffer volta
+        ao pool quando ela termina.
+        """
+        future = self.loop.run_in_executor(self.disk_executor, function, *args)
+        future.add_done_callback(lambda _: self.buffers.release(buffer))
+        return future
+
+    async def run_on_disk(self, function, *args):
+        return await self.loop.run_in_executor(self.disk_executor, function, *args)
+
+    async def recv_buffer(self, sock, n_bytes: int, exactly: bool):
+        """
+        Pega um buffer e recebe nele até <n_bytes> (ou exatamente).
+        :return: (buffer, bytes recebidos)
+        """
+        if self.buffers.exhausted:
+            await wait_readable(self.loop, sock)
+        buffer = await self.buffers.acquire(n_bytes)
+        try:
+            view = memoryview(buffer)[:min(n_bytes, len(buffer))]
+            if exactly:
+                await recv_into_exactly_async(self.loop, sock, view)
+                return buffer, len(view)
+            return buffer, await recv_available(self.loop, sock, view)
+        except BaseException:
+            self.buffers.release(buffer)
+            raise
+
+    async def recv_to_writer(self, sock, write, n_bytes: int) -> int:
+        """
+        Recebe <n_bytes> e os passa a write() em pedaços, na ordem. O
+        próximo pedaço é recebido enquanto o anterior é escrito.
+        """
+        remaining = n_bytes
+        pending_write = None
+        try:
+            while remaining > 0:
+                buffer, bytes_received = await self.recv_buffer(sock, remaining, False)
+                if pending_write is not None:
+                    await pending_write
+                pending_write = self.write_on_disk(
+                    buffer, write, memoryview(buffer)[:bytes_received])
+                remaining -= bytes_received
+                self.on_progress(bytes_received)
+        finally:
+            if pending_write is not None:
+                await pending_write
+        return n_bytes
+
+    async def recv_chunks(self, sock, writer, checksum) -> Tuple[int, int]:
+        """
+        Pedaços com CHUNK_HEADER até o pedaço vazio (verificados ou
+        agendados), cada um inteiro num buffer antes de ser escrito.
+        :return: (bytes recebidos, pedaços corrompidos)
+        """
+        total_bytes_received = 0
+        corrupt_chunks = 0
+        pending_write = None
+        try:
+            while True:
+                header = await recv_exactly_async(self.loop, sock, CHUNK_HEADER.size)
+                offset, size, payload_size, chunk_checksum, raw = CHUNK_HEADER.unpack(header)
+                if not size and not payload_size:
+                    break
+                buffer, _ = await self.recv_buffer(sock, payload_size, True)
+                if pending_write is not None:
+                    corrupt_chunks += not await pending_write
+                pending_write = self.write_on_disk(
+                    buffer, write_verified, writer,
+                    memoryview(buffer)[:payload_size], checksum,
+                    chunk_checksum, offset, size, raw)
+                total_bytes_received += payload_size
+                self.on_progress(payload_size)
+        finally:
+            if pending_write is not None:
+                corrupt_chunks += not await pending_write
+        return total_bytes_received, corrupt_chunks
+
+    async def recv_frames(self, sock, writer) -> int:
+        total_bytes_received = 0
+        while True:
+            header = await recv_exactly_async(self.loop, sock, FRAME_HEADER.size)
+            frame_size, raw = FRAME_HEADER.unpack(header)
+            if not frame_size:
+                return total_bytes_received
+            total_bytes_received += await self.recv_to_writer(
+                sock, raw_writer(writer).write if raw else writer.write, frame_size)
+
+    async def download_stream(
+            self,
+            address: Tuple[str, int],
+            token: str,
+            stream_id: int,
+            partial_path: str,
+            writer=None,
+            checksum=None
+    ) -> int:
+        """
+        Conecta a stream <stream_id> da sessão e a recebe até o fim.
+        :return: Quantidade de pedaços corrompidos (descartados)
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await self.loop.sock_connect(sock, address)
+            await self.loop.sock_sendall(sock, encode_message(
+                MessageType.STREAM_ATTACH,
+                {'token': token, 'stream': stream_id}
+            ))
+            header = await recv_exactly_async(self.loop, sock, PARTITION_HEADER.size)
+            (file_length,) = PARTITION_HEADER.unpack(header)
+
+            if writer is None:
+                writer = await self.run_on_disk(open, partial_path, 'wb')
+            corrupt_chunks = 0
+            try:
+                if file_length in (SCHEDULED_PARTITION_SIZE, CHUNKED_PARTITION_SIZE):
+                    _, corrupt_chunks = await self.recv_chunks(sock, writer, checksum)
+                elif file_length == STREAMED_PARTITION_SIZE:
+                    await self.recv_frames(sock, writer)
+                else:
+                    await self.recv_to_writer(sock, writer.write, file_length)
+            except BaseException as exc:
+                await self.run_on_disk(
+                    writer.__exit__, type(exc), exc, exc.__traceback__)
+                raise
+            await self.run_on_disk(writer.__exit__, None, None, None)
+        finally:
+            sock.close()
+        if corrupt_chunks:
+            print(f'{partial_path}: {corrupt_chunks} pedaço(s) corrompido(s) descartado(s).')
+        return corrupt_chunks
+
+
+def download_streams(
+        address: Tuple[str, int],
+        token: str,
+        partial_paths: List[str],
+        writers: list,
+        checksum=None,
+        total_size: Optional[int] = None,
+        description: str = 'Baixando'
+) -> Tuple[List[int], List[float], List[BaseException]]:
+    """
+    Baixa todas as streams da sessão <token> num laço de eventos, com uma
+    barra de progresso só.
+    :param address: (IP, porta) do servidor
+    :param token: Token da sessão dado no DOWNLOAD_RESPONSE
+    :param partial_paths: Arquivo parcial de cada stream
+    :param writers: Escritor de cada stream, ou None para o arquivo parcial
+    :param checksum: Função de checksum dos pedaços verificados
+    :param total_size: Total esperado, para a barra de progresso
+    :param description: Texto da barra de progresso
+    :return: (pedaços corrompidos, tempo em que cada stream terminou,
+        erros das streams que falharam)
+    """
+    corrupt_chunks = []
+    finish_times = []
+    errors = []
+
+    loop = asyncio.SelectorEventLoop()
+    disk_executor = ThreadPoolExecutor(
+        max_workers=DISK_WRITE_WORKERS,
+        thread_name_prefix='ccp-disk'
+    )
+    progress_bar = tqdm.tqdm(
+        total=total_size,
+        desc=description,
+        unit='B',
+        unit_scale=True
+    )
+
+    async def run_stream(receiver, start, stream_id, partial_path, writer):
+        try:
+            corrupt_chunks.append(await receiver.download_stream(
+                address, token, stream_id, partial_path, writer, checksum))
+        except Exception as exc:
+            logging.debug('Stream %d falhou: %s', stream_id, exc)
+            errors.append(exc)
+        finally:
+            finish_times.append(time.perf_counter() - start)
+
+    async def run_all():
+        receiver = StreamReceiver(
+            loop, disk_executor, SharedBuffers(), progress_bar.update)
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            run_stream(receiver, start, stream_id, partial_path, writer)
+            for stream_id, (partial_path, writer) in enumerate(zip(partial_paths, writers))
+        ))
+
+    try:
+        with progress_bar:
+            loop.run_until_complete(run_all())
+    finally:
+        loop.close()
+        disk_executor.shutdown(wait=True)
+    return corrupt_chunks, finish_times, errors
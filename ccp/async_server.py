@@ -0,0 +1,1436 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from ccp.addressing import get_abspath
+from ccp.chunking import MAX_INDEX_CHUNKS, ChunkIndexCache
+from ccp.compression import ParallelCompressor, get_codec
+from ccp.delta import DELTA_MAX_BLOCK_SIZE, DELTA_OP, OP_END, OP_LITERAL, DeltaGenerator
+from ccp.integrity import get_checksum, sha256_file
+from ccp.manifest import get_file_identity
+from ccp.merkle import (
+    MAX_MERKLE_BLOCK_SIZE,
+    MIN_MERKLE_BLOCK_SIZE,
+    MerkleTreeCache,
+    answer_nodes
+)
+from ccp.messaging import (
+    CHUNK_HEADER,
+    CHUNKED_PARTITION_SIZE,
+    DEFAULT_INLINE_THRESHOLD,
+    FRAME_HEADER,
+    PARTITION_HEADER,
+    SCHEDULED_PARTITION_SIZE,
+    STREAMED_PARTITION_SIZE,
+    MessageType,
+    ProtocolError,
+    recv_message_async,
+    send_message_async
+)
+from ccp.packing import (
+    BATCH_HEADER,
+    BatchQueue,
+    compress_batch,
+    entry_path,
+    pack_batch_header,
+    pack_entries,
+    scan_tree,
+    split_listing,
+    tree_size
+)
+from ccp.pipeline import REQUEST_CHUNK, PipelineChunk, read_chunk
+from ccp.resources import (
+    POLL_INTERVAL,
+    RETRY_AFTER,
+    ResourceManager,
+    configure_connection
+)
+from ccp.scheduling import ChunkScheduler, STATIC_SCHEDULE
+from ccp.server import (
+    BUSY_RESPONSE,
+    MISSING_DIRECTORY_RESPONSE,
+    MISSING_FILE_RESPONSE,
+    MISSING_CHUNKS_RESPONSE,
+    MISSING_DELTA_RESPONSE,
+    MISSING_SESSION_RESPONSE,
+    MISSING_TREE_RESPONSE,
+    MISSING_UPLOAD_RESPONSE,
+    answer_session_request,
+    directory_options,
+    download_options,
+    inline_response,
+    plan_download,
+    session_options,
+    upload_options
+)
+from ccp.sessions import STREAM_ATTACH_TIMEOUT, SessionRegistry
+from ccp.upload import UPLOAD_CHUNK, UploadTarget, check_upload_chunk_header, resolve_upload_path
+from ccp.utils import bytes2human
+
+
+# Fila de conexões esperando accept na porta principal.
+LISTEN_BACKLOG = 4096
+
+# Bytes no buffer de escrita de uma conexão antes de drain() esperar.
+WRITE_BUFFER_LIMIT = 4 * 2 ** 20
+
+# Instruções de delta geradas por vez no executor.
+DELTA_BATCH_SIZE = 256
+
+
+class AsyncTransferSession:
+    """
+    Como sessions.TransferSession, para o laço do asyncio: cada stream é
+    uma corrotina que recebe o leitor e o escritor da conexão de dados, e
+    a espera pelas streams não ocupa nenhuma thread.
+    """
+
+    def __init__(self, token: str, jobs: List[Callable]):
+        self.token = token
+        self.__jobs = dict(enumerate(jobs))
+        self.__running = set()
+        self.__all_claimed = asyncio.Event()
+        self.__all_finished = asyncio.Event()
+        if not jobs:
+            self.__all_claimed.set()
+            self.__all_finished.set()
+
+    def claim(self, stream_id: int) -> Optional[Callable]:
+        """
+        :return: Função da stream, ou None se o id não existe ou já foi usado
+        """
+        job = self.__jobs.pop(stream_id, None)
+        if job is not None:
+            self.__running.add(stream_id)
+        if not self.__jobs:
+            self.__all_claimed.set()
+        return job
+
+    def finish(self, stream_id: int):
+        self.__running.discard(stream_id)
+        if not self.__jobs and not self.__running:
+            self.__all_finished.set()
+
+    async def wait(self, attach_timeout: float = STREAM_ATTACH_TIMEOUT) -> int:
+        """
+        Espera todas as streams terminarem. Streams que não se conectarem
+        em <attach_timeout> segundos são descartadas.
+        :return: Quantidade de streams descartadas
+        """
+        abandoned = 0
+        try:
+            await asyncio.wait_for(self.__all_claimed.wait(), attach_timeout)
+        except asyncio.TimeoutError:
+            abandoned = len(self.__jobs)
+            self.__jobs.clear()
+            self.__all_claimed.set()
+            if not self.__running:
+                self.__all_finished.set()
+        await self.__all_finished.wait()
+        return abandoned
+
+
+class AsyncSessionPipeline:
+    """
+    Como pipeline.SessionPipeline, para o laço do asyncio: as respostas
+    saem inteiras pela conexão de controle, e os pedaços esperam numa
+    asyncio.Queue pelas corrotinas das streams.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, streams: int):
+        self.writer = writer
+        self.streams = streams
+        self.__chunks = asyncio.Queue()
+        self.__failed = set()
+
+    async def reply(self, request_id: int, message: Dict):
+        await send_message_async(self.writer, MessageType.SESSION_REPLY, {
+            'error': None,
+            **message,
+            'id': request_id
+        })
+
+    def add_download(self, request_id: int, path: str, ranges: List[Tuple[int, int]]):
+        for offset, size in ranges:
+            self.__chunks.put_nowait(PipelineChunk(request_id, path, offset, size))
+
+    async def next_chunk(self) -> Optional[PipelineChunk]:
+        """
+        :return: Próximo pedaço, ou None quando a sessão fechou e a fila acabou
+        """
+        while True:
+            chunk = await self.__chunks.get()
+            if chunk is None or chunk.request not in self.__failed:
+                return chunk
+
+    def failed(self, request_id: int) -> bool:
+        return request_id in self.__failed
+
+    async def fail(self, request_id: int, error: str):
+        if request_id in self.__failed:
+            return
+        self.__failed.add(request_id)
+        logging.debug('Pedido %d falhou: %s', request_id, error)
+        await self.reply(request_id, {'error': error})
+
+    def close(self):
+        # Um fim por stream, atrás dos pedaços que ainda estão na fila.
+        for _ in range(self.streams):
+            self.__chunks.put_nowait(None)
+
+
+def next_batch(iterator: Iterator, batch_size: int) -> list:
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            break
+    return batch
+
+
+async def iterate_in_executor(
+        executor: ThreadPoolExecutor,
+        iterator: Iterator,
+        batch_size: int = 1
+) -> AsyncIterator:
+    """
+    Consome um iterador bloqueante (leitura de arquivo, compressão) no
+    executor, <batch_size> itens por vez, sem travar o laço.
+    Ao sair, o iterador é fechado no executor, depois que o último
+    pedido a ele terminar.
+    """
+    loop = asyncio.get_running_loop()
+    future = None
+    try:
+        while True:
+            future = loop.run_in_executor(executor, next_batch, iterator, batch_size)
+            batch = await future
+            if not batch:
+                return
+            for item in batch:
+                yield item
+    finally:
+        if future is not None and not future.done():
+            await asyncio.wait([future])
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await loop.run_in_executor(executor, close)
+
+
+async def poll(try_function: Callable, timeout: Optional[float] = None):
+    """
+    Chama <try_function> (um try_* do ResourceManager, que não bloqueia)
+    até ela dar certo ou passarem <timeout> segundos, sem travar o laço.
+    :return: O último resultado de try_function
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        result = try_function()
+        if result or (deadline is not None and time.monotonic() >= deadline):
+            return result
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+def pack_chunk_header(block) -> bytes:
+    return CHUNK_HEADER.pack(
+        block.offset, block.size, len(block.payload), block.checksum or 0, block.raw)
+
+
+def raise_open_file_limit():
+    """
+    Cada cliente ocupa ao menos um descritor: sobe o limite flexível de
+    arquivos abertos até o limite rígido.
+    """
+    if resource is None:
+        return
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard_limit == resource.RLIM_INFINITY or soft_limit < hard_limit:
+        with contextlib.suppress(ValueError, OSError):
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+
+class AsyncFileServer:
+    """
+    Servidor com o mesmo protocolo do ThreadedFileServer num único laço do
+    asyncio: conexões de controle e de dados são corrotinas com sockets
+    não bloqueantes, em vez de uma thread cada. O que bloqueia (ler e
+    comprimir blocos, hashes, árvores, deltas) vai para executores de
+    tamanho fixo; partições sem compressão saem por loop.sendfile.
+    """
+
+    def __init__(
+            self,
+            server_address: Tuple[str, int],
+            compressor: Optional[ParallelCompressor] = None,
+            io_workers: Optional[int] = None,
+            resources: Optional[ResourceManager] = None,
+            inline_threshold: int = DEFAULT_INLINE_THRESHOLD,
+            upload_root: Optional[str] = None,
+            max_upload_size: Optional[int] = None
+    ):
+        """
+        :param server_address: (IP, porta); porta 0 escolhe uma livre
+        :param compressor: Compressor compartilhado pelas streams
+        :param io_workers: Threads para leituras e hashes bloqueantes
+            (padrão: o do ThreadPoolExecutor)
+        :param resources: Limites de streams, memória, compressões e
+            conexões do servidor
+        :param inline_threshold: Arquivos até este tamanho vão na própria
+            resposta, sem streams de dados
+        :param upload_root: Único diretório que recebe uploads (None:
+            uploads recusados)
+        :param max_upload_size: Maior upload aceito, ou None
+        """
+        self.server_address = server_address
+        self.inline_threshold = inline_threshold
+        self.upload_root = upload_root
+        self.max_upload_size = max_upload_size
+        self.resources = resources or ResourceManager()
+        self.compressor = compressor or ParallelCompressor(
+            memory_budget=self.resources)
+        self.tree_cache = MerkleTreeCache()
+        self.chunk_indexes = ChunkIndexCache()
+        self.sessions = SessionRegistry(session_class=AsyncTransferSession)
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=io_workers,
+            thread_name_prefix='ccp-io'
+        )
+        self.__server = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        # O sendfile sem suporte do sistema lê o arquivo no executor padrão.
+        loop.set_default_executor(self.io_executor)
+        host, port = self.server_address
+        self.__server = await asyncio.start_server(
+            self.handle,
+            host,
+            port,
+            backlog=LISTEN_BACKLOG,
+            reuse_address=True
+        )
+        self.server_address = self.__server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        if self.__server is None:
+            await self.start()
+        async with self.__server:
+            await self.__server.serve_forever()
+
+    def server_close(self):
+        if self.__server is not None:
+            self.__server.close()
+        self.compressor.shutdown()
+        self.io_executor.shutdown(wait=False)
+
+    async def run_blocking(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.io_executor, function, *args)
+
+    async def recv_request(self, reader: asyncio.StreamReader, expected_type=None):
+        """
+        recv_message_async com o idle_timeout do servidor.
+        """
+        return await asyncio.wait_for(
+            recv_message_async(reader, expected_type),
+            self.resources.idle_timeout
+        )
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info('peername')
+        if not self.resources.open_connection(peer[0]):
+            writer.close()
+            return None
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_LIMIT)
+        configure_connection(
+            writer.get_extra_info('socket'), self.resources.idle_timeout)
+        try:
+            message_type, request_message = await self.recv_request(reader)
+            logging.debug('Mensagem recebida de %s: %s', peer, request_message)
+
+            if message_type == MessageType.STREAM_ATTACH:
+                await self.stream_interaction(
+                    reader,
+                    writer,
+                    request_message['token'],
+                    request_message['stream']
+                )
+            elif message_type == MessageType.TREE_REQUEST:
+                await self.tree_interaction(
+                    reader,
+                    writer,
+                    request_message['path'],
+                    request_message['block_size']
+                )
+            elif message_type == MessageType.CHUNKS_REQUEST:
+                await self.chunks_interaction(writer, request_message['path'])
+            elif message_type == MessageType.DELTA_REQUEST:
+                await self.delta_interaction(
+                    writer,
+                    request_message['path'],
+                    request_message['block_size'],
+                    request_message['weak'],
+                    request_message['strong']
+                )
+            elif message_type == MessageType.DIRECTORY_REQUEST:
+                await self.directory_interaction(
+                    writer,
+                    **directory_options(request_message)
+                )
+            elif message_type == MessageType.DOWNLOAD_REQUEST:
+                await self.download_interaction(
+                    writer,
+                    **download_options(request_message)
+                )
+            elif message_type == MessageType.SESSION_OPEN:
+                await self.session_interaction(
+                    reader,
+                    writer,
+                    **session_options(request_message)
+                )
+            elif message_type == MessageType.UPLOAD_REQUEST:
+                await self.upload_interaction(
+                    reader,
+                    writer,
+                    **upload_options(request_message)
+                )
+            else:
+                raise ProtocolError(f'Pedido inesperado: {message_type.name}.')
+        except (ConnectionError, asyncio.IncompleteReadError) as exc:
+            logging.debug('Conexão com %s caiu: %s', peer, exc)
+        except asyncio.TimeoutError:
+            logging.debug('%s ficou parado por tempo demais.', peer)
+        except ProtocolError as exc:
+            print(f'{peer}: {exc}')
+        finally:
+            self.resources.close_connection(peer[0])
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def stream_interaction(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            token: str,
+            stream_id: int
+    ):
+        """
+        Conexão de dados: roda a stream <stream_id> da sessão <token>.
+        Token ou stream desconhecidos fecham a conexão.
+        """
+        session = self.sessions.get(token)
+        job = session.claim(stream_id) if session is not None else None
+        if job is None:
+            logging.debug('Stream %s da sessão %s desconhecida.', stream_id, token)
+            return None
+        try:
+            await job(reader, writer)
+        finally:
+            session.finish(stream_id)
+
+    async def send_range(
+            self,
+            reader,
+            writer,
+            source_path,
+            start_byte,
+            partition_size
+    ):
+        """
+        Envia a partição sem compressão: o kernel copia do arquivo para o
+        socket (loop.sendfile). Partição vazia (arquivo vazio em modo
+        .partN) só leva o cabeçalho: loop.sendfile não aceita count=0.
+        """
+        writer.write(PARTITION_HEADER.pack(partition_size))
+        if partition_size == 0:
+            return await writer.drain()
+        with open(source_path, mode='rb') as file:
+            await asyncio.get_running_loop().sendfile(
+                writer.transport, file, start_byte, partition_size)
+
+    async def send_blocks(
+            self,
+            writer,
+            source_path,
+            start_byte,
+            size,
+            codec,
+            level,
+            adaptive,
+            raw_blocks,
+            checksum,
+            pack_header
+    ):
+        """
+        Lê, comprime e envia os blocos da faixa; a leitura e a compressão
+        rodam no executor, à frente do envio.
+        :param raw_blocks: Blocos incompressíveis vão sem compressão
+        :param pack_header: Função (bloco) -> cabeçalho do bloco na rede
+        :return: Bytes enviados (sem cabeçalhos)
+        """
+        bytes_sent = 0
+        with open(source_path, mode='rb') as file:
+            blocks = self.compressor.process_range(
+                file,
+                start_byte,
+                size,
+                codec=codec,
+                level=level,
+                adaptive=adaptive,
+                checksum=checksum,
+                raw_blocks=raw_blocks
+            )
+            async_blocks = iterate_in_executor(self.io_executor, blocks)
+            try:
+                async for block in async_blocks:
+                    writer.write(pack_header(block))
+                    writer.write(block.payload)
+                    bytes_sent += len(block.payload)
+                    await writer.drain()
+            finally:
+                await async_blocks.aclose()
+        return bytes_sent
+
+    async def send_compressed_range(
+            self,
+            reader,
+            writer,
+            source_path,
+            start_byte,
+            partition_size,
+            codec,
+            level=None,
+            adaptive=False,
+            raw_blocks=False
+    ):
+        """
+        Envia a partição comprimida em quadros, como o servidor com threads.
+        """
+        writer.write(PARTITION_HEADER.pack(STREAMED_PARTITION_SIZE))
+        await self.send_blocks(
+            writer, source_path, start_byte, partition_size, codec, level,
+            adaptive, raw_blocks, None,
+            lambda block: FRAME_HEADER.pack(len(block.payload), block.raw))
+        writer.write(FRAME_HEADER.pack(0, False))
+        await writer.drain()
+
+    async def send_verified_range(
+            self,
+            reader,
+            writer,
+            source_path,
+            start_byte,
+            partition_size,
+            codec,
+            level,
+            adaptive,
+            checksum,
+            raw_blocks=False
+    ):
+        """
+        Envia a partição em pedaços com checksum (CHUNK_HEADER).
+        """
+        writer.write(PARTITION_HEADER.pack(CHUNKED_PARTITION_SIZE))
+        await self.send_blocks(
+            writer, source_path, start_byte, partition_size, codec, level,
+            adaptive, raw_blocks, checksum, pack_chunk_header)
+        writer.write(CHUNK_HEADER.pack(0, 0, 0, 0, False))
+        await writer.drain()
+
+    async def send_scheduled_chunks(
+            self,
+            reader,
+            writer,
+            stream_id,
+            source_path,
+            scheduler: ChunkScheduler,
+            codec,
+            level,
+            adaptive,
+            checksum,
+            raw_blocks=False
+    ):
+        """
+        Envia os pedaços que o agendador entregar a esta stream, como
+        ThreadedFileServerRequestHandler.send_scheduled_chunks.
+        """
+        loop = asyncio.get_running_loop()
+        block_size = self.compressor.block_size
+        writer.write(PARTITION_HEADER.pack(SCHEDULED_PARTITION_SIZE))
+        with open(source_path, mode='rb') as file:
+            while True:
+                assignment = scheduler.next_chunk(stream_id)
+                if assignment is None:
+                    break
+                chunk, position = assignment
+                start_position = position
+                start = time.perf_counter()
+                if codec is None and checksum is None:
+                    while position < chunk.end and not chunk.done:
+                        size = min(block_size, chunk.end - position)
+                        writer.write(CHUNK_HEADER.pack(position, size, size, 0, False))
+                        await loop.sendfile(writer.transport, file, position, size)
+                        position += size
+                        scheduler.advance(chunk, position)
+                else:
+                    blocks = self.compressor.process_range(
+                        file,
+                        position,
+                        chunk.end - position,
+                        codec=codec,
+                        level=level,
+                        adaptive=adaptive,
+                        checksum=checksum,
+                        raw_blocks=raw_blocks
+                    )
+                    async_blocks = iterate_in_executor(self.io_executor, blocks)
+                    try:
+                        async for block in async_blocks:
+                            writer.write(pack_chunk_header(block))
+                            writer.write(block.payload)
+                            await writer.drain()
+                            position = block.offset + block.size
+                            if scheduler.advance(chunk, position):
+                                break
+                    finally:
+                        await async_blocks.aclose()
+                scheduler.finish(
+                    stream_id,
+                    position - start_position,
+                    time.perf_counter() - start
+                )
+        writer.write(CHUNK_HEADER.pack(0, 0, 0, 0, False))
+        await writer.drain()
+
+    async def run_compressing(self, reader, writer, job):
+        """
+        Roda a stream comprimida <job> quando houver vaga para comprimir.
+        """
+        await poll(self.resources.try_acquire_compression)
+        try:
+            await job(reader, writer)
+        finally:
+            self.resources.release_compression()
+
+    def stream_job(self, plan, stream_id, abs_path, level, adaptive, raw_blocks, checksum):
+        """
+        :return: Corrotina (leitor e escritor da conexão de dados) da stream
+            <stream_id>
+        """
+        codec = get_codec(plan.codec) if plan.codec is not None else None
+        checksum_fn = get_checksum(checksum) if checksum is not None else None
+        if plan.scheduler is not None:
+            return functools.partial(
+                self.send_scheduled_chunks,
+                stream_id=stream_id,
+                source_path=abs_path,
+                scheduler=plan.scheduler,
+                codec=codec,
+                level=level,
+                adaptive=adaptive,
+                checksum=checksum_fn,
+                raw_blocks=raw_blocks
+            )
+        start_byte, partition_size = plan.ranges[stream_id]
+        if checksum_fn is not None:
+            return functools.partial(
+                self.send_verified_range,
+                source_path=abs_path,
+                start_byte=start_byte,
+                partition_size=partition_size,
+                codec=codec,
+                level=level,
+                adaptive=adaptive,
+                checksum=checksum_fn,
+                raw_blocks=raw_blocks
+            )
+        if codec is None:
+            return functools.partial(
+                self.send_range,
+                source_path=abs_path,
+                start_byte=start_byte,
+                partition_size=partition_size
+            )
+        return functools.partial(
+            self.send_compressed_range,
+            source_path=abs_path,
+            start_byte=start_byte,
+            partition_size=partition_size,
+            codec=codec,
+            level=level,
+            adaptive=adaptive,
+            raw_blocks=raw_blocks
+        )
+
+    async def download_interaction(
+            self,
+            writer: asyncio.StreamWriter,
+            path: str,
+            streams: int,
+            codec: Optional[str],
+            level: Optional[int] = None,
+            adaptive: bool = False,
+            raw_blocks: bool = False,
+            ranges: Optional[List[Tuple[int, int]]] = None,
+            identity: Optional[Dict] = None,
+            checksum: Optional[str] = None,
+            sha256: bool = False,
+            schedule: str = STATIC_SCHEDULE,
+            inline: bool = False
+    ):
+        """
+        Como ThreadedFileServerRequestHandler.download_interaction: as
+        streams são corrotinas que rodam quando as conexões de dados se
+        apresentam com o token da sessão.
+        """
+        abs_path = get_abspath(path)
+        if not os.path.exists(abs_path):
+            logging.debug('Arquivo %s não existe!', abs_path)
+            await send_message_async(
+                writer, MessageType.DOWNLOAD_RESPONSE, MISSING_FILE_RESPONSE)
+            return None
+
+        if inline and ranges is None:
+            server_response = await self.run_blocking(functools.partial(
+                inline_response,
+                abs_path,
+                self.inline_threshold,
+                codec,
+                level,
+                adaptive,
+                sha256
+            ))
+            if server_response is not None:
+                await send_message_async(
+                    writer, MessageType.DOWNLOAD_RESPONSE, server_response)
+                return None
+
+        granted_streams = await poll(
+            functools.partial(self.resources.try_admit, streams),
+            self.resources.admission_wait
+        )
+        if not granted_streams:
+            print(f'Servidor cheio: {path} fica para depois.')
+            await send_message_async(
+                writer, MessageType.DOWNLOAD_RESPONSE, BUSY_RESPONSE)
+            return None
+        try:
+            await self.send_download(
+                writer,
+                abs_path,
+                granted_streams,
+                codec,
+                level,
+                adaptive,
+                raw_blocks,
+                ranges,
+                identity,
+                checksum,
+                sha256,
+                schedule
+            )
+        finally:
+            self.resources.release_streams(granted_streams)
+
+    async def send_download(
+            self,
+            writer: asyncio.StreamWriter,
+            abs_path: str,
+            streams: int,
+            codec: Optional[str],
+            level: Optional[int],
+            adaptive: bool,
+            raw_blocks: bool,
+            ranges: Optional[List[Tuple[int, int]]],
+            identity: Optional[Dict],
+            checksum: Optional[str],
+            sha256: bool,
+            schedule: str
+    ):
+        """
+        Como ThreadedFileServerRequestHandler.send_download.
+        """
+        plan = await self.run_blocking(functools.partial(
+            plan_download,
+            abs_path,
+            streams,
+            codec,
+            adaptive,
+            ranges,
+            identity,
+            schedule,
+            alignment=self.compressor.block_size
+        ))
+        # O hash do arquivo todo é calculado enquanto as partições saem.
+        file_hash = None
+        if sha256:
+            file_hash = asyncio.ensure_future(self.run_blocking(sha256_file, abs_path))
+        await self.run_blocking(
+            self.compressor.record_access,
+            abs_path,
+            get_codec(plan.codec) if plan.codec is not None else None,
+            level
+        )
+
+        jobs = []
+        for i in range(plan.streams):
+            job = self.stream_job(plan, i, abs_path, level, adaptive, raw_blocks, checksum)
+            if plan.codec is not None:
+                job = functools.partial(self.run_compressing, job=job)
+            jobs.append(job)
+        session = self.sessions.open(jobs)
+        start = time.perf_counter()
+        try:
+            await send_message_async(
+                writer,
+                MessageType.DOWNLOAD_RESPONSE,
+                plan.response(session.token, checksum)
+            )
+            abandoned_streams = await session.wait()
+        except BaseException:
+            # O hash só é cancelado se o envio falhou: num envio rápido
+            # (poucas faixas) ele ainda está rodando e vai no resultado.
+            if file_hash is not None and not file_hash.done():
+                file_hash.cancel()
+            raise
+        finally:
+            self.sessions.close(session)
+        if abandoned_streams:
+            print(f'{abandoned_streams} stream(s) não se conectaram a tempo.')
+
+        if checksum is not None or file_hash is not None:
+            await send_message_async(writer, MessageType.DOWNLOAD_RESULT, {
+                'sha256': await file_hash if file_hash is not None else None
+            })
+        print(
+            f'{abs_path}: {bytes2human(sum(size for _, size in plan.ranges))} '
+            f'em {plan.streams} stream(s), {time.perf_counter() - start:.3f} s.')
+
+    async def send_tree_batches(
+            self,
+            reader,
+            writer,
+            root,
+            entries,
+            batches: BatchQueue,
+            codec,
+            level
+    ):
+        """
+        Envia os lotes de arquivos que a fila entregar a esta stream, como
+        ThreadedFileServerRequestHandler.send_tree_batches.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = batches.next_batch()
+            if batch is None:
+                break
+            if codec is None and len(batch) == 1:
+                (segment,) = batch
+                writer.write(pack_batch_header(batch, segment.size))
+                with open(entry_path(root, entries[segment.index].path), 'rb') as file:
+                    await loop.sendfile(
+                        writer.transport, file, segment.offset, segment.size)
+            else:
+                payload = await self.run_blocking(
+                    compress_batch, root, entries, batch, codec, level)
+                writer.write(pack_batch_header(batch, len(payload)))
+                writer.write(payload)
+                await writer.drain()
+        writer.write(BATCH_HEADER.pack(0, 0))
+        await writer.drain()
+
+    async def directory_interaction(
+            self,
+            writer: asyncio.StreamWriter,
+            path: str,
+            streams: int,
+            codec: Optional[str],
+            level: Optional[int] = None
+    ):
+        """
+        Como ThreadedFileServerRequestHandler.directory_interaction; a
+        varredura do diretório roda no executor.
+        """
+        abs_path = get_abspath(path)
+        if not os.path.isdir(abs_path):
+            logging.debug('Diretório %s não existe!', abs_path)
+            await send_message_async(
+                writer, MessageType.DIRECTORY_RESPONSE, MISSING_DIRECTORY_RESPONSE)
+            return None
+
+        granted_streams = await poll(
+            functools.partial(self.resources.try_admit, streams),
+            self.resources.admission_wait
+        )
+        if not granted_streams:
+            print(f'Servidor cheio: {path} fica para depois.')
+            await send_message_async(writer, MessageType.DIRECTORY_RESPONSE, {
+                **MISSING_DIRECTORY_RESPONSE,
+                'retry_after': RETRY_AFTER
+            })
+            return None
+        try:
+            start = time.perf_counter()
+            skipped = []
+            entries = await self.run_blocking(
+                functools.partial(scan_tree, abs_path, skipped=skipped))
+            batches = pack_entries(entries, self.compressor.block_size)
+            files, size = tree_size(entries)
+            streams = min(granted_streams, len(batches))
+            listing = split_listing(entries)
+
+            batch_queue = BatchQueue(batches)
+            jobs = []
+            for _ in range(streams):
+                job = functools.partial(
+                    self.send_tree_batches,
+                    root=abs_path,
+                    entries=entries,
+                    batches=batch_queue,
+                    codec=get_codec(codec) if codec is not None else None,
+                    level=level
+                )
+                if codec is not None:
+                    job = functools.partial(self.run_compressing, job=job)
+                jobs.append(job)
+            session = self.sessions.open(jobs)
+            try:
+                await send_message_async(writer, MessageType.DIRECTORY_RESPONSE, {
+                    'token': session.token,
+                    'streams': streams,
+                    'codec': codec,
+                    'files': files,
+                    'size': size,
+                    'batches': len(batches),
+                    'listing_messages': len(listing),
+                    'skipped': len(skipped),
+                    'retry_after': None
+                })
+                for items in listing:
+                    await send_message_async(writer, MessageType.DIRECTORY_RESPONSE, {
+                        'entries': items
+                    })
+                abandoned_streams = await session.wait()
+            finally:
+                self.sessions.close(session)
+        finally:
+            self.resources.release_streams(granted_streams)
+        if abandoned_streams:
+            print(f'{abandoned_streams} stream(s) não se conectaram a tempo.')
+        print(
+            f'{abs_path}: {files} arquivo(s), {bytes2human(size)} em '
+            f'{len(batches)} lote(s), {time.perf_counter() - start:.3f} s.')
+
+    async def send_session_chunks(
+            self,
+            reader,
+            writer,
+            pipeline: AsyncSessionPipeline,
+            codec,
+            level
+    ):
+        """
+        Stream de uma sessão, como
+        ThreadedFileServerRequestHandler.send_session_chunks.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await pipeline.next_chunk()
+            if chunk is None:
+                break
+            if codec is None:
+                try:
+                    file = open(chunk.path, mode='rb')
+                except OSError as exc:
+                    await pipeline.fail(chunk.request, str(exc))
+                    continue
+                with file:
+                    writer.write(REQUEST_CHUNK.pack(
+                        chunk.request, chunk.offset, chunk.size, chunk.size, False))
+                    await loop.sendfile(writer.transport, file, chunk.offset, chunk.size)
+                continue
+            await poll(self.resources.try_acquire_compression)
+            try:
+                payload, compressed = await self.run_blocking(
+                    read_chunk, chunk.path, chunk.offset, chunk.size, codec, level)
+            except OSError as exc:
+                await pipeline.fail(chunk.request, str(exc))
+                continue
+            finally:
+                self.resources.release_compression()
+            writer.write(REQUEST_CHUNK.pack(
+                chunk.request, chunk.offset, chunk.size, len(payload), compressed))
+            writer.write(payload)
+            await writer.drain()
+        writer.write(REQUEST_CHUNK.pack(0, 0, 0, 0, False))
+        await writer.drain()
+
+    async def serve_session_request(
+            self,
+            pipeline: AsyncSessionPipeline,
+            request_message: Dict,
+            codec: Optional[str],
+            level: Optional[int]
+    ):
+        """
+        Como ThreadedFileServerRequestHandler.serve_session_request; o
+        pedido é atendido no executor.
+        """
+        request_id = request_message['id']
+        try:
+            response, abs_path, ranges = await self.run_blocking(
+                answer_session_request,
+                request_message,
+                self.inline_threshold,
+                codec,
+                level,
+                self.compressor.block_size
+            )
+        except (OSError, ValueError, KeyError) as exc:
+            response, abs_path, ranges = {'error': str(exc)}, None, []
+        await pipeline.reply(request_id, response)
+        if not ranges:
+            return None
+        pipeline.add_download(request_id, abs_path, ranges)
+        if request_message.get('sha256', False):
+            try:
+                file_sha256 = await self.run_blocking(sha256_file, abs_path)
+            except OSError as exc:
+                await pipeline.fail(request_id, str(exc))
+                return None
+            if not pipeline.failed(request_id):
+                await pipeline.reply(request_id, {'sha256': file_sha256})
+
+    async def session_interaction(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            streams: int,
+            codec: Optional[str],
+            level: Optional[int] = None
+    ):
+        """
+        Como ThreadedFileServerRequestHandler.session_interaction: cada
+        pedido vira uma tarefa, então vários são atendidos ao mesmo tempo.
+        """
+        granted_streams = await poll(
+            functools.partial(self.resources.try_admit, streams),
+            self.resources.admission_wait
+        )
+        if not granted_streams:
+            print('Servidor cheio: sessão fica para depois.')
+            await send_message_async(writer, MessageType.SESSION_READY, {
+                **MISSING_SESSION_RESPONSE,
+                'retry_after': RETRY_AFTER
+            })
+            return None
+        try:
+            pipeline = AsyncSessionPipeline(writer, granted_streams)
+            jobs = [
+                functools.partial(
+                    self.send_session_chunks,
+                    pipeline=pipeline,
+                    codec=get_codec(codec) if codec is not None else None,
+                    level=level
+                )
+                for _ in range(granted_streams)
+            ]
+            session = self.sessions.open(jobs)
+            tasks = set()
+            requests = 0
+            start = time.perf_counter()
+            try:
+                await send_message_async(writer, MessageType.SESSION_READY, {
+                    'token': session.token,
+                    'streams': granted_streams,
+                    'codec': codec,
+                    'retry_after': None
+                })
+                while True:
+                    try:
+                        _, request_message = await self.recv_request(
+                            reader, MessageType.SESSION_REQUEST)
+                    except (
+                            ConnectionError,
+                            asyncio.IncompleteReadError,
+                            asyncio.TimeoutError,
+                            ProtocolError
+                    ) as exc:
+                        # Inclui o fim normal: o cliente fecha a conexão.
+                        logging.debug('Fim dos pedidos da sessão: %s', exc)
+                        break
+                    task = asyncio.create_task(self.serve_session_request(
+                        pipeline, request_message, codec, level))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    requests += 1
+                if tasks:
+                    await asyncio.gather(*tasks, return_exceptions=True)
+            finally:
+                pipeline.close()
+                abandoned_streams = await session.wait()
+                self.sessions.close(session)
+        finally:
+            self.resources.release_streams(granted_streams)
+        if abandoned_streams:
+            print(f'{abandoned_streams} stream(s) não se conectaram a tempo.')
+        print(f'Sessão com {requests} pedido(s) em {time.perf_counter() - start:.3f} s.')
+
+    async def recv_upload_stream(
+            self,
+            reader,
+            writer,
+            target: UploadTarget,
+            codec
+    ):
+        """
+        Stream de um upload, como
+        ThreadedFileServerRequestHandler.recv_upload_stream: cada pedaço é
+        descomprimido e escrito no executor enquanto o próximo chega.
+        """
+        pending_write = None
+        try:
+            while True:
+                header = UPLOAD_CHUNK.unpack(await reader.readexactly(UPLOAD_CHUNK.size))
+                check_upload_chunk_header(header)
+                offset, size, payload_size, compressed = header
+                if not size:
+                    break
+                if compressed and codec is None:
+                    raise ProtocolError('Pedaço comprimido sem codec negociado.')
+                payload = await reader.readexactly(payload_size)
+                if pending_write is not None:
+                    await pending_write
+                pending_write = asyncio.ensure_future(self.run_blocking(
+                    target.write_chunk,
+                    offset,
+                    size,
+                    payload,
+                    codec if compressed else None
+                ))
+            if pending_write is not None:
+                await pending_write
+        except Exception as exc:
+            target.fail(str(exc))
+            print(exc)
+            if pending_write is not None:
+                with contextlib.suppress(Exception):
+                    await pending_write
+
+    async def upload_interaction(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            path: str,
+            size: Optional[int],
+            streams: int,
+            codec: Optional[str]
+    ):
+        """
+        Como ThreadedFileServerRequestHandler.upload_interaction; a
+        pré-alocação e a conferência final rodam no executor.
+        """
+        try:
+            abs_path = resolve_upload_path(self.upload_root, path)
+        except (OSError, ValueError) as exc:
+            logging.debug('Upload para %s recusado: %s', path, exc)
+            await send_message_async(writer, MessageType.UPLOAD_RESPONSE, {
+                **MISSING_UPLOAD_RESPONSE,
+                'error': str(exc)
+            })
+            return None
+
+        granted_streams = await poll(
+            functools.partial(self.resources.try_admit, streams),
+            self.resources.admission_wait
+        )
+        if not granted_streams:
+            print(f'Servidor cheio: upload de {path} fica para depois.')
+            await send_message_async(writer, MessageType.UPLOAD_RESPONSE, {
+                **MISSING_UPLOAD_RESPONSE,
+                'retry_after': RETRY_AFTER
+            })
+            return None
+        try:
+            try:
+                target = await self.run_blocking(
+                    UploadTarget, abs_path, size, self.max_upload_size)
+            except (OSError, ValueError) as exc:
+                await send_message_async(writer, MessageType.UPLOAD_RESPONSE, {
+                    **MISSING_UPLOAD_RESPONSE,
+                    'error': str(exc)
+                })
+                return None
+
+            jobs = []
+            for _ in range(granted_streams):
+                job = functools.partial(
+                    self.recv_upload_stream,
+                    target=target,
+                    codec=get_codec(codec) if codec is not None else None
+                )
+                if codec is not None:
+                    job = functools.partial(self.run_compressing, job=job)
+                jobs.append(job)
+            session = self.sessions.open(jobs)
+            start = time.perf_counter()
+            try:
+                await send_message_async(writer, MessageType.UPLOAD_RESPONSE, {
+                    'token': session.token,
+                    'streams': granted_streams,
+                    'codec': codec,
+                    'retry_after': None,
+                    'error': None
+                })
+                abandoned_streams = await session.wait()
+                if abandoned_streams:
+                    target.fail(f'{abandoned_streams} stream(s) não se conectaram a tempo.')
+                _, commit_message = await self.recv_request(
+                    reader, MessageType.UPLOAD_COMMIT)
+                try:
+                    await self.run_blocking(
+                        target.commit,
+                        commit_message['size'],
+                        commit_message.get('sha256'),
+                        commit_message.get('mode')
+                    )
+                    result = {'size': commit_message['size'], 'error': None}
+                except (OSError, RuntimeError) as exc:
+                    result = {'size': None, 'error': str(exc)}
+                await send_message_async(writer, MessageType.UPLOAD_RESULT, result)
+            finally:
+                self.sessions.close(session)
+                await self.run_blocking(target.abort)
+        finally:
+            self.resources.release_streams(granted_streams)
+        if result['error'] is not None:
+            print(f'Upload de {abs_path} falhou: {result["error"]}')
+            return None
+        print(
+            f'{abs_path}: {bytes2human(result["size"])} recebidos em '
+            f'{granted_streams} stream(s), {time.perf_counter() - start:.3f} s.')
+
+    async def tree_interaction(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            path: str,
+            block_size: int
+    ):
+        """
+        Como ThreadedFileServerRequestHandler.tree_interaction; a árvore é
+        montada no executor.
+        """
+        abs_path = get_abspath(path)
+        if not os.path.isfile(abs_path):
+            logging.debug('Arquivo %s não existe!', abs_path)
+            await send_message_async(
+                writer, MessageType.TREE_RESPONSE, MISSING_TREE_RESPONSE)
+            return None
+
+        granted_streams = await poll(
+            functools.partial(self.resources.try_admit, 1),
+            self.resources.admission_wait
+        )
+        if not granted_streams:
+            print(f'Servidor cheio: comparação de {path} fica para depois.')
+            await send_message_async(writer, MessageType.TREE_RESPONSE, {
+                **MISSING_TREE_RESPONSE,
+                'retry_after': RETRY_AFTER
+            })
+            return None
+        try:
+            block_size = min(max(block_size, MIN_MERKLE_BLOCK_SIZE), MAX_MERKLE_BLOCK_SIZE)
+            tree = await self.run_blocking(self.tree_cache.get, abs_path, block_size)
+            await send_message_async(writer, MessageType.TREE_RESPONSE, {
+                'size': tree.size,
+                'block_size': tree.block_size,
+                'depth': tree.depth,
+                'leaves': len(tree.levels[0])
+            })
+
+            while True:
+                _, request_message = await self.recv_request(
+                    reader,
+                    expected_type=MessageType.TREE_REQUEST
+                )
+                nodes = request_message['nodes']
+                if not nodes:
+                    break
+                hashes = answer_nodes(tree, nodes)
+                await send_message_async(
+                    writer, MessageType.TREE_RESPONSE, {'hashes': hashes})
+                if hashes is None:
+                    logging.debug('Pedido de nós inválido para %s.', abs_path)
+                    return None
+        finally:
+            self.resources.release_streams(granted_streams)
+        logging.debug('Fim da comparação de %s.', abs_path)
+
+    async def chunks_interaction(self, writer: asyncio.StreamWriter, path: str):
+        """
+        Como ThreadedFileServerRequestHandler.chunks_interaction; a lista é
+        montada no executor.
+        """
+        abs_path = get_abspath(path)
+        index = None
+        if os.path.isfile(abs_path):
+            granted_streams = await poll(
+                functools.partial(self.resources.try_admit, 1),
+                self.resources.admission_wait
+            )
+            if not granted_streams:
+                print(f'Servidor cheio: lista de pedaços de {path} fica para depois.')
+                await send_message_async(writer, MessageType.CHUNKS_RESPONSE, {
+                    **MISSING_CHUNKS_RESPONSE,
+                    'retry_after': RETRY_AFTER
+                })
+                return None
+            try:
+                file_identity = await self.run_blocking(get_file_identity, abs_path)
+                index = await self.run_blocking(self.chunk_indexes.get, abs_path)
+            finally:
+                self.resources.release_streams(granted_streams)
+        if index is None or len(index) > MAX_INDEX_CHUNKS:
+            logging.debug('Sem lista de pedaços para %s.', abs_path)
+            await send_message_async(
+                writer, MessageType.CHUNKS_RESPONSE, MISSING_CHUNKS_RESPONSE)
+            return None
+
+        await send_message_async(writer, MessageType.CHUNKS_RESPONSE, {
+            'identity': file_identity,
+            **index.to_message()
+        })
+        print(f'Lista de {len(index)} pedaço(s) de {abs_path} enviada.')
+
+    async def delta_interaction(
+            self,
+            writer: asyncio.StreamWriter,
+            path: str,
+            block_size: int,
+            weak: bytes,
+            strong: bytes
+    ):
+        """
+        Como ThreadedFileServerRequestHandler.delta_interaction.
+        """
+        abs_path = get_abspath(path)
+        if not os.path.isfile(abs_path) or not 0 < block_size <= DELTA_MAX_BLOCK_SIZE:
+            logging.debug('Pedido de delta inválido para %s.', abs_path)
+            await send_message_async(
+                writer, MessageType.DELTA_RESPONSE, MISSING_DELTA_RESPONSE)
+            return None
+
+        granted_streams = await poll(
+            functools.partial(self.resources.try_admit, 1),
+            self.resources.admission_wait
+        )
+        if not granted_streams:
+            print(f'Servidor cheio: delta de {path} fica para depois.')
+            await send_message_async(writer, MessageType.DELTA_RESPONSE, {
+                **MISSING_DELTA_RESPONSE,
+                'retry_after': RETRY_AFTER
+            })
+            return None
+        try:
+            await self.send_file_delta(writer, abs_path, block_size, weak, strong)
+        finally:
+            self.resources.release_streams(granted_streams)
+
+    async def send_file_delta(
+            self,
+            writer: asyncio.StreamWriter,
+            abs_path: str,
+            block_size: int,
+            weak: bytes,
+            strong: bytes
+    ):
+        """
+        Como ThreadedFileServerRequestHandler.send_file_delta; o índice
+        das assinaturas e a busca dos blocos rodam no executor.
+        """
+        file_hash = asyncio.ensure_future(self.run_blocking(sha256_file, abs_path))
+        try:
+            file_identity = await self.run_blocking(get_file_identity, abs_path)
+            await send_message_async(writer, MessageType.DELTA_RESPONSE, {
+                'size': file_identity['size'],
+                'identity': file_identity
+            })
+
+            generator = await self.run_blocking(DeltaGenerator, block_size, weak, strong)
+            copied_bytes = literal_bytes = 0
+            instructions = iterate_in_executor(
+                self.io_executor,
+                generator.generate(abs_path),
+                batch_size=DELTA_BATCH_SIZE
+            )
+            try:
+                async for instruction in instructions:
+                    writer.write(DELTA_OP.pack(
+                        instruction.op, instruction.offset, instruction.size))
+                    if instruction.op == OP_LITERAL:
+                        writer.write(instruction.payload)
+                        literal_bytes += instruction.size
+                    else:
+                        copied_bytes += instruction.size
+                    await writer.drain()
+            finally:
+                await instructions.aclose()
+            writer.write(DELTA_OP.pack(OP_END, 0, 0))
+            await send_message_async(writer, MessageType.DOWNLOAD_RESULT, {
+                'sha256': await file_hash
+            })
+        finally:
+            if not file_hash.done():
+                file_hash.cancel()
+        print(
+            f'Delta de {abs_path}: {bytes2human(literal_bytes)} enviados, '
+            f'{bytes2human(copied_bytes)} reaproveitados pelo cliente.')
+
+
+def run_async_server(
+        server_address: Tuple[str, int],
+        compressor: ParallelCompressor,
+        io_workers: Optional[int] = None,
+        resources: Optional[ResourceManager] = None,
+        inline_threshold: int = DEFAULT_INLINE_THRESHOLD,
+        upload_root: Optional[str] = None,
+        max_upload_size: Optional[int] = None
+):
+    """
+    Roda o AsyncFileServer até KeyboardInterrupt.
+    """
+    raise_open_file_limit()
+    file_server = AsyncFileServer(
+        server_address,
+        compressor,
+        io_workers=io_workers,
+        resources=resources,
+        inline_threshold=inline_threshold,
+        upload_root=upload_root,
+        max_upload_size=max_upload_size
+    )
+    print(
+        '-----------------------------------------------------------\n'
+        f'Servidor de arquivos (asyncio) ouvindo na porta {server_address[1]}\n'
+        '-----------------------------------------------------------\n'
+    )
+    try:
+        asyncio.run(file_server.serve_forever())
+    except KeyboardInterrupt:
+        print('\nKeyboardInterrupt!')
+    finally:
+        print('\nDesligando servidor...')
+        file_server.server_close()
@@ -0,0 +1,103 @@
+import contextlib
+import socket
+import threading
+from typing import BinaryIO, Callable, Optional
+
+
+# Tamanho de cada buffer de recebimento.
+RECV_BUFFER_SIZE = 2 ** 20
+
+# Quantidade máxima de buffers livres guardados pelo pool.
+MAX_POOLED_BUFFERS = 64
+
+
+class BufferPool:
+    """
+    Pool de buffers pré-alocados e reutilizáveis.
+
+    Todos os laços de recebimento pegam buffers daqui e usam recv_into,
+    então o volume de dados recebido não gera novos objetos bytes.
+    """
+
+    def __init__(
+            self,
+            buffer_size: int = RECV_BUFFER_SIZE,
+            max_buffers: int = MAX_POOLED_BUFFERS
+    ):
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self.__free_buffers = []
+        self.__lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        with self.__lock:
+            if self.__free_buffers:
+                return self.__free_buffers.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer: bytearray):
+        if len(buffer) != self.buffer_size:
+            return
+        with self.__lock:
+            if len(self.__free_buffers) < self.max_buffers:
+                self.__free_buffers.append(buffer)
+
+    @contextlib.contextmanager
+    def buffer(self):
+        buffer = self.acquire()
+        try:
+            yield buffer
+        finally:
+            self.release(buffer)
+
+
+# Pool compartilhado por todas as streams do processo.
+RECV_POOL = BufferPool()
+
+
+def recv_into_exactly(connection: socket.socket, view: memoryview):
+    """
+    Preenche <view> inteira com bytes da conexão.
+    :param connection: Conexão TCP
+    :param view: Destino (memoryview de um buffer gravável)
+    """
+    total_bytes_received = 0
+    n_bytes = len(view)
+    while total_bytes_received < n_bytes:
+        bytes_received = connection.recv_into(view[total_bytes_received:])
+        if bytes_received == 0:
+            raise RuntimeError('Broken connection.')
+        total_bytes_received += bytes_received
+
+
+def recv_to_file(
+        connection: socket.socket,
+        file: BinaryIO,
+        n_bytes: int,
+        pool: BufferPool = RECV_POOL,
+        on_progress: Optional[Callable[[int], object]] = None
+) -> int:
+    """
+    Recebe exatamente <n_bytes> da conexão e os escreve em <file>
+    sem cópias intermediárias: recv_into num buffer do pool e escrita
+    da fatia recebida (memoryview).
+    :param connection: Conexão TCP
+    :param file: Arquivo aberto em modo binário
+    :param n_bytes: Quantidade de bytes
+    :param pool: Pool de buffers
+    :param on_progress: Chamada com a quantidade de bytes de cada recebimento
+    :return: Total de bytes escritos
+    """
+    total_bytes_written = 0
+    with pool.buffer() as buffer:
+        view = memoryview(buffer)
+        while total_bytes_written < n_bytes:
+            bytes_received = connection.recv_into(
+                view[:min(n_bytes - total_bytes_written, len(view))])
+            if bytes_received == 0:
+                raise RuntimeError('Broken connection.')
+            total_bytes_written += file.write(view[:bytes_received])
+            if on_progress is not None:
+                on_progress(bytes_received)
+        view.release()
+    return total_bytes_written
@@ -0,0 +1,271 @@
+import collections
+import contextlib
+import hashlib
+import logging
+import mmap
+import os
+import threading
+from typing import Dict, Hashable, Optional, Tuple
+
+
+# Bytes de blocos comprimidos guardados em memória pelo servidor.
+DEFAULT_CACHE_SIZE = 256 * 2 ** 20
+
+# Bytes de blocos comprimidos guardados no disco, quando há diretório.
+DEFAULT_DISK_CACHE_SIZE = 4 * 2 ** 30
+
+# Downloads comprimidos de um arquivo até ele ser comprimido inteiro em
+# segundo plano (pré-aquecido).
+PREWARM_ACCESSES = 3
+
+# Subdiretório do diretório do cache com os blocos guardados. Ele é só
+# do cache: o que estiver lá ao iniciar é de uma execução anterior.
+CHUNK_SUBDIRECTORY = 'ccp-server-blocks'
+
+# Extensão dos blocos guardados no diretório do cache.
+CHUNK_EXTENSION = '.ccp-chunk'
+
+# Identidade de uma versão de um arquivo: (dispositivo, inode, tamanho, mtime).
+FileIdentity = Tuple[int, int, int, int]
+
+
+def stat_identity(info: os.stat_result) -> FileIdentity:
+    return info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns
+
+
+def map_file(path: str) -> memoryview:
+    """
+    Mapeia o arquivo em memória, só para leitura: o conteúdo vai do cache
+    de páginas do sistema direto para o socket, sem read() nem cópia.
+    """
+    with open(path, mode='rb') as file:
+        return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def release_mapped(payload):
+    """
+    Desfaz o mapeamento de um bloco vindo de map_file, depois de enviado.
+    Outros tipos de bloco são ignorados. Se ainda houver quem use o
+    mapeamento, ele é desfeito quando essa referência sumir.
+    """
+    if not isinstance(payload, memoryview) or not isinstance(payload.obj, mmap.mmap):
+        return None
+    file_map = payload.obj
+    with contextlib.suppress(BufferError):
+        payload.release()
+        file_map.close()
+
+
+class ChunkCache:
+    """
+    Cache de blocos comprimidos do servidor, compartilhado por todos os
+    pedidos. A chave é (identidade do arquivo, byte inicial, tamanho,
+    codec, nível, adaptativo), então um bloco só é reaproveitado enquanto
+    o arquivo não muda; quando um inode aparece com outro tamanho ou
+    mtime, os blocos da versão antiga são descartados na hora.
+
+    Há duas camadas, cada uma com orçamento em bytes e descarte do bloco
+    usado há mais tempo (LRU): a memória, e opcionalmente um diretório no
+    disco, que recebe uma cópia de cada bloco e é servido por mmap.
+    O cache também conta os downloads de cada arquivo, para que os mais
+    pedidos sejam comprimidos inteiros antes do próximo pedido.
+    """
+
+    def __init__(
+            self,
+            max_memory: int = DEFAULT_CACHE_SIZE,
+            directory: Optional[str] = None,
+            max_disk: int = DEFAULT_DISK_CACHE_SIZE,
+            prewarm_accesses: int = PREWARM_ACCESSES
+    ):
+        """
+        :param max_memory: Bytes de blocos em memória
+        :param directory: Diretório da camada em disco, ou None para não
+            usar o disco. Os blocos ficam no subdiretório
+            CHUNK_SUBDIRECTORY, e os de execuções anteriores são apagados
+        :param max_disk: Bytes de blocos no disco
+        :param prewarm_accesses: Downloads de um arquivo até pré-aquecê-lo
+            (0 desliga)
+        """
+        if max_memory < 0 or max_disk < 0:
+            raise ValueError('Tamanhos do cache não podem ser negativos.')
+        self.max_memory = max_memory
+        self.directory = directory
+        self.chunk_directory = (
+            os.path.join(directory, CHUNK_SUBDIRECTORY) if directory is not None else None)
+        self.max_disk = max_disk if directory is not None else 0
+        self.prewarm_accesses = prewarm_accesses
+
+        self.__memory: Dict[Hashable, bytes] = collections.OrderedDict()
+        self.__memory_bytes = 0
+        self.__disk: Dict[Hashable, Tuple[str, int]] = collections.OrderedDict()
+        self.__disk_bytes = 0
+        self.__keys = collections.defaultdict(set)
+        self.__inodes: Dict[Tuple[int, int], FileIdentity] = {}
+        self.__accesses = collections.Counter()
+        self.__prewarmed = set()
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+
+        if directory is not None:
+            os.makedirs(self.chunk_directory, exist_ok=True)
+            # As chaves só existem em memória: blocos antigos não servem.
+            # Só os arquivos do cache (blocos e temporários) são apagados.
+            for name in os.listdir(self.chunk_directory):
+                if CHUNK_EXTENSION in name:
+                    with contextlib.suppress(OSError):
+                        os.remove(os.path.join(self.chunk_directory, name))
+
+    @property
+    def capacity(self) -> int:
+        return max(self.max_memory, self.max_disk)
+
+    def identify(self, info: os.stat_result) -> FileIdentity:
+        """
+        Registra a versão atual de um arquivo e descarta os blocos das
+        versões anteriores do mesmo inode.
+        :param info: os.stat/os.fstat do arquivo
+        :return: Identidade usada nas chaves
+        """
+        identity = stat_identity(info)
+        stale_paths = []
+        with self.__lock:
+            previous = self.__inodes.get(identity[:2])
+            if previous is not None and previous != identity:
+                stale_paths = self.__invalidate(previous)
+            self.__inodes[identity[:2]] = identity
+        self.__remove_files(stale_paths)
+        return identity
+
+    def __invalidate(self, identity: FileIdentity) -> list:
+        stale_paths = []
+        for key in self.__keys.pop(identity, ()):
+            payload = self.__memory.pop(key, None)
+            if payload is not None:
+                self.__memory_bytes -= len(payload)
+            entry = self.__disk.pop(key, None)
+            if entry is not None:
+                self.__disk_bytes -= entry[1]
+                stale_paths.append(entry[0])
+        for access in [access for access in self.__accesses if access[0] == identity]:
+            del self.__accesses[access]
+        self.__prewarmed = {
+            prewarmed for prewarmed in self.__prewarmed if prewarmed[0] != identity}
+        logging.debug('Cache: arquivo %s mudou; blocos da versão antiga descartados.', identity)
+        return stale_paths
+
+    @staticmethod
+    def __remove_files(paths):
+        # Quem está enviando um bloco mapeado continua com ele (POSIX).
+        for path in paths:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+    def __forget(self, key):
+        if key not in self.__memory and key not in self.__disk:
+            keys = self.__keys.get(key[0])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.__keys[key[0]]
+
+    def get(self, key: Hashable):
+        """
+        :return: Bloco comprimido (bytes da memória ou memoryview do
+            arquivo mapeado), ou None
+        """
+        with self.__lock:
+            payload = self.__memory.get(key)
+            if payload is not None:
+                self.__memory.move_to_end(key)
+                self.hits += 1
+                return payload
+            entry = self.__disk.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.__disk.move_to_end(key)
+            self.hits += 1
+        try:
+            return map_file(entry[0])
+        except (OSError, ValueError):
+            # Descartado entre a consulta e a abertura.
+            return None
+
+    def put(self, key: Hashable, payload):
+        """
+        Guarda um bloco comprimido, descartando os usados há mais tempo
+        para caber nos orçamentos.
+        """
+        size = len(payload)
+        if not size:
+            return None
+        with self.__lock:
+            if self.__inodes.get(key[0][:2]) != key[0]:
+                # Versão do arquivo que já foi invalidada.
+                return None
+            if size <= self.max_memory and key not in self.__memory:
+                self.__memory[key] = bytes(payload)
+                self.__memory_bytes += size
+                self.__keys[key[0]].add(key)
+                while self.__memory_bytes > self.max_memory:
+                    old_key, old_payload = self.__memory.popitem(last=False)
+                    self.__memory_bytes -= len(old_payload)
+                    self.__forget(old_key)
+            write_to_disk = size <= self.max_disk and key not in self.__disk
+        if write_to_disk:
+            self.__put_on_disk(key, payload)
+
+    def __put_on_disk(self, key: Hashable, payload):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        path = os.path.join(self.chunk_directory, name + CHUNK_EXTENSION)
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(temp_path, mode='wb') as file:
+                file.write(payload)
+            os.replace(temp_path, path)
+        except OSError as exc:
+            logging.debug('Cache: não consegui gravar %s: %s', path, exc)
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            return None
+        stale_paths = []
+        with self.__lock:
+            if key in self.__disk:
+                return None
+            self.__disk[key] = (path, len(payload))
+            self.__disk_bytes += len(payload)
+            self.__keys[key[0]].add(key)
+            while self.__disk_bytes > self.max_disk:
+                old_key, (old_path, old_size) = self.__disk.popitem(last=False)
+                self.__disk_bytes -= old_size
+                stale_paths.append(old_path)
+                self.__forget(old_key)
+        self.__remove_files(stale_paths)
+
+    def record_access(self, identity: FileIdentity, codec_name: str, level: int) -> bool:
+        """
+        Conta um download comprimido do arquivo.
+        :return: True uma única vez por versão, codec e nível: quando o
+            arquivo acaba de ficar popular e cabe no cache
+        """
+        if not self.prewarm_accesses or identity[2] > self.capacity:
+            return False
+        access = (identity, codec_name, level)
+        with self.__lock:
+            self.__accesses[access] += 1
+            if self.__accesses[access] < self.prewarm_accesses or access in self.__prewarmed:
+                return False
+            self.__prewarmed.add(access)
+            return True
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'memory': self.__memory_bytes,
+                'disk': self.__disk_bytes,
+                'chunks': len(self.__memory.keys() | self.__disk.keys())
+            }
@@ -1,10 +1,31 @@
 import argparse
+import json
+import mmap
 import os
-from typing import List
+import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple
 import tqdm
-import gzip
 import sys
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from ccp.addressing import parse_address
+from ccp.merkle import MERKLE_BLOCK_SIZE, compare_remote_tree
+from ccp.partitioning import merge_ranges
+from ccp.utils import human2bytes
+
+
+# Tamanho de cada pedaço comparado por uma tarefa do pool.
+DEFAULT_CHUNK_SIZE = 16 * 2 ** 20
+
+# Sem NumPy, pedaços diferentes são varridos em blocos deste tamanho
+# antes da comparação byte a byte.
+SCAN_BLOCK_SIZE = 4096
+
 
 def get_compare_argparse():
     parser = argparse.ArgumentParser(
@@ -16,50 +37,266 @@ def get_compare_argparse():
         nargs=2,
         dest='files',
         type=str,
-        help='Dois arquivos para comparar'
+        help=(
+            'Dois arquivos para comparar (com --remote, o segundo é o '
+            'caminho no servidor)'
+        )
+    )
+
+    parser.add_argument(
+        '-r', '--remote',
+        dest='remote_address',
+        type=str,
+        default=None,
+        help=(
+            'Compara com um arquivo do servidor <IP>:<PORTA> por árvore de '
+            'Merkle, sem baixá-lo'
+        )
+    )
+
+    parser.add_argument(
+        '-b', '--block-size',
+        dest='block_size',
+        type=str,
+        default='1 M',
+        help='Tamanho dos blocos da árvore de Merkle (com --remote)'
+    )
+
+    parser.add_argument(
+        '-w', '--workers',
+        dest='workers',
+        type=int,
+        default=None,
+        help='Threads de comparação (padrão: quantidade de CPUs)'
+    )
+
+    parser.add_argument(
+        '-c', '--chunk-size',
+        dest='chunk_size',
+        type=str,
+        default='16 M',
+        help='Tamanho de cada pedaço comparado em paralelo (ex.: 16 M)'
+    )
+
+    parser.add_argument(
+        '-g', '--merge-gap',
+        dest='merge_gap',
+        type=int,
+        default=0,
+        help='Junta faixas diferentes separadas por até N bytes iguais'
+    )
+
+    parser.add_argument(
+        '-j', '--json',
+        dest='json_output',
+        action='store_true',
+        help='Imprime o relatório completo em JSON'
     )
 
     return parser
 
 
-import os
-def compare_files(source_file, target_file):
+def numpy_diff_ranges(source, target, offset, merge_gap=0):
+    """
+    Faixas diferentes entre dois arrays de bytes, sem laço em Python.
+    """
+    mismatch = np.concatenate(([False], source != target, [False]))
+    edges = np.flatnonzero(mismatch[1:] != mismatch[:-1])
+    starts, ends = edges[::2], edges[1::2]
+    if merge_gap and len(starts) > 1:
+        keep = starts[1:] - ends[:-1] > merge_gap
+        starts = np.concatenate((starts[:1], starts[1:][keep]))
+        ends = np.concatenate((ends[:-1][keep], ends[-1:]))
+    return [
+        (offset + int(start), int(end - start))
+        for start, end in zip(starts, ends)
+    ]
+
+
+def python_diff_ranges(source, target, offset, merge_gap=0):
+    """
+    Faixas diferentes entre dois buffers sem NumPy: blocos iguais são
+    pulados com uma comparação só; os diferentes, varridos byte a byte.
+    """
+    ranges = []
+    for block_start in range(0, len(source), SCAN_BLOCK_SIZE):
+        block_end = block_start + SCAN_BLOCK_SIZE
+        source_block = source[block_start:block_end]
+        target_block = target[block_start:block_end]
+        if source_block == target_block:
+            continue
+        for i, (s, t) in enumerate(zip(source_block, target_block)):
+            if s != t:
+                ranges.append((offset + block_start + i, 1))
+    return merge_ranges(ranges, merge_gap)
+
+
+def diff_chunk(
+        source_map: mmap.mmap,
+        target_map: mmap.mmap,
+        offset: int,
+        size: int,
+        merge_gap: int = 0
+) -> List[Tuple[int, int]]:
+    """
+    :param source_map: Arquivo-fonte mapeado em memória
+    :param target_map: Arquivo-destino mapeado em memória
+    :param offset: Byte inicial do pedaço
+    :param size: Tamanho do pedaço
+    :param merge_gap: Junta faixas separadas por até N bytes iguais
+    :return: Faixas (byte inicial, tamanho) diferentes no pedaço
+    """
+    if np is not None:
+        # Views sem cópia sobre os mapas; as comparações do NumPy soltam
+        # o GIL, então os pedaços andam em paralelo de verdade.
+        source = np.frombuffer(source_map, dtype=np.uint8, count=size, offset=offset)
+        target = np.frombuffer(target_map, dtype=np.uint8, count=size, offset=offset)
+        if np.array_equal(source, target):
+            return []
+        return numpy_diff_ranges(source, target, offset, merge_gap)
+
+    source = source_map[offset:offset + size]
+    target = target_map[offset:offset + size]
+    if source == target:
+        return []
+    return python_diff_ranges(source, target, offset, merge_gap)
+
+
+def find_differences(
+        source_file: str,
+        target_file: str,
+        workers: int = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        merge_gap: int = 0,
+        progress: bool = True
+) -> Dict:
+    """
+    Compara os dois arquivos inteiros: eles são mapeados em memória e
+    divididos em pedaços de <chunk_size> bytes, comparados em paralelo.
+    Bytes que só existem no arquivo maior contam como uma faixa diferente.
+    :param source_file: Caminho do primeiro arquivo
+    :param target_file: Caminho do segundo arquivo
+    :param workers: Threads de comparação (padrão: quantidade de CPUs)
+    :param chunk_size: Tamanho de cada pedaço
+    :param merge_gap: Junta faixas separadas por até N bytes iguais
+    :param progress: Mostra barra de progresso
+    :return: Relatório com tamanhos, 'equal' e 'differences', a lista de
+        faixas [byte inicial, tamanho] diferentes
+    """
     source_size = os.path.getsize(source_file)
     target_size = os.path.getsize(target_file)
+    common_size = min(source_size, target_size)
+
+    differences = []
+    if common_size:
+        with open(source_file, 'rb') as sf, open(target_file, 'rb') as tf:
+            source_map = mmap.mmap(sf.fileno(), 0, access=mmap.ACCESS_READ)
+            target_map = mmap.mmap(tf.fileno(), 0, access=mmap.ACCESS_READ)
+            for file_map in (source_map, target_map):
+                if hasattr(file_map, 'madvise'):
+                    file_map.madvise(mmap.MADV_SEQUENTIAL)
+
+            progress_bar = tqdm.tqdm(
+                total=common_size,
+                desc='Comparando os arquivos',
+                unit='B',
+                unit_scale=True,
+                disable=not progress
+            )
+            with progress_bar as p_bar:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = {
+                        executor.submit(
+                            diff_chunk,
+                            source_map,
+                            target_map,
+                            offset,
+                            min(chunk_size, common_size - offset),
+                            merge_gap
+                        ): min(chunk_size, common_size - offset)
+                        for offset in range(0, common_size, chunk_size)
+                    }
+                    for future in as_completed(futures):
+                        differences.extend(future.result())
+                        p_bar.update(futures[future])
+            source_map.close()
+            target_map.close()
+
     if source_size != target_size:
+        differences.append((common_size, abs(source_size - target_size)))
+    differences = merge_ranges(sorted(differences), merge_gap)
+
+    return {
+        'source': source_file,
+        'target': target_file,
+        'source_size': source_size,
+        'target_size': target_size,
+        'equal': not differences,
+        'differing_bytes': sum(length for _, length in differences),
+        'differences': [[start, length] for start, length in differences]
+    }
+
+
+def compare_remote(
+        server_address: str,
+        local_file: str,
+        remote_file: str,
+        block_size: int = MERKLE_BLOCK_SIZE
+) -> Dict:
+    """
+    Compara <local_file> com <remote_file> no servidor por árvore de
+    Merkle: só hashes dos nós diferentes passam pela rede.
+    :param server_address: <IP>:<PORTA> do servidor
+    :return: Relatório no formato de find_differences
+    """
+    hostname, port = parse_address(server_address)
+    with socket.create_connection((hostname, port)) as connection:
+        return compare_remote_tree(connection, local_file, remote_file, block_size)
+
+
+def print_report(report: Dict) -> bool:
+    """
+    Mostra o relatório de comparação.
+    :return: True se os arquivos são iguais
+    """
+    source_file, target_file = report['source'], report['target']
+    if report['source_size'] != report['target_size']:
         print(
             'Arquivos têm tamanhos diferentes:\n'
-            f' [{source_file}] --> {source_size}\n'
-            f' [{target_file}] --> {target_size}\n'
+            f' [{source_file}] --> {report["source_size"]}\n'
+            f' [{target_file}] --> {report["target_size"]}\n'
         )
-        return False
-
-    buffer_size = 1024
-    progress_bar = tqdm.tqdm(
-        total=target_size,
-        desc=f"Comparando os arquivos",
-        unit="B",
-        unit_scale=True,
-        # unit_divisor=buffer_size
-    )
 
-    with progress_bar as p_bar:
-        bytes_read = 0
-        with open(target_file, 'rb') as tf:
-            with open(source_file, 'rb') as sf:
-                while bytes_read < target_size:
-                    sbytes = sf.read(min(target_size - bytes_read, buffer_size))
-                    tbytes = tf.read(min(target_size - bytes_read, buffer_size))
-                    bytes_read += len(sbytes)
-                    # print(f'Li {len(sbytes)} bytes. Faltam {target_size - bytes_read}')
-                    if sbytes != tbytes:
-                        print(f'Diferença encontrada no byte {bytes_read}.')
-                        return False
-                    p_bar.update(n=len(sbytes))
-        p_bar.refresh()
-
-    print('Arquivos são iguais!')
-    return True
+    if report['equal']:
+        print('Arquivos são iguais!')
+        return True
+
+    differences = report['differences']
+    print(
+        f'{len(differences)} faixa(s) diferente(s), '
+        f'{report["differing_bytes"]} byte(s) no total.')
+    for start, length in differences[:10]:
+        print(f' - bytes [{start}, {start + length})')
+    if len(differences) > 10:
+        print(f' - ... mais {len(differences) - 10} faixa(s); use --json.')
+    return False
+
+
+def compare_files(
+        source_file,
+        target_file,
+        workers=None,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        merge_gap=0
+):
+    report = find_differences(
+        source_file,
+        target_file,
+        workers=workers,
+        chunk_size=chunk_size,
+        merge_gap=merge_gap
+    )
+    return print_report(report)
 
 
 def run():
@@ -68,8 +305,37 @@ def run():
 
     first_file, second_file = parsed_args.files
 
-    compare_files(first_file, second_file)
+    try:
+        if parsed_args.remote_address is not None:
+            report = compare_remote(
+                parsed_args.remote_address,
+                first_file,
+                second_file,
+                block_size=human2bytes(parsed_args.block_size)
+            )
+        else:
+            report = find_differences(
+                first_file,
+                second_file,
+                workers=parsed_args.workers,
+                chunk_size=human2bytes(parsed_args.chunk_size),
+                merge_gap=parsed_args.merge_gap,
+                progress=not parsed_args.json_output
+            )
+    except (FileNotFoundError, ConnectionError) as exc:
+        # Código 2, como o cmp: 1 fica reservado para "arquivos diferentes".
+        print(f'Não foi possível comparar: {exc}', file=sys.stderr)
+        sys.exit(2)
+
+    if parsed_args.json_output:
+        json.dump(report, sys.stdout)
+        print()
+        equal = report['equal']
+    else:
+        equal = print_report(report)
+
+    sys.exit(0 if equal else 1)
 
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    run()
@@ -1,14 +1,21 @@
 import argparse
-import gzip
 import os
 import sys
-from typing import List
+from typing import List, Optional
 
 import tqdm
 
+from ccp.compression import available_codecs, detect_codec, get_codec
 from ccp.utils import bytes2human
 
 
+# Identifica o codec de cada partição pelo magic number.
+AUTO_CODEC = 'auto'
+
+# Quantidade de bytes lida das partições por vez.
+READ_SIZE = 2 ** 20
+
+
 def get_finish_argparse():
     parser = argparse.ArgumentParser(
         prog='CCP Finish',
@@ -36,14 +43,50 @@ def get_finish_argparse():
         action='store_true',
     )
 
+    parser.add_argument(
+        '-C', '--codec',
+        dest='codec',
+        choices=[AUTO_CODEC, 'raw'] + available_codecs(),
+        default=AUTO_CODEC,
+        help='Codec das partições (padrão: identificado pelo conteúdo)'
+    )
+
     return parser
 
 
+def iter_file_blocks(partial_file, read_size=READ_SIZE):
+    while True:
+        read_bytes = partial_file.read(read_size)
+        if not read_bytes:
+            break
+        yield read_bytes
+
+
+def partition_sort_key(path: str):
+    """
+    Ordena partições pelo número em ".part<N>", e não pela string
+    (".part10" vem depois de ".part2").
+    """
+    root, extension = os.path.splitext(path)
+    if extension.startswith('.part') and extension[5:].isdigit():
+        return root, int(extension[5:])
+    return path, -1
+
+
 def join_downloaded_files(
         source_paths: List[str],
         target_path: str,
-        keep: bool
+        keep: bool,
+        codec: Optional[str] = AUTO_CODEC
 ):
+    """
+    Une as partições baixadas em um só arquivo, descomprimindo-as.
+    :param source_paths: Partições baixadas
+    :param target_path: Arquivo-destino
+    :param keep: Mantém as partições após a união
+    :param codec: Codec das partições; None se não foram comprimidas,
+        ou AUTO_CODEC para identificar pelo magic number de cada uma.
+    """
     total_downloaded_bytes = sum(
         os.path.getsize(path) for path in source_paths
     )
@@ -57,22 +100,31 @@ def join_downloaded_files(
     )
     with progress_bar as p_bar:
         with open(target_path, 'wb') as complete_file:
-            for path in sorted(source_paths):
+            for path in sorted(source_paths, key=partition_sort_key):
                 with open(path, 'rb') as partial_file:
-                    read_bytes = partial_file.read()
-                    print(f'Read {len(read_bytes)}')
-                    try:
-                        decompressed_bytes = gzip.decompress(read_bytes)
-                        print(
-                            f'Decompressed {bytes2human(len(read_bytes))} -> {bytes2human(len(decompressed_bytes))} to {target_path}')
-                        complete_file.write(decompressed_bytes)
-                        print(
-                            f'Wrote (decompressed) {bytes2human(len(decompressed_bytes))} to {target_path}')
-                    except gzip.BadGzipFile:
-                        complete_file.write(read_bytes)
-                        print(f'Wrote {bytes2human(len(read_bytes))} to {target_path}')
-                    finally:
-                        p_bar.update(len(read_bytes))
+                    if codec == AUTO_CODEC:
+                        partition_codec = detect_codec(partial_file.peek(8))
+                    elif codec is not None:
+                        partition_codec = get_codec(codec)
+                    else:
+                        partition_codec = None
+
+                    def counted_blocks():
+                        for read_bytes in iter_file_blocks(partial_file):
+                            p_bar.update(len(read_bytes))
+                            yield read_bytes
+
+                    if partition_codec is None:
+                        blocks = counted_blocks()
+                    else:
+                        blocks = partition_codec.iter_decompress(counted_blocks())
+
+                    bytes_written = 0
+                    for block in blocks:
+                        bytes_written += complete_file.write(block)
+                    print(
+                        f'Wrote {bytes2human(bytes_written)} from {path} to {target_path}'
+                        f' ({partition_codec.name if partition_codec else "raw"})')
         p_bar.refresh()
 
     if not keep:
@@ -91,8 +143,9 @@ def run():
     source_files = parsed_args.source_files
     target_file = parsed_args.target_file
     keep = parsed_args.keep
+    codec = None if parsed_args.codec == 'raw' else parsed_args.codec
 
-    join_downloaded_files(source_files, target_file, keep=keep)
+    join_downloaded_files(source_files, target_file, keep=keep, codec=codec)
 
 
 if __name__ == '__main__':
@@ -5,7 +5,6 @@ from __future__ import print_function
 import argparse
 import logging
 import os
-import pickle
 
 import sys
 import select
@@ -16,6 +15,8 @@ import udt4py
 
 from config import COMMANDS_SHUTDOWN_DENY, COMMANDS_SHUTDOWN_CONFIRM
 from ccp.misc import buscar_endereco_lan, buscar_enderecos_globais
+from ccp.messaging import MessageType, encode_message, read_message
+from ccp.upload import resolve_upload_path, upload_temp_path
 
 # import daemon
 
@@ -42,9 +43,15 @@ class FileServer:
 
     __thread_info_lock = threading.Lock()
 
-    def __init__(self, _port):
+    def __init__(self, _port, upload_root=None):
+        """
+        :param _port: Porta do servidor
+        :param upload_root: Único diretório que recebe arquivos (modo 'U');
+            sem ele, todo envio é recusado
+        """
         self.__host = '127.0.0.1'
         self.__port = _port
+        self.__upload_root = upload_root
 
         # # Abre uma conexão TCP
         # self.__main_socket = socket.socket(
@@ -151,8 +158,7 @@ class FileServer:
 
         logger.debug('Responder conexão no endereço: %s', address)
         try:
-            user_message_bytes = user_connection.recv(1024)
-            user_message = pickle.loads(user_message_bytes)
+            _, user_message = read_message(user_connection.recv)
             try:
                 if user_message['mode'] == 'U':
                     self.__run_recv_file_interaction(user_connection, user_message)
@@ -178,6 +184,75 @@ class FileServer:
 
     def __run_recv_file_interaction(self, connection, message):
         path = message['path']
+        file_size = message.get('size')
+
+        logger.debug('Preparando para receber arquivo: %s', path)
+
+        # Só dentro do diretório de uploads, e só se o servidor tem um.
+        abs_path = None
+        try:
+            abs_path = resolve_upload_path(self.__upload_root, path)
+        except (OSError, ValueError) as exc:
+            logger.debug('Envio para %s recusado: %s', path, exc)
+
+        if (abs_path is None or file_size is None or os.path.isdir(abs_path)
+                or not os.path.isdir(os.path.dirname(abs_path))):
+            # Send 'Invalid target' message
+            response_text = '-1'
+            response_status = 0
+            logger.debug('Não posso receber o arquivo %s', path)
+        else:
+            response_text = str(file_size)
+            response_status = 1
+            logger.debug('Vou receber o arquivo %s, que tem tamanho %d bytes', path, file_size)
+
+        udt_socket = None
+        free_port = None
+
+        if response_status == 1:
+            logger.info('Vou tentar criar socket UDT.')
+            udt_socket = udt4py.UDTSocket()
+            try:
+                free_port = self.__bind_and_listen_on_free_port(
+                    udt_socket,
+                    min_port=self.__port
+                )
+            except IOError as exc:
+                udt_socket = None
+                response_text = f'UDT ERROR {exc}'
+                response_status = 0
+            else:
+                with self.__thread_info_lock:
+                    self.__open_threads[connection].udt_socket = udt_socket
+
+                logger.info('UDT socket está ouvindo porta %d', free_port)
+
+        response_msg = {
+            'text': response_text,
+            'status': response_status,
+            'port': free_port
+        }
+        logger.info('Mensagem para cliente: %s', response_msg)
+        response_msg_bytes = encode_message(MessageType.TRANSFER_RESPONSE, response_msg)
+        connection.send(response_msg_bytes)
+
+        if udt_socket:
+            logger.info("Agora que enviei mensagem ao cliente, eu espero a conexão UDT...")
+            user_connection, addr = udt_socket.accept()
+            with self.__thread_info_lock:
+                self.__open_threads[connection].udt_connection = user_connection
+
+            # O arquivo chega num temporário ao lado do destino e só
+            # substitui o antigo depois de completo.
+            temp_path = upload_temp_path(abs_path)
+            logger.info("Vou receber arquivo %s de %d bytes", abs_path, file_size)
+            try:
+                user_connection.recvfile(temp_path, offset=0, size=file_size)
+                os.replace(temp_path, abs_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            logger.info("Terminei de receber o arquivo %s de %d bytes", abs_path, file_size)
 
     def __run_error_file_interaction(self, connection, message):
         path = message['path']
@@ -224,7 +299,7 @@ class FileServer:
             'port': free_port
         }
         logger.info('Mensagem para cliente: %s', response_msg)
-        response_msg_bytes = pickle.dumps(response_msg)
+        response_msg_bytes = encode_message(MessageType.TRANSFER_RESPONSE, response_msg)
         connection.send(response_msg_bytes)
 
         if udt_socket:
@@ -282,7 +357,7 @@ class FileServer:
             'port': free_port
         }
         logger.info('Mensagem para cliente: %s', response_msg)
-        response_msg_bytes = pickle.dumps(response_msg)
+        response_msg_bytes = encode_message(MessageType.TRANSFER_RESPONSE, response_msg)
         connection.send(response_msg_bytes)
 
         if udt_socket:
@@ -595,6 +670,10 @@ def run():
     parsed_args = ccpd_argparser.parse_args(sys.argv[1:])
 
     port = parsed_args.port
+    upload_root = parsed_args.upload_root
+    if upload_root is not None and not os.path.isdir(upload_root):
+        print(f'Diretório de uploads {upload_root} não existe.')
+        sys.exit(1)
 
     debug_mode = parsed_args.debug_mode
     if debug_mode:
@@ -608,7 +687,7 @@ def run():
     )
 
     try:
-        file_server = FileServer(port)
+        file_server = FileServer(port, upload_root=upload_root)
     except OverflowError:
         print('Porta {} inválida. Ela deve pertencer a [0, 65535].'.format(port))
         sys.exit(1)
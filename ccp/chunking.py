@@ -0,0 +1,445 @@
+import bisect
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import socket
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from ccp.messaging import MAX_MESSAGE_SIZE, MessageType, recv_message, send_message
+
+
+# Limites e tamanho médio dos pedaços definidos pelo conteúdo.
+CDC_MIN_SIZE = 16 * 2 ** 10
+CDC_AVG_SIZE = 64 * 2 ** 10
+CDC_MAX_SIZE = 256 * 2 ** 10
+
+# Bits a mais (antes do tamanho médio) e a menos (depois dele) nas máscaras
+# do corte normalizado do FastCDC: os tamanhos se concentram perto da média.
+NORMALIZATION_BITS = 2
+
+# O hash "gear" soma um valor aleatório por byte e desloca 1 bit por byte:
+# com 32 bits, ele depende só dos últimos 32 bytes (a janela).
+GEAR_BITS = 32
+GEAR_MASK = 2 ** GEAR_BITS - 1
+
+# Tamanho do hash de cada pedaço (BLAKE2b truncado), que também é o nome
+# dele no armazenamento do cliente.
+CHUNK_DIGEST_SIZE = 16
+
+# Tamanho de cada pedaço na lista mandada pelo servidor.
+CHUNK_SIZE_FORMAT = '!I'
+
+# Bytes do arquivo processados por vez na busca dos cortes (trechos
+# pequenos deixam os arrays intermediários no cache do processador).
+SCAN_SEGMENT_SIZE = 256 * 2 ** 10
+
+# Listas de pedaços guardadas pelo servidor.
+MAX_CACHED_INDEXES = 32
+
+# Maior lista de pedaços que cabe numa mensagem (a resposta tem pouco mais).
+MAX_INDEX_CHUNKS = MAX_MESSAGE_SIZE // (CHUNK_DIGEST_SIZE + struct.calcsize(CHUNK_SIZE_FORMAT)) - 1
+
+# Bytes de pedaços guardados pelo cliente.
+DEFAULT_CHUNK_STORE_SIZE = 4 * 2 ** 30
+
+# Extensão dos pedaços guardados pelo cliente.
+STORE_EXTENSION = '.ccp-chunk'
+
+
+def _gear_table() -> List[int]:
+    # Valores fixos (derivados do próprio byte) para que servidores
+    # diferentes cortem os mesmos arquivos nos mesmos lugares.
+    return [
+        int.from_bytes(hashlib.blake2b(bytes([byte]), digest_size=4).digest(), 'big')
+        for byte in range(256)
+    ]
+
+
+GEAR = _gear_table()
+GEAR_ARRAY = np.array(GEAR, dtype=np.uint32) if np is not None else None
+
+
+def chunk_digest(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=CHUNK_DIGEST_SIZE).digest()
+
+
+def cut_threshold(bits: int) -> int:
+    """
+    Um corte acontece quando os <bits> bits de cima do hash são zero, ou
+    seja, quando o hash é menor que este limite (probabilidade 2^-bits).
+    """
+    return 1 << (GEAR_BITS - bits)
+
+
+def gear_candidates(
+        data,
+        skip: int,
+        strict_bits: int,
+        loose_bits: int
+) -> Tuple[List[int], List[int]]:
+    """
+    Posições de <data> (a partir de <skip>) em que o hash gear da janela
+    que termina nelas permite um corte, com a máscara estrita e com a
+    frouxa. Os <skip> primeiros bytes só servem de contexto da janela.
+    Com NumPy, o hash de todas as posições sai de uma vez:
+        h(i) = soma, para k < 32, de gear[x(i - k)] << k   (mod 2^32)
+    montado por duplicação, h_2m(i) = h_m(i) + (h_m(i - m) << m), em 5
+    passadas em vez de 32.
+    :return: (posições do corte estrito, posições do corte frouxo)
+    """
+    strict_threshold = cut_threshold(strict_bits)
+    loose_threshold = cut_threshold(loose_bits)
+    if np is None:
+        strict, loose = [], []
+        h = 0
+        for position, byte in enumerate(data):
+            h = ((h << 1) + GEAR[byte]) & GEAR_MASK
+            if position >= skip and h < loose_threshold:
+                loose.append(position)
+                if h < strict_threshold:
+                    strict.append(position)
+        return strict, loose
+
+    h = GEAR_ARRAY[np.frombuffer(data, dtype=np.uint8)]
+    shifted = np.empty_like(h)
+    shift = 1
+    while shift < GEAR_BITS:
+        np.left_shift(h[:-shift], np.uint32(shift), out=shifted[:-shift])
+        h[shift:] += shifted[:-shift]
+        shift *= 2
+    h = h[skip:]
+    loose = np.flatnonzero(h < loose_threshold)
+    strict = loose[h[loose] < strict_threshold]
+    return (strict + skip).tolist(), (loose + skip).tolist()
+
+
+def find_cut_points(
+        path: str,
+        min_size: int = CDC_MIN_SIZE,
+        avg_size: int = CDC_AVG_SIZE,
+        max_size: int = CDC_MAX_SIZE,
+        workers: Optional[int] = None
+) -> List[int]:
+    """
+    Divide o arquivo em pedaços definidos pelo conteúdo (estilo FastCDC):
+    depois de <min_size> bytes, corta onde o hash gear da janela bater
+    com a máscara estrita até <avg_size>, com a frouxa até <max_size>, e
+    em <max_size> se nenhuma bater. Como o corte só depende dos bytes
+    perto dele, inserir ou remover dados muda só os pedaços vizinhos.
+    Os trechos do arquivo são varridos em paralelo (NumPy solta o GIL).
+    :return: Byte final de cada pedaço, em ordem
+    """
+    size = os.path.getsize(path)
+    bits = avg_size.bit_length() - 1
+    strict_bits = bits + NORMALIZATION_BITS
+    loose_bits = bits - NORMALIZATION_BITS
+    context = GEAR_BITS - 1
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        def scan_segment(start):
+            skip = min(context, start)
+            data = os.pread(fd, SCAN_SEGMENT_SIZE + skip, start - skip)
+            strict, loose = gear_candidates(data, skip, strict_bits, loose_bits)
+            base = start - skip
+            return [base + p for p in strict], [base + p for p in loose]
+
+        strict, loose = [], []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for segment_strict, segment_loose in executor.map(
+                    scan_segment, range(0, size, SCAN_SEGMENT_SIZE)):
+                strict.extend(segment_strict)
+                loose.extend(segment_loose)
+    finally:
+        os.close(fd)
+
+    # Um candidato na posição p corta depois do byte p.
+    cut_points = []
+    start = 0
+    while start < size:
+        end = min(start + max_size, size)
+        if size - start > min_size:
+            i = bisect.bisect_left(strict, start + min_size - 1)
+            j = bisect.bisect_left(loose, start + avg_size - 1)
+            if i < len(strict) and strict[i] < start + avg_size - 1:
+                end = strict[i] + 1
+            elif j < len(loose) and loose[j] < end - 1:
+                end = loose[j] + 1
+        cut_points.append(end)
+        start = end
+    return cut_points
+
+
+class ChunkIndex:
+    """
+    Lista dos pedaços definidos pelo conteúdo de um arquivo: tamanho e
+    hash de cada um, em ordem.
+    """
+
+    def __init__(self, size: int, sizes: List[int], digests: bytes):
+        self.size = size
+        self.sizes = sizes
+        self.digests = digests
+
+    @classmethod
+    def build(cls, path: str, workers: Optional[int] = None) -> 'ChunkIndex':
+        """
+        Acha os cortes e hasheia os pedaços em paralelo (hashlib solta o GIL).
+        """
+        cut_points = find_cut_points(path, workers=workers)
+        starts = [0] + cut_points[:-1]
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            def hash_chunk(bounds):
+                start, end = bounds
+                return chunk_digest(os.pread(fd, end - start, start))
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                digests = b''.join(executor.map(hash_chunk, zip(starts, cut_points)))
+        finally:
+            os.close(fd)
+        sizes = [end - start for start, end in zip(starts, cut_points)]
+        return cls(cut_points[-1] if cut_points else 0, sizes, digests)
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def chunks(self) -> Iterator[Tuple[int, int, bytes]]:
+        """
+        :return: Iterador de (byte inicial, tamanho, hash)
+        """
+        offset = 0
+        for i, size in enumerate(self.sizes):
+            yield offset, size, self.digests[i * CHUNK_DIGEST_SIZE:(i + 1) * CHUNK_DIGEST_SIZE]
+            offset += size
+
+    def to_message(self) -> Dict:
+        return {
+            'size': self.size,
+            'sizes': struct.pack(f'!{len(self.sizes)}I', *self.sizes),
+            'digests': self.digests
+        }
+
+    @classmethod
+    def from_message(cls, message: Dict) -> 'ChunkIndex':
+        """
+        :raise ValueError: Lista que não descreve o arquivo inteiro
+        """
+        count, remainder = divmod(len(message['sizes']), struct.calcsize(CHUNK_SIZE_FORMAT))
+        if remainder:
+            raise ValueError('Lista de pedaços com tamanho truncado.')
+        sizes = list(struct.unpack(f'!{count}I', message['sizes']))
+        if len(message['digests']) != len(sizes) * CHUNK_DIGEST_SIZE:
+            raise ValueError('Lista de pedaços com hashes faltando.')
+        if 0 in sizes:
+            raise ValueError('Lista de pedaços com pedaço vazio.')
+        if sum(sizes) != message['size']:
+            raise ValueError('Pedaços não cobrem o arquivo inteiro.')
+        return cls(message['size'], sizes, message['digests'])
+
+
+class ChunkIndexCache:
+    """
+    Listas de pedaços recentes do servidor, por (caminho, tamanho, mtime):
+    pedir de novo a lista de um arquivo que não mudou não relê o arquivo.
+    """
+
+    def __init__(self, max_indexes: int = MAX_CACHED_INDEXES):
+        self.max_indexes = max_indexes
+        self.__indexes = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, path: str) -> ChunkIndex:
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        with self.__lock:
+            index = self.__indexes.get(key)
+            if index is not None:
+                self.__indexes.move_to_end(key)
+                return index
+
+        index = ChunkIndex.build(path)
+        with self.__lock:
+            self.__indexes[key] = index
+            while len(self.__indexes) > self.max_indexes:
+                self.__indexes.popitem(last=False)
+        return index
+
+
+class ChunkStore:
+    """
+    Armazenamento local de pedaços do cliente, endereçado pelo hash: o
+    pedaço h fica em <directory>/h[:2]/h.ccp-chunk. Serve qualquer
+    download, de qualquer arquivo, que tenha um pedaço com o mesmo hash.
+
+    O orçamento em bytes é mantido descartando o pedaço usado há mais
+    tempo (LRU); o uso é o mtime do arquivo, então a ordem sobrevive entre
+    execuções. Pedaços corrompidos no disco são descartados ao serem lidos.
+    """
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_CHUNK_STORE_SIZE):
+        """
+        :param directory: Diretório do armazenamento (criado se não existir)
+        :param max_size: Bytes de pedaços guardados
+        """
+        if max_size < 0:
+            raise ValueError('Tamanho do armazenamento não pode ser negativo.')
+        self.directory = directory
+        self.max_size = max_size
+        self.__entries: Dict[str, int] = collections.OrderedDict()
+        self.__bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for dir_path, _, file_names in os.walk(directory):
+            for name in file_names:
+                if not name.endswith(STORE_EXTENSION):
+                    continue
+                with contextlib.suppress(OSError):
+                    info = os.stat(os.path.join(dir_path, name))
+                    found.append((info.st_mtime_ns, name[:-len(STORE_EXTENSION)], info.st_size))
+        for _, name, size in sorted(found):
+            self.__entries[name] = size
+            self.__bytes += size
+        self.__evict()
+
+    @property
+    def size(self) -> int:
+        return self.__bytes
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __contains__(self, digest: bytes) -> bool:
+        return digest.hex() in self.__entries
+
+    def path(self, digest: bytes) -> str:
+        name = digest.hex()
+        return os.path.join(self.directory, name[:2], name + STORE_EXTENSION)
+
+    def get(self, digest: bytes) -> Optional[bytes]:
+        """
+        :return: Conteúdo do pedaço, ou None se ele não está guardado
+        """
+        name = digest.hex()
+        if name not in self.__entries:
+            return None
+        path = self.path(digest)
+        try:
+            with open(path, mode='rb') as file:
+                data = file.read()
+            os.utime(path)
+        except OSError:
+            self.__discard(name)
+            return None
+        if chunk_digest(data) != digest:
+            logging.debug('Pedaço %s corrompido no armazenamento: descartado.', name)
+            self.__discard(name)
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            return None
+        self.__entries.move_to_end(name)
+        return data
+
+    def put(self, digest: bytes, data):
+        """
+        Guarda um pedaço (se ainda não estiver guardado), descartando os
+        usados há mais tempo para caber no orçamento.
+        """
+        name = digest.hex()
+        if name in self.__entries:
+            self.__entries.move_to_end(name)
+            return None
+        if len(data) > self.max_size:
+            return None
+        path = self.path(digest)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, mode='wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except OSError as exc:
+            logging.debug('Não consegui guardar o pedaço %s: %s', name, exc)
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            return None
+        self.__entries[name] = len(data)
+        self.__bytes += len(data)
+        self.__evict()
+
+    def fill(self, target, index: ChunkIndex) -> List[Tuple[int, int]]:
+        """
+        Escreve em <target> (target.TargetFile) os pedaços de <index> que
+        estão guardados.
+        :return: Faixas (byte inicial, tamanho) escritas
+        """
+        filled = []
+        for offset, size, digest in index.chunks():
+            data = self.get(digest)
+            if data is not None and len(data) == size:
+                target.pwrite(data, offset)
+                filled.append((offset, size))
+        return filled
+
+    def add_file(self, path: str, index: ChunkIndex) -> Tuple[int, int]:
+        """
+        Guarda os pedaços do arquivo baixado <path> que ainda não estão
+        guardados; os que não batem com o hash de <index> ficam de fora.
+        :return: (pedaços guardados, pedaços que não bateram)
+        """
+        stored = mismatched = 0
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            for offset, size, digest in index.chunks():
+                if digest in self:
+                    continue
+                data = os.pread(fd, size, offset)
+                if chunk_digest(data) != digest:
+                    mismatched += 1
+                    continue
+                self.put(digest, data)
+                stored += 1
+        finally:
+            os.close(fd)
+        return stored, mismatched
+
+    def __discard(self, name: str):
+        size = self.__entries.pop(name, None)
+        if size is not None:
+            self.__bytes -= size
+
+    def __evict(self):
+        while self.__bytes > self.max_size:
+            name, size = self.__entries.popitem(last=False)
+            self.__bytes -= size
+            with contextlib.suppress(OSError):
+                os.remove(self.path(bytes.fromhex(name)))
+
+
+def request_chunk_index(
+        connection: socket.socket,
+        remote_path: str
+) -> Tuple[Optional[Dict], Optional[ChunkIndex]]:
+    """
+    Pede ao servidor a lista de pedaços de <remote_path>.
+    :param connection: Conexão de controle (só para este pedido)
+    :param remote_path: Caminho do arquivo remoto
+    :return: (identidade do arquivo, lista de pedaços), ou (None, None) se
+        o arquivo não existe ou a lista não cabe numa mensagem
+    """
+    send_message(connection, MessageType.CHUNKS_REQUEST, {'path': remote_path})
+    _, response = recv_message(connection, expected_type=MessageType.CHUNKS_RESPONSE)
+    if response['sizes'] is None:
+        return None, None
+    return response['identity'], ChunkIndex.from_message(response)
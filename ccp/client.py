@@ -2,11 +2,13 @@ import argparse
 import logging
 import os
 import pathlib
-import pickle
 import socket
+import stat
 import sys
 import time
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional, Tuple
 
 import tqdm
 
@@ -20,70 +22,889 @@ from ccp.addressing import (
 )
 
 from ccp.messaging import (
+    CHUNKED_PARTITION_SIZE,
+    SCHEDULED_PARTITION_SIZE,
+    STREAMED_PARTITION_SIZE,
+    MessageType,
     send_message,
-    recv_message
+    recv_message,
+    recv_chunk_header,
+    recv_exactly,
+    recv_frame_to_file,
+    recv_partition_header,
+    raw_writer
 )
 
-from ccp.utils import bytes2human
-from ccp.argparsers import get_client_parser
+from ccp.buffers import RECV_BUFFER_SIZE, RECV_POOL, recv_into_exactly, recv_to_file
+from ccp.utils import bytes2human, human2bytes
+from ccp.argparsers import ASYNCIO_ENGINE, THREADED_ENGINE, get_client_parser
+from ccp.async_client import DISK_WRITE_WORKERS, download_streams
 from ccp.ccp_finish import join_downloaded_files
+from ccp.chunking import DEFAULT_CHUNK_STORE_SIZE, ChunkStore, request_chunk_index
+from ccp.compression import ParallelCompressor, available_codecs, get_codec
+from ccp.delta import (
+    DELTA_EXTENSION,
+    MAX_DELTA_BLOCKS,
+    apply_delta,
+    choose_block_size,
+    compute_signatures
+)
+from ccp.integrity import BackgroundFileHash, available_checksums, get_checksum, sha256_file
+from ccp.manifest import RangeManifest
+from ccp.packing import TreeWriter, decode_entries, is_symlink, recv_batch, segments_size
+from ccp.partitioning import get_partition_ranges
+from ccp.pipeline import PipelinedClient
+from ccp.scheduling import DYNAMIC_SCHEDULE, STATIC_SCHEDULE
+from ccp.target import DecodingWriter, TargetFile, save_inline
+from ccp.upload import STDIN_PATH, StdinReader, send_stdin_blocks, send_upload_range
+
+
+# Quantas vezes o cliente pede de novo as faixas de pedaços corrompidos.
+MAX_REFETCH_ATTEMPTS = 3
+
+# Quantas vezes o cliente tenta de novo quando o servidor está cheio.
+MAX_BUSY_ATTEMPTS = 5
+
+
+def recv_verified_chunks(
+        connection: socket.socket,
+        writer,
+        checksum: Callable[[bytes], int],
+        on_progress: Optional[Callable[[int], object]] = None
+) -> Tuple[int, int]:
+    """
+    Recebe pedaços com checksum até o pedaço vazio. Pedaços corrompidos
+    não são escritos: o escritor pula a faixa deles, que continua
+    faltando no manifesto e é pedida de novo depois.
+    :param connection: Conexão TCP
+    :param writer: Escritor com write() e skip() (RangeWriter, DecodingWriter)
+    :param checksum: Função de checksum negociada
+    :param on_progress: Chamada com a quantidade de bytes de cada pedaço
+    :return: (bytes recebidos, pedaços corrompidos)
+    """
+    total_bytes_received = 0
+    corrupt_chunks = 0
+    while True:
+        offset, size, payload_size, chunk_checksum, raw = recv_chunk_header(connection)
+        if not size and not payload_size:
+            break
+        payload = recv_exactly(connection, payload_size)
+        if checksum(payload) == chunk_checksum:
+            (raw_writer(writer) if raw else writer).write(payload)
+        else:
+            logging.debug(
+                'Pedaço [%d, %d) corrompido.', offset, offset + size)
+            writer.skip(size)
+            corrupt_chunks += 1
+        total_bytes_received += payload_size
+        if on_progress is not None:
+            on_progress(payload_size)
+    return total_bytes_received, corrupt_chunks
+
+
+def recv_scheduled_chunks(
+        connection: socket.socket,
+        writer,
+        checksum: Optional[Callable[[bytes], int]] = None,
+        on_progress: Optional[Callable[[int], object]] = None
+) -> Tuple[int, int]:
+    """
+    Recebe pedaços de qualquer parte do arquivo até o pedaço vazio e os
+    escreve no seu byte inicial. Com checksum, pedaços corrompidos são
+    descartados e continuam faltando no manifesto.
+    :param connection: Conexão TCP
+    :param writer: ChunkWriter do arquivo-destino
+    :param checksum: Função de checksum negociada, ou None
+    :param on_progress: Chamada com a quantidade de bytes de cada pedaço
+    :return: (bytes recebidos, pedaços corrompidos)
+    """
+    total_bytes_received = 0
+    corrupt_chunks = 0
+    with RECV_POOL.buffer() as buffer:
+        view = memoryview(buffer)
+        while True:
+            offset, size, payload_size, chunk_checksum, raw = recv_chunk_header(connection)
+            if not size and not payload_size:
+                break
+            if payload_size <= len(buffer):
+                payload = view[:payload_size]
+                recv_into_exactly(connection, payload)
+            else:
+                payload = recv_exactly(connection, payload_size)
+            if checksum is None or checksum(payload) == chunk_checksum:
+                writer.write_chunk(offset, size, payload, raw)
+            else:
+                logging.debug('Pedaço [%d, %d) corrompido.', offset, offset + size)
+                corrupt_chunks += 1
+            total_bytes_received += payload_size
+            if on_progress is not None:
+                on_progress(payload_size)
+        view.release()
+    return total_bytes_received, corrupt_chunks
 
 
 def start_download(
         hostname: str,
         port: int,
         partial_path: str,
-        target_path: pathlib.Path
-):
+        target_path: pathlib.Path,
+        writer=None,
+        checksum: Optional[Callable[[bytes], int]] = None,
+        token: Optional[str] = None,
+        stream_id: int = 0
+) -> int:
     """
     Inicia o download de parte do arquivo até receber byte de término.
     :param hostname: IP do servidor
-    :param port: Porta de envio do servidor
-    :param part_id: ID of partition
+    :param port: Porta do servidor
+    :param partial_path: Caminho do arquivo parcial
     :param target_path: Caminho absoluto do arquivo-destino
+    :param writer: Se dado, recebe os bytes no lugar do arquivo parcial
+        (ex.: faixa do arquivo-destino pré-alocado)
+    :param checksum: Função de checksum dos pedaços verificados
+    :param token: Token da sessão dado pelo servidor no DOWNLOAD_RESPONSE
+    :param stream_id: Stream da sessão recebida por esta conexão
+    :return: Quantidade de pedaços corrompidos (descartados)
     """
 
 
     # print(f'{port}: Iniciando download de {target_path} para o arquivo parcial {partial_path}')
 
-    download_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    download_socket.connect((hostname, port))
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as download_socket:
+        download_socket.connect((hostname, port))
+        # A conexão de dados chega pela porta principal: o token e o id
+        # dizem ao servidor qual stream de qual pedido ela recebe.
+        send_message(download_socket, MessageType.STREAM_ATTACH, {
+            'token': token,
+            'stream': stream_id
+        })
+
+        file_length = recv_partition_header(download_socket)
+        # print(f'{port}: Recebi tamanho do download: ', file_length)
+
+        progress_bar = tqdm.tqdm(
+            total=file_length if file_length >= 0 else None,
+            desc=f"Baixando {partial_path}.",
+            unit="B",
+            unit_scale=True,
+            unit_divisor=RECV_BUFFER_SIZE
+        )
+        total_data_written = 0
+        corrupt_chunks = 0
+
+        start = time.perf_counter()
+        with progress_bar as p_bar:
+            if writer is None:
+                writer = open(partial_path, 'wb')
+            with writer as partial_file:
+                if file_length == SCHEDULED_PARTITION_SIZE:
+                    total_data_written, corrupt_chunks = recv_scheduled_chunks(
+                        download_socket,
+                        partial_file,
+                        checksum,
+                        on_progress=p_bar.update
+                    )
+                elif file_length == CHUNKED_PARTITION_SIZE:
+                    total_data_written, corrupt_chunks = recv_verified_chunks(
+                        download_socket,
+                        partial_file,
+                        checksum,
+                        on_progress=p_bar.update
+                    )
+                elif file_length == STREAMED_PARTITION_SIZE:
+                    # Partição comprimida durante o envio: chega em quadros
+                    # até o quadro vazio.
+                    while True:
+                        frame_size = recv_frame_to_file(
+                            download_socket,
+                            partial_file,
+                            on_progress=p_bar.update
+                        )
+                        if not frame_size:
+                            break
+                        total_data_written += frame_size
+                else:
+                    total_data_written = recv_to_file(
+                        download_socket,
+                        partial_file,
+                        file_length,
+                        on_progress=p_bar.update
+                    )
+            p_bar.refresh()
+
+    end = time.perf_counter()
+    print(
+        f'Fim do download de {partial_path}.\n'
+        f'Tamanho: {bytes2human(total_data_written)}.'
+        f'Tempo: {(end - start):.5f} s'
+    )
+    if corrupt_chunks:
+        print(f'{partial_path}: {corrupt_chunks} pedaço(s) corrompido(s) descartado(s).')
+    return corrupt_chunks
+
+
+def download_threads(
+        hostname: str,
+        port: int,
+        token: str,
+        partial_paths: List[str],
+        target_path: pathlib.Path,
+        writers: list,
+        checksum: Optional[Callable[[bytes], int]] = None
+) -> Tuple[List[int], List[float], List[Exception]]:
+    """
+    Baixa as streams da sessão <token> com uma thread por stream.
+    :return: (pedaços corrompidos, tempo em que cada stream terminou,
+        erros das streams que falharam)
+    """
+    errors = []
+    corrupt_chunks = []
+    finish_times = []
+    transfer_start = time.perf_counter()
+
+    def download_partition(*args):
+        try:
+            corrupt_chunks.append(start_download(*args))
+        except Exception as exc:
+            errors.append(exc)
+            raise
+        finally:
+            finish_times.append(time.perf_counter() - transfer_start)
+
+    threads = [
+        threading.Thread(
+            target=download_partition,
+            args=(
+                hostname,
+                port,
+                partial_path,
+                target_path,
+                writer,
+                checksum,
+                token,
+                stream_id
+            )
+        )
+        for stream_id, (partial_path, writer) in enumerate(zip(partial_paths, writers))
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+    return corrupt_chunks, finish_times, errors
+
+
+def download_tree_stream(
+        hostname: str,
+        port: int,
+        token: str,
+        stream_id: int,
+        tree_writer: TreeWriter,
+        disk_executor: ThreadPoolExecutor,
+        on_progress: Callable[[int], object]
+) -> int:
+    """
+    Recebe os lotes de uma stream de diretório. Cada lote é escrito pelas
+    threads de disco enquanto o próximo é recebido.
+    :return: Quantidade de lotes recebidos
+    """
+    received_batches = 0
+    pending_write = None
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as download_socket:
+        download_socket.connect((hostname, port))
+        send_message(download_socket, MessageType.STREAM_ATTACH, {
+            'token': token,
+            'stream': stream_id
+        })
+        try:
+            while True:
+                batch = recv_batch(download_socket)
+                if batch is None:
+                    break
+                segments, payload = batch
+                if pending_write is not None:
+                    pending_write.result()
+                pending_write = disk_executor.submit(
+                    tree_writer.write_batch, segments, payload)
+                received_batches += 1
+                on_progress(segments_size(segments))
+        finally:
+            if pending_write is not None:
+                pending_write.result()
+    return received_batches
+
+
+def run_directory_client(
+        server_hostname: str,
+        server_port: int,
+        local_path: str,
+        remote_path: str,
+        streams: int,
+        compressed: bool,
+        codecs: Optional[List[str]] = None,
+        level: Optional[int] = None,
+        ask_confirmation=True,
+        busy_attempt: int = 0
+):
+    """
+    Baixa o diretório <remote_path> inteiro para <local_path> numa sessão
+    só: o servidor manda a listagem pela conexão de controle e junta o
+    conteúdo dos arquivos em lotes (arquivos pequenos num lote só,
+    grandes divididos entre lotes) que as streams pegam sob demanda.
+    :param server_hostname: IP do servidor
+    :param server_port: Porta do servidor
+    :param local_path: Diretório local (criado se não existir)
+    :param remote_path: Diretório remoto
+    :param streams: Conexões paralelas
+    :param compressed: Pede os lotes comprimidos
+    :param codecs: Codecs aceitos, em ordem de preferência (padrão: todos)
+    :param level: Nível de compressão pedido (padrão: o do codec)
+    :param ask_confirmation: Pede confirmação de download
+    :param busy_attempt: Quantas vezes o servidor já respondeu que estava
+        cheio
+    :return: Tempo (s) em que cada stream terminou
+    """
+    sock = open_control_connection(server_hostname, server_port)
+    if codecs is None:
+        codecs = available_codecs()
+    send_message(sock, MessageType.DIRECTORY_REQUEST, {
+        'path': remote_path,
+        'streams': streams,
+        'compressed': compressed,
+        'codecs': codecs,
+        'level': level
+    })
+    _, directory_response = recv_message(
+        sock, expected_type=MessageType.DIRECTORY_RESPONSE)
+
+    retry_after = directory_response['retry_after']
+    if directory_response['token'] is None and retry_after is not None:
+        sock.close()
+        if busy_attempt >= MAX_BUSY_ATTEMPTS:
+            print('Servidor continua cheio. Tente de novo mais tarde.')
+            sys.exit(1)
+        print(f'Servidor cheio. Tentando de novo em {retry_after:g} s...')
+        time.sleep(retry_after)
+        return run_directory_client(
+            server_hostname,
+            server_port,
+            local_path,
+            remote_path,
+            streams,
+            compressed,
+            codecs=codecs,
+            level=level,
+            ask_confirmation=ask_confirmation,
+            busy_attempt=busy_attempt + 1
+        )
+    if directory_response['token'] is None:
+        print(f'Diretório {remote_path} não foi encontrado pelo servidor.')
+        sys.exit(1)
+
+    entries = []
+    for _ in range(directory_response['listing_messages']):
+        _, listing = recv_message(sock, expected_type=MessageType.DIRECTORY_RESPONSE)
+        entries.extend(decode_entries(listing['entries']))
+
+    codec_name = directory_response['codec']
+    if ask_confirmation:
+        decision_str = (
+            'CONFIRMANDO O DOWNLOAD:\n'
+            f' - Diretório local (absoluto): "{get_abspath(local_path)}"\n'
+            f' - Diretório remoto: "{remote_path}"\n'
+            f' - Arquivos: {directory_response["files"]} '
+            f'({bytes2human(directory_response["size"])})\n'
+            f' - Compressão: {codec_name or "desativada"}\n'
+            'Tem certeza que quer continuar?'
+        )
+        if not confirm_decision(decision_str):
+            print('Tudo bem! Fechando conexão.')
+            sock.close()
+            sys.exit()
+
+    tree_writer = TreeWriter(
+        local_path,
+        entries,
+        codec=get_codec(codec_name) if codec_name is not None else None
+    )
+    tree_writer.prepare()
+
+    stream_count = directory_response['streams']
+    errors = []
+    received_batches = []
+    finish_times = []
+    transfer_start = time.perf_counter()
+    disk_executor = ThreadPoolExecutor(
+        max_workers=DISK_WRITE_WORKERS,
+        thread_name_prefix='ccp-disk'
+    )
+    progress_bar = tqdm.tqdm(
+        total=directory_response['size'],
+        desc=f'Baixando {local_path} ({stream_count} streams)',
+        unit='B',
+        unit_scale=True
+    )
+
+    def download_stream(stream_id):
+        try:
+            received_batches.append(download_tree_stream(
+                server_hostname,
+                server_port,
+                directory_response['token'],
+                stream_id,
+                tree_writer,
+                disk_executor,
+                progress_bar.update
+            ))
+        except Exception as exc:
+            logging.debug('Stream %d falhou: %s', stream_id, exc)
+            errors.append(exc)
+        finally:
+            finish_times.append(time.perf_counter() - transfer_start)
+
+    threads = [
+        threading.Thread(target=download_stream, args=(stream_id,))
+        for stream_id in range(stream_count)
+    ]
+    with progress_bar:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    disk_executor.shutdown(wait=True)
+    sock.close()
+
+    missing_batches = directory_response['batches'] - sum(received_batches)
+    if errors or missing_batches:
+        if errors:
+            print(f'Download falhou em {len(errors)} stream(s): {errors[0]}')
+        print(f'Download incompleto: faltam {missing_batches} lote(s).')
+        sys.exit(1)
 
-    file_length = recv_message(download_socket, nbytes=30)
-    # print(f'{port}: Recebi tamanho do download: ', file_length)
+    tree_writer.finish()
+    total_time = time.perf_counter() - transfer_start
+    links = sum(1 for entry in entries if is_symlink(entry))
+    print(
+        f'{directory_response["files"]} arquivo(s), '
+        f'{bytes2human(directory_response["size"])} em {total_time:.3f} s.')
+    if links:
+        print(f'{links - len(tree_writer.failed_links)} link(s) simbólico(s) recriado(s).')
+    if tree_writer.failed_links:
+        print(
+            f'{len(tree_writer.failed_links)} link(s) não puderam ser criados: '
+            f'{", ".join(tree_writer.failed_links[:10])}')
+    if directory_response['skipped']:
+        print(
+            f'{directory_response["skipped"]} entrada(s) ignorada(s) pelo servidor '
+            '(nem arquivo, nem diretório, nem link).')
+    print('Fim!')
+    return sorted(finish_times)
 
-    BUFFER_SIZE = 2 ** 20
 
+def run_upload_client(
+        server_hostname: str,
+        server_port: int,
+        local_path: str,
+        remote_path: str,
+        streams: int,
+        compressed: bool,
+        codecs: Optional[List[str]] = None,
+        level: Optional[int] = None,
+        adaptive: bool = False,
+        sha256: bool = False,
+        ask_confirmation=True,
+        busy_attempt: int = 0
+):
+    """
+    Envia <local_path> para <remote_path> no servidor. O arquivo é
+    dividido numa faixa por stream, e os blocos de todas as faixas são
+    lidos e comprimidos em paralelo enquanto as streams enviam; o servidor
+    escreve cada pedaço no seu byte de um arquivo pré-alocado e só o põe
+    no lugar do destino (renomeando) quando tudo chegou.
+    Com <local_path> igual a STDIN_PATH ('-'), envia a entrada padrão:
+    os blocos são lidos em sequência e distribuídos entre as streams, e o
+    tamanho só é informado ao servidor no fim.
+    :param server_hostname: IP do servidor
+    :param server_port: Porta do servidor
+    :param local_path: Arquivo local, ou '-' para a entrada padrão
+    :param remote_path: Caminho do arquivo no servidor
+    :param streams: Conexões paralelas
+    :param compressed: Envia os blocos comprimidos
+    :param codecs: Codecs aceitos, em ordem de preferência (padrão: todos)
+    :param level: Nível de compressão (padrão: o do codec)
+    :param adaptive: Compressão adaptativa (ver ParallelCompressor)
+    :param sha256: Servidor confere o SHA-256 do arquivo recebido
+    :param ask_confirmation: Pede confirmação de upload (nunca com a
+        entrada padrão, que não pode ser lida duas vezes)
+    :param busy_attempt: Quantas vezes o servidor já respondeu que estava
+        cheio
+    :return: Tempo (s) em que cada stream terminou
+    """
+    compressor = ParallelCompressor()
+    from_stdin = local_path == STDIN_PATH
+    size = mode = None
+    requested_streams = streams
+    if not from_stdin:
+        info = os.stat(local_path)
+        if not stat.S_ISREG(info.st_mode):
+            print(f'{local_path} não é um arquivo.')
+            sys.exit(1)
+        size = info.st_size
+        mode = stat.S_IMODE(info.st_mode)
+        # Uma stream por bloco, no máximo: nenhuma fica sem faixa.
+        requested_streams = min(streams, max(-(-size // compressor.block_size), 1))
+
+    sock = open_control_connection(server_hostname, server_port)
+    if codecs is None:
+        codecs = available_codecs()
+    send_message(sock, MessageType.UPLOAD_REQUEST, {
+        'path': remote_path,
+        'size': size,
+        'streams': requested_streams,
+        'compressed': compressed,
+        'codecs': codecs
+    })
+    _, upload_response = recv_message(sock, expected_type=MessageType.UPLOAD_RESPONSE)
+
+    retry_after = upload_response['retry_after']
+    if upload_response['token'] is None and retry_after is not None:
+        sock.close()
+        compressor.shutdown()
+        if busy_attempt >= MAX_BUSY_ATTEMPTS:
+            print('Servidor continua cheio. Tente de novo mais tarde.')
+            sys.exit(1)
+        print(f'Servidor cheio. Tentando de novo em {retry_after:g} s...')
+        time.sleep(retry_after)
+        return run_upload_client(
+            server_hostname,
+            server_port,
+            local_path,
+            remote_path,
+            streams,
+            compressed,
+            codecs=codecs,
+            level=level,
+            adaptive=adaptive,
+            sha256=sha256,
+            ask_confirmation=ask_confirmation,
+            busy_attempt=busy_attempt + 1
+        )
+    if upload_response['token'] is None:
+        print(f'Servidor recusou o upload para {remote_path}: {upload_response["error"]}')
+        sock.close()
+        compressor.shutdown()
+        sys.exit(1)
+
+    codec_name = upload_response['codec']
+    if ask_confirmation and not from_stdin:
+        decision_str = (
+            'CONFIRMANDO O UPLOAD:\n'
+            f' - Arquivo local: "{local_path}" ({bytes2human(size)})\n'
+            f' - Arquivo remoto: "{remote_path}"\n'
+            f' - Compressão: {codec_name or "desativada"}\n'
+            'Tem certeza que quer continuar?'
+        )
+        if not confirm_decision(decision_str):
+            print('Tudo bem! Fechando conexão.')
+            sock.close()
+            compressor.shutdown()
+            sys.exit()
+
+    codec = get_codec(codec_name) if codec_name is not None else None
+    stream_count = upload_response['streams']
+    reader = file_hash = None
+    if from_stdin:
+        reader = StdinReader(sys.stdin.buffer, compressor.block_size, stream_count)
+    else:
+        ranges = get_partition_ranges(size, stream_count)
+        if sha256:
+            file_hash = BackgroundFileHash(local_path)
+
+    errors = []
+    bytes_sent = []
+    finish_times = []
+    transfer_start = time.perf_counter()
     progress_bar = tqdm.tqdm(
-        total=file_length,
-        desc=f"Baixando {partial_path}.",
-        unit="B",
-        unit_scale=True,
-        unit_divisor=BUFFER_SIZE
+        total=size,
+        desc=f'Enviando {remote_path} ({stream_count} streams)',
+        unit='B',
+        unit_scale=True
     )
-    total_data_written = 0
-    total_data_received = 0
 
+    def upload_stream(stream_id):
+        try:
+            with open_control_connection(server_hostname, server_port) as upload_socket:
+                send_message(upload_socket, MessageType.STREAM_ATTACH, {
+                    'token': upload_response['token'],
+                    'stream': stream_id
+                })
+                if reader is not None:
+                    bytes_sent.append(send_stdin_blocks(
+                        upload_socket, reader, codec, level, progress_bar.update))
+                    return None
+                # Streams a mais (arquivo vazio) só avisam que acabaram.
+                start_byte, partition_size = (
+                    ranges[stream_id] if stream_id < len(ranges) else (0, 0))
+                with open(local_path, mode='rb') as file:
+                    bytes_sent.append(send_upload_range(
+                        upload_socket,
+                        file,
+                        start_byte,
+                        partition_size,
+                        compressor,
+                        codec,
+                        level,
+                        adaptive,
+                        progress_bar.update
+                    ))
+        except Exception as exc:
+            logging.debug('Stream %d falhou: %s', stream_id, exc)
+            errors.append(exc)
+        finally:
+            finish_times.append(time.perf_counter() - transfer_start)
+
+    threads = [
+        threading.Thread(target=upload_stream, args=(stream_id,))
+        for stream_id in range(stream_count)
+    ]
+    with progress_bar:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    compressor.shutdown()
+
+    try:
+        if reader is not None:
+            size, digest = reader.result()
+        else:
+            digest = file_hash.result() if file_hash is not None else None
+    except OSError as exc:
+        errors.append(exc)
+    if errors:
+        # Sem UPLOAD_COMMIT o servidor descarta o que recebeu.
+        sock.close()
+        print(f'Upload falhou em {len(errors)} stream(s): {errors[0]}')
+        sys.exit(1)
+
+    send_message(sock, MessageType.UPLOAD_COMMIT, {
+        'size': size,
+        'sha256': digest if sha256 else None,
+        'mode': mode
+    })
+    _, upload_result = recv_message(sock, expected_type=MessageType.UPLOAD_RESULT)
+    sock.close()
+    if upload_result['error'] is not None:
+        print(f'Servidor não aceitou o upload: {upload_result["error"]}')
+        sys.exit(1)
+
+    total_time = time.perf_counter() - transfer_start
+    print(
+        f'{bytes2human(size)} enviados como {bytes2human(sum(bytes_sent))} '
+        f'em {total_time:.3f} s.')
+    print('Fim!')
+    return sorted(finish_times)
+
+
+def read_batch_list(list_path: str, local_path: str) -> List[Tuple[str, str]]:
+    """
+    :param list_path: Lista com um caminho remoto por linha, opcionalmente
+        seguido de TAB e do caminho local (relativo a <local_path>)
+    :param local_path: Diretório local
+    :return: (caminho remoto, caminho local) de cada arquivo
+    """
+    files = []
+    with open(list_path, encoding='utf-8') as list_file:
+        for line in list_file:
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            remote_path, _, relative_path = line.partition('\t')
+            relative_path = relative_path or os.path.basename(remote_path.rstrip('/'))
+            files.append((remote_path, os.path.join(local_path, relative_path)))
+    return files
+
+
+def run_batch_client(
+        server_hostname: str,
+        server_port: int,
+        local_path: str,
+        list_path: str,
+        streams: int,
+        compressed: bool,
+        codecs: Optional[List[str]] = None,
+        level: Optional[int] = None,
+        sha256: bool = False,
+        busy_attempt: int = 0
+) -> int:
+    """
+    Baixa os arquivos de <list_path> para o diretório <local_path> numa
+    sessão persistente: todos os pedidos vão pela mesma conexão de
+    controle sem esperar as respostas, e as mesmas streams levam todos os
+    arquivos (ver pipeline.PipelinedClient).
+    :param server_hostname: IP do servidor
+    :param server_port: Porta do servidor
+    :param local_path: Diretório local (criado se não existir)
+    :param list_path: Lista de arquivos (ver read_batch_list)
+    :param streams: Conexões paralelas
+    :param compressed: Pede os pedaços comprimidos
+    :param codecs: Codecs aceitos, em ordem de preferência (padrão: todos)
+    :param level: Nível de compressão pedido (padrão: o do codec)
+    :param sha256: Confere o SHA-256 de cada arquivo baixado
+    :param busy_attempt: Quantas vezes o servidor já respondeu que estava
+        cheio
+    :return: Quantidade de arquivos baixados
+    """
+    files = read_batch_list(list_path, local_path)
+    sock = open_control_connection(server_hostname, server_port)
+    session = PipelinedClient(
+        sock,
+        (server_hostname, server_port),
+        streams=streams,
+        compressed=compressed,
+        codecs=codecs,
+        level=level
+    )
+    retry_after = session.open()
+    if retry_after is not None:
+        sock.close()
+        if busy_attempt >= MAX_BUSY_ATTEMPTS:
+            print('Servidor continua cheio. Tente de novo mais tarde.')
+            sys.exit(1)
+        print(f'Servidor cheio. Tentando de novo em {retry_after:g} s...')
+        time.sleep(retry_after)
+        return run_batch_client(
+            server_hostname,
+            server_port,
+            local_path,
+            list_path,
+            streams,
+            compressed,
+            codecs=codecs,
+            level=level,
+            sha256=sha256,
+            busy_attempt=busy_attempt + 1
+        )
+
+    failures = 0
     start = time.perf_counter()
+    progress_bar = tqdm.tqdm(
+        total=len(files),
+        desc=f'Baixando {len(files)} arquivo(s) ({session.streams} streams)',
+        unit='arquivo'
+    )
+    with session, progress_bar:
+        futures = {}
+        for remote_path, file_path in files:
+            os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+            futures[session.download(remote_path, file_path, sha256=sha256)] = remote_path
+        for future in as_completed(futures):
+            progress_bar.update(1)
+            if future.exception() is not None:
+                failures += 1
+                progress_bar.write(f'{futures[future]}: {future.exception()}')
+
+    print(
+        f'{len(files) - failures} de {len(files)} arquivo(s) em '
+        f'{time.perf_counter() - start:.3f} s.')
+    if failures:
+        sys.exit(1)
+    return len(files)
+
+
+def download_delta(
+        server_hostname: str,
+        server_port: int,
+        local_path: str,
+        remote_path: str
+):
+    """
+    Atualiza a cópia antiga <local_path> com o delta do servidor: o
+    cliente manda as assinaturas dos seus blocos, recebe cópias e
+    literais e reconstrói o arquivo ao lado do antigo, que só é
+    substituído depois de conferir o SHA-256.
+    :param server_hostname: IP do servidor
+    :param server_port: Porta do servidor
+    :param local_path: Caminho da cópia antiga
+    :param remote_path: Caminho do arquivo remoto
+    """
+    block_size = choose_block_size(os.path.getsize(local_path))
+    print(f'Calculando assinaturas de {local_path} (blocos de {bytes2human(block_size)})...')
+    weak, strong = compute_signatures(local_path, block_size)
+    busy_attempt = 0
+    while True:
+        sock = open_control_connection(server_hostname, server_port)
+        send_message(sock, MessageType.DELTA_REQUEST, {
+            'path': remote_path,
+            'block_size': block_size,
+            'weak': weak,
+            'strong': strong
+        })
+        _, delta_response = recv_message(sock, expected_type=MessageType.DELTA_RESPONSE)
+        retry_after = delta_response.get('retry_after')
+        if delta_response['size'] is not None or retry_after is None:
+            break
+        sock.close()
+        if busy_attempt >= MAX_BUSY_ATTEMPTS:
+            print('Servidor continua cheio. Tente de novo mais tarde.')
+            sys.exit(1)
+        print(f'Servidor cheio. Tentando de novo em {retry_after:g} s...')
+        time.sleep(retry_after)
+        busy_attempt += 1
+    if delta_response['size'] is None:
+        print(f'Arquivo {remote_path} não foi encontrado pelo servidor.')
+        sys.exit(1)
+
+    new_path = str(local_path) + DELTA_EXTENSION
+    progress_bar = tqdm.tqdm(
+        total=delta_response['size'],
+        desc=f'Reconstruindo {local_path}.',
+        unit='B',
+        unit_scale=True
+    )
     with progress_bar as p_bar:
-        with open(partial_path, 'wb') as partial_file:
-            while total_data_written < file_length:
-                recv_bytes = download_socket.recv(BUFFER_SIZE)
-                # print(f'{port}: Recebi {len(recv_bytes)} bytes do servidor.')
-                if not recv_bytes or recv_bytes == 0:
-                    raise RuntimeError('Broken connection')
-                curr_data_written = partial_file.write(recv_bytes)
-                total_data_written += curr_data_written
-                total_data_received += len(recv_bytes)
-                p_bar.update(n=len(recv_bytes))
-        p_bar.refresh()
+        local_sha256, copied_bytes, literal_bytes = apply_delta(
+            sock,
+            local_path,
+            new_path,
+            on_progress=p_bar.update
+        )
+    _, download_result = recv_message(sock, expected_type=MessageType.DOWNLOAD_RESULT)
+    sock.close()
 
-    end = time.perf_counter()
+    if local_sha256 != download_result['sha256']:
+        os.remove(new_path)
+        print(f'SHA-256 do arquivo reconstruído difere do remoto. {local_path} não foi alterado.')
+        sys.exit(1)
+    os.replace(new_path, local_path)
     print(
-        f'Fim do download de {partial_path}.\n'
-        f'Tamanho: {bytes2human(total_data_written)}.'
-        f'Tempo: {(end - start):.5f} s'
+        f'Delta aplicado: {bytes2human(literal_bytes)} recebidos, '
+        f'{bytes2human(copied_bytes)} reaproveitados da cópia antiga.')
+    print('Fim!')
+
+
+def open_control_connection(server_hostname: str, server_port: int) -> socket.socket:
+    """
+    Abre a conexão de controle com o servidor, em IPv4 ou IPv6.
+    """
+    if is_valid_ipv4_hostname(server_hostname):
+        socket_family = socket.AF_INET
+    elif is_valid_ipv6_hostname(server_hostname):
+        socket_family = socket.AF_INET6
+    else:
+        raise ValueError(f'IP {server_hostname} não é válido para IPv4 ou IPv6')
+
+    logging.debug('Socket é da família %s.', socket_family)
+    sock = socket.socket(socket_family, socket.SOCK_STREAM)
+
+    sock.connect((server_hostname, server_port))
+    logging.debug(
+        'Cliente se conectou ao servidor em (%s, %s)',
+        server_hostname, server_port
     )
+    return sock
 
 
 def confirm_decision(question):
@@ -107,16 +928,33 @@ def run_client(
         compressed: bool,
         decompress: bool = False,
         ask_confirmation=True,
-        keep_partitions=False
+        keep_partitions=False,
+        codecs: Optional[List[str]] = None,
+        level: Optional[int] = None,
+        adaptive: bool = False,
+        use_partitions: bool = False,
+        verify: bool = False,
+        sha256: bool = False,
+        refetch_attempt: int = 0,
+        delta: bool = False,
+        schedule: str = DYNAMIC_SCHEDULE,
+        engine: str = THREADED_ENGINE,
+        busy_attempt: int = 0,
+        chunk_cache: Optional[str] = None,
+        chunk_cache_size: int = DEFAULT_CHUNK_STORE_SIZE
 ):
     """
     Protocolo:
      - Cliente abre conexão com servidor.
      - Cliente pede arquivo <remote_path> ao servidor.
      - Cliente recebe tamanho de <remote_path> em bytes e P portas de conexão.
-     - Cliente abre P portas de conexão com servidor, e salva os arquivos
-        usando o nome <porta>_<local_path>.
-     - Ao terminar todos os downloads, o cliente concatena os bytes um.
+     - Cliente pré-aloca <local_path> e abre P portas de conexão com o
+        servidor; cada uma escreve a sua faixa direto no arquivo.
+     - As faixas gravadas ficam em <local_path>.ccp-manifest. Se o download
+        for interrompido, a próxima execução pede só as faixas que faltam.
+     - Com use_partitions (ou compressão sem descompressão), cada conexão
+        salva o arquivo <local_path>.partN e, ao terminar todos os
+        downloads, o cliente concatena os bytes um.
         Arquivo remoto: A = 1234A
         Arquivos baixados: 1A, 2A, 3A, 4A
         (1A + 2A) = 12A
@@ -133,54 +971,191 @@ def run_client(
     :param decompress: Descomprime após receber
     :param ask_confirmation: Pede confirmação de download
     :param keep_partitions: Mantém partições após união de arquivos
+    :param codecs: Codecs aceitos, em ordem de preferência (padrão: todos)
+    :param level: Nível de compressão pedido (padrão: o do codec)
+    :param adaptive: Servidor pula dados incompressíveis e ajusta o nível
+    :param use_partitions: Baixa para arquivos .partN e os junta no fim, em
+        vez de escrever cada faixa direto no arquivo-destino pré-alocado
+    :param verify: Pede pedaços com checksum; os corrompidos são
+        descartados e pedidos de novo (só escrevendo direto no destino)
+    :param sha256: Compara o SHA-256 do arquivo baixado com o do servidor
+    :param refetch_attempt: Quantas vezes faixas corrompidas já foram
+        pedidas de novo
+    :param delta: Se <local_path> já existe, baixa só o que mudou (delta
+        estilo rsync, numa conexão só)
+    :param schedule: DYNAMIC_SCHEDULE (pedaços distribuídos sob demanda
+        entre as streams) ou STATIC_SCHEDULE (uma faixa fixa por stream);
+        arquivos .partN sempre usam faixas fixas
+    :param engine: THREADED_ENGINE (uma thread e uma barra por stream) ou
+        ASYNCIO_ENGINE (todas as streams num laço de eventos)
+    :param busy_attempt: Quantas vezes o servidor já respondeu que estava
+        cheio
+    :param chunk_cache: Diretório do armazenamento local de pedaços: o
+        servidor manda a lista de pedaços definidos pelo conteúdo do
+        arquivo, e só os que não estão guardados (de qualquer download
+        anterior) são baixados
+    :param chunk_cache_size: Bytes de pedaços guardados (LRU)
+    :return: Tempo (s) em que cada stream terminou
     """
 
-    if is_valid_ipv4_hostname(server_hostname):
-        socket_family = socket.AF_INET
-    elif is_valid_ipv6_hostname(server_hostname):
-        socket_family = socket.AF_INET6
-    else:
-        raise ValueError(f'IP {server_hostname} não é válido para IPv4 ou IPv6')
+    if delta and os.path.isfile(local_path) and os.path.getsize(local_path):
+        local_size = os.path.getsize(local_path)
+        # As assinaturas vão numa mensagem só, limitada a MAX_MESSAGE_SIZE.
+        if local_size // choose_block_size(local_size) <= MAX_DELTA_BLOCKS:
+            return download_delta(server_hostname, server_port, local_path, remote_path)
+        print(
+            f'{local_path} tem blocos demais para o delta '
+            f'(máximo de {MAX_DELTA_BLOCKS}): baixando o arquivo inteiro.')
 
-    logging.debug('Socket é da família %s.', socket_family)
-    sock = socket.socket(socket_family, socket.SOCK_STREAM)
+    sock = open_control_connection(server_hostname, server_port)
 
-    sock.connect((server_hostname, server_port))
-    logging.debug(
-        'Cliente se conectou ao servidor em (%s, %s)',
-        server_hostname, server_port
-    )
+    # Partições comprimidas que não serão descomprimidas continuam em
+    # arquivos .partN. O resto é escrito direto no arquivo-destino.
+    direct = not use_partitions and (not compressed or decompress)
+    if verify and not direct:
+        print('Verificação por pedaço exige escrever direto no destino: desativada.')
+        verify = False
+
+    chunk_store = chunk_identity = chunk_index = None
+    if chunk_cache is not None and not direct:
+        print('Cache de pedaços exige escrever direto no destino: desativado.')
+    elif chunk_cache is not None:
+        chunk_store = ChunkStore(chunk_cache, chunk_cache_size)
+        # A conexão só serve este pedido; o download abre outra se faltar algo.
+        chunk_identity, chunk_index = request_chunk_index(sock, remote_path)
+        sock.close()
+        sock = None
+        if chunk_index is None:
+            print('Servidor não mandou a lista de pedaços: baixando o arquivo inteiro.')
 
     # Agora que cliente se conectou, ele envia o pedido de download.
+    if codecs is None:
+        codecs = available_codecs()
     download_request = {
         'path': remote_path,
         'streams': streams,
-        'compressed': compressed
+        'compressed': compressed,
+        'codecs': codecs,
+        'level': level,
+        'adaptive': adaptive,
+        # Blocos incompressíveis sem compressão só cabem quando a partição
+        # é descomprimida ao chegar; o .partN guarda só membros do codec.
+        'raw_blocks': direct,
+        'verify': verify,
+        'checksums': available_checksums(),
+        'sha256': sha256,
+        'schedule': schedule if direct else STATIC_SCHEDULE,
+        # Arquivos pequenos podem vir na própria resposta, escritos direto
+        # no destino.
+        'inline': direct
     }
+
+    # Download anterior interrompido: pede só as faixas que faltam.
+    manifest = None
+    if not use_partitions:
+        manifest = RangeManifest.load(local_path, remote_path)
+    if manifest is not None:
+        print(
+            f'Retomando download: {bytes2human(manifest.completed_bytes())} '
+            f'de {bytes2human(manifest.size)} já baixados.')
+    elif chunk_index is not None:
+        # Os pedaços guardados vão direto para o destino e contam como já
+        # baixados: o pedido é o de um download retomado.
+        manifest = RangeManifest(local_path, remote_path, identity=chunk_identity)
+        with TargetFile(local_path, chunk_index.size) as target:
+            for start_byte, length in chunk_store.fill(target, chunk_index):
+                manifest.add(start_byte, length)
+        manifest.save()
+        print(
+            f'{bytes2human(manifest.completed_bytes())} de '
+            f'{bytes2human(manifest.size)} já estavam no cache de pedaços.')
+        if not manifest.missing():
+            manifest.remove()
+            print(
+                f'{local_path} montado só com pedaços guardados, todos '
+                'conferidos com os hashes do servidor.')
+            print('Fim!')
+            return []
+    if manifest is not None:
+        download_request['ranges'] = manifest.missing()
+        download_request['identity'] = manifest.identity
     logging.debug(
         'Pedido de download do cliente:\n%s', download_request
     )
-    send_message(sock, download_request)
+    if sock is None:
+        sock = open_control_connection(server_hostname, server_port)
+    send_message(sock, MessageType.DOWNLOAD_REQUEST, download_request)
 
     # E recebe informações de download do servidor
-    download_response = recv_message(sock)
+    _, download_response = recv_message(
+        sock,
+        expected_type=MessageType.DOWNLOAD_RESPONSE
+    )
     logging.debug(
         'Mensagem de resposta do servidor:\n%s', download_response
     )
 
-    download_ports = download_response['ports']
+    download_token = download_response['token']
+    stream_count = download_response['streams']
     download_uncompressed_size = download_response['size']
-    if download_ports is None:
+    download_codec = download_response.get('codec')
+    retry_after = download_response.get('retry_after')
+    if download_token is None and retry_after is not None:
+        sock.close()
+        if busy_attempt >= MAX_BUSY_ATTEMPTS:
+            print('Servidor continua cheio. Tente de novo mais tarde.')
+            sys.exit(1)
+        print(f'Servidor cheio. Tentando de novo em {retry_after:g} s...')
+        time.sleep(retry_after)
+        return run_client(
+            server_hostname,
+            server_port,
+            local_path,
+            remote_path,
+            streams,
+            compressed,
+            decompress=decompress,
+            ask_confirmation=ask_confirmation,
+            keep_partitions=keep_partitions,
+            codecs=codecs,
+            level=level,
+            adaptive=adaptive,
+            use_partitions=use_partitions,
+            verify=verify,
+            sha256=sha256,
+            refetch_attempt=refetch_attempt,
+            delta=delta,
+            schedule=schedule,
+            engine=engine,
+            busy_attempt=busy_attempt + 1,
+            chunk_cache=chunk_cache,
+            chunk_cache_size=chunk_cache_size
+        )
+    inline = download_response.get('inline') is not None
+    if download_token is None and not inline:
         print(f'Arquivo {remote_path} não foi encontrado pelo servidor.')
         sys.exit(1)
 
+    if compressed and download_codec is None and not inline:
+        if adaptive:
+            print('Servidor decidiu enviar sem compressão (arquivo já comprimido).')
+        else:
+            print(f'Servidor não suporta nenhum dos codecs {codecs}. Baixando sem compressão.')
+        compressed = False
+        direct = not use_partitions
+
+    checksum_name = download_response.get('checksum')
+    if verify and checksum_name is None:
+        print('Servidor não suporta nenhum dos checksums. Baixando sem verificação.')
+    checksum = get_checksum(checksum_name) if checksum_name else None
+
     if ask_confirmation:
         decision_str = (
             'CONFIRMANDO O DOWNLOAD:\n'
             f' - Caminho local (absoluto): "{local_path}"\n'
             f' - Caminho remoto: "{remote_path}"\n'
             f' - Tamanho descomprimido do arquivo remoto: {bytes2human(download_uncompressed_size)}\n'
-            f' - Compressão: {"ativada" if compressed else "desativada"}\n'
+            f' - Compressão: {download_codec if compressed else "desativada"}\n'
             'Tem certeza que quer continuar?'
         )
         confirmed = confirm_decision(decision_str)
@@ -189,38 +1164,183 @@ def run_client(
             sock.close()
             sys.exit()
 
+    if inline:
+        # Arquivo pequeno: já chegou inteiro, numa ida e volta só.
+        sock.close()
+        local_sha256 = save_inline(local_path, download_response)
+        if manifest is not None:
+            manifest.remove()
+        remote_sha256 = download_response.get('sha256')
+        if remote_sha256 is not None:
+            if local_sha256 != remote_sha256:
+                print(
+                    f'SHA-256 de {local_path} ({local_sha256}) difere do '
+                    f'arquivo remoto ({remote_sha256}).')
+                sys.exit(1)
+            print(f'SHA-256 conferido: {local_sha256}.')
+        print(f'{local_path}: {bytes2human(download_response["size"])} recebidos na resposta.')
+        print('Fim!')
+        return []
+
     partial_paths = [
         get_partial_path(local_path, part_id=i)
-        for i in range(len(download_ports))
+        for i in range(stream_count)
     ]
 
-    threads = [
-        threading.Thread(
-            target=start_download,
-            args=(
-                server_hostname,
-                port,
-                partial_path,
-                local_path
+    target = None
+    writers = [None for _ in range(stream_count)]
+    if direct:
+        download_identity = download_response['identity']
+        if manifest is not None and manifest.identity != download_identity:
+            print('Arquivo remoto mudou desde o download parcial: baixando tudo de novo.')
+            manifest.remove()
+            manifest = None
+        if manifest is None:
+            manifest = RangeManifest(
+                local_path,
+                remote_path,
+                identity=download_identity,
+                codec=download_codec
             )
-        )
-        for port, partial_path in zip(download_ports, partial_paths)
-    ]
+            manifest.save()
 
-    for thread in threads:
-        thread.start()
+        target = TargetFile(local_path, download_uncompressed_size)
+        if download_response.get('schedule') == DYNAMIC_SCHEDULE:
+            # Qualquer stream pode receber qualquer pedaço.
+            chunk_writer = target.chunk_writer(
+                get_codec(download_codec) if compressed else None,
+                on_write=manifest.add
+            )
+            writers = [chunk_writer for _ in range(stream_count)]
+        else:
+            for i, (start_byte, partition_size) in enumerate(download_response['ranges']):
+                writers[i] = target.writer(
+                    start_byte,
+                    partition_size,
+                    on_write=manifest.add
+                )
+                if compressed:
+                    writers[i] = DecodingWriter(get_codec(download_codec), writers[i])
 
-    for thread in threads:
-        thread.join()
+    if engine == ASYNCIO_ENGINE:
+        # Todas as streams num laço de eventos, com uma barra só.
+        corrupt_chunks, finish_times, errors = download_streams(
+            (server_hostname, server_port),
+            download_token,
+            partial_paths,
+            writers,
+            checksum=checksum,
+            total_size=None if compressed else sum(
+                size for _, size in download_response['ranges']),
+            description=f'Baixando {local_path} ({stream_count} streams)'
+        )
+    else:
+        corrupt_chunks, finish_times, errors = download_threads(
+            server_hostname,
+            server_port,
+            download_token,
+            partial_paths,
+            local_path,
+            writers,
+            checksum
+        )
 
+    # Com verificação ou SHA-256, o servidor manda o resultado no fim.
+    download_result = {}
+    if not errors and (checksum is not None or sha256):
+        _, download_result = recv_message(
+            sock,
+            expected_type=MessageType.DOWNLOAD_RESULT
+        )
     sock.close()
+    if target is not None:
+        target.close()
+
+    if finish_times:
+        print(
+            f'Streams terminaram entre {min(finish_times):.3f} s e '
+            f'{max(finish_times):.3f} s '
+            f'(diferença: {max(finish_times) - min(finish_times):.3f} s).')
+
+    if errors:
+        print(f'Download falhou em {len(errors)} partição(ões): {errors[0]}')
+        if manifest is not None:
+            manifest.save()
+            print('Execute o mesmo comando de novo para continuar o download.')
+        sys.exit(1)
+
+    if direct:
+        missing_ranges = manifest.missing()
+        if missing_ranges:
+            manifest.save()
+            if sum(corrupt_chunks) and refetch_attempt < MAX_REFETCH_ATTEMPTS:
+                print(
+                    f'Pedindo de novo {len(missing_ranges)} faixa(s) '
+                    f'com pedaços corrompidos...')
+                return run_client(
+                    server_hostname,
+                    server_port,
+                    local_path,
+                    remote_path,
+                    streams,
+                    compressed,
+                    decompress=decompress,
+                    ask_confirmation=False,
+                    keep_partitions=keep_partitions,
+                    codecs=codecs,
+                    level=level,
+                    adaptive=adaptive,
+                    use_partitions=use_partitions,
+                    verify=verify,
+                    sha256=sha256,
+                    refetch_attempt=refetch_attempt + 1,
+                    schedule=schedule,
+                    engine=engine,
+                    chunk_cache=chunk_cache,
+                    chunk_cache_size=chunk_cache_size
+                )
+            print(
+                f'Download incompleto: faltam {len(missing_ranges)} faixa(s).\n'
+                'Execute o mesmo comando de novo para continuar o download.')
+            sys.exit(1)
+        manifest.remove()
+
+    if chunk_index is not None:
+        if download_response['identity'] != chunk_identity:
+            print('Arquivo remoto mudou depois da lista de pedaços: nada foi guardado.')
+        else:
+            stored_chunks, mismatched_chunks = chunk_store.add_file(local_path, chunk_index)
+            print(
+                f'{stored_chunks} pedaço(s) novo(s) guardado(s) no cache '
+                f'({bytes2human(chunk_store.size)} de {bytes2human(chunk_store.max_size)}).')
+            if mismatched_chunks:
+                print(f'{mismatched_chunks} pedaço(s) não bateram com os hashes do servidor.')
 
     # Se o download não foi comprimido, eu já junto as partições.
-    if not compressed or (compressed and decompress):
+    if not direct and (not compressed or decompress):
         print('Juntando partições baixadas...')
-        join_downloaded_files(partial_paths, local_path, keep_partitions)
+        join_downloaded_files(
+            partial_paths,
+            local_path,
+            keep_partitions,
+            codec=download_codec
+        )
+
+    remote_sha256 = download_result.get('sha256')
+    if remote_sha256 is not None:
+        if direct or not compressed or decompress:
+            local_sha256 = sha256_file(local_path)
+            if local_sha256 != remote_sha256:
+                print(
+                    f'SHA-256 de {local_path} ({local_sha256}) difere do '
+                    f'arquivo remoto ({remote_sha256}).')
+                sys.exit(1)
+            print(f'SHA-256 conferido: {local_sha256}.')
+        else:
+            print('SHA-256 não conferido: partições continuam comprimidas.')
 
     print('Fim!')
+    return sorted(finish_times)
 
 
 def run():
@@ -234,6 +1354,17 @@ def run():
     compressed = parsed_args.compressed
     keep_partitions = parsed_args.keep
     decompress = parsed_args.decompress
+    codecs = parsed_args.codecs
+    level = parsed_args.level
+    adaptive = parsed_args.adaptive
+    use_partitions = parsed_args.use_partitions
+    verify = parsed_args.verify
+    sha256 = parsed_args.sha256
+    delta = parsed_args.delta
+    schedule = parsed_args.schedule
+    engine = parsed_args.engine
+    chunk_cache = parsed_args.chunk_cache
+    chunk_cache_size = human2bytes(parsed_args.chunk_cache_size)
 
     if parsed_args.debug_mode:
         logging.basicConfig(
@@ -245,6 +1376,50 @@ def run():
 
     server_hostname, server_port = parse_address(server_address)
 
+    if parsed_args.upload:
+        run_upload_client(
+            server_hostname,
+            server_port,
+            local_path,
+            remote_path,
+            streams,
+            compressed,
+            codecs=codecs,
+            level=level,
+            adaptive=adaptive,
+            sha256=sha256,
+            ask_confirmation=True
+        )
+        return None
+
+    if parsed_args.batch:
+        run_batch_client(
+            server_hostname,
+            server_port,
+            local_path,
+            remote_path,
+            streams,
+            compressed,
+            codecs=codecs,
+            level=level,
+            sha256=sha256
+        )
+        return None
+
+    if parsed_args.recursive:
+        run_directory_client(
+            server_hostname,
+            server_port,
+            local_path,
+            remote_path,
+            streams,
+            compressed,
+            codecs=codecs,
+            level=level,
+            ask_confirmation=True
+        )
+        return None
+
     abs_local_path = get_abspath(local_path)
     validate_path(abs_local_path)
 
@@ -257,7 +1432,18 @@ def run():
         compressed,
         decompress=decompress,
         ask_confirmation=True,
-        keep_partitions=keep_partitions
+        keep_partitions=keep_partitions,
+        codecs=codecs,
+        level=level,
+        adaptive=adaptive,
+        use_partitions=use_partitions,
+        verify=verify,
+        sha256=sha256,
+        delta=delta,
+        schedule=schedule,
+        engine=engine,
+        chunk_cache=chunk_cache,
+        chunk_cache_size=chunk_cache_size
     )
 
 
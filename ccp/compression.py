@@ -0,0 +1,653 @@
+import bz2
+import collections
+import gzip
+import logging
+import lzma
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional
+
+from ccp.cache import release_mapped, stat_identity
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# Tamanho padrão de cada bloco comprimido de forma independente.
+DEFAULT_BLOCK_SIZE = 2 ** 20
+
+# Codec usado quando o cliente só pede "compressed" (protocolo antigo).
+DEFAULT_CODEC = 'gzip'
+
+# Amostra de cada bloco usada para decidir se vale a pena comprimi-lo.
+SAMPLE_SIZE = 64 * 2 ** 10
+
+# Razão comprimido/original a partir da qual a amostra é incompressível.
+INCOMPRESSIBLE_RATIO = 0.95
+
+# Extensões de formatos que já são comprimidos.
+PRECOMPRESSED_EXTENSIONS = {
+    '.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz', '.lzma', '.zst', '.lz4',
+    '.zip', '.7z', '.rar', '.jar', '.apk', '.whl', '.docx', '.xlsx', '.pptx',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.ogg', '.flac', '.aac', '.m4a', '.opus',
+    '.mp4', '.mkv', '.avi', '.mov', '.webm',
+    '.gpg', '.age',
+}
+
+# Magic numbers de formatos que já são comprimidos (além dos codecs).
+PRECOMPRESSED_MAGICS = (
+    b'PK\x03\x04',  # zip, jar, docx...
+    b'7z\xbc\xaf\x27\x1c',
+    b'Rar!\x1a\x07',
+    b'\xff\xd8\xff',  # jpeg
+    b'\x89PNG\r\n\x1a\n',
+    b'GIF87a',
+    b'GIF89a',
+    b'OggS',
+    b'fLaC',
+    b'ID3',  # mp3
+    b'\x1a\x45\xdf\xa3',  # mkv, webm
+)
+
+
+class Codec:
+    """
+    Formato de compressão registrado no CCP.
+
+    Cada bloco é comprimido de forma independente, então uma partição é a
+    concatenação de vários quadros/membros do formato. O descompressor
+    precisa expor <eof> e <unused_data> para que a decodificação continue
+    no membro seguinte.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            compress: Callable[[bytes, int], bytes],
+            decompressor: Callable[[], object],
+            magic: bytes,
+            default_level: int,
+            min_level: int,
+            max_level: int,
+            fastest_level: Optional[int] = None,
+            adaptive_max_level: Optional[int] = None
+    ):
+        self.name = name
+        self.__compress = compress
+        self.__decompressor = decompressor
+        self.magic = magic
+        self.default_level = default_level
+        # min_level é o modo mais barato do codec (no gzip, blocos sem
+        # compressão); fastest_level é o nível mais rápido que ainda
+        # comprime.
+        self.min_level = min_level
+        self.max_level = max_level
+        self.fastest_level = min_level if fastest_level is None else fastest_level
+        self.adaptive_max_level = max_level if adaptive_max_level is None else adaptive_max_level
+
+    def __repr__(self):
+        return f'Codec({self.name!r})'
+
+    def clamp_level(self, level: Optional[int]) -> int:
+        if level is None:
+            return self.default_level
+        return max(self.min_level, min(self.max_level, level))
+
+    def compress(self, data, level: Optional[int] = None) -> bytes:
+        return self.__compress(data, self.clamp_level(level))
+
+    def stream_decoder(self) -> 'StreamDecoder':
+        return StreamDecoder(self.__decompressor)
+
+    def iter_decompress(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Descomprime aos poucos a concatenação de membros do formato.
+        :param chunks: Pedaços do conteúdo comprimido, em ordem
+        :return: Iterador de pedaços descomprimidos
+        """
+        decoder = self.stream_decoder()
+        for chunk in chunks:
+            yield from decoder.feed(chunk)
+        decoder.finish()
+
+    def decompress(self, data) -> bytes:
+        return b''.join(self.iter_decompress([data]))
+
+
+class StreamDecoder:
+    """
+    Descompressor incremental de uma concatenação de membros de um codec.
+    """
+
+    def __init__(self, decompressor_factory: Callable[[], object]):
+        self.__decompressor_factory = decompressor_factory
+        self.__decompressor = None
+
+    def feed(self, chunk) -> Iterator[bytes]:
+        """
+        :param chunk: Próximo pedaço do conteúdo comprimido
+        :return: Iterador de pedaços descomprimidos
+        """
+        while chunk:
+            if self.__decompressor is None:
+                self.__decompressor = self.__decompressor_factory()
+            decompressed_bytes = self.__decompressor.decompress(chunk)
+            if decompressed_bytes:
+                yield decompressed_bytes
+            if self.__decompressor.eof:
+                chunk = self.__decompressor.unused_data
+                self.__decompressor = None
+            else:
+                chunk = b''
+
+    def finish(self):
+        """
+        Verifica que o último membro terminou.
+        """
+        if self.__decompressor is not None:
+            raise ValueError('Conteúdo comprimido truncado.')
+
+
+CODECS: Dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec):
+    """
+    Registra um codec, que passa a poder ser negociado com clientes.
+    :param codec: Codec
+    """
+    CODECS[codec.name] = codec
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f'Codec {name} não é suportado.')
+
+
+def available_codecs() -> List[str]:
+    """
+    :return: Nomes dos codecs registrados, em ordem de preferência.
+    """
+    return list(CODECS)
+
+
+def negotiate_codec(
+        client_codecs: Iterable[str],
+        server_codecs: Optional[Iterable[str]] = None
+) -> Optional[str]:
+    """
+    Escolhe o primeiro codec da lista do cliente que o servidor conhece.
+    :param client_codecs: Codecs do cliente, em ordem de preferência
+    :param server_codecs: Codecs do servidor (padrão: todos os registrados)
+    :return: Nome do codec, ou None se não houver codec em comum
+    """
+    if server_codecs is None:
+        server_codecs = available_codecs()
+    server_codecs = set(server_codecs)
+    for name in client_codecs:
+        if name in server_codecs:
+            return name
+    return None
+
+
+def detect_codec(head: bytes) -> Optional[Codec]:
+    """
+    Identifica o codec pelos primeiros bytes (magic number) de um arquivo.
+    :param head: Primeiros bytes do arquivo
+    :return: Codec, ou None se não for reconhecido
+    """
+    for codec in CODECS.values():
+        if head.startswith(codec.magic):
+            return codec
+    return None
+
+
+register_codec(Codec(
+    name='gzip',
+    compress=lambda data, level: gzip.compress(data, compresslevel=level, mtime=0),
+    decompressor=lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    magic=b'\x1f\x8b',
+    default_level=1,
+    min_level=0,
+    max_level=9,
+    fastest_level=1
+))
+
+if zstandard is not None:
+    register_codec(Codec(
+        name='zstd',
+        compress=lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+        decompressor=lambda: zstandard.ZstdDecompressor().decompressobj(),
+        magic=b'\x28\xb5\x2f\xfd',
+        default_level=3,
+        min_level=-5,
+        max_level=22,
+        adaptive_max_level=19
+    ))
+
+if lz4 is not None:
+    register_codec(Codec(
+        name='lz4',
+        compress=lambda data, level: lz4.frame.compress(data, compression_level=level),
+        decompressor=lambda: lz4.frame.LZ4FrameDecompressor(),
+        magic=b'\x04\x22\x4d\x18',
+        default_level=0,
+        min_level=0,
+        max_level=16
+    ))
+
+register_codec(Codec(
+    name='bz2',
+    compress=lambda data, level: bz2.compress(data, compresslevel=level),
+    decompressor=bz2.BZ2Decompressor,
+    magic=b'BZh',
+    default_level=9,
+    min_level=1,
+    max_level=9
+))
+
+register_codec(Codec(
+    name='lzma',
+    compress=lambda data, level: lzma.compress(data, preset=level),
+    decompressor=lzma.LZMADecompressor,
+    magic=b'\xfd7zXZ\x00',
+    default_level=6,
+    min_level=0,
+    max_level=9
+))
+
+
+def read_block(file: BinaryIO, offset: int, size: int, lock: threading.Lock) -> bytes:
+    """
+    Lê <size> bytes de <file> a partir de <offset> sem depender da
+    posição atual do arquivo (os.pread quando disponível).
+    :param file: Arquivo aberto em modo binário
+    :param offset: Byte inicial
+    :param size: Quantidade de bytes
+    :param lock: Trava usada quando não existe os.pread
+    :return: Bytes lidos
+    """
+    if hasattr(os, 'pread'):
+        return os.pread(file.fileno(), size, offset)
+    with lock:
+        file.seek(offset)
+        return file.read(size)
+
+
+def is_incompressible(data) -> bool:
+    """
+    Estima se um bloco é incompressível comprimindo uma amostra dele
+    com o nível mais rápido do zlib.
+    :param data: Bloco
+    :return: True se não vale a pena comprimir o bloco
+    """
+    sample = memoryview(data)[:SAMPLE_SIZE]
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) >= INCOMPRESSIBLE_RATIO * len(sample)
+
+
+def is_precompressed(path: str) -> bool:
+    """
+    Verifica pela extensão e pelo magic number se o arquivo está em um
+    formato que já é comprimido (jpeg, zip, gzip...).
+    :param path: Caminho do arquivo
+    :return: True se o arquivo já é comprimido
+    """
+    _, extension = os.path.splitext(str(path))
+    if extension.lower() in PRECOMPRESSED_EXTENSIONS:
+        return True
+
+    with open(path, mode='rb') as file:
+        head = file.read(16)
+    if detect_codec(head) is not None:
+        return True
+    if head[4:8] == b'ftyp':  # mp4, mov, heic
+        return True
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return True
+    return head.startswith(PRECOMPRESSED_MAGICS)
+
+
+class AdaptiveLevelController:
+    """
+    Ajusta o nível de compressão de uma stream conforme o gargalo medido.
+
+    Se a stream precisou esperar o compressor por mais tempo do que gastou
+    enviando o bloco anterior, a compressão é o gargalo e o nível cai.
+    Se o bloco seguinte já estava pronto por <raise_after> blocos seguidos,
+    a rede é o gargalo e sobra CPU para um nível maior.
+    """
+
+    def __init__(self, codec: Codec, level: Optional[int] = None, raise_after: int = 4):
+        self.codec = codec
+        self.level = max(codec.fastest_level, codec.clamp_level(level))
+        self.raise_after = raise_after
+        self.__network_bound_blocks = 0
+
+    def observe(self, compress_wait: float, send_time: float) -> int:
+        """
+        :param compress_wait: Tempo esperando o bloco ficar pronto
+        :param send_time: Tempo enviando o bloco anterior
+        :return: Nível para os próximos blocos
+        """
+        if compress_wait > send_time:
+            self.__network_bound_blocks = 0
+            self.level = max(self.codec.fastest_level, self.level - 1)
+        else:
+            self.__network_bound_blocks += 1
+            if self.__network_bound_blocks >= self.raise_after:
+                self.__network_bound_blocks = 0
+                self.level = min(self.codec.adaptive_max_level, self.level + 1)
+        return self.level
+
+
+# Bloco lido da faixa [offset, offset + size) do arquivo, já comprimido
+# (payload) e com o checksum do payload (ou None). Com raw, o payload é o
+# conteúdo original: o bloco era incompressível e não passou pelo codec.
+Block = collections.namedtuple(
+    'Block', ['offset', 'size', 'payload', 'checksum', 'raw'], defaults=(False,))
+
+
+class ParallelCompressor:
+    """
+    Compressor em blocos no estilo pigz.
+
+    Cada partição é dividida em blocos de <block_size> bytes, que são lidos
+    e comprimidos em paralelo por <workers> threads (os codecs liberam o
+    GIL). Os blocos saem na ordem original como membros independentes do
+    codec, e a concatenação deles é válida para Codec.decompress (e, com
+    gzip, para gzip.decompress).
+
+    O mesmo compressor é compartilhado por todas as streams do servidor,
+    de forma que a vazão depende dos núcleos e não da quantidade de streams.
+    Com <memory_budget> (ex.: resources.ResourceManager), os blocos lidos
+    à frente do consumidor contam num orçamento de memória global.
+    Com <cache> (cache.ChunkCache), blocos já comprimidos do mesmo arquivo,
+    faixa, codec e nível saem do cache sem ler nem comprimir nada, e os
+    blocos ficam alinhados a múltiplos de <block_size> para que pedidos
+    com faixas diferentes caiam nos mesmos blocos.
+    Com <flights> (singleflight.FlightGroup), pedidos simultâneos do mesmo
+    bloco (ex.: muitos clientes baixando o mesmo arquivo ao mesmo tempo)
+    esperam uma única leitura e compressão, com a mesma grade de blocos.
+    """
+
+    def __init__(
+            self,
+            workers: Optional[int] = None,
+            block_size: int = DEFAULT_BLOCK_SIZE,
+            memory_budget=None,
+            cache=None,
+            flights=None
+    ):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError(f'Quantidade de workers inválida: {workers}')
+        if block_size < 1:
+            raise ValueError(f'Tamanho de bloco inválido: {block_size}')
+
+        self.workers = workers
+        self.block_size = block_size
+        # Objeto com reserve_memory(n, required) e release_memory(n).
+        self.memory_budget = memory_budget
+        self.cache = cache
+        self.flights = flights
+        self.__executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='ccp-compress'
+        )
+        # Pré-aquecimento do cache: um arquivo por vez, fora do caminho
+        # dos pedidos.
+        self.__prewarm_executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='ccp-prewarm'
+        )
+
+    def process_block(
+            self,
+            file,
+            offset,
+            size,
+            lock,
+            codec,
+            level,
+            adaptive=False,
+            checksum=None,
+            identity=None,
+            raw_blocks=False
+    ) -> Block:
+        cache_key = None
+        if identity is not None and codec is not None:
+            cache_key = (identity, offset, size, codec.name, codec.clamp_level(level), adaptive)
+            if self.cache is not None:
+                payload = self.cache.get(cache_key)
+                if payload is not None:
+                    block_checksum = checksum(payload) if checksum is not None else None
+                    return Block(offset, size, payload, block_checksum)
+
+        if adaptive and raw_blocks and codec is not None:
+            # A amostra decide antes de qualquer compressão: bloco
+            # incompressível vai como está, sem passar pelo codec nem
+            # ocupar o cache de blocos comprimidos.
+            sample = read_block(file, offset, min(size, SAMPLE_SIZE), lock)
+            if is_incompressible(sample):
+                payload = self.compress_block(file, offset, size, lock, None, level)
+                block_checksum = checksum(payload) if checksum is not None else None
+                return Block(offset, size, payload, block_checksum, raw=True)
+
+        if cache_key is not None and self.flights is not None:
+            # Quem pedir o mesmo bloco enquanto ele é lido e comprimido
+            # espera este resultado em vez de repetir o trabalho.
+            payload = self.flights.run(
+                cache_key, self.compress_block, file, offset, size, lock,
+                codec, level, adaptive, cache_key)
+        else:
+            payload = self.compress_block(
+                file, offset, size, lock, codec, level, adaptive, cache_key)
+        block_checksum = checksum(payload) if checksum is not None else None
+        return Block(offset, size, payload, block_checksum)
+
+    def compress_block(
+            self,
+            file,
+            offset,
+            size,
+            lock,
+            codec,
+            level,
+            adaptive=False,
+            cache_key=None
+    ) -> bytes:
+        block_bytes = read_block(file, offset, size, lock)
+        if len(block_bytes) != size:
+            raise RuntimeError(
+                f'Li {len(block_bytes)} bytes em vez de {size} no byte {offset}.')
+        if codec is None:
+            return block_bytes
+        if adaptive and is_incompressible(block_bytes):
+            # Bloco vai no modo mais barato do codec (gzip: sem compressão).
+            level = codec.min_level
+        payload = codec.compress(block_bytes, level)
+        if cache_key is not None and self.cache is not None:
+            self.cache.put(cache_key, payload)
+        return payload
+
+    def process_range(
+            self,
+            file: BinaryIO,
+            start_byte: int,
+            size: int,
+            codec: Optional[Codec] = None,
+            level: Optional[int] = None,
+            adaptive: bool = False,
+            checksum: Optional[Callable[[bytes], int]] = None,
+            raw_blocks: bool = False
+    ) -> Iterator[Block]:
+        """
+        Lê, comprime (se houver codec) e calcula o checksum (se pedido)
+        dos blocos de <size> bytes de <file> a partir de <start_byte>, em
+        paralelo e à frente do consumidor.
+        No máximo 2 * workers blocos ficam em memória por chamada; novos
+        blocos só são pedidos quando o consumidor pega os já prontos. Com
+        orçamento de memória, só o primeiro bloco pendente é garantido: os
+        outros esperam o orçamento ter espaço.
+        :param file: Arquivo-fonte aberto em modo binário
+        :param start_byte: Byte inicial da partição
+        :param size: Tamanho da partição
+        :param codec: Codec, ou None para enviar os blocos sem compressão
+        :param level: Nível de compressão (padrão: o do codec)
+        :param adaptive: Pula blocos incompressíveis e ajusta o nível
+            conforme o consumidor (a rede) ou o compressor for mais lento
+        :param checksum: Função de checksum do conteúdo de cada bloco
+        :param raw_blocks: Com adaptive, blocos incompressíveis saem sem
+            compressão (Block.raw), para o destinatário que os distingue;
+            sem isso, eles vão no modo mais barato do codec e a
+            concatenação dos blocos continua válida para o codec
+        :return: Iterador de blocos, em ordem. O conteúdo de um bloco do
+            cache em disco só vale até o próximo bloco ser pedido
+        """
+        controller = None
+        if adaptive and codec is not None:
+            controller = AdaptiveLevelController(codec, level)
+            level = controller.level
+
+        identity = None
+        if codec is not None and (self.cache is not None or self.flights is not None):
+            info = os.fstat(file.fileno())
+            identity = self.cache.identify(info) if self.cache is not None else stat_identity(info)
+
+        lock = threading.Lock()
+        max_pending = 2 * self.workers
+        pending = collections.deque()
+
+        end_byte = start_byte + size
+        next_offset = start_byte
+
+        def submit_next():
+            nonlocal next_offset
+            if next_offset >= end_byte:
+                return False
+            block_size = min(self.block_size, end_byte - next_offset)
+            if identity is not None:
+                # Blocos na grade de block_size: as mesmas chaves no cache
+                # e nos trabalhos em andamento para qualquer divisão do
+                # arquivo em faixas.
+                block_size = min(self.block_size - next_offset % self.block_size, block_size)
+            if not self.reserve_memory(block_size, required=not pending):
+                return False
+            pending.append((self.__executor.submit(
+                self.process_block, file, next_offset, block_size, lock, codec,
+                level, adaptive, checksum, identity, raw_blocks
+            ), block_size))
+            next_offset += block_size
+            return True
+
+        try:
+            while len(pending) < max_pending and submit_next():
+                pass
+            send_time = 0.0
+            while pending:
+                wait_start = time.perf_counter()
+                future, reserved = pending[0]
+                block = future.result()
+                pending.popleft()
+                # O bloco sai do orçamento quando vai para o consumidor.
+                self.release_memory(reserved)
+                if controller is not None:
+                    compress_wait = time.perf_counter() - wait_start
+                    level = controller.observe(compress_wait, send_time)
+                while len(pending) < max_pending and submit_next():
+                    pass
+
+                send_start = time.perf_counter()
+                try:
+                    yield block
+                finally:
+                    # Bloco do cache em disco: o mapeamento acaba com o envio.
+                    release_mapped(block.payload)
+                send_time = time.perf_counter() - send_start
+        finally:
+            # Consumidor desistiu (ex.: conexão caiu): nenhum bloco pode
+            # continuar lendo o arquivo depois que ele for fechado.
+            for future, _ in pending:
+                future.cancel()
+            wait([future for future, _ in pending])
+            for _, reserved in pending:
+                self.release_memory(reserved)
+
+    def record_access(self, path: str, codec: Optional[Codec], level: Optional[int] = None):
+        """
+        Conta um download comprimido de <path> no cache; quando o arquivo
+        fica popular, ele é comprimido inteiro em segundo plano, para que
+        os próximos pedidos já encontrem todos os blocos prontos.
+        """
+        if self.cache is None or codec is None:
+            return None
+        identity = self.cache.identify(os.stat(path))
+        if self.cache.record_access(identity, codec.name, codec.clamp_level(level)):
+            logging.debug('Pré-aquecendo o cache com %s (%s).', path, codec.name)
+            self.__prewarm_executor.submit(self.prewarm, path, codec, level)
+
+    def prewarm(self, path: str, codec: Codec, level: Optional[int] = None):
+        """
+        Comprime <path> inteiro só para encher o cache.
+        """
+        try:
+            with open(path, mode='rb') as file:
+                size = os.fstat(file.fileno()).st_size
+                for _ in self.process_range(file, 0, size, codec, level):
+                    pass
+        except Exception as exc:
+            logging.debug('Pré-aquecimento de %s falhou: %s', path, exc)
+
+    def reserve_memory(self, n_bytes: int, required: bool = False) -> bool:
+        if self.memory_budget is None:
+            return True
+        return self.memory_budget.reserve_memory(n_bytes, required)
+
+    def release_memory(self, n_bytes: int):
+        if self.memory_budget is not None:
+            self.memory_budget.release_memory(n_bytes)
+
+    def compress_range(
+            self,
+            file: BinaryIO,
+            start_byte: int,
+            size: int,
+            codec: Optional[Codec] = None,
+            level: Optional[int] = None,
+            adaptive: bool = False
+    ) -> Iterator[bytes]:
+        """
+        Comprime <size> bytes de <file> a partir de <start_byte>.
+        :param file: Arquivo-fonte aberto em modo binário
+        :param start_byte: Byte inicial da partição
+        :param size: Tamanho da partição
+        :param codec: Codec (padrão: gzip)
+        :param level: Nível de compressão (padrão: o do codec)
+        :param adaptive: Compressão adaptativa (ver process_range)
+        :return: Iterador de blocos comprimidos, em ordem
+        """
+        if codec is None:
+            codec = get_codec(DEFAULT_CODEC)
+        blocks = self.process_range(file, start_byte, size, codec, level, adaptive)
+        for block in blocks:
+            yield block.payload
+
+    def shutdown(self):
+        self.__prewarm_executor.shutdown(wait=False)
+        self.__executor.shutdown(wait=False)
@@ -0,0 +1,376 @@
+import bisect
+import collections
+import hashlib
+import itertools
+import math
+import mmap
+import os
+import socket
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from ccp.buffers import RECV_POOL, recv_into_exactly
+from ccp.messaging import MAX_MESSAGE_SIZE, recv_exactly, send_buffers
+
+
+# Limites do tamanho de bloco das assinaturas (padrão: ~raiz do tamanho).
+DELTA_MIN_BLOCK_SIZE = 4096
+DELTA_MAX_BLOCK_SIZE = 2 ** 20
+
+# Máscara do checksum fraco: a e b são somas módulo 2^16, como no rsync.
+# Com módulo potência de 2, a versão vetorizada pode fazer toda a conta
+# em inteiros sem sinal com overflow.
+WEAK_MASK = 0xFFFF
+
+# Tamanho do hash forte de cada bloco (BLAKE2b truncado).
+STRONG_DIGEST_SIZE = 16
+
+# Posições do arquivo novo processadas por vez na busca vetorizada.
+SCAN_SEGMENT_SIZE = 4 * 2 ** 20
+
+# Blocos cujas assinaturas (checksum fraco + hash forte) cabem num
+# DELTA_REQUEST, com folga para o resto da mensagem.
+MAX_DELTA_BLOCKS = (MAX_MESSAGE_SIZE - 2 ** 16) // (4 + STRONG_DIGEST_SIZE)
+
+# Bytes do arquivo antigo assinados por vez.
+SIGNATURE_BATCH_SIZE = 64 * 2 ** 20
+
+# Bits do filtro de checksums fracos (tabela de 2^N booleanos) que
+# descarta quase todas as posições antes da busca exata. A tabela cresce
+# com o número de blocos (uns 32 bits livres por bloco, para poucos
+# falsos positivos), de MIN a MAX bits: pequena, ela cabe no cache.
+MIN_WEAK_FILTER_BITS = 16
+MAX_WEAK_FILTER_BITS = 24
+
+# Maior literal enviado numa instrução.
+MAX_LITERAL_SIZE = 2 ** 20
+
+# Instrução do delta: operação, byte inicial no arquivo antigo, tamanho.
+# Um literal é seguido de <tamanho> bytes.
+DELTA_OP = struct.Struct('!BQQ')
+OP_END = 0
+OP_COPY = 1
+OP_LITERAL = 2
+
+# Sufixo do arquivo reconstruído antes de substituir o antigo.
+DELTA_EXTENSION = '.ccp-delta'
+
+Instruction = collections.namedtuple('Instruction', ['op', 'offset', 'size', 'payload'])
+
+
+def choose_block_size(size: int) -> int:
+    """
+    Bloco próximo de raiz(tamanho), como no rsync: arquivos maiores têm
+    blocos maiores e assinaturas proporcionalmente menores.
+    """
+    block_size = 1 << max(math.isqrt(size).bit_length() - 1, 0)
+    return min(max(block_size, DELTA_MIN_BLOCK_SIZE), DELTA_MAX_BLOCK_SIZE)
+
+
+def strong_hash(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=STRONG_DIGEST_SIZE).digest()
+
+
+def weak_checksum(data) -> int:
+    """
+    Checksum fraco de um bloco de B bytes x_0..x_{B-1}:
+        a = soma x_j (mod 2^16)
+        b = soma (B - j) * x_j (mod 2^16) = soma das somas prefixadas
+    :return: a | (b << 16)
+    """
+    a = sum(data) & WEAK_MASK
+    b = sum(itertools.accumulate(data)) & WEAK_MASK
+    return a | (b << 16)
+
+
+def weak_checksums(data, block_size: int) -> List[int]:
+    """
+    Checksums fracos de todos os blocos inteiros de <data>; com NumPy,
+    todos de uma vez (a soma ponderada vira um produto de matrizes).
+    """
+    n_blocks = len(data) // block_size
+    if np is None:
+        view = memoryview(data)
+        return [
+            weak_checksum(view[i * block_size:(i + 1) * block_size])
+            for i in range(n_blocks)
+        ]
+    blocks = np.frombuffer(data, dtype=np.uint8, count=n_blocks * block_size)
+    blocks = blocks.reshape(n_blocks, block_size)
+    a = blocks.sum(axis=1, dtype=np.uint32) & WEAK_MASK
+    weights = np.arange(block_size, 0, -1, dtype=np.uint32)
+    b = (blocks.astype(np.uint32) @ weights) & WEAK_MASK
+    return (a | (b << 16)).tolist()
+
+
+def compute_signatures(
+        path: str,
+        block_size: int,
+        workers: Optional[int] = None
+) -> Tuple[bytes, bytes]:
+    """
+    Assinaturas dos blocos inteiros do arquivo antigo: checksum fraco
+    (o que o servidor rola) e hash forte. O arquivo é lido em lotes; os
+    fracos de um lote saem de uma vez e os fortes, em paralelo (hashlib
+    solta o GIL).
+    :param path: Caminho do arquivo antigo
+    :param block_size: Tamanho dos blocos
+    :param workers: Threads de hash
+    :return: (checksums fracos '!I' concatenados, hashes fortes concatenados)
+    """
+    batch_size = max(SIGNATURE_BATCH_SIZE // block_size, 1) * block_size
+    weak = []
+    strong = []
+    with open(path, mode='rb') as file, ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = file.read(batch_size)
+            if len(batch) < block_size:
+                break
+            view = memoryview(batch)
+            n_blocks = len(batch) // block_size
+            digests = executor.map(
+                strong_hash,
+                (view[i * block_size:(i + 1) * block_size] for i in range(n_blocks))
+            )
+            weak.extend(weak_checksums(batch, block_size))
+            strong.extend(digests)
+
+    return struct.pack(f'!{len(weak)}I', *weak), b''.join(strong)
+
+
+def rolling_checksums(data, start: int, stop: int, block_size: int):
+    """
+    Checksum fraco de todas as janelas de <block_size> bytes que começam
+    em [start, stop), de uma vez, com somas prefixadas:
+        a(k) = S1[k + B] - S1[k]
+        b(k) = (B + k) * a(k) - (S2[k + B] - S2[k])
+    com S1 a soma dos bytes e S2 a soma de i * byte[i] (índices relativos
+    a <start>). Equivale a rolar a janela byte a byte; a conta é toda em
+    uint16, módulo 2^16 como o próprio checksum.
+    :param data: Arquivo novo (array uint8)
+    :return: Array com os checksums, posição k - start
+    """
+    n_positions = stop - start
+    window = data[start:stop + block_size - 1].astype(np.uint16)
+    # Índices relativos, módulo 2^16 (arange em uint16 nem sempre dá a volta).
+    indexes = np.arange(n_positions + block_size, dtype=np.uint32).astype(np.uint16)
+    s1 = np.zeros(len(window) + 1, dtype=np.uint16)
+    np.cumsum(window, dtype=np.uint16, out=s1[1:])
+    window *= indexes[:len(window)]
+    s2 = np.zeros(len(window) + 1, dtype=np.uint16)
+    np.cumsum(window, dtype=np.uint16, out=s2[1:])
+
+    a = s1[block_size:block_size + n_positions] - s1[:n_positions]
+    b = indexes[block_size:block_size + n_positions] * a
+    b -= s2[block_size:block_size + n_positions]
+    b += s2[:n_positions]
+    weak = b.astype(np.uint32)
+    weak <<= 16
+    weak |= a
+    return weak
+
+
+class DeltaGenerator:
+    """
+    Lado do servidor: acha no arquivo novo os blocos que o cliente já tem
+    e gera instruções de cópia (do arquivo antigo) e literais.
+    """
+
+    def __init__(self, block_size: int, weak: bytes, strong: bytes):
+        self.block_size = block_size
+        n_blocks = len(weak) // 4
+        if len(strong) != n_blocks * STRONG_DIGEST_SIZE:
+            raise ValueError('Assinaturas inconsistentes.')
+        # Hash forte -> bloco; o primeiro bloco vence.
+        self.index: Dict[bytes, int] = {
+            strong[i * STRONG_DIGEST_SIZE:(i + 1) * STRONG_DIGEST_SIZE]: i
+            for i in reversed(range(n_blocks))
+        }
+        self.known_weak = self.weak_filter = None
+        if np is not None and n_blocks:
+            self.known_weak = np.unique(np.frombuffer(weak, dtype='>u4').astype(np.uint32))
+            filter_bits = min(
+                max(len(self.known_weak).bit_length() + 5, MIN_WEAK_FILTER_BITS),
+                MAX_WEAK_FILTER_BITS
+            )
+            self.filter_mask = (1 << filter_bits) - 1
+            self.weak_filter = np.zeros(1 << filter_bits, dtype=bool)
+            self.weak_filter[self.known_weak & self.filter_mask] = True
+
+    def find_block(self, window) -> Optional[int]:
+        """
+        :return: Bloco do arquivo antigo igual a <window>, ou None
+        """
+        return self.index.get(strong_hash(window))
+
+    def candidates(self, data, start: int, stop: int) -> Sequence[int]:
+        """
+        Posições em [start, stop) que podem começar um bloco do arquivo
+        antigo, em ordem. Com NumPy, todas as posições cujo checksum fraco
+        existe lá, filtradas de uma vez: o filtro descarta quase todas e
+        o isin tira os falsos positivos dele. Sem NumPy, só posições
+        alinhadas a blocos (cobre mudanças no lugar, não inserções).
+        """
+        block_size = self.block_size
+        if data is None:
+            first = -(-start // block_size) * block_size
+            return range(first, stop, block_size)
+        weak = rolling_checksums(data, start, stop, block_size)
+        positions = np.flatnonzero(self.weak_filter[weak & self.filter_mask])
+        positions = positions[np.isin(weak[positions], self.known_weak)]
+        positions += start
+        return positions
+
+    def generate(self, path: str) -> Iterator[Instruction]:
+        """
+        :param path: Caminho do arquivo novo
+        :return: Instruções em ordem; cópias seguidas são juntadas
+        """
+        size = os.path.getsize(path)
+        block_size = self.block_size
+        if size < block_size or not self.index:
+            yield from file_literals(path, size)
+            return
+
+        with open(path, mode='rb') as file:
+            file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            data = np.frombuffer(file_map, dtype=np.uint8) if np is not None else None
+
+            pending_copy = None
+            literal_start = 0
+            last_position = size - block_size
+            for segment_start in range(0, last_position + 1, SCAN_SEGMENT_SIZE):
+                segment_stop = min(segment_start + SCAN_SEGMENT_SIZE, last_position + 1)
+                # Posições antes de literal_start caem dentro de um bloco
+                # já casado: nem entram na busca.
+                scan_start = max(segment_start, literal_start)
+                positions = (
+                    self.candidates(data, scan_start, segment_stop)
+                    if scan_start < segment_stop else ()
+                )
+                i = 0
+                while i < len(positions):
+                    position = int(positions[i])
+                    block = self.find_block(file_map[position:position + block_size])
+                    if block is None:
+                        i += 1
+                        continue
+                    if position > literal_start:
+                        if pending_copy is not None:
+                            yield pending_copy
+                            pending_copy = None
+                        yield from map_literals(file_map, literal_start, position)
+                    copy_offset = block * block_size
+                    if (pending_copy is not None
+                            and pending_copy.offset + pending_copy.size == copy_offset):
+                        pending_copy = pending_copy._replace(
+                            size=pending_copy.size + block_size)
+                    else:
+                        if pending_copy is not None:
+                            yield pending_copy
+                        pending_copy = Instruction(OP_COPY, copy_offset, block_size, None)
+                    literal_start = position + block_size
+                    # Candidatos dentro do bloco casado são pulados de uma vez.
+                    i = bisect.bisect_left(positions, literal_start, i + 1)
+
+                # Nenhum bloco pode começar antes do próximo segmento:
+                # o literal até aqui já pode sair.
+                if literal_start < segment_stop:
+                    if pending_copy is not None:
+                        yield pending_copy
+                        pending_copy = None
+                    yield from map_literals(file_map, literal_start, segment_stop)
+                    literal_start = segment_stop
+
+            if pending_copy is not None:
+                yield pending_copy
+            yield from map_literals(file_map, literal_start, size)
+            del data
+            file_map.close()
+
+
+def map_literals(file_map, start: int, stop: int) -> Iterator[Instruction]:
+    for offset in range(start, stop, MAX_LITERAL_SIZE):
+        payload = file_map[offset:min(offset + MAX_LITERAL_SIZE, stop)]
+        yield Instruction(OP_LITERAL, 0, len(payload), payload)
+
+
+def file_literals(path: str, size: int) -> Iterator[Instruction]:
+    with open(path, mode='rb') as file:
+        for offset in range(0, size, MAX_LITERAL_SIZE):
+            payload = file.read(min(MAX_LITERAL_SIZE, size - offset))
+            yield Instruction(OP_LITERAL, 0, len(payload), payload)
+
+
+def send_delta(connection: socket.socket, instructions: Iterator[Instruction]) -> Tuple[int, int]:
+    """
+    Envia as instruções e a instrução de fim.
+    :return: (bytes copiados do arquivo antigo, bytes literais)
+    """
+    copied_bytes = literal_bytes = 0
+    for instruction in instructions:
+        header = DELTA_OP.pack(instruction.op, instruction.offset, instruction.size)
+        if instruction.op == OP_LITERAL:
+            send_buffers(connection, header, instruction.payload)
+            literal_bytes += instruction.size
+        else:
+            connection.sendall(header)
+            copied_bytes += instruction.size
+    connection.sendall(DELTA_OP.pack(OP_END, 0, 0))
+    return copied_bytes, literal_bytes
+
+
+def apply_delta(
+        connection: socket.socket,
+        old_path: str,
+        new_path: str,
+        on_progress=None
+) -> Tuple[str, int, int]:
+    """
+    Reconstrói o arquivo novo em <new_path> com as instruções recebidas:
+    cópias vêm de <old_path>, literais da conexão.
+    :param on_progress: Chamada com a quantidade de bytes de cada instrução
+    :return: (SHA-256 do arquivo novo, bytes copiados, bytes literais)
+    """
+    file_hash = hashlib.sha256()
+    copied_bytes = literal_bytes = 0
+    old_fd = os.open(old_path, os.O_RDONLY)
+    try:
+        with open(new_path, mode='wb') as new_file, RECV_POOL.buffer() as buffer:
+            view = memoryview(buffer)
+            while True:
+                op, offset, size = DELTA_OP.unpack(recv_exactly(connection, DELTA_OP.size))
+                if op == OP_END:
+                    break
+                if op == OP_COPY:
+                    for block_offset in range(offset, offset + size, len(buffer)):
+                        n_bytes = min(len(buffer), offset + size - block_offset)
+                        data = os.pread(old_fd, n_bytes, block_offset)
+                        if len(data) != n_bytes:
+                            raise RuntimeError('Arquivo antigo mudou durante o delta.')
+                        new_file.write(data)
+                        file_hash.update(data)
+                    copied_bytes += size
+                elif op == OP_LITERAL:
+                    received = 0
+                    while received < size:
+                        chunk = view[:min(len(buffer), size - received)]
+                        recv_into_exactly(connection, chunk)
+                        new_file.write(chunk)
+                        file_hash.update(chunk)
+                        received += len(chunk)
+                    literal_bytes += size
+                else:
+                    raise RuntimeError(f'Instrução de delta desconhecida: {op}.')
+                if on_progress is not None:
+                    on_progress(size)
+            view.release()
+    finally:
+        os.close(old_fd)
+    return file_hash.hexdigest(), copied_bytes, literal_bytes
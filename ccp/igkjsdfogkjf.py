@@ -2,7 +2,6 @@ import udt4py
 
 import tqdm
 import argparse 
-import pickle
 import socket
 import sys
 import logging
@@ -11,6 +10,8 @@ from config import *
 import re
 import typing
 
+from ccp.buffers import RECV_POOL, recv_to_file
+from ccp.messaging import MessageType, encode_message, read_message
 
 logger = logging.getLogger('ccp')
 
@@ -103,28 +104,22 @@ def send_download_request(s, path):
     send_request(s, path, upload_mode=False)
 
 
-def send_upload_request(s, path):
-    send_request(s, path, upload_mode=True)
+def send_upload_request(s, path, size):
+    send_request(s, path, upload_mode=True, size=size)
 
 
-def send_request(s, path, upload_mode):
+def send_request(s, path, upload_mode, size=None):
     message = {
         'mode': 'U' if upload_mode else 'D',
-        'path': path
+        'path': path,
+        'size': size
     }
-    message_bytes = pickle.dumps(message)
+    message_bytes = encode_message(MessageType.TRANSFER_REQUEST, message)
     s.sendall(message_bytes)
 
 
 def recv_response(s):
-    end_byte = b'\0'
-    response_bytes = b''
-    while True:
-        recv_bytes = s.recv(1024)
-        if recv_bytes == end_byte:
-            break
-        response_bytes += recv_bytes
-    response = pickle.loads(response_bytes)
+    _, response = read_message(s.recv)
     return response
 
 
@@ -176,26 +171,24 @@ def sendfile(sock, path):
 
 def recvfile(sock, path, size):
     progress = tqdm.tqdm(range(size), f"Receiving {size}", unit="B", unit_scale=True, unit_divisor=BUFFER_SIZE)
-    total_data_written = 0
     with open(path, 'wb') as file:
-        while total_data_written < size:
-            data = sock.recv(BUFFER_SIZE)
-            curr_data_written = file.write(data)
-            total_data_written += curr_data_written
-            progress.update(curr_data_written)
+        recv_to_file(sock, file, size, on_progress=progress.update)
 
 
 def udt_recvfile(sock, path, size):
     progress = tqdm.tqdm(range(size), f"Receiving {size}", unit="B", unit_scale=True, unit_divisor=BUFFER_SIZE)
     total_data_written = 0
-    buffer = bytearray(BUFFER_SIZE)
-    bv = memoryview(buffer)
-    with open(path, 'wb') as file:
-        while total_data_written < size:
-            sock.recv(bv)
-            curr_data_written = file.write(bv.tobytes())
-            total_data_written += curr_data_written
-            progress.update(curr_data_written)
+    with RECV_POOL.buffer() as buffer:
+        bv = memoryview(buffer)
+        with open(path, 'wb') as file:
+            while total_data_written < size:
+                # Só a parte recebida do buffer vai para o arquivo.
+                bytes_received = sock.recv(bv[:min(size - total_data_written, len(bv))])
+                if not bytes_received:
+                    raise RuntimeError('Broken connection.')
+                curr_data_written = file.write(bv[:bytes_received])
+                total_data_written += curr_data_written
+                progress.update(curr_data_written)
 
 
 def parse_remote_path(path: str) -> typing.Optional[typing.Tuple[str, str, str]]:
@@ -260,7 +253,12 @@ def run_client(local_path, remote_path, upload_mode=False):
         sys.exit(1)
 
     try:
-        send_request(tcp_connection, path=remote_path, upload_mode=upload_mode)
+        send_request(
+            tcp_connection,
+            path=remote_path,
+            upload_mode=upload_mode,
+            size=os.path.getsize(local_path) if upload_mode else None
+        )
     except Exception as err:
         print(err)
         sys.exit(1)
@@ -281,7 +279,10 @@ def run_client(local_path, remote_path, upload_mode=False):
         sys.exit(1)
     else:
         file_size = int(server_text.split()[-1])
-        logger.info('Servidor vai enviar %s de tamanho %s bytes.', remote_path, file_size)
+        if upload_mode:
+            logger.info('Servidor vai receber %s de tamanho %s bytes.', remote_path, file_size)
+        else:
+            logger.info('Servidor vai enviar %s de tamanho %s bytes.', remote_path, file_size)
 
     try:
         udt_connection = open_udt_connection(remote_host, udt_port)
@@ -291,8 +292,12 @@ def run_client(local_path, remote_path, upload_mode=False):
         sys.exit(1)
 
     try:
-        logger.info('Esperando receber por UDT o arquivo %s de tamanho %s do servidor em (%s, %s)', remote_path, file_size, remote_host, udt_port)
-        udt_connection.recvfile(local_path, offset=0, size=file_size)
+        if upload_mode:
+            logger.info('Enviando por UDT o arquivo %s de tamanho %s ao servidor em (%s, %s)', local_path, file_size, remote_host, udt_port)
+            udt_connection.sendfile(local_path)
+        else:
+            logger.info('Esperando receber por UDT o arquivo %s de tamanho %s do servidor em (%s, %s)', remote_path, file_size, remote_host, udt_port)
+            udt_connection.recvfile(local_path, offset=0, size=file_size)
         # recvfile(tcp_connection, local_path, file_size)
     except Exception as err:
         print(err)
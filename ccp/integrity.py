@@ -0,0 +1,92 @@
+import hashlib
+import threading
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+# Checksums por pedaço, em ordem de preferência.
+CHECKSUMS: Dict[str, Callable[[bytes], int]] = {}
+
+if xxhash is not None:
+    CHECKSUMS['xxh64'] = xxhash.xxh64_intdigest
+
+CHECKSUMS['crc32'] = zlib.crc32
+
+# Tamanho das leituras do hash do arquivo inteiro.
+HASH_READ_SIZE = 4 * 2 ** 20
+
+
+def available_checksums() -> List[str]:
+    return list(CHECKSUMS)
+
+
+def get_checksum(name: str) -> Callable[[bytes], int]:
+    try:
+        return CHECKSUMS[name]
+    except KeyError:
+        raise ValueError(f'Checksum {name} não é suportado.')
+
+
+def negotiate_checksum(client_checksums: Iterable[str]) -> Optional[str]:
+    """
+    Escolhe o primeiro checksum da lista do cliente que o servidor conhece.
+    :param client_checksums: Checksums do cliente, em ordem de preferência
+    :return: Nome do checksum, ou None se não houver checksum em comum
+    """
+    for name in client_checksums:
+        if name in CHECKSUMS:
+            return name
+    return None
+
+
+def sha256_file(path: str, read_size: int = HASH_READ_SIZE) -> str:
+    """
+    :param path: Caminho do arquivo
+    :param read_size: Tamanho de cada leitura
+    :return: SHA-256 do arquivo inteiro (hexadecimal)
+    """
+    file_hash = hashlib.sha256()
+    buffer = bytearray(read_size)
+    view = memoryview(buffer)
+    with open(path, mode='rb') as file:
+        while True:
+            bytes_read = file.readinto(buffer)
+            if not bytes_read:
+                break
+            file_hash.update(view[:bytes_read])
+    return file_hash.hexdigest()
+
+
+class BackgroundFileHash:
+    """
+    Calcula o SHA-256 de um arquivo numa thread separada, em paralelo ao
+    envio das partições.
+    """
+
+    def __init__(self, path: str):
+        self.__result = None
+        self.__error = None
+        self.__thread = threading.Thread(
+            target=self.__run,
+            args=(path,),
+            name='ccp-sha256',
+            daemon=True
+        )
+        self.__thread.start()
+
+    def __run(self, path):
+        try:
+            self.__result = sha256_file(path)
+        except Exception as exc:
+            self.__error = exc
+
+    def result(self) -> str:
+        self.__thread.join()
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
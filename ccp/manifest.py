@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+# Extensão do manifesto guardado ao lado do arquivo baixado.
+MANIFEST_EXTENSION = '.ccp-manifest'
+
+# Intervalo mínimo entre gravações do manifesto durante o download.
+SAVE_INTERVAL = 1.0
+
+# Bytes do começo e do fim do arquivo usados na assinatura de identidade.
+IDENTITY_SAMPLE_SIZE = 64 * 2 ** 10
+
+
+def get_file_identity(path: str) -> Dict:
+    """
+    Identidade do arquivo remoto: tamanho, mtime e hash de amostras do
+    começo e do fim. Se mudar, o download parcial não vale mais.
+    :param path: Caminho do arquivo
+    :return: Identidade
+    """
+    stat = os.stat(path)
+    sample_hash = hashlib.sha256()
+    with open(path, mode='rb') as file:
+        sample_hash.update(file.read(IDENTITY_SAMPLE_SIZE))
+        if stat.st_size > IDENTITY_SAMPLE_SIZE:
+            file.seek(max(IDENTITY_SAMPLE_SIZE, stat.st_size - IDENTITY_SAMPLE_SIZE))
+            sample_hash.update(file.read(IDENTITY_SAMPLE_SIZE))
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'sample_hash': sample_hash.hexdigest()
+    }
+
+
+def get_manifest_path(local_path: str) -> str:
+    return str(local_path) + MANIFEST_EXTENSION
+
+
+class RangeManifest:
+    """
+    Manifesto das faixas já gravadas de um download, para retomá-lo.
+
+    Fica em <local_path>.ccp-manifest (JSON) e é regravado no máximo a
+    cada SAVE_INTERVAL segundos, então um processo morto perde no máximo
+    esse intervalo de progresso.
+    """
+
+    def __init__(
+            self,
+            local_path: str,
+            remote_path: str,
+            identity: Dict,
+            codec: Optional[str] = None,
+            completed: Optional[List[Tuple[int, int]]] = None
+    ):
+        self.local_path = str(local_path)
+        self.remote_path = remote_path
+        self.identity = identity
+        self.codec = codec
+        # Faixas [início, fim) disjuntas e ordenadas.
+        self.__completed = [tuple(r) for r in (completed or [])]
+        self.__lock = threading.Lock()
+        self.__last_save = 0.0
+
+    @property
+    def path(self) -> str:
+        return get_manifest_path(self.local_path)
+
+    @property
+    def size(self) -> int:
+        return self.identity['size']
+
+    @classmethod
+    def load(cls, local_path: str, remote_path: str) -> Optional['RangeManifest']:
+        """
+        Carrega o manifesto de um download anterior do mesmo arquivo.
+        :return: Manifesto, ou None se não houver um válido
+        """
+        manifest_path = get_manifest_path(local_path)
+        if not os.path.isfile(manifest_path) or not os.path.isfile(local_path):
+            return None
+        try:
+            with open(manifest_path, 'r') as manifest_file:
+                content = json.load(manifest_file)
+            if content['remote_path'] != remote_path:
+                return None
+            return cls(
+                local_path,
+                remote_path,
+                identity=content['identity'],
+                codec=content.get('codec'),
+                completed=content['completed']
+            )
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def add(self, start_byte: int, length: int):
+        """
+        Marca [start_byte, start_byte + length) como gravado.
+        """
+        if length <= 0:
+            return
+        end_byte = start_byte + length
+        with self.__lock:
+            merged = []
+            for start, end in self.__completed:
+                if end < start_byte or start > end_byte:
+                    merged.append((start, end))
+                else:
+                    start_byte = min(start, start_byte)
+                    end_byte = max(end, end_byte)
+            merged.append((start_byte, end_byte))
+            merged.sort()
+            self.__completed = merged
+            should_save = time.monotonic() - self.__last_save >= SAVE_INTERVAL
+        if should_save:
+            self.save()
+
+    def completed_bytes(self) -> int:
+        with self.__lock:
+            return sum(end - start for start, end in self.__completed)
+
+    def missing(self) -> List[Tuple[int, int]]:
+        """
+        :return: Faixas (byte inicial, tamanho) que ainda faltam
+        """
+        missing = []
+        position = 0
+        with self.__lock:
+            for start, end in self.__completed:
+                if start > position:
+                    missing.append((position, start - position))
+                position = max(position, end)
+        if position < self.size:
+            missing.append((position, self.size - position))
+        return missing
+
+    def save(self):
+        with self.__lock:
+            content = {
+                'remote_path': self.remote_path,
+                'identity': self.identity,
+                'codec': self.codec,
+                'completed': self.__completed,
+            }
+            self.__last_save = time.monotonic()
+            temporary_path = self.path + '.tmp'
+            with open(temporary_path, 'w') as manifest_file:
+                json.dump(content, manifest_file)
+            os.replace(temporary_path, self.path)
+
+    def remove(self):
+        with self.__lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
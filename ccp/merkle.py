@@ -0,0 +1,262 @@
+import collections
+import hashlib
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from ccp.messaging import MessageType, ProtocolError, recv_message, send_message
+from ccp.partitioning import merge_ranges
+
+
+# Tamanho dos blocos das folhas da árvore.
+MERKLE_BLOCK_SIZE = 2 ** 20
+
+# Menor e maior tamanho de bloco aceitos pelo servidor. O teto é baixo
+# porque cada worker do build lê uma folha inteira na memória.
+MIN_MERKLE_BLOCK_SIZE = 4096
+MAX_MERKLE_BLOCK_SIZE = 4 * 2 ** 20
+
+# Tamanho de cada hash (BLAKE2b truncado).
+DIGEST_SIZE = 16
+
+# Árvores guardadas pelo servidor.
+MAX_CACHED_TREES = 32
+
+# Nós pedidos numa mensagem TREE_REQUEST: pedido e resposta ficam bem
+# abaixo de MAX_MESSAGE_SIZE (uns 23 bytes por nó).
+MAX_TREE_NODES = 2 ** 16
+
+
+def hash_leaf(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def hash_children(left: bytes, right: bytes) -> bytes:
+    return hashlib.blake2b(left + right, digest_size=DIGEST_SIZE).digest()
+
+
+class MerkleTree:
+    """
+    Árvore de hashes dos blocos de um arquivo.
+    levels[0] são as folhas (um hash por bloco) e levels[-1] é a raiz.
+    O nó i do nível l cobre os blocos [i * 2^l, (i + 1) * 2^l); um nó sem
+    irmão sobe sem ser re-hasheado.
+    """
+
+    def __init__(self, size: int, block_size: int, levels: List[List[bytes]]):
+        self.size = size
+        self.block_size = block_size
+        self.levels = levels
+
+    @classmethod
+    def build(
+            cls,
+            path: str,
+            block_size: int = MERKLE_BLOCK_SIZE,
+            workers: Optional[int] = None
+    ) -> 'MerkleTree':
+        """
+        Hasheia os blocos do arquivo em paralelo (hashlib solta o GIL) e
+        monta os níveis de cima.
+        """
+        size = os.path.getsize(path)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            def hash_block(offset):
+                return hash_leaf(os.pread(fd, min(block_size, size - offset), offset))
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                leaves = list(executor.map(hash_block, range(0, size, block_size)))
+        finally:
+            os.close(fd)
+
+        # Arquivo vazio: uma folha com o hash de nada.
+        levels = [leaves or [hash_leaf(b'')]]
+        while len(levels[-1]) > 1:
+            below = levels[-1]
+            levels.append([
+                hash_children(below[i], below[i + 1]) if i + 1 < len(below) else below[i]
+                for i in range(0, len(below), 2)
+            ])
+        return cls(size, block_size, levels)
+
+    @property
+    def depth(self) -> int:
+        return len(self.levels)
+
+    @property
+    def root(self) -> bytes:
+        return self.levels[-1][0]
+
+    def node(self, level: int, index: int) -> Optional[bytes]:
+        """
+        :return: Hash do nó, ou None se ele não existe nesta árvore
+        """
+        if 0 <= level < len(self.levels) and 0 <= index < len(self.levels[level]):
+            return self.levels[level][index]
+        return None
+
+
+class MerkleTreeCache:
+    """
+    Árvores recentes do servidor, por (caminho, tamanho, mtime, tamanho do
+    bloco): verificar de novo um arquivo que não mudou não relê o arquivo.
+    """
+
+    def __init__(self, max_trees: int = MAX_CACHED_TREES):
+        self.max_trees = max_trees
+        self.__trees = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, path: str, block_size: int) -> MerkleTree:
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns, block_size)
+        with self.__lock:
+            tree = self.__trees.get(key)
+            if tree is not None:
+                self.__trees.move_to_end(key)
+                return tree
+
+        tree = MerkleTree.build(path, block_size)
+        with self.__lock:
+            self.__trees[key] = tree
+            while len(self.__trees) > self.max_trees:
+                self.__trees.popitem(last=False)
+        return tree
+
+
+def answer_nodes(tree: MerkleTree, nodes) -> Optional[List[Optional[bytes]]]:
+    """
+    Hashes dos nós que o cliente pediu num TREE_REQUEST.
+    :param tree: Árvore do arquivo
+    :param nodes: Pares (nível, índice) pedidos
+    :return: Hash de cada nó (None para nós que não existem nesta árvore,
+        como os da parte que sobra do arquivo maior), ou None se o pedido
+        é inválido: malformado, com nível ou índice negativo, ou com mais
+        de MAX_TREE_NODES nós
+    """
+    if not isinstance(nodes, list) or len(nodes) > MAX_TREE_NODES:
+        return None
+    hashes = []
+    for node in nodes:
+        if not isinstance(node, list) or len(node) != 2:
+            return None
+        level, index = node
+        if type(level) is not int or type(index) is not int or level < 0 or index < 0:
+            return None
+        hashes.append(tree.node(level, index))
+    return hashes
+
+
+def request_nodes(
+        connection: socket.socket,
+        nodes: List[Tuple[int, int]]
+) -> List[Optional[bytes]]:
+    """
+    Pede ao servidor os hashes de <nodes>, em mensagens de até
+    MAX_TREE_NODES nós.
+    :return: Hash remoto de cada nó, na ordem de <nodes>
+    """
+    hashes = []
+    for start in range(0, len(nodes), MAX_TREE_NODES):
+        batch = nodes[start:start + MAX_TREE_NODES]
+        send_message(connection, MessageType.TREE_REQUEST, {'nodes': batch})
+        _, response = recv_message(connection, expected_type=MessageType.TREE_RESPONSE)
+        if response.get('hashes') is None or len(response['hashes']) != len(batch):
+            raise ProtocolError('Servidor recusou os nós pedidos da árvore.')
+        hashes.extend(response['hashes'])
+    return hashes
+
+
+def leaf_range(size: int, block_size: int, index: int) -> Tuple[int, int]:
+    """
+    :return: Faixa (byte inicial, tamanho) do bloco <index>, cortada em <size>
+    """
+    start = index * block_size
+    return start, max(min(block_size, size - start), 0)
+
+
+def compare_remote_tree(
+        connection: socket.socket,
+        local_path: str,
+        remote_path: str,
+        block_size: int = MERKLE_BLOCK_SIZE
+) -> Dict:
+    """
+    Compara <local_path> com <remote_path> no servidor sem baixar o
+    arquivo: o cliente monta a árvore local e desce, nível a nível, só nos
+    nós cujo hash difere do remoto. Cada nível custa uma ida e volta com
+    os hashes pedidos.
+    :param connection: Conexão com o servidor
+    :param local_path: Caminho do arquivo local
+    :param remote_path: Caminho do arquivo remoto
+    :param block_size: Tamanho dos blocos das folhas
+    :return: Relatório no formato de ccp_compare.find_differences
+    """
+    send_message(connection, MessageType.TREE_REQUEST, {
+        'path': remote_path,
+        'block_size': block_size
+    })
+    _, response = recv_message(connection, expected_type=MessageType.TREE_RESPONSE)
+    if response['size'] is None and response.get('retry_after') is not None:
+        raise ConnectionError(
+            f'Servidor cheio: tente de novo em {response["retry_after"]:g} s.')
+    if response['size'] is None:
+        raise FileNotFoundError(f'Arquivo {remote_path} não foi encontrado pelo servidor.')
+
+    remote_size = response['size']
+    local_tree = MerkleTree.build(local_path, response['block_size'])
+    block_size = local_tree.block_size
+
+    # Com tamanhos diferentes as alturas podem diferir: a descida começa
+    # por todos os nós do nível mais alto que as duas árvores têm.
+    level = min(local_tree.depth, response['depth']) - 1
+    remote_width = -(-response['leaves'] // 2 ** level)
+    nodes = [
+        (level, index)
+        for index in range(max(len(local_tree.levels[level]), remote_width))
+    ]
+
+    differing_leaves = []
+    while nodes:
+        differing = [
+            (node_level, index)
+            for (node_level, index), remote_hash in zip(nodes, request_nodes(connection, nodes))
+            if local_tree.node(node_level, index) != remote_hash
+        ]
+        if not differing or differing[0][0] == 0:
+            differing_leaves = [index for _, index in differing]
+            break
+        # Nós que não existem numa das árvores valem None dos dois lados.
+        nodes = [
+            (node_level - 1, child)
+            for node_level, index in differing
+            for child in (2 * index, 2 * index + 1)
+        ]
+    # Lista vazia termina a sessão.
+    send_message(connection, MessageType.TREE_REQUEST, {'nodes': []})
+
+    common_size = min(local_tree.size, remote_size)
+    differences = [
+        (start, length)
+        for start, length in (
+            leaf_range(common_size, block_size, index)
+            for index in differing_leaves
+        )
+        if length
+    ]
+    if local_tree.size != remote_size:
+        differences.append((common_size, abs(local_tree.size - remote_size)))
+    differences = merge_ranges(sorted(differences))
+
+    return {
+        'source': local_path,
+        'target': remote_path,
+        'source_size': local_tree.size,
+        'target_size': remote_size,
+        'equal': not differences,
+        'differing_bytes': sum(length for _, length in differences),
+        'differences': [[start, length] for start, length in differences]
+    }
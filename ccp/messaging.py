@@ -1,50 +1,473 @@
-import pickle
+import asyncio
+import enum
 import socket
-from typing import Dict
+import struct
+from typing import Any, BinaryIO, Callable, Dict, Optional, Tuple
 
+from ccp.buffers import RECV_POOL, BufferPool, recv_into_exactly, recv_to_file
 
-def send_message(connection: socket.socket, message):
+
+# Versão do protocolo binário. Mensagens de outra versão são recusadas.
+PROTOCOL_VERSION = 1
+
+# Cabeçalho de cada mensagem de controle:
+# magic (2 bytes), versão, tipo da mensagem e tamanho do conteúdo.
+MESSAGE_MAGIC = b'CP'
+MESSAGE_HEADER = struct.Struct('!2sBBI')
+
+# Limite para não alocar memória arbitrária a partir de dados da rede.
+MAX_MESSAGE_SIZE = 64 * 2 ** 20
+
+# Arquivos até este tamanho vão inteiros no DOWNLOAD_RESPONSE, pela
+# conexão de controle, sem streams de dados (o limite é configurável no
+# servidor, até MAX_INLINE_SIZE).
+DEFAULT_INLINE_THRESHOLD = 64 * 2 ** 10
+MAX_INLINE_SIZE = MAX_MESSAGE_SIZE // 2
+
+# Cabeçalho de cada partição: tamanho, ou STREAMED_PARTITION_SIZE quando
+# a partição chega em quadros até o quadro vazio, ou CHUNKED_PARTITION_SIZE
+# quando chega em pedaços com checksum (CHUNK_HEADER), ou
+# SCHEDULED_PARTITION_SIZE quando a stream recebe pedaços de qualquer parte
+# do arquivo (CHUNK_HEADER), distribuídos sob demanda pelo servidor.
+PARTITION_HEADER = struct.Struct('!q')
+STREAMED_PARTITION_SIZE = -1
+CHUNKED_PARTITION_SIZE = -2
+SCHEDULED_PARTITION_SIZE = -3
+
+# Cabeçalho de cada pedaço com checksum: byte inicial e tamanho da faixa
+# original, tamanho do conteúdo enviado, checksum do conteúdo e se o
+# conteúdo foi sem compressão (bloco incompressível, compressão adaptativa).
+# Um pedaço com faixa e conteúdo vazios marca o fim da partição.
+CHUNK_HEADER = struct.Struct('!QIIQ?')
+
+# Cabeçalho de cada quadro de dados: tamanho do conteúdo (uint32) e se o
+# conteúdo foi sem compressão. Um quadro vazio marca o fim do fluxo.
+FRAME_HEADER = struct.Struct('!I?')
+
+
+class MessageType(enum.IntEnum):
+    DOWNLOAD_REQUEST = 1
+    DOWNLOAD_RESPONSE = 2
+    # Protocolo UDT (ccpd.py / igkjsdfogkjf.py)
+    TRANSFER_REQUEST = 3
+    TRANSFER_RESPONSE = 4
+    DOWNLOAD_RESULT = 5
+    # Comparação remota por árvore de Merkle (ccp/merkle.py)
+    TREE_REQUEST = 6
+    TREE_RESPONSE = 7
+    # Download por delta, estilo rsync (ccp/delta.py)
+    DELTA_REQUEST = 8
+    DELTA_RESPONSE = 9
+    # Primeira mensagem de uma conexão de dados: token da sessão e id da stream
+    STREAM_ATTACH = 10
+    # Download de um diretório inteiro em lotes (ccp/packing.py)
+    DIRECTORY_REQUEST = 11
+    DIRECTORY_RESPONSE = 12
+    # Sessão com vários pedidos numa conexão de controle (ccp/pipeline.py)
+    SESSION_OPEN = 13
+    SESSION_READY = 14
+    SESSION_REQUEST = 15
+    SESSION_REPLY = 16
+    # Upload em faixas paralelas (ccp/upload.py)
+    UPLOAD_REQUEST = 17
+    UPLOAD_RESPONSE = 18
+    UPLOAD_COMMIT = 19
+    UPLOAD_RESULT = 20
+    # Lista de pedaços definidos pelo conteúdo (ccp/chunking.py)
+    CHUNKS_REQUEST = 21
+    CHUNKS_RESPONSE = 22
+
+
+class ProtocolError(RuntimeError):
+    pass
+
+
+# Tags dos valores codificados no conteúdo das mensagens.
+_NONE = ord('N')
+_TRUE = ord('T')
+_FALSE = ord('F')
+_INT = ord('i')
+_FLOAT = ord('d')
+_STR = ord('s')
+_BYTES = ord('b')
+_LIST = ord('l')
+_DICT = ord('m')
+
+_INT_STRUCT = struct.Struct('!Bq')
+_FLOAT_STRUCT = struct.Struct('!Bd')
+_LENGTH_STRUCT = struct.Struct('!BI')
+
+_SINGLETONS = {None: bytes([_NONE]), True: bytes([_TRUE]), False: bytes([_FALSE])}
+
+
+def _encode_value(value, parts: list):
+    value_type = type(value)
+    if value_type is str:
+        encoded = value.encode('utf-8')
+        parts.append(_LENGTH_STRUCT.pack(_STR, len(encoded)))
+        parts.append(encoded)
+    elif value_type is int:
+        parts.append(_INT_STRUCT.pack(_INT, value))
+    elif value is None or value_type is bool:
+        parts.append(_SINGLETONS[value])
+    elif value_type is float:
+        parts.append(_FLOAT_STRUCT.pack(_FLOAT, value))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        parts.append(_LENGTH_STRUCT.pack(_BYTES, len(value)))
+        parts.append(bytes(value))
+    elif isinstance(value, (list, tuple)):
+        parts.append(_LENGTH_STRUCT.pack(_LIST, len(value)))
+        for item in value:
+            _encode_value(item, parts)
+    elif isinstance(value, dict):
+        parts.append(_LENGTH_STRUCT.pack(_DICT, len(value)))
+        for key, item in value.items():
+            _encode_value(str(key), parts)
+            _encode_value(item, parts)
+    elif isinstance(value, int):  # IntEnum, etc.
+        parts.append(_INT_STRUCT.pack(_INT, int(value)))
+    else:
+        raise TypeError(f'Tipo não suportado na mensagem: {type(value).__name__}')
+
+
+def _decode_value(data: bytes, offset: int) -> Tuple[Any, int]:
+    tag = data[offset]
+    if tag == _STR or tag == _BYTES:
+        _, length = _LENGTH_STRUCT.unpack_from(data, offset)
+        start = offset + _LENGTH_STRUCT.size
+        end = start + length
+        if end > len(data):
+            raise ProtocolError('Mensagem truncada.')
+        if tag == _STR:
+            return data[start:end].decode('utf-8'), end
+        return data[start:end], end
+    if tag == _INT:
+        return _INT_STRUCT.unpack_from(data, offset)[1], offset + _INT_STRUCT.size
+    if tag == _NONE:
+        return None, offset + 1
+    if tag == _TRUE:
+        return True, offset + 1
+    if tag == _FALSE:
+        return False, offset + 1
+    if tag == _FLOAT:
+        return _FLOAT_STRUCT.unpack_from(data, offset)[1], offset + _FLOAT_STRUCT.size
+    if tag == _LIST or tag == _DICT:
+        _, length = _LENGTH_STRUCT.unpack_from(data, offset)
+        offset += _LENGTH_STRUCT.size
+        if tag == _LIST:
+            items = []
+            for _ in range(length):
+                item, offset = _decode_value(data, offset)
+                items.append(item)
+            return items, offset
+        items = {}
+        for _ in range(length):
+            key, offset = _decode_value(data, offset)
+            items[key], offset = _decode_value(data, offset)
+        return items, offset
+    raise ProtocolError(f'Tag desconhecida na mensagem: {tag!r}')
+
+
+def encode_message(message_type: MessageType, message: Dict) -> bytes:
     """
-    Envia mensagem  de 512 bytes pela conexão para recv_message.
+    Codifica a mensagem no formato binário: cabeçalho + campos.
+    :param message_type: Tipo da mensagem
+    :param message: Campos da mensagem
+    :return: Bytes da mensagem
+    """
+    parts = [b'']
+    _encode_value(message, parts)
+    payload_size = sum(len(part) for part in parts)
+    if payload_size > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f'Mensagem de {payload_size} bytes é grande demais.')
+    parts[0] = MESSAGE_HEADER.pack(
+        MESSAGE_MAGIC, PROTOCOL_VERSION, message_type, payload_size
+    )
+    return b''.join(parts)
+
+
+def decode_message_header(header: bytes) -> Tuple[MessageType, int]:
+    """
+    :param header: MESSAGE_HEADER.size bytes
+    :return: (Tipo da mensagem, tamanho do conteúdo)
+    """
+    magic, version, message_type, payload_size = MESSAGE_HEADER.unpack(header)
+    if magic != MESSAGE_MAGIC:
+        raise ProtocolError('Mensagem não é do protocolo CCP.')
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f'Versão {version} do protocolo não é suportada.')
+    if payload_size > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f'Mensagem de {payload_size} bytes é grande demais.')
+    try:
+        message_type = MessageType(message_type)
+    except ValueError:
+        raise ProtocolError(f'Tipo de mensagem desconhecido: {message_type}')
+    return message_type, payload_size
+
+
+def decode_message_payload(payload) -> Dict:
+    payload = bytes(payload)
+    try:
+        message, offset = _decode_value(payload, 0)
+    except (IndexError, struct.error, UnicodeDecodeError, RecursionError) as exc:
+        raise ProtocolError(f'Conteúdo de mensagem inválido: {exc}')
+    if offset != len(payload) or not isinstance(message, dict):
+        raise ProtocolError('Conteúdo de mensagem inválido.')
+    return message
+
+
+def decode_message(data) -> Tuple[MessageType, Dict]:
+    """
+    Decodifica uma mensagem completa criada por encode_message.
+    :param data: Bytes da mensagem
+    :return: (Tipo da mensagem, campos)
+    """
+    header = bytes(data[:MESSAGE_HEADER.size])
+    if len(header) < MESSAGE_HEADER.size:
+        raise ProtocolError('Mensagem truncada.')
+    message_type, payload_size = decode_message_header(header)
+    payload = memoryview(data)[MESSAGE_HEADER.size:]
+    if len(payload) != payload_size:
+        raise ProtocolError('Mensagem truncada.')
+    return message_type, decode_message_payload(payload)
+
+
+def send_message(
+        connection: socket.socket,
+        message_type: MessageType,
+        message: Dict
+):
+    """
+    Envia mensagem pela conexão para recv_message.
     :param connection: Conexão TCP
+    :param message_type: Tipo da mensagem
     :param message: Mensagem (pedido)
     """
-    message_sendbuf = bytearray(512)
-    request_bytes = pickle.dumps(message)
-    message_sendbuf[:len(request_bytes)] = request_bytes
-    connection.sendall(message_sendbuf)
+    connection.sendall(encode_message(message_type, message))
 
 
-def recv_n_bytes(
+def recv_message(
         connection: socket.socket,
-        n_bytes: int,
-        bufsize=1024
+        expected_type: MessageType = None
+) -> Tuple[MessageType, Dict]:
+    """
+    Recebe mensagem pela conexão enviada por send_message.
+    :param connection: Conexão TCP
+    :param expected_type: Se dado, outro tipo de mensagem é erro
+    :return: (Tipo da mensagem, mensagem)
+    """
+    header = recv_exactly(connection, MESSAGE_HEADER.size)
+    message_type, payload_size = decode_message_header(header)
+    if expected_type is not None and message_type != expected_type:
+        raise ProtocolError(
+            f'Esperava mensagem {expected_type.name}, recebi {message_type.name}.')
+    payload = recv_exactly(connection, payload_size)
+    return message_type, decode_message_payload(payload)
+
+
+async def recv_message_async(
+        reader: asyncio.StreamReader,
+        expected_type: MessageType = None
+) -> Tuple[MessageType, Dict]:
+    """
+    Como recv_message, para o servidor asyncio.
+    :param reader: Leitor da conexão
+    :param expected_type: Se dado, outro tipo de mensagem é erro
+    :return: (Tipo da mensagem, mensagem)
+    """
+    header = await reader.readexactly(MESSAGE_HEADER.size)
+    message_type, payload_size = decode_message_header(header)
+    if expected_type is not None and message_type != expected_type:
+        raise ProtocolError(
+            f'Esperava mensagem {expected_type.name}, recebi {message_type.name}.')
+    payload = await reader.readexactly(payload_size)
+    return message_type, decode_message_payload(payload)
+
+
+async def send_message_async(
+        writer: asyncio.StreamWriter,
+        message_type: MessageType,
+        message: Dict
 ):
-    empty_byte = b''
-    message_bytes = b''
-    total_bytes_received = 0
-    while total_bytes_received < n_bytes:
-        recv_bytes = connection.recv(min(n_bytes - total_bytes_received, bufsize))
-        if recv_bytes == empty_byte:
-            raise RuntimeError('Broken connection.')
-        message_bytes += recv_bytes
-        total_bytes_received += len(recv_bytes)
-
-    message = pickle.loads(message_bytes)
-    return message
+    """
+    Como send_message, para o servidor asyncio.
+    :param writer: Escritor da conexão
+    :param message_type: Tipo da mensagem
+    :param message: Mensagem
+    """
+    writer.write(encode_message(message_type, message))
+    await writer.drain()
 
 
-def recv_message(connection: socket.socket, nbytes=512):
+def read_message(recv: Callable[[int], bytes]) -> Tuple[MessageType, Dict]:
     """
-    Recebe mensagem pela conexão enviada por send_message.
+    Lê uma mensagem usando uma função recv(n) que devolve bytes, para
+    sockets que não são do módulo socket (ex.: UDT).
+    :param recv: Função de recebimento
+    :return: (Tipo da mensagem, mensagem)
+    """
+    def read_exactly(n_bytes):
+        chunks = []
+        missing = n_bytes
+        while missing > 0:
+            chunk = recv(missing)
+            if not chunk:
+                raise RuntimeError('Broken connection.')
+            chunks.append(chunk)
+            missing -= len(chunk)
+        return b''.join(chunks)
+
+    message_type, payload_size = decode_message_header(
+        read_exactly(MESSAGE_HEADER.size))
+    return message_type, decode_message_payload(read_exactly(payload_size))
+
+
+def send_partition_header(connection: socket.socket, size: int):
+    """
+    Antes de enviar a partição, enviamos o seu tamanho, ou
+    STREAMED_PARTITION_SIZE se ela for enviada em quadros.
+    :param connection: Conexão TCP de dados
+    :param size: Tamanho da partição
+    """
+    connection.sendall(PARTITION_HEADER.pack(size))
+
+
+def recv_partition_header(connection: socket.socket) -> int:
+    """
+    :param connection: Conexão TCP de dados
+    :return: Tamanho da partição, ou STREAMED_PARTITION_SIZE
+    """
+    (size,) = PARTITION_HEADER.unpack(
+        recv_exactly(connection, PARTITION_HEADER.size))
+    return size
+
+
+def send_chunk(
+        connection: socket.socket,
+        offset: int,
+        size: int,
+        payload,
+        checksum: int,
+        raw: bool = False
+):
+    """
+    Envia um pedaço com checksum para recv_chunk_header.
     :param connection: Conexão TCP
-    :param nbytes: Tamanho esperado da mensagem
-    :return: Mensagem
+    :param offset: Byte inicial da faixa original
+    :param size: Tamanho da faixa original
+    :param payload: Conteúdo (comprimido ou não)
+    :param checksum: Checksum do conteúdo
+    :param raw: O conteúdo vai sem compressão numa partição comprimida
     """
+    header = CHUNK_HEADER.pack(offset, size, len(payload), checksum, raw)
+    send_buffers(connection, header, payload)
 
-    message = recv_n_bytes(
-        connection,
-        n_bytes=nbytes,
-    )
 
-    return message
+def send_end_chunk(connection: socket.socket):
+    connection.sendall(CHUNK_HEADER.pack(0, 0, 0, 0, False))
+
+
+def recv_chunk_header(connection: socket.socket) -> Tuple[int, int, int, int, bool]:
+    """
+    :param connection: Conexão TCP
+    :return: (byte inicial, tamanho da faixa, tamanho do conteúdo, checksum,
+        sem compressão); faixa e conteúdo vazios no fim da partição
+    """
+    return CHUNK_HEADER.unpack(recv_exactly(connection, CHUNK_HEADER.size))
+
+
+def send_buffers(connection: socket.socket, header: bytes, payload):
+    """
+    Envia cabeçalho e conteúdo sem concatená-los (copiá-los).
+    """
+    if hasattr(connection, 'sendmsg'):
+        total_bytes = len(header) + len(payload)
+        bytes_sent = connection.sendmsg([header, payload])
+        if bytes_sent < total_bytes:
+            remaining = (header + bytes(payload))[bytes_sent:]
+            connection.sendall(remaining)
+    else:
+        connection.sendall(header + bytes(payload))
+
+
+def send_frame(connection: socket.socket, payload, raw: bool = False):
+    """
+    Envia um quadro de dados (cabeçalho + conteúdo) para recv_frame.
+    :param connection: Conexão TCP
+    :param payload: Conteúdo do quadro (bytes-like)
+    :param raw: O conteúdo vai sem compressão numa partição comprimida
+    """
+    send_buffers(connection, FRAME_HEADER.pack(len(payload), raw), payload)
+
+
+def send_end_frame(connection: socket.socket):
+    """
+    Envia o quadro vazio que termina o fluxo de dados.
+    :param connection: Conexão TCP
+    """
+    connection.sendall(FRAME_HEADER.pack(0, False))
+
+
+def recv_frame(connection: socket.socket) -> Tuple[bytes, bool]:
+    """
+    Recebe um quadro de dados enviado por send_frame.
+    :param connection: Conexão TCP
+    :return: (conteúdo do quadro, vazio no fim do fluxo; se ele veio sem
+        compressão)
+    """
+    payload_size, raw = FRAME_HEADER.unpack(recv_exactly(connection, FRAME_HEADER.size))
+    if payload_size == 0:
+        return b'', False
+    return recv_exactly(connection, payload_size), raw
+
+
+def raw_writer(writer):
+    """
+    Escritor do conteúdo de um bloco que veio sem compressão numa partição
+    comprimida: o escritor por baixo do que descomprime (DecodingWriter),
+    ou o próprio escritor se ele não descomprime (RangeWriter).
+    :param writer: Escritor da partição
+    :return: Escritor com write()
+    :raise ProtocolError: <writer> guarda o conteúdo comprimido como veio
+        (arquivo .partN), onde um bloco sem compressão não cabe
+    """
+    if not hasattr(writer, 'raw_writer'):
+        raise ProtocolError('Bloco sem compressão numa partição guardada comprimida.')
+    return writer.raw_writer()
+
+
+def recv_frame_to_file(
+        connection: socket.socket,
+        file: BinaryIO,
+        pool: BufferPool = RECV_POOL,
+        on_progress: Optional[Callable[[int], object]] = None
+) -> int:
+    """
+    Recebe um quadro de dados e escreve seu conteúdo direto em <file>,
+    usando os buffers do pool. Quadros sem compressão vão para
+    raw_writer(file).
+    :param connection: Conexão TCP
+    :param file: Arquivo aberto em modo binário
+    :param pool: Pool de buffers
+    :param on_progress: Chamada com a quantidade de bytes recebidos
+    :return: Tamanho do conteúdo (0 no fim do fluxo)
+    """
+    payload_size, raw = FRAME_HEADER.unpack(recv_exactly(connection, FRAME_HEADER.size))
+    if payload_size == 0:
+        return 0
+    if raw:
+        file = raw_writer(file)
+    return recv_to_file(connection, file, payload_size, pool, on_progress)
+
+
+def recv_exactly(connection: socket.socket, n_bytes: int) -> bytearray:
+    """
+    Recebe exatamente n_bytes da conexão num único buffer, sem
+    concatenações.
+    :param connection: Conexão TCP
+    :param n_bytes: Quantidade de bytes
+    :return: Bytes recebidos
+    """
+    buffer = bytearray(n_bytes)
+    recv_into_exactly(connection, memoryview(buffer))
+    return buffer
@@ -0,0 +1,373 @@
+import collections
+import logging
+import os
+import stat
+import struct
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List, Optional, Sequence, Tuple
+
+from ccp.messaging import MAX_MESSAGE_SIZE, ProtocolError, recv_exactly
+
+
+# Threads que varrem os diretórios do servidor em paralelo.
+SCAN_WORKERS = 8
+
+# Entradas da listagem por mensagem DIRECTORY_RESPONSE.
+ENTRIES_PER_MESSAGE = 10000
+
+# Cabeçalho de cada lote numa stream de diretório: quantidade de
+# segmentos e tamanho do conteúdo enviado (comprimido ou não).
+# Um lote vazio marca o fim da stream.
+BATCH_HEADER = struct.Struct('!II')
+
+# Cada segmento do lote: índice do arquivo na listagem, byte inicial no
+# arquivo e tamanho. O conteúdo do lote é a concatenação dos segmentos.
+SEGMENT = struct.Struct('!IQI')
+
+# Arquivo, diretório ou link simbólico da árvore, com caminho relativo
+# separado por '/'. <target> é o destino do link (None para os outros).
+TreeEntry = collections.namedtuple(
+    'TreeEntry', ['path', 'size', 'mode', 'mtime_ns', 'target'], defaults=(None,))
+
+# Faixa de um arquivo dentro de um lote.
+Segment = collections.namedtuple('Segment', ['index', 'offset', 'size'])
+
+
+def is_directory(entry: TreeEntry) -> bool:
+    return stat.S_ISDIR(entry.mode)
+
+
+def is_symlink(entry: TreeEntry) -> bool:
+    return stat.S_ISLNK(entry.mode)
+
+
+def is_regular(entry: TreeEntry) -> bool:
+    return stat.S_ISREG(entry.mode)
+
+
+def scan_directory(
+        root: str,
+        relative: str,
+        skipped: Optional[List[str]] = None
+) -> List[TreeEntry]:
+    """
+    Lista um diretório (sem descer), sem seguir links simbólicos: os links
+    entram na listagem com o seu destino, para o cliente recriá-los.
+    :param root: Raiz da árvore
+    :param relative: Diretório relativo a <root> ('' para a raiz)
+    :param skipped: Lista que recebe os caminhos ignorados (FIFOs,
+        sockets, dispositivos)
+    :return: Arquivos, links e subdiretórios do diretório
+    """
+    entries = []
+    with os.scandir(os.path.join(root, *relative.split('/'))) as directory:
+        for dir_entry in directory:
+            info = dir_entry.stat(follow_symlinks=False)
+            path = f'{relative}/{dir_entry.name}' if relative else dir_entry.name
+            if stat.S_ISDIR(info.st_mode):
+                entries.append(TreeEntry(path, 0, info.st_mode, info.st_mtime_ns))
+            elif stat.S_ISREG(info.st_mode):
+                entries.append(TreeEntry(path, info.st_size, info.st_mode, info.st_mtime_ns))
+            elif stat.S_ISLNK(info.st_mode):
+                entries.append(TreeEntry(
+                    path, 0, info.st_mode, info.st_mtime_ns, os.readlink(dir_entry.path)))
+            else:
+                logging.debug('Ignorando %s (nem arquivo, nem diretório, nem link).', path)
+                if skipped is not None:
+                    skipped.append(path)
+    return entries
+
+
+def scan_tree(
+        root: str,
+        workers: int = SCAN_WORKERS,
+        skipped: Optional[List[str]] = None
+) -> List[TreeEntry]:
+    """
+    Varre a árvore de <root> com <workers> threads, um diretório por
+    tarefa, de forma que diretórios irmãos são lidos em paralelo.
+    :param skipped: Lista que recebe os caminhos ignorados (ver
+        scan_directory)
+    :return: Entradas ordenadas pelo caminho (pais antes dos filhos)
+    """
+    entries = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ccp-scan') as executor:
+        pending = {executor.submit(scan_directory, root, '', skipped)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for entry in future.result():
+                    entries.append(entry)
+                    if is_directory(entry):
+                        pending.add(executor.submit(scan_directory, root, entry.path, skipped))
+    entries.sort(key=lambda entry: entry.path.split('/'))
+    return entries
+
+
+def pack_entries(entries: Sequence[TreeEntry], batch_size: int) -> List[List[Segment]]:
+    """
+    Junta os arquivos em lotes de até <batch_size> bytes: arquivos
+    pequenos dividem o mesmo lote, e arquivos grandes são divididos entre
+    lotes. Arquivos vazios, diretórios e links não entram em lote nenhum.
+    :param entries: Listagem da árvore
+    :param batch_size: Tamanho máximo de cada lote
+    :return: Segmentos de cada lote
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for index, entry in enumerate(entries):
+        if not is_regular(entry):
+            continue
+        offset = 0
+        while offset < entry.size:
+            size = min(entry.size - offset, batch_size - batch_bytes)
+            batch.append(Segment(index, offset, size))
+            batch_bytes += size
+            offset += size
+            if batch_bytes == batch_size:
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class BatchQueue:
+    """
+    Entrega os lotes às streams conforme elas ficam livres, como o
+    ChunkScheduler faz com os pedaços de um arquivo.
+    """
+
+    def __init__(self, batches: List[List[Segment]]):
+        self.__batches = collections.deque(batches)
+        self.__lock = threading.Lock()
+
+    def next_batch(self) -> Optional[List[Segment]]:
+        """
+        :return: Próximo lote, ou None se acabaram
+        """
+        with self.__lock:
+            return self.__batches.popleft() if self.__batches else None
+
+
+def segments_size(batch: Sequence[Segment]) -> int:
+    return sum(segment.size for segment in batch)
+
+
+def pack_batch_header(batch: Sequence[Segment], payload_size: int) -> bytes:
+    return BATCH_HEADER.pack(len(batch), payload_size) + b''.join(
+        SEGMENT.pack(*segment) for segment in batch)
+
+
+def recv_batch(connection) -> Optional[Tuple[List[Segment], bytearray]]:
+    """
+    Recebe um lote de uma stream de diretório.
+    :return: (segmentos, conteúdo), ou None no fim da stream
+    """
+    count, payload_size = BATCH_HEADER.unpack(recv_exactly(connection, BATCH_HEADER.size))
+    if not count and not payload_size:
+        return None
+    if payload_size > MAX_MESSAGE_SIZE or SEGMENT.size * count > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f'Lote grande demais: {payload_size} bytes.')
+    table = recv_exactly(connection, SEGMENT.size * count)
+    segments = [Segment(*fields) for fields in SEGMENT.iter_unpack(table)]
+    return segments, recv_exactly(connection, payload_size)
+
+
+def read_batch(root: str, entries: Sequence[TreeEntry], batch: Sequence[Segment]) -> bytearray:
+    """
+    Lê o conteúdo de um lote: os segmentos concatenados.
+    """
+    payload = bytearray(segments_size(batch))
+    view = memoryview(payload)
+    position = 0
+    for segment in batch:
+        with open(entry_path(root, entries[segment.index].path), 'rb') as file:
+            file.seek(segment.offset)
+            bytes_read = file.readinto(view[position:position + segment.size])
+        if bytes_read != segment.size:
+            raise RuntimeError(
+                f'{entries[segment.index].path}: li {bytes_read} bytes em vez de {segment.size}.')
+        position += segment.size
+    view.release()
+    return payload
+
+
+def compress_batch(
+        root: str,
+        entries: Sequence[TreeEntry],
+        batch: Sequence[Segment],
+        codec=None,
+        level: Optional[int] = None
+) -> bytes:
+    """
+    Lê e comprime (se houver codec) um lote inteiro: arquivos pequenos
+    comprimem juntos.
+    """
+    payload = read_batch(root, entries, batch)
+    return codec.compress(payload, level) if codec is not None else payload
+
+
+def entry_path(root: str, relative: str) -> str:
+    """
+    Caminho local de uma entrada da listagem. Caminhos que sairiam de
+    <root> (absolutos, '..', separadores do sistema) são recusados.
+    """
+    parts = relative.split('/')
+    for part in parts:
+        if part in ('', '.', '..') or os.sep in part or (os.altsep and os.altsep in part):
+            raise ProtocolError(f'Caminho inválido na listagem: {relative!r}.')
+    path = os.path.join(root, *parts)
+    if os.path.splitdrive(path)[0] != os.path.splitdrive(root)[0]:
+        raise ProtocolError(f'Caminho inválido na listagem: {relative!r}.')
+    return path
+
+
+def encode_entries(entries: Sequence[TreeEntry]) -> List[List]:
+    return [list(entry) for entry in entries]
+
+
+def decode_entries(items: Sequence[Sequence]) -> List[TreeEntry]:
+    return [TreeEntry(*item) for item in items]
+
+
+def split_listing(entries: Sequence[TreeEntry]) -> List[List[List]]:
+    """
+    :return: Listagem dividida em mensagens de ENTRIES_PER_MESSAGE entradas
+    """
+    return [
+        encode_entries(entries[start:start + ENTRIES_PER_MESSAGE])
+        for start in range(0, len(entries), ENTRIES_PER_MESSAGE)
+    ]
+
+
+def tree_size(entries: Sequence[TreeEntry]) -> Tuple[int, int]:
+    """
+    :return: (quantidade de arquivos regulares, soma dos tamanhos)
+    """
+    files = [entry for entry in entries if is_regular(entry)]
+    return len(files), sum(entry.size for entry in files)
+
+
+class TreeWriter:
+    """
+    Escreve os lotes de uma stream de diretório em <root>. Cada segmento é
+    escrito no seu byte do arquivo, então os lotes podem chegar em
+    qualquer ordem e por qualquer stream, e ser escritos em paralelo.
+    """
+
+    def __init__(self, root: str, entries: Sequence[TreeEntry], codec=None):
+        """
+        :param root: Diretório-destino
+        :param entries: Listagem recebida do servidor
+        :param codec: Codec dos lotes, ou None
+        """
+        self.root = root
+        self.entries = entries
+        self.codec = codec
+        self.paths = [entry_path(root, entry.path) for entry in entries]
+        # Links que não puderam ser criados (ex.: Windows sem permissão).
+        self.failed_links: List[str] = []
+
+        # Nada pode ficar dentro de um link: escrever ali sairia de <root>.
+        links = set()
+        for entry in entries:
+            if is_symlink(entry):
+                if not isinstance(entry.target, str) or not entry.target:
+                    raise ProtocolError(f'Link sem destino na listagem: {entry.path!r}.')
+                links.add(entry.path)
+        for entry in entries:
+            parts = entry.path.split('/')
+            for end in range(1, len(parts)):
+                if '/'.join(parts[:end]) in links:
+                    raise ProtocolError(f'Caminho dentro de um link: {entry.path!r}.')
+
+    def prepare(self):
+        """
+        Cria os diretórios, os links e os arquivos vazios; os outros
+        arquivos são criados pelo primeiro segmento que chegar.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        for entry, path in zip(self.entries, self.paths):
+            if is_directory(entry):
+                os.makedirs(path, exist_ok=True)
+            elif is_symlink(entry):
+                self.create_link(entry, path)
+            elif not entry.size:
+                open(path, 'wb').close()
+            elif os.path.isfile(path) and os.path.getsize(path) > entry.size:
+                # Cópia antiga maior: o que sobrar no fim não pode ficar.
+                os.truncate(path, entry.size)
+
+    def create_link(self, entry: TreeEntry, path: str):
+        """
+        Recria o link <entry> em <path>, trocando o que houver lá (menos
+        diretórios). Falhas vão para failed_links.
+        """
+        try:
+            if os.path.islink(path) or os.path.isfile(path):
+                os.unlink(path)
+            os.symlink(entry.target, path)
+        except OSError as exc:
+            logging.debug('Não criei o link %s: %s', path, exc)
+            self.failed_links.append(entry.path)
+
+    def write_batch(self, segments: Sequence[Segment], payload) -> int:
+        """
+        :param segments: Segmentos do lote
+        :param payload: Conteúdo recebido (comprimido, se houver codec)
+        :return: Bytes escritos
+        """
+        if self.codec is not None:
+            payload = self.codec.decompress(payload)
+        view = memoryview(payload)
+        if len(view) != segments_size(segments):
+            raise ProtocolError('Conteúdo do lote não bate com os segmentos.')
+        for segment in segments:
+            if not segment.index < len(self.entries):
+                raise ProtocolError(f'Segmento aponta para a entrada {segment.index}.')
+            entry = self.entries[segment.index]
+            if not is_regular(entry) or segment.offset + segment.size > entry.size:
+                raise ProtocolError(f'Segmento inválido para {entry.path!r}.')
+        position = 0
+        for segment in segments:
+            entry = self.entries[segment.index]
+            fd = os.open(
+                self.paths[segment.index],
+                os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0),
+                # Permissão final só em finish(): o arquivo pode ser
+                # somente leitura e ainda ter segmentos por chegar.
+                stat.S_IMODE(entry.mode) | stat.S_IRUSR | stat.S_IWUSR
+            )
+            try:
+                if segment.offset:
+                    os.lseek(fd, segment.offset, os.SEEK_SET)
+                end = position + segment.size
+                while position < end:
+                    position += os.write(fd, view[position:end])
+            finally:
+                os.close(fd)
+        view.release()
+        return position
+
+    def finish(self):
+        """
+        Restaura permissões e datas de modificação. Diretórios por último,
+        dos mais fundos para a raiz, porque escrever neles muda a data.
+        """
+        for entry, path in zip(self.entries, self.paths):
+            if is_symlink(entry):
+                # chmod seguiria o link; a data só muda se der para não seguir.
+                if os.utime in os.supports_follow_symlinks and os.path.islink(path):
+                    os.utime(path, ns=(entry.mtime_ns, entry.mtime_ns), follow_symlinks=False)
+            elif not is_directory(entry):
+                os.chmod(path, stat.S_IMODE(entry.mode))
+                os.utime(path, ns=(entry.mtime_ns, entry.mtime_ns))
+        for entry, path in reversed(list(zip(self.entries, self.paths))):
+            if is_directory(entry):
+                os.chmod(path, stat.S_IMODE(entry.mode))
+                os.utime(path, ns=(entry.mtime_ns, entry.mtime_ns))
+
@@ -0,0 +1,87 @@
+from typing import List, Tuple
+
+
+def get_partition_sizes(size, n_workers):
+    division, remainder = divmod(size, n_workers)
+    return [division + 1 for _ in range(remainder)] + [division for _ in range(n_workers - remainder)]
+
+
+def get_partition_ranges(size: int, n_workers: int) -> List[Tuple[int, int]]:
+    """
+    Divide o arquivo em <n_workers> faixas contíguas. Arquivos com menos
+    bytes que <n_workers> ficam com uma faixa por byte (e um arquivo
+    vazio, com uma faixa vazia), sem faixas vazias sobrando.
+    :param size: Tamanho do arquivo
+    :param n_workers: Quantidade de faixas
+    :return: Lista de (byte inicial, tamanho)
+    """
+    n_workers = max(min(n_workers, size), 1)
+    ranges = []
+    start_byte = 0
+    for partition_size in get_partition_sizes(size, n_workers):
+        ranges.append((start_byte, partition_size))
+        start_byte += partition_size
+    return ranges
+
+
+def normalize_ranges(ranges, size: int) -> List[Tuple[int, int]]:
+    """
+    Ordena, valida e junta faixas pedidas pelo cliente.
+    :param ranges: Faixas (byte inicial, tamanho)
+    :param size: Tamanho do arquivo
+    :return: Faixas disjuntas e ordenadas, sem faixas vazias
+    """
+    normalized = []
+    for start_byte, length in sorted((int(s), int(n)) for s, n in ranges):
+        if start_byte < 0 or length < 0 or start_byte + length > size:
+            raise ValueError(
+                f'Faixa [{start_byte}, {start_byte + length}) fora do arquivo de {size} bytes.')
+        if length == 0:
+            continue
+        if normalized and start_byte <= sum(normalized[-1]):
+            last_start, last_length = normalized[-1]
+            end_byte = max(last_start + last_length, start_byte + length)
+            normalized[-1] = (last_start, end_byte - last_start)
+        else:
+            normalized.append((start_byte, length))
+    return normalized
+
+
+def split_ranges(ranges, n_workers: int) -> List[Tuple[int, int]]:
+    """
+    Divide as maiores faixas até existirem <n_workers> faixas, para que
+    todas as streams tenham trabalho.
+    :param ranges: Faixas disjuntas (byte inicial, tamanho)
+    :param n_workers: Quantidade desejada de faixas
+    :return: Faixas ordenadas
+    """
+    ranges = [tuple(r) for r in ranges if r[1] > 0]
+    while ranges and len(ranges) < n_workers:
+        largest = max(range(len(ranges)), key=lambda i: ranges[i][1])
+        start_byte, length = ranges[largest]
+        if length < 2:
+            break
+        half = length // 2
+        ranges[largest:largest + 1] = [
+            (start_byte, length - half),
+            (start_byte + length - half, half)
+        ]
+    return sorted(ranges)
+
+
+def merge_ranges(
+        ranges: List[Tuple[int, int]],
+        merge_gap: int = 0
+) -> List[Tuple[int, int]]:
+    """
+    Junta faixas (byte inicial, tamanho) ordenadas que se tocam ou estão
+    separadas por até <merge_gap> bytes.
+    """
+    merged = []
+    for start, length in ranges:
+        if merged and start - sum(merged[-1]) <= merge_gap:
+            last_start, _ = merged[-1]
+            merged[-1] = (last_start, start + length - last_start)
+        else:
+            merged.append((start, length))
+    return merged
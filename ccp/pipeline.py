@@ -0,0 +1,519 @@
+import collections
+import contextlib
+import logging
+import os
+import socket
+import struct
+import threading
+from concurrent.futures import Future, wait
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from ccp.compression import available_codecs, get_codec
+from ccp.integrity import sha256_file
+from ccp.messaging import (
+    MAX_MESSAGE_SIZE,
+    MessageType,
+    ProtocolError,
+    recv_exactly,
+    recv_message,
+    send_message
+)
+from ccp.packing import decode_entries, encode_entries, scan_directory
+from ccp.target import TargetFile, save_inline
+
+
+# Operações de um SESSION_REQUEST.
+DOWNLOAD_OPERATION = 'download'
+STAT_OPERATION = 'stat'
+LIST_OPERATION = 'list'
+
+# Pedidos de uma sessão que o servidor com threads atende ao mesmo tempo.
+SESSION_WORKERS = 4
+
+# Pedidos em andamento por sessão no cliente (cada download deixa o
+# arquivo-destino aberto); os seguintes esperam uma vaga.
+MAX_PENDING_REQUESTS = 64
+
+# Cabeçalho de cada pedaço nas streams de uma sessão: id do pedido, byte
+# inicial e tamanho da faixa original, tamanho do conteúdo enviado e se
+# ele está comprimido. O id 0 marca o fim da stream.
+REQUEST_CHUNK = struct.Struct('!IQII?')
+
+# Pedaço de um download na fila das streams da sessão.
+PipelineChunk = collections.namedtuple('PipelineChunk', ['request', 'path', 'offset', 'size'])
+
+
+class RemoteError(RuntimeError):
+    """
+    Pedido que o servidor não conseguiu atender (arquivo inexistente,
+    sem permissão...).
+    """
+
+
+def split_chunks(size: int, chunk_size: int) -> List[Tuple[int, int]]:
+    """
+    :return: Faixas (byte inicial, tamanho) de até <chunk_size> bytes
+    """
+    return [
+        (offset, min(chunk_size, size - offset))
+        for offset in range(0, size, chunk_size)
+    ]
+
+
+def read_chunk(
+        path: str,
+        offset: int,
+        size: int,
+        codec=None,
+        level: Optional[int] = None
+) -> Tuple[bytes, bool]:
+    """
+    Lê um pedaço e o comprime, se houver codec e se isso o diminuir.
+    :return: (conteúdo, se está comprimido)
+    """
+    with open(path, mode='rb') as file:
+        file.seek(offset)
+        payload = file.read(size)
+    if len(payload) != size:
+        raise OSError(f'{path} diminuiu durante o envio.')
+    if codec is not None:
+        compressed_payload = codec.compress(payload, level)
+        if len(compressed_payload) < size:
+            return compressed_payload, True
+    return payload, False
+
+
+def stat_path(abs_path: str) -> Dict:
+    """
+    :return: Resposta a STAT_OPERATION
+    """
+    info = os.stat(abs_path)
+    return {
+        'size': info.st_size,
+        'mode': info.st_mode,
+        'mtime_ns': info.st_mtime_ns
+    }
+
+
+def list_directory(abs_path: str) -> Dict:
+    """
+    :return: Resposta a LIST_OPERATION: entradas do diretório (sem descer)
+    """
+    entries = sorted(scan_directory(abs_path, ''), key=lambda entry: entry.path)
+    return {'entries': encode_entries(entries)}
+
+
+class SessionPipeline:
+    """
+    Pedidos de uma sessão no servidor com threads: as respostas saem pela
+    conexão de controle, uma de cada vez, e os pedaços dos downloads
+    aceitos esperam numa fila, na ordem dos pedidos, pela próxima stream
+    livre.
+    """
+
+    def __init__(self, connection: socket.socket):
+        """
+        :param connection: Conexão de controle da sessão
+        """
+        self.connection = connection
+        self.__chunks = collections.deque()
+        self.__failed = set()
+        self.__closed = False
+        self.__changed = threading.Condition()
+        self.__send_lock = threading.Lock()
+
+    def reply(self, request_id: int, message: Dict):
+        with self.__send_lock:
+            send_message(self.connection, MessageType.SESSION_REPLY, {
+                'error': None,
+                **message,
+                'id': request_id
+            })
+
+    def add_download(self, request_id: int, path: str, ranges: Sequence[Tuple[int, int]]):
+        with self.__changed:
+            self.__chunks.extend(
+                PipelineChunk(request_id, path, offset, size) for offset, size in ranges)
+            self.__changed.notify_all()
+
+    def next_chunk(self) -> Optional[PipelineChunk]:
+        """
+        Espera o próximo pedaço de qualquer download da sessão.
+        :return: Pedaço, ou None quando a sessão fechou e a fila acabou
+        """
+        with self.__changed:
+            while True:
+                while self.__chunks:
+                    chunk = self.__chunks.popleft()
+                    if chunk.request not in self.__failed:
+                        return chunk
+                if self.__closed:
+                    return None
+                self.__changed.wait()
+
+    def failed(self, request_id: int) -> bool:
+        with self.__changed:
+            return request_id in self.__failed
+
+    def fail(self, request_id: int, error: str):
+        """
+        Descarta o que falta do download <request_id> e avisa o cliente.
+        """
+        with self.__changed:
+            if request_id in self.__failed:
+                return
+            self.__failed.add(request_id)
+        logging.debug('Pedido %d falhou: %s', request_id, error)
+        self.reply(request_id, {'error': error})
+
+    def close(self):
+        """
+        Sem pedidos novos: as streams terminam quando a fila acabar.
+        """
+        with self.__changed:
+            self.__closed = True
+            self.__changed.notify_all()
+
+
+class PendingRequest:
+    """
+    Pedido enviado numa sessão do cliente, esperando a resposta e, nos
+    downloads, os pedaços que chegam pelas streams.
+    """
+
+    def __init__(
+            self,
+            operation: str,
+            local_path: Optional[str] = None,
+            sha256: bool = False
+    ):
+        self.operation = operation
+        self.local_path = local_path
+        self.future = Future()
+        # Marcado quando a resposta chega (e o destino já está aberto).
+        self.ready = threading.Event()
+        self.target: Optional[TargetFile] = None
+        self.size = 0
+        self.received = 0
+        # Downloads pelas streams com sha256 esperam também o hash remoto,
+        # que chega numa segunda resposta.
+        self.sha256 = sha256
+        self.remote_sha256: Optional[str] = None
+        self.__finished = False
+        self.__lock = threading.Lock()
+
+    def add(self, n_bytes: int) -> bool:
+        """
+        :return: True se o download acabou com estes bytes
+        """
+        with self.__lock:
+            self.received += n_bytes
+            return self.__finish()
+
+    def set_remote_sha256(self, digest: str) -> bool:
+        """
+        :return: True se o download acabou com o hash remoto
+        """
+        with self.__lock:
+            self.remote_sha256 = digest
+            return self.__finish()
+
+    def __finish(self) -> bool:
+        if self.__finished or self.received < self.size:
+            return False
+        if self.sha256 and self.remote_sha256 is None:
+            return False
+        self.__finished = True
+        return True
+
+
+class PipelinedClient:
+    """
+    Sessão persistente com o servidor: uma conexão de controle leva muitos
+    pedidos (download, stat, list) sem esperar as respostas, que voltam
+    fora de ordem com o id do pedido. As streams de dados são abertas uma
+    vez só e levam os pedaços de todos os downloads da sessão; arquivos
+    pequenos vêm na própria resposta. Cada pedido devolve um Future.
+    """
+
+    def __init__(
+            self,
+            control: socket.socket,
+            address: Tuple[str, int],
+            streams: int = 4,
+            compressed: bool = False,
+            codecs: Optional[List[str]] = None,
+            level: Optional[int] = None,
+            max_pending: int = MAX_PENDING_REQUESTS
+    ):
+        """
+        :param control: Conexão de controle já aberta
+        :param address: (IP, porta) do servidor, para as streams
+        :param streams: Streams de dados pedidas
+        :param compressed: Pede os pedaços comprimidos
+        :param codecs: Codecs aceitos, em ordem de preferência
+        :param level: Nível de compressão
+        :param max_pending: Pedidos em andamento ao mesmo tempo
+        """
+        self.control = control
+        self.address = address
+        self.streams = streams
+        self.compressed = compressed
+        self.codecs = codecs if codecs is not None else available_codecs()
+        self.level = level
+        self.codec = None
+        self.__pending: Dict[int, PendingRequest] = {}
+        self.__next_id = 1
+        self.__error: Optional[BaseException] = None
+        self.__lock = threading.Lock()
+        self.__send_lock = threading.Lock()
+        self.__slots = threading.BoundedSemaphore(max_pending)
+        self.__threads: List[threading.Thread] = []
+
+    def open(self) -> Optional[float]:
+        """
+        Abre a sessão e conecta as streams.
+        :return: None se a sessão abriu, ou os segundos que o servidor
+            (cheio) pediu para esperar antes de tentar de novo
+        """
+        send_message(self.control, MessageType.SESSION_OPEN, {
+            'streams': self.streams,
+            'compressed': self.compressed,
+            'codecs': self.codecs,
+            'level': self.level
+        })
+        _, response = recv_message(self.control, expected_type=MessageType.SESSION_READY)
+        if response['token'] is None:
+            return response['retry_after']
+        self.streams = response['streams']
+        self.codec = get_codec(response['codec']) if response['codec'] is not None else None
+
+        self.__threads.append(threading.Thread(
+            target=self.__read_replies,
+            name='ccp-session-control',
+            daemon=True
+        ))
+        for stream_id in range(self.streams):
+            self.__threads.append(threading.Thread(
+                target=self.__receive_stream,
+                args=(response['token'], stream_id),
+                name=f'ccp-session-stream-{stream_id}',
+                daemon=True
+            ))
+        for thread in self.__threads:
+            thread.start()
+        return None
+
+    def download(self, remote_path: str, local_path: str, sha256: bool = False) -> Future:
+        """
+        :param sha256: Confere o SHA-256 do arquivo baixado (RemoteError
+            se for diferente do remoto)
+        :return: Future com o tamanho do arquivo baixado
+        """
+        return self.__submit(PendingRequest(DOWNLOAD_OPERATION, local_path, sha256), {
+            'op': DOWNLOAD_OPERATION,
+            'path': remote_path,
+            'sha256': sha256
+        })
+
+    def stat(self, remote_path: str) -> Future:
+        """
+        :return: Future com {'size', 'mode', 'mtime_ns'}
+        """
+        return self.__submit(PendingRequest(STAT_OPERATION), {
+            'op': STAT_OPERATION,
+            'path': remote_path
+        })
+
+    def list(self, remote_path: str) -> Future:
+        """
+        :return: Future com as entradas (packing.TreeEntry) do diretório
+        """
+        return self.__submit(PendingRequest(LIST_OPERATION), {
+            'op': LIST_OPERATION,
+            'path': remote_path
+        })
+
+    def close(self):
+        """
+        Espera os pedidos em andamento e fecha a sessão: o servidor termina
+        as streams quando a conexão de controle fecha.
+        """
+        with self.__lock:
+            futures = [request.future for request in self.__pending.values()]
+        wait(futures)
+        with contextlib.suppress(OSError):
+            self.control.shutdown(socket.SHUT_WR)
+        for thread in self.__threads:
+            thread.join()
+        self.control.close()
+        # Sobram só downloads que falharam no meio: o destino fica incompleto.
+        for request in self.__pending.values():
+            if request.target is not None:
+                request.target.close()
+                with contextlib.suppress(OSError):
+                    os.remove(request.local_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __submit(self, request: PendingRequest, message: Dict) -> Future:
+        self.__slots.acquire()
+        request.future.add_done_callback(lambda _: self.__slots.release())
+        with self.__lock:
+            if self.__error is not None:
+                request.future.set_exception(self.__error)
+                return request.future
+            request_id = self.__next_id
+            self.__next_id += 1
+            self.__pending[request_id] = request
+        with self.__send_lock:
+            send_message(self.control, MessageType.SESSION_REQUEST, {
+                **message,
+                'id': request_id
+            })
+        return request.future
+
+    def __complete(self, request_id: int, result):
+        with self.__lock:
+            request = self.__pending.pop(request_id)
+        if request.target is not None:
+            request.target.close()
+        request.future.set_result(result)
+
+    def __fail(self, request_id: int, exc: BaseException):
+        # Downloads que falham continuam em __pending: pedaços deles que
+        # já estavam a caminho ainda chegam e são descartados.
+        with self.__lock:
+            request = self.__pending[request_id]
+            if request.future.done():
+                return
+            if request.operation != DOWNLOAD_OPERATION:
+                del self.__pending[request_id]
+        request.future.set_exception(exc)
+        request.ready.set()
+
+    def __fail_all(self, exc: BaseException):
+        with self.__lock:
+            if self.__error is None:
+                self.__error = exc
+            request_ids = [
+                request_id for request_id, request in self.__pending.items()
+                if not request.future.done()
+            ]
+        for request_id in request_ids:
+            self.__fail(request_id, exc)
+
+    def __start_download(self, request_id: int, request: PendingRequest, reply: Dict):
+        if reply.get('inline') is not None:
+            local_sha256 = save_inline(request.local_path, reply)
+            if reply.get('sha256') not in (None, local_sha256):
+                raise RemoteError(f'SHA-256 de {request.local_path} difere do remoto.')
+            self.__complete(request_id, reply['size'])
+            return
+        request.size = reply['size']
+        request.target = TargetFile(request.local_path, request.size)
+        request.ready.set()
+        if not request.size:
+            self.__complete(request_id, 0)
+
+    def __finish_download(self, request_id: int, request: PendingRequest):
+        """
+        Todos os bytes (e o hash remoto, se pedido) chegaram. A conferência
+        relê o arquivo numa thread própria, fora das threads da sessão.
+        """
+        if request.remote_sha256 is None:
+            self.__complete(request_id, request.size)
+            return
+        threading.Thread(
+            target=self.__verify_download,
+            args=(request_id, request),
+            name='ccp-sha256',
+            daemon=True
+        ).start()
+
+    def __verify_download(self, request_id: int, request: PendingRequest):
+        target, request.target = request.target, None
+        try:
+            target.close()
+            local_sha256 = sha256_file(request.local_path)
+        except OSError as exc:
+            self.__fail(request_id, exc)
+            return
+        if local_sha256 != request.remote_sha256:
+            self.__fail(request_id, RemoteError(
+                f'SHA-256 de {request.local_path} ({local_sha256}) difere do '
+                f'arquivo remoto ({request.remote_sha256}).'))
+            return
+        self.__complete(request_id, request.size)
+
+    def __answer(self, reply: Dict):
+        request_id = reply['id']
+        with self.__lock:
+            request = self.__pending.get(request_id)
+        if request is None:
+            raise ProtocolError(f'Resposta a um pedido desconhecido: {request_id}.')
+        if reply['error'] is not None:
+            self.__fail(request_id, RemoteError(reply['error']))
+        elif request.operation == STAT_OPERATION:
+            self.__complete(request_id, reply)
+        elif request.operation == LIST_OPERATION:
+            self.__complete(request_id, decode_entries(reply['entries']))
+        elif request.ready.is_set():
+            # Segunda resposta de um download pelas streams: o hash remoto.
+            if request.future.done():
+                return
+            if not request.sha256 or not isinstance(reply.get('sha256'), str):
+                raise ProtocolError(f'Resposta repetida ao pedido {request_id}.')
+            if request.set_remote_sha256(reply['sha256']):
+                self.__finish_download(request_id, request)
+        else:
+            try:
+                self.__start_download(request_id, request, reply)
+            except (OSError, RuntimeError) as exc:
+                self.__fail(request_id, exc)
+
+    def __read_replies(self):
+        try:
+            while True:
+                _, reply = recv_message(self.control, expected_type=MessageType.SESSION_REPLY)
+                self.__answer(reply)
+        except Exception as exc:
+            # Também o fim normal: o servidor fecha depois de close().
+            logging.debug('Conexão de controle da sessão terminou: %s', exc)
+            self.__fail_all(RuntimeError('Conexão com o servidor caiu.'))
+
+    def __receive_stream(self, token: str, stream_id: int):
+        try:
+            with socket.create_connection(self.address) as sock:
+                send_message(sock, MessageType.STREAM_ATTACH, {
+                    'token': token,
+                    'stream': stream_id
+                })
+                while True:
+                    request_id, offset, size, payload_size, compressed = REQUEST_CHUNK.unpack(
+                        recv_exactly(sock, REQUEST_CHUNK.size))
+                    if not request_id:
+                        break
+                    if payload_size > MAX_MESSAGE_SIZE:
+                        raise ProtocolError(f'Pedaço grande demais: {payload_size} bytes.')
+                    payload = recv_exactly(sock, payload_size)
+                    with self.__lock:
+                        request = self.__pending.get(request_id)
+                    if request is None:
+                        raise ProtocolError(f'Pedaço de um pedido desconhecido: {request_id}.')
+                    request.ready.wait()
+                    if request.future.done():
+                        continue
+                    data = self.codec.decompress(payload) if compressed else payload
+                    if len(data) != size or offset + size > request.size:
+                        raise ProtocolError(f'Pedaço no byte {offset} não bate com o arquivo.')
+                    request.target.pwrite(data, offset)
+                    if request.add(size):
+                        self.__finish_download(request_id, request)
+        except Exception as exc:
+            logging.debug('Stream %d da sessão falhou: %s', stream_id, exc)
+            self.__fail_all(exc)
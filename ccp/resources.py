@@ -0,0 +1,246 @@
+import collections
+import contextlib
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Dict, Optional
+
+import psutil
+
+
+# Streams de dados ativas no servidor, somando todos os pedidos.
+DEFAULT_MAX_STREAMS = 256
+
+# Conexões abertas por um mesmo IP (controle + dados).
+DEFAULT_MAX_CLIENT_CONNECTIONS = 512
+
+# Conexão sem tráfego por mais que isso (s) é fechada.
+DEFAULT_IDLE_TIMEOUT = 300.0
+
+# Tempo máximo (s) de um pedido na fila esperando streams livres.
+ADMISSION_WAIT = 10.0
+
+# Sugestão ao cliente (s) para tentar de novo quando o servidor está cheio.
+RETRY_AFTER = 5.0
+
+# Intervalo (s) entre tentativas de quem espera sem bloquear (asyncio).
+POLL_INTERVAL = 0.05
+
+# Teto padrão da memória de blocos lidos (e comprimidos) à frente do envio.
+MAX_DEFAULT_MEMORY = 2 * 2 ** 30
+
+
+def default_memory_budget() -> int:
+    """
+    :return: Um quarto da memória da máquina, até MAX_DEFAULT_MEMORY
+    """
+    return min(psutil.virtual_memory().total // 4, MAX_DEFAULT_MEMORY)
+
+
+def configure_connection(connection: socket.socket, idle_timeout: Optional[float]):
+    """
+    Faz o sistema derrubar conexões com clientes mortos: keepalive e
+    TCP_USER_TIMEOUT (quando o sistema tem) para dados que nunca são
+    confirmados. O timeout das operações fica a cargo de cada servidor.
+    :param connection: Conexão aceita pelo servidor
+    :param idle_timeout: Segundos sem resposta, ou None para nunca
+    """
+    if idle_timeout is None:
+        return
+    with contextlib.suppress(OSError):
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_USER_TIMEOUT'):
+        with contextlib.suppress(OSError):
+            connection.setsockopt(
+                socket.IPPROTO_TCP,
+                socket.TCP_USER_TIMEOUT,
+                int(idle_timeout * 1000)
+            )
+
+
+class ResourceManager:
+    """
+    Limites globais do servidor, compartilhados por todos os pedidos:
+     - streams de dados ativas: pedidos além do limite esperam na fila
+       até ADMISSION_WAIT segundos e, se ainda não couberem, recebem um
+       aviso para tentar de novo depois;
+     - memória dos blocos lidos à frente pelo compressor (cada stream
+       tem sempre um bloco garantido, para nunca travar);
+     - streams comprimindo ao mesmo tempo;
+     - conexões por cliente (IP);
+     - tempo máximo sem tráfego de cada conexão.
+    Os métodos que esperam bloqueiam a thread; try_* nunca esperam.
+    """
+
+    def __init__(
+            self,
+            max_streams: int = DEFAULT_MAX_STREAMS,
+            max_memory: Optional[int] = None,
+            max_compressions: Optional[int] = None,
+            max_client_connections: int = DEFAULT_MAX_CLIENT_CONNECTIONS,
+            idle_timeout: Optional[float] = DEFAULT_IDLE_TIMEOUT,
+            admission_wait: float = ADMISSION_WAIT
+    ):
+        """
+        :param max_streams: Streams de dados ativas, somando os pedidos
+        :param max_memory: Bytes de blocos lidos à frente (padrão:
+            default_memory_budget())
+        :param max_compressions: Streams comprimindo ao mesmo tempo
+            (padrão: 2 por núcleo)
+        :param max_client_connections: Conexões abertas por IP
+        :param idle_timeout: Segundos sem tráfego antes de fechar uma
+            conexão, ou None para nunca
+        :param admission_wait: Segundos na fila antes de mandar o cliente
+            tentar de novo
+        """
+        if max_memory is None:
+            max_memory = default_memory_budget()
+        if max_compressions is None:
+            max_compressions = 2 * (os.cpu_count() or 1)
+        if min(max_streams, max_memory, max_compressions, max_client_connections) < 1:
+            raise ValueError('Limites de recursos devem ser positivos.')
+
+        self.max_streams = max_streams
+        self.max_memory = max_memory
+        self.max_compressions = max_compressions
+        self.max_client_connections = max_client_connections
+        self.idle_timeout = idle_timeout
+        self.admission_wait = admission_wait
+
+        self.__streams = 0
+        self.__memory = 0
+        self.__compressions = 0
+        self.__connections: Dict[str, int] = collections.Counter()
+        self.__changed = threading.Condition()
+
+    def __wait_for(self, predicate, timeout: Optional[float]) -> bool:
+        with self.__changed:
+            return self.__changed.wait_for(predicate, timeout)
+
+    def __release(self, update):
+        with self.__changed:
+            update()
+            self.__changed.notify_all()
+
+    # Conexões por cliente.
+
+    def open_connection(self, client: str) -> bool:
+        """
+        :param client: IP do cliente
+        :return: False se o cliente já tem conexões demais
+        """
+        with self.__changed:
+            if self.__connections[client] >= self.max_client_connections:
+                logging.debug('Conexões demais de %s.', client)
+                return False
+            self.__connections[client] += 1
+            return True
+
+    def close_connection(self, client: str):
+        with self.__changed:
+            self.__connections[client] -= 1
+            if self.__connections[client] <= 0:
+                del self.__connections[client]
+
+    # Streams de dados.
+
+    def try_admit(self, streams: int) -> int:
+        """
+        :param streams: Streams pedidas
+        :return: Streams concedidas (até as livres), ou 0 se não há nenhuma
+        """
+        with self.__changed:
+            granted = min(max(streams, 1), self.max_streams - self.__streams)
+            if granted <= 0:
+                return 0
+            self.__streams += granted
+            return granted
+
+    def admit(self, streams: int) -> int:
+        """
+        Espera na fila por streams livres até admission_wait segundos.
+        :return: Streams concedidas, ou 0 se o servidor continua cheio
+        """
+        deadline = time.monotonic() + self.admission_wait
+        while True:
+            granted = self.try_admit(streams)
+            if granted:
+                return granted
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return 0
+            self.__wait_for(lambda: self.__streams < self.max_streams, remaining)
+
+    def release_streams(self, streams: int):
+        def update():
+            self.__streams -= streams
+        self.__release(update)
+
+    @contextlib.contextmanager
+    def admitted(self, streams: int):
+        """
+        admit() que devolve as streams concedidas ao sair do bloco.
+        :return: Streams concedidas, ou 0 se o servidor está cheio
+        """
+        granted = self.admit(streams)
+        try:
+            yield granted
+        finally:
+            if granted:
+                self.release_streams(granted)
+
+    # Memória dos blocos.
+
+    def reserve_memory(self, n_bytes: int, required: bool = False) -> bool:
+        """
+        :param n_bytes: Bytes a reservar
+        :param required: Reserva mesmo acima do orçamento (o bloco sem o
+            qual a stream não anda); conta para barrar as outras reservas
+        :return: True se reservou
+        """
+        with self.__changed:
+            if not required and self.__memory + n_bytes > self.max_memory:
+                return False
+            self.__memory += n_bytes
+            return True
+
+    def release_memory(self, n_bytes: int):
+        with self.__changed:
+            self.__memory -= n_bytes
+
+    # Compressões.
+
+    def try_acquire_compression(self) -> bool:
+        with self.__changed:
+            if self.__compressions >= self.max_compressions:
+                return False
+            self.__compressions += 1
+            return True
+
+    def release_compression(self):
+        def update():
+            self.__compressions -= 1
+        self.__release(update)
+
+    @contextlib.contextmanager
+    def compression_slot(self):
+        """
+        Espera uma vaga para comprimir uma stream.
+        """
+        while not self.try_acquire_compression():
+            self.__wait_for(lambda: self.__compressions < self.max_compressions, None)
+        try:
+            yield
+        finally:
+            self.release_compression()
+
+    def stats(self) -> Dict:
+        with self.__changed:
+            return {
+                'streams': self.__streams,
+                'memory': self.__memory,
+                'compressions': self.__compressions,
+                'clients': len(self.__connections)
+            }
@@ -0,0 +1,182 @@
+import collections
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+# Modos de distribuição das faixas entre as streams.
+STATIC_SCHEDULE = 'static'
+DYNAMIC_SCHEDULE = 'dynamic'
+
+# Primeiro pedaço de cada stream, antes de medir a vazão dela.
+INITIAL_CHUNK_SIZE = 4 * 2 ** 20
+
+# Limites do tamanho dos pedaços.
+MIN_CHUNK_SIZE = 256 * 2 ** 10
+MAX_CHUNK_SIZE = 64 * 2 ** 20
+
+# Cada pedaço deve levar mais ou menos isso para sair pela stream.
+TARGET_CHUNK_SECONDS = 0.5
+
+# Peso da última medição na média da vazão de cada stream.
+THROUGHPUT_SMOOTHING = 0.5
+
+# No fim, só vale duplicar pedaços que ainda tenham isso por enviar.
+MIN_HEDGE_SIZE = 64 * 2 ** 10
+
+
+def max_chunks(size: int, alignment: int = 1) -> int:
+    """
+    :param size: Bytes a distribuir
+    :param alignment: Pedaços são múltiplos disto
+    :return: Quantos pedaços de tamanho mínimo cabem em <size> (ao menos
+        1); streams além disso nunca recebem pedaço nenhum
+    """
+    alignment = max(alignment, 1)
+    min_size = max(MIN_CHUNK_SIZE // alignment, 1) * alignment
+    return max(-(-size // min_size), 1)
+
+
+class Chunk:
+    """
+    Faixa [start, end) entregue a uma stream. <position> é até onde alguma
+    stream já enviou; <done> marca que a faixa inteira já saiu.
+    """
+
+    __slots__ = ('start', 'end', 'position', 'owner', 'hedged', 'done')
+
+    def __init__(self, start: int, end: int, owner: int):
+        self.start = start
+        self.end = end
+        self.position = start
+        self.owner = owner
+        self.hedged = False
+        self.done = False
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.position
+
+
+class ChunkScheduler:
+    """
+    Distribui as faixas pedidas em pedaços que as streams pegam sob
+    demanda, em vez de uma partição fixa por stream:
+     - o tamanho do pedaço segue a vazão medida da stream (cerca de
+       TARGET_CHUNK_SECONDS de envio) e encolhe perto do fim, para as
+       streams terminarem juntas;
+     - sem pedaços novos, uma stream ociosa duplica a parte que falta do
+       pedaço em andamento que deve terminar por último; quem chegar ao
+       fim primeiro marca o pedaço como feito e a outra para.
+    O cliente escreve cada bloco no seu byte inicial, então blocos
+    repetidos não causam problema.
+    """
+
+    def __init__(
+            self,
+            ranges: List[Tuple[int, int]],
+            streams: int,
+            alignment: int = 1
+    ):
+        """
+        :param ranges: Faixas (byte inicial, tamanho) a enviar
+        :param streams: Quantidade de streams
+        :param alignment: Pedaços são múltiplos disto (ex.: bloco de compressão)
+        """
+        self.streams = max(streams, 1)
+        self.alignment = max(alignment, 1)
+        self.__pending = collections.deque(
+            (start, start + size) for start, size in ranges if size > 0)
+        self.__pending_bytes = sum(end - start for start, end in self.__pending)
+        self.__outstanding: List[Chunk] = []
+        self.__throughputs: Dict[int, float] = {}
+        self.__finish_times: Dict[int, float] = {}
+        self.__start_time = time.perf_counter()
+        self.__lock = threading.Lock()
+
+    def chunk_size(self, stream_id: int) -> int:
+        throughput = self.__throughputs.get(stream_id)
+        if throughput is None:
+            size = INITIAL_CHUNK_SIZE
+        else:
+            size = int(throughput * TARGET_CHUNK_SECONDS)
+        # Perto do fim, pedaços menores deixam as streams terminarem juntas.
+        size = min(size, self.__pending_bytes // (2 * self.streams))
+        size = min(max(size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+        return max(size // self.alignment, 1) * self.alignment
+
+    def next_chunk(self, stream_id: int) -> Optional[Tuple[Chunk, int]]:
+        """
+        :param stream_id: Stream que pede trabalho
+        :return: (pedaço, byte inicial a enviar), ou None se não há mais
+            nada para esta stream
+        """
+        with self.__lock:
+            self.__outstanding = [c for c in self.__outstanding if not c.done]
+            if self.__pending:
+                start, end = self.__pending.popleft()
+                chunk_end = min(end, start + self.chunk_size(stream_id))
+                if chunk_end < end:
+                    self.__pending.appendleft((chunk_end, end))
+                self.__pending_bytes -= chunk_end - start
+                chunk = Chunk(start, chunk_end, stream_id)
+                self.__outstanding.append(chunk)
+                return chunk, start
+
+            # Sem pedaços novos: duplica o que deve terminar por último.
+            candidates = [
+                c for c in self.__outstanding
+                if not c.hedged and c.owner != stream_id
+                and c.remaining >= MIN_HEDGE_SIZE
+            ]
+            if not candidates:
+                self.__finish_times.setdefault(
+                    stream_id, time.perf_counter() - self.__start_time)
+                return None
+            chunk = max(candidates, key=self.__expected_finish)
+            chunk.hedged = True
+            return chunk, chunk.position
+
+    def __expected_finish(self, chunk: Chunk) -> float:
+        throughput = self.__throughputs.get(chunk.owner)
+        if not throughput:
+            return float('inf')
+        return chunk.remaining / throughput
+
+    def advance(self, chunk: Chunk, position: int) -> bool:
+        """
+        Registra que uma stream enviou o pedaço até <position>.
+        :return: True se o pedaço já foi todo enviado (por qualquer stream)
+        """
+        with self.__lock:
+            if position > chunk.position:
+                chunk.position = position
+            if chunk.position >= chunk.end:
+                chunk.done = True
+            return chunk.done
+
+    def finish(self, stream_id: int, n_bytes: int, elapsed: float):
+        """
+        Atualiza a vazão da stream com um pedaço enviado.
+        :param stream_id: Stream
+        :param n_bytes: Bytes do arquivo cobertos pelo envio
+        :param elapsed: Tempo gasto (s)
+        """
+        if elapsed <= 0 or n_bytes <= 0:
+            return
+        throughput = n_bytes / elapsed
+        with self.__lock:
+            previous = self.__throughputs.get(stream_id)
+            if previous is not None:
+                throughput = (
+                    THROUGHPUT_SMOOTHING * throughput
+                    + (1 - THROUGHPUT_SMOOTHING) * previous
+                )
+            self.__throughputs[stream_id] = throughput
+
+    def finish_times(self) -> Dict[int, float]:
+        """
+        :return: Tempo (s, desde a criação) em que cada stream ficou sem trabalho
+        """
+        with self.__lock:
+            return dict(self.__finish_times)
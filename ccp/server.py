@@ -1,35 +1,508 @@
+import contextlib
+import functools
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import socketserver
-import pickle
 import os
-import threading
 import socket
 import sys
-import gzip
-import psutil
+import time
 # import daemon
-import math
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 
-from ccp.messaging import send_message, recv_message
-from ccp.addressing import get_abspath, validate_path
-from ccp.argparsers import get_server_parser
+from ccp.messaging import (
+    CHUNK_HEADER,
+    CHUNKED_PARTITION_SIZE,
+    DEFAULT_INLINE_THRESHOLD,
+    MAX_INLINE_SIZE,
+    SCHEDULED_PARTITION_SIZE,
+    STREAMED_PARTITION_SIZE,
+    MessageType,
+    ProtocolError,
+    send_message,
+    recv_message,
+    send_buffers,
+    send_chunk,
+    send_end_chunk,
+    send_frame,
+    send_end_frame,
+    send_partition_header
+)
+from ccp.addressing import get_abspath
+from ccp.argparsers import ASYNCIO_ENGINE, get_server_parser
 from ccp.utils import bytes2human, human2bytes
-import shutil
-from ccp.addressing import get_partial_path
+from ccp.manifest import get_file_identity
+from ccp.packing import (
+    BATCH_HEADER,
+    BatchQueue,
+    compress_batch,
+    entry_path,
+    pack_batch_header,
+    pack_entries,
+    scan_tree,
+    split_listing,
+    tree_size
+)
+from ccp.partitioning import get_partition_ranges, normalize_ranges, split_ranges
+from ccp.pipeline import (
+    DOWNLOAD_OPERATION,
+    LIST_OPERATION,
+    REQUEST_CHUNK,
+    SESSION_WORKERS,
+    STAT_OPERATION,
+    SessionPipeline,
+    list_directory,
+    read_chunk,
+    split_chunks,
+    stat_path
+)
+from ccp.scheduling import DYNAMIC_SCHEDULE, STATIC_SCHEDULE, ChunkScheduler, max_chunks
+from ccp.sessions import SessionRegistry
+from ccp.upload import UploadTarget, recv_upload_chunks, resolve_upload_path
+from ccp.resources import RETRY_AFTER, ResourceManager, configure_connection
+from ccp.cache import ChunkCache
+from ccp.chunking import MAX_INDEX_CHUNKS, ChunkIndexCache
+from ccp.singleflight import FlightGroup
+from ccp.compression import (
+    DEFAULT_CODEC,
+    ParallelCompressor,
+    get_codec,
+    is_precompressed,
+    negotiate_codec
+)
+from ccp.integrity import BackgroundFileHash, get_checksum, negotiate_checksum, sha256_file
+from ccp.delta import DELTA_MAX_BLOCK_SIZE, DeltaGenerator, send_delta
+from ccp.merkle import (
+    MAX_MERKLE_BLOCK_SIZE,
+    MIN_MERKLE_BLOCK_SIZE,
+    MerkleTreeCache,
+    answer_nodes
+)
 
 
-def get_partition_sizes(size, n_workers):
-    division, remainder = divmod(size, n_workers)
-    return [division + 1 for _ in range(remainder)] + [division for _ in range(n_workers - remainder)]
+# Resposta a um pedido de download de arquivo que não existe.
+MISSING_FILE_RESPONSE = {
+    'size': None,
+    'streams': None,
+    'token': None,
+    'ranges': None,
+    'codec': None,
+    'identity': None,
+    'checksum': None,
+    'schedule': None,
+    'retry_after': None,
+    'inline': None,
+    'sha256': None
+}
+
+# Resposta quando o servidor está cheio: o cliente tenta de novo depois.
+BUSY_RESPONSE = {**MISSING_FILE_RESPONSE, 'retry_after': RETRY_AFTER}
+
+
+# Respostas a comparação remota, lista de pedaços e delta de um arquivo
+# que não existe (ou, com retry_after, quando o servidor está cheio).
+MISSING_TREE_RESPONSE = {
+    'size': None,
+    'block_size': None,
+    'depth': None,
+    'leaves': None,
+    'retry_after': None
+}
+MISSING_CHUNKS_RESPONSE = {
+    'size': None,
+    'identity': None,
+    'sizes': None,
+    'digests': None,
+    'retry_after': None
+}
+MISSING_DELTA_RESPONSE = {
+    'size': None,
+    'identity': None,
+    'retry_after': None
+}
+
+
+# Resposta a um pedido de diretório que não existe (ou servidor cheio).
+MISSING_DIRECTORY_RESPONSE = {
+    'token': None,
+    'streams': None,
+    'codec': None,
+    'files': None,
+    'size': None,
+    'batches': None,
+    'listing_messages': None,
+    'skipped': None,
+    'retry_after': None
+}
+
+
+# Resposta a um SESSION_OPEN quando o servidor está cheio.
+MISSING_SESSION_RESPONSE = {
+    'token': None,
+    'streams': None,
+    'codec': None,
+    'retry_after': None
+}
+
+
+# Resposta a um UPLOAD_REQUEST recusado (destino inválido ou servidor cheio).
+MISSING_UPLOAD_RESPONSE = {
+    'token': None,
+    'streams': None,
+    'codec': None,
+    'retry_after': None,
+    'error': None
+}
+
+
+def upload_options(request_message: Dict) -> Dict:
+    """
+    Lê o UPLOAD_REQUEST e negocia o codec com o cliente.
+    :param request_message: Mensagem do cliente
+    :return: Argumentos de upload_interaction
+    """
+    codec = None
+    if request_message['compressed']:
+        codec = negotiate_codec(request_message.get('codecs', [DEFAULT_CODEC]))
+    return {
+        'path': request_message['path'],
+        'size': request_message.get('size'),
+        'streams': request_message['streams'],
+        'codec': codec
+    }
+
+
+def session_options(request_message: Dict) -> Dict:
+    """
+    Lê o SESSION_OPEN e negocia o codec da sessão com o cliente.
+    :param request_message: Mensagem do cliente
+    :return: Argumentos de session_interaction
+    """
+    codec = None
+    if request_message['compressed']:
+        codec = negotiate_codec(request_message.get('codecs', [DEFAULT_CODEC]))
+    return {
+        'streams': request_message['streams'],
+        'codec': codec,
+        'level': request_message.get('level')
+    }
+
+
+def directory_options(request_message: Dict) -> Dict:
+    """
+    Lê o DIRECTORY_REQUEST e negocia o codec com o cliente.
+    :param request_message: Mensagem do cliente
+    :return: Argumentos de directory_interaction
+    """
+    codec = None
+    if request_message['compressed']:
+        codec = negotiate_codec(request_message.get('codecs', [DEFAULT_CODEC]))
+    return {
+        'path': request_message['path'],
+        'streams': request_message['streams'],
+        'codec': codec,
+        'level': request_message.get('level')
+    }
+
+
+def download_options(request_message: Dict) -> Dict:
+    """
+    Lê o DOWNLOAD_REQUEST e negocia codec e checksum com o cliente.
+    :param request_message: Mensagem do cliente
+    :return: Argumentos de download_interaction
+    """
+    # O cliente lista os codecs que entende; o servidor escolhe um.
+    codec = None
+    if request_message['compressed']:
+        client_codecs = request_message.get('codecs', [DEFAULT_CODEC])
+        codec = negotiate_codec(client_codecs)
+        logging.debug(
+            'Codecs do cliente: %s. Escolhido: %s', client_codecs, codec)
+
+    checksum = None
+    if request_message.get('verify', False):
+        checksum = negotiate_checksum(request_message.get('checksums', []))
+        logging.debug('Checksum dos pedaços: %s', checksum)
+
+    return {
+        'path': request_message['path'],
+        'streams': request_message['streams'],
+        'codec': codec,
+        'level': request_message.get('level'),
+        'adaptive': request_message.get('adaptive', False),
+        'raw_blocks': request_message.get('raw_blocks', False),
+        'ranges': request_message.get('ranges'),
+        'identity': request_message.get('identity'),
+        'checksum': checksum,
+        'sha256': request_message.get('sha256', False),
+        'schedule': request_message.get('schedule', STATIC_SCHEDULE),
+        'inline': request_message.get('inline', False)
+    }
+
+
+class DownloadPlan:
+    """
+    O que um pedido de download vai enviar: as faixas de cada stream (ou
+    o agendador que as distribui) e o codec final.
+    """
+
+    def __init__(
+            self,
+            identity: Dict,
+            ranges: List[Tuple[int, int]],
+            streams: int,
+            codec: Optional[str],
+            scheduler: Optional[ChunkScheduler]
+    ):
+        self.identity = identity
+        self.size = identity['size']
+        self.ranges = ranges
+        self.streams = streams
+        self.codec = codec
+        self.scheduler = scheduler
+
+    def response(self, token: str, checksum: Optional[str]) -> Dict:
+        """
+        :param token: Token da sessão com as streams do pedido
+        :param checksum: Checksum negociado, ou None
+        :return: Mensagem DOWNLOAD_RESPONSE
+        """
+        return {
+            'size': self.size,
+            'streams': self.streams,
+            'token': token,
+            'ranges': self.ranges,
+            'codec': self.codec,
+            'identity': self.identity,
+            'checksum': checksum,
+            'schedule': (
+                DYNAMIC_SCHEDULE if self.scheduler is not None else STATIC_SCHEDULE
+            ),
+            'retry_after': None,
+            'inline': None,
+            'sha256': None
+        }
+
+
+def plan_download(
+        abs_path: str,
+        streams: int,
+        codec: Optional[str],
+        adaptive: bool,
+        ranges: Optional[List[Tuple[int, int]]],
+        identity: Optional[Dict],
+        schedule: str,
+        alignment: int = 1
+) -> DownloadPlan:
+    """
+    Divide o arquivo (ou as faixas que faltam ao cliente) entre as streams.
+    :param abs_path: Caminho absoluto do arquivo pedido
+    :param streams: Quantidade de conexões pedida
+    :param codec: Codec negociado, ou None
+    :param adaptive: Compressão adaptativa
+    :param ranges: Faixas pedidas para retomar um download, ou None
+    :param identity: Identidade do arquivo quando as faixas foram calculadas
+    :param schedule: STATIC_SCHEDULE ou DYNAMIC_SCHEDULE
+    :param alignment: Pedaços dinâmicos são múltiplos disto
+    :return: Plano do download
+    """
+    file_identity = get_file_identity(abs_path)
+    file_size = file_identity['size']
+
+    if ranges is not None and identity != file_identity:
+        logging.debug('Arquivo %s mudou desde o download parcial.', abs_path)
+        ranges = None
+
+    if ranges is not None:
+        try:
+            ranges = normalize_ranges(ranges, file_size)
+        except ValueError as exc:
+            logging.debug('Faixas inválidas (%s): enviando o arquivo todo.', exc)
+            ranges = None
+
+    scheduler = None
+    if schedule == DYNAMIC_SCHEDULE:
+        # As streams pegam pedaços das faixas conforme ficam livres.
+        download_ranges = ranges if ranges is not None else [(0, file_size)]
+        # Streams que nunca receberiam um pedaço nem chegam a ser abertas.
+        streams = max(min(streams, max_chunks(
+            sum(size for _, size in download_ranges), alignment)), 1)
+        scheduler = ChunkScheduler(download_ranges, streams, alignment=alignment)
+    elif ranges is None:
+        # Particiona tamanho do arquivo em N streams.
+        download_ranges = get_partition_ranges(file_size, streams)
+    else:
+        download_ranges = split_ranges(ranges, streams)
+    if scheduler is None:
+        streams = len(download_ranges)
+
+    if codec is not None and adaptive and is_precompressed(abs_path):
+        # Comprimir de novo só gastaria CPU: vai sem compressão.
+        logging.debug('Arquivo %s já é comprimido.', abs_path)
+        codec = None
+
+    return DownloadPlan(file_identity, download_ranges, streams, codec, scheduler)
+
+
+def inline_response(
+        abs_path: str,
+        threshold: int,
+        codec: Optional[str],
+        level: Optional[int],
+        adaptive: bool,
+        sha256: bool
+) -> Optional[Dict]:
+    """
+    Lê um arquivo pequeno inteiro para ir no próprio DOWNLOAD_RESPONSE,
+    sem sessão nem streams de dados: o download leva uma ida e volta só.
+    O conteúdo vai comprimido só se o codec de fato o diminuir.
+    :param abs_path: Caminho absoluto do arquivo pedido
+    :param threshold: Tamanho máximo enviado assim
+    :param codec: Codec negociado, ou None
+    :param level: Nível de compressão
+    :param adaptive: Compressão adaptativa
+    :param sha256: Manda também o SHA-256 do conteúdo
+    :return: Mensagem DOWNLOAD_RESPONSE, ou None se o arquivo não é
+        pequeno o bastante (ou não é um arquivo comum)
+    """
+    threshold = min(threshold, MAX_INLINE_SIZE)
+    if threshold <= 0 or not os.path.isfile(abs_path):
+        return None
+    file_identity = get_file_identity(abs_path)
+    if file_identity['size'] > threshold:
+        return None
+    with open(abs_path, mode='rb') as file:
+        payload = file.read(threshold + 1)
+    if len(payload) != file_identity['size']:
+        # Mudou durante a leitura: vai pelo caminho normal.
+        return None
+
+    file_sha256 = hashlib.sha256(payload).hexdigest() if sha256 else None
+    if codec is not None and adaptive and is_precompressed(abs_path):
+        codec = None
+    if codec is not None:
+        compressed_payload = get_codec(codec).compress(payload, level)
+        if len(compressed_payload) < len(payload):
+            payload = compressed_payload
+        else:
+            codec = None
+    return {
+        **MISSING_FILE_RESPONSE,
+        'size': file_identity['size'],
+        'streams': 0,
+        'ranges': [],
+        'codec': codec,
+        'identity': file_identity,
+        'schedule': STATIC_SCHEDULE,
+        'inline': payload,
+        'sha256': file_sha256
+    }
+
+
+def answer_session_request(
+        request_message: Dict,
+        inline_threshold: int,
+        codec: Optional[str],
+        level: Optional[int],
+        chunk_size: int
+) -> Tuple[Dict, Optional[str], List[Tuple[int, int]]]:
+    """
+    Atende um SESSION_REQUEST (download, stat ou list). Downloads pequenos
+    vão na própria resposta; os outros são divididos em pedaços para as
+    streams da sessão.
+    :param request_message: Pedido do cliente
+    :param inline_threshold: Tamanho máximo enviado na resposta
+    :param codec: Codec da sessão, ou None
+    :param level: Nível de compressão
+    :param chunk_size: Tamanho dos pedaços dos downloads
+    :return: (resposta, caminho absoluto, faixas a enviar pelas streams)
+    """
+    operation = request_message['op']
+    abs_path = get_abspath(request_message['path'])
+    if operation == STAT_OPERATION:
+        return stat_path(abs_path), abs_path, []
+    if operation == LIST_OPERATION:
+        return list_directory(abs_path), abs_path, []
+    if operation != DOWNLOAD_OPERATION:
+        raise ValueError(f'Operação desconhecida: {operation}.')
+
+    if not os.path.isfile(abs_path):
+        raise FileNotFoundError(f'Arquivo {request_message["path"]} não foi encontrado.')
+    response = inline_response(
+        abs_path,
+        inline_threshold,
+        codec,
+        level,
+        False,
+        request_message.get('sha256', False)
+    )
+    if response is not None:
+        return response, abs_path, []
+    file_identity = get_file_identity(abs_path)
+    return {
+        **MISSING_FILE_RESPONSE,
+        'size': file_identity['size'],
+        'identity': file_identity,
+        'codec': codec
+    }, abs_path, split_chunks(file_identity['size'], chunk_size)
 
 
 class ThreadedFileServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    pass
+    # Streams de dados também chegam pela porta principal, várias de uma vez.
+    request_queue_size = 1024
+    allow_reuse_address = True
+
+    def __init__(
+            self,
+            server_address,
+            request_handler_class,
+            compressor: ParallelCompressor = None,
+            resources: ResourceManager = None,
+            inline_threshold: int = DEFAULT_INLINE_THRESHOLD,
+            upload_root: Optional[str] = None,
+            max_upload_size: Optional[int] = None
+    ):
+        super().__init__(server_address, request_handler_class)
+        # Arquivos até este tamanho vão na própria resposta (inline_response).
+        self.inline_threshold = inline_threshold
+        # Único diretório que recebe uploads (None: uploads recusados).
+        self.upload_root = upload_root
+        # Maior upload aceito (None: só o espaço livre limita).
+        self.max_upload_size = max_upload_size
+        # Limites de streams, memória, compressões e conexões do servidor.
+        self.resources = resources or ResourceManager()
+        # Compressor compartilhado por todos os pedidos.
+        self.compressor = compressor or ParallelCompressor(
+            memory_budget=self.resources)
+        # Árvores de Merkle por (caminho, tamanho, mtime).
+        self.tree_cache = MerkleTreeCache()
+        # Listas de pedaços definidos pelo conteúdo por (caminho, tamanho, mtime).
+        self.chunk_indexes = ChunkIndexCache()
+        # Pedidos esperando as suas streams de dados (na porta principal).
+        self.sessions = SessionRegistry()
+
+    def verify_request(self, request, client_address):
+        # Recusa clientes com conexões demais; a vaga volta em finish().
+        return self.resources.open_connection(client_address[0])
+
+    def server_close(self):
+        super().server_close()
+        self.compressor.shutdown()
 
 
 class ThreadedFileServerRequestHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        idle_timeout = self.server.resources.idle_timeout
+        # Cliente parado ou morto não segura a thread para sempre.
+        self.request.settimeout(idle_timeout)
+        configure_connection(self.request, idle_timeout)
+
+    def finish(self):
+        self.server.resources.close_connection(self.client_address[0])
+
     # def start_download(
     #         self,
     #         sock,
@@ -69,276 +542,1176 @@ class ThreadedFileServerRequestHandler(socketserver.BaseRequestHandler):
     #         connection.close()
     #         sock.close()
 
-    def compress_file(self, source_path, target_path, start_byte, partition_size):
-        print(
-            f'Compressing {source_path} to {target_path} from {start_byte} to {start_byte + partition_size}.')
-        with open(
-                source_path,
-                mode='rb'
-        ) as file:
-            file.seek(start_byte)
-            with gzip.open(
-                    target_path,
-                    mode='wb',
-                    compresslevel=1
-            ) as gzip_file:
-                bytes_written = gzip_file.write(file.read(partition_size))
-                print(f'Wrote {bytes2human(bytes_written)} to {target_path}')
-
-    def partition_file(self, source_path, target_path, start_byte, partition_size):
-        """
-        Write to <dest> <source>'s content from start_byte to start_byte + partition_size.
-        :param source_path: Source file
-        :param target_path: Destination file
-        :param start_byte:
-        :param partition_size:
-        :return:
-        """
-        print(f'Partitioning {source_path} to {target_path} from {start_byte} to {start_byte + partition_size}.')
-        with open(
-                source_path,
-                mode='rb'
-        ) as file:
-            with open(
-                    target_path,
-                    mode='wb',
-            ) as partitioned_file:
-                file.seek(start_byte)
-                bytes_written = partitioned_file.write(file.read(partition_size))
-                print(f'Wrote {bytes2human(bytes_written)} to {target_path}')
-
-    def send_partition(
+    def send_file_range(
             self,
-            sock,
-            partition_path,
+            connection,
+            source_path,
+            start_byte,
+            partition_size,
             block_size
     ):
+        """
+        Envia <partition_size> bytes de <source_path> a partir de <start_byte>
+        diretamente do arquivo para o socket, sem arquivo temporário.
+        Usa socket.sendfile (cópia feita pelo kernel, respeitando o timeout
+        da conexão) quando disponível.
+        :param connection: Conexão TCP de dados
+        :param source_path: Caminho do arquivo-fonte
+        :param start_byte: Byte inicial da partição
+        :param partition_size: Tamanho da partição
+        :param block_size: Tamanho máximo de cada envio
+        :return: Total de bytes enviados
+        """
+        with open(source_path, mode='rb') as file:
+            return self.send_file_bytes(
+                connection,
+                file,
+                start_byte,
+                partition_size,
+                block_size
+            )
 
-        download_port = sock.getsockname()[1]
+    def send_file_bytes(self, connection, file, start_byte, size, block_size):
+        """
+        Como send_file_range, com o arquivo-fonte já aberto. Plataformas
+        sem sendfile (ex.: Windows) leem em blocos dentro de socket.sendfile.
+        :return: Total de bytes enviados
+        """
+        total_bytes_sent = 0
+        while total_bytes_sent < size:
+            bytes_sent = connection.sendfile(
+                file,
+                start_byte + total_bytes_sent,
+                min(size - total_bytes_sent, block_size)
+            )
+            if bytes_sent == 0:
+                raise RuntimeError(f'{file.name}: Li 0 bytes!')
+            total_bytes_sent += bytes_sent
+        return total_bytes_sent
 
-        connection, _ = sock.accept()
+    def send_range(
+            self,
+            connection,
+            source_path,
+            start_byte,
+            partition_size,
+            block_size
+    ):
+        """
+        Envia a partição sem compressão.
+        """
+        download_port = connection.getpeername()[1]
 
-        # Antes de enviar o arquivo, enviamos o tamanho.
-        import os
-        file_size = os.path.getsize(partition_path)
-        length_bytes = pickle.dumps(file_size)
-        length_bytes_buf = bytearray(30)
-        length_bytes_buf[:len(length_bytes)] = length_bytes
-        connection.sendall(length_bytes_buf)
+        try:
+            send_partition_header(connection, partition_size)
+            bytes_sent = self.send_file_range(
+                connection,
+                source_path,
+                start_byte,
+                partition_size,
+                block_size
+            )
+            print(
+                f'{download_port}: Enviei {bytes2human(bytes_sent)} de {source_path}.')
+        except Exception as exc:
+            print(exc)
+        else:
+            print('Finished sending!')
+        finally:
+            connection.close()
 
-        print(
-            f'{download_port}: Enviei o tamanho do arquivo parcial "{partition_path}": {bytes2human(file_size)}')
+    def send_compressed_range(
+            self,
+            connection,
+            source_path,
+            start_byte,
+            partition_size,
+            codec,
+            level,
+            adaptive=False,
+            raw_blocks=False
+    ):
+        """
+        Envia a partição comprimida enquanto a lê: os blocos são
+        comprimidos em paralelo pelo compressor do servidor e cada membro
+        do codec é enviado como um quadro assim que fica pronto. O sendall bloqueante segura a leitura quando a rede
+        está lenta. Sem <raw_blocks>, o resultado concatenado é válido
+        para o codec; com ele, blocos incompressíveis vão em quadros
+        marcados como sem compressão.
+        """
+        download_port = connection.getpeername()[1]
 
         try:
-            with open(partition_path, mode='rb') as partial_file:
-                total_bytes_read = 0
-                blocks_written = 0
-                while total_bytes_read < file_size:
-                    block_bytes = partial_file.read(
-                        min(file_size - total_bytes_read, block_size))
-                    if not block_bytes:
-                        raise RuntimeError(f'{download_port}: Read 0 bytes!')
-                    print(
-                        f'{download_port}: Li {bytes2human(len(block_bytes))} bytes de {partition_path} para enviar.')
-                    connection.sendall(block_bytes)
-                    print(f'{download_port}: Enviei block_bytes.')
-
-                    # print(
-                    #     f'{download_port}: Bytes read: {len(block_bytes)}')
-                    total_bytes_read += len(block_bytes)
-                    print(
-                        f'{download_port}:  Total bytes read: {bytes2human(total_bytes_read)}.')
-                    blocks_written += 1
-                    # print(f'{download_port}:  Total blocks_written:',
-                    #       blocks_written)
+            # Avisa ao cliente que virão quadros até o quadro vazio.
+            send_partition_header(connection, STREAMED_PARTITION_SIZE)
 
+            total_bytes_sent = 0
+            with open(source_path, mode='rb') as file:
+                blocks = self.server.compressor.process_range(
+                    file,
+                    start_byte,
+                    partition_size,
+                    codec=codec,
+                    level=level,
+                    adaptive=adaptive,
+                    raw_blocks=raw_blocks
+                )
+                for block in blocks:
+                    send_frame(connection, block.payload, block.raw)
+                    total_bytes_sent += len(block.payload)
+            send_end_frame(connection)
+            print(
+                f'{download_port}: Comprimi {bytes2human(partition_size)} '
+                f'em {bytes2human(total_bytes_sent)}.')
         except Exception as exc:
             print(exc)
         else:
             print('Finished sending!')
         finally:
             connection.close()
-            sock.close()
+
+    def send_verified_range(
+            self,
+            connection,
+            source_path,
+            start_byte,
+            partition_size,
+            codec,
+            level,
+            adaptive,
+            checksum,
+            raw_blocks=False
+    ):
+        """
+        Envia a partição em pedaços com checksum: cada bloco (comprimido
+        ou não) leva sua faixa original e o checksum do conteúdo, para o
+        cliente descartar só os pedaços corrompidos e pedi-los de novo.
+        """
+        download_port = connection.getpeername()[1]
+
+        try:
+            send_partition_header(connection, CHUNKED_PARTITION_SIZE)
+
+            total_bytes_sent = 0
+            with open(source_path, mode='rb') as file:
+                blocks = self.server.compressor.process_range(
+                    file,
+                    start_byte,
+                    partition_size,
+                    codec=codec,
+                    level=level,
+                    adaptive=adaptive,
+                    checksum=checksum,
+                    raw_blocks=raw_blocks
+                )
+                for block in blocks:
+                    send_chunk(
+                        connection,
+                        block.offset,
+                        block.size,
+                        block.payload,
+                        block.checksum,
+                        block.raw
+                    )
+                    total_bytes_sent += len(block.payload)
+            send_end_chunk(connection)
+            print(
+                f'{download_port}: Enviei {bytes2human(partition_size)} '
+                f'em {bytes2human(total_bytes_sent)} verificados.')
+        except Exception as exc:
+            print(exc)
+        finally:
+            connection.close()
+
+    def send_scheduled_chunks(
+            self,
+            connection,
+            stream_id,
+            source_path,
+            scheduler,
+            codec,
+            level,
+            adaptive,
+            checksum,
+            raw_blocks=False
+    ):
+        """
+        Envia os pedaços que o agendador entregar a esta stream, até ele
+        não ter mais nada. Cada bloco vai com o seu byte inicial
+        (CHUNK_HEADER); sem compressão nem checksum, o conteúdo sai por
+        sendfile. Entre blocos, a stream confere se o
+        pedaço já foi terminado por outra stream (duplicação no fim).
+        """
+        download_port = connection.getpeername()[1]
+        block_size = self.server.compressor.block_size
+
+        try:
+            send_partition_header(connection, SCHEDULED_PARTITION_SIZE)
+            total_bytes_sent = 0
+            with open(source_path, mode='rb') as file:
+                while True:
+                    assignment = scheduler.next_chunk(stream_id)
+                    if assignment is None:
+                        break
+                    chunk, position = assignment
+                    start_position = position
+                    start = time.perf_counter()
+                    if codec is None and checksum is None:
+                        while position < chunk.end and not chunk.done:
+                            size = min(block_size, chunk.end - position)
+                            connection.sendall(CHUNK_HEADER.pack(position, size, size, 0, False))
+                            total_bytes_sent += self.send_file_bytes(
+                                connection, file, position, size, size)
+                            position += size
+                            scheduler.advance(chunk, position)
+                    else:
+                        blocks = self.server.compressor.process_range(
+                            file,
+                            position,
+                            chunk.end - position,
+                            codec=codec,
+                            level=level,
+                            adaptive=adaptive,
+                            checksum=checksum,
+                            raw_blocks=raw_blocks
+                        )
+                        with contextlib.closing(blocks):
+                            for block in blocks:
+                                send_chunk(
+                                    connection,
+                                    block.offset,
+                                    block.size,
+                                    block.payload,
+                                    block.checksum or 0,
+                                    block.raw
+                                )
+                                total_bytes_sent += len(block.payload)
+                                position = block.offset + block.size
+                                if scheduler.advance(chunk, position):
+                                    break
+                    scheduler.finish(
+                        stream_id,
+                        position - start_position,
+                        time.perf_counter() - start
+                    )
+            send_end_chunk(connection)
+            print(f'{download_port}: Enviei {bytes2human(total_bytes_sent)} em pedaços.')
+        except Exception as exc:
+            print(exc)
+        finally:
+            connection.close()
 
     def start_download(
             self,
+            connection,
             partition_id,
-            sock,
             path,
             start_byte,
             partition_size,
             block_size,
-            compressed
+            codec,
+            level,
+            adaptive,
+            checksum=None,
+            raw_blocks=False
     ):
 
-        partition_path = get_partial_path(
-            path,
-            part_id=partition_id
-        )
-
-        if compressed:
-            self.compress_file(
-                source_path=path,
-                target_path=partition_path,
-                start_byte=start_byte,
-                partition_size=partition_size
-            )
-        else:
-            self.partition_file(
-                source_path=path,
-                target_path=partition_path,
-                start_byte=start_byte,
-                partition_size=partition_size
-            )
-
         info_str = (
             f'Send file whole: {path}\n'
             f' - start_byte: {start_byte}\n'
             f' - partition_size: {bytes2human(partition_size)}\n'
             f' - block_size: {bytes2human(block_size)}\n'
-            f' - compressed: {compressed}\n'
-            f'Result: {partition_path}\n'
+            f' - codec: {codec}\n'
+            f' - adaptive: {adaptive}\n'
+            f' - checksum: {checksum}\n'
         )
         print(info_str)
 
-        self.send_partition(
-            sock,
-            partition_path,
-            block_size=block_size
-        )
-        os.remove(partition_path)
-
+        if checksum is not None:
+            # Pedaços verificados: sem sendfile, mesmo sem compressão.
+            self.send_verified_range(
+                connection,
+                path,
+                start_byte,
+                partition_size,
+                codec=get_codec(codec) if codec is not None else None,
+                level=level,
+                adaptive=adaptive,
+                checksum=get_checksum(checksum),
+                raw_blocks=raw_blocks
+            )
+        elif codec is None:
+            # Sem compressão, a partição sai direto do arquivo-fonte.
+            self.send_range(
+                connection,
+                path,
+                start_byte,
+                partition_size,
+                block_size=block_size
+            )
+        else:
+            self.send_compressed_range(
+                connection,
+                path,
+                start_byte,
+                partition_size,
+                codec=get_codec(codec),
+                level=level,
+                adaptive=adaptive,
+                raw_blocks=raw_blocks
+            )
 
     def download_interaction(
             self,
             path: str,
             streams: int,
-            compressed: bool,
+            codec: Optional[str],
+            level: Optional[int] = None,
+            adaptive: bool = False,
+            raw_blocks: bool = False,
+            ranges: Optional[List[Tuple[int, int]]] = None,
+            identity: Optional[Dict] = None,
+            checksum: Optional[str] = None,
+            sha256: bool = False,
+            schedule: str = STATIC_SCHEDULE,
+            inline: bool = False
     ):
+        """
+        Envia o arquivo <path> em <streams> conexões paralelas.
+        :param path: Caminho do arquivo pedido
+        :param streams: Quantidade de conexões
+        :param codec: Codec negociado, ou None
+        :param level: Nível de compressão
+        :param adaptive: Compressão adaptativa
+        :param raw_blocks: O cliente aceita blocos incompressíveis sem
+            compressão (marcados no CHUNK_HEADER/FRAME_HEADER)
+        :param ranges: Faixas (byte inicial, tamanho) pedidas pelo cliente
+            para retomar um download; None pede o arquivo todo
+        :param identity: Identidade do arquivo quando as faixas foram
+            calculadas; se o arquivo mudou, ele é enviado por inteiro
+        :param checksum: Checksum negociado para verificar cada pedaço,
+            ou None para enviar sem verificação
+        :param sha256: Calcula o SHA-256 do arquivo todo durante o envio
+            e o manda ao cliente no fim (DOWNLOAD_RESULT)
+        :param schedule: STATIC_SCHEDULE (uma faixa fixa por stream) ou
+            DYNAMIC_SCHEDULE (pedaços distribuídos sob demanda)
+        :param inline: O cliente aceita arquivos pequenos na própria
+            resposta (inline_response), sem streams de dados
+        """
         abs_path = get_abspath(path)
 
         logging.debug('Caminho absoluto do arquivo pedido: %s', abs_path)
 
         if not os.path.exists(abs_path):
-            print('AAHAHGIFHGIHFIGHFIGH')
             logging.debug('Arquivo %s não existe!', abs_path)
-            server_response = {
-                'ports': None,
-                'size': None
-            }
+            server_response = MISSING_FILE_RESPONSE
             send_message(
                 connection=self.request,
+                message_type=MessageType.DOWNLOAD_RESPONSE,
                 message=server_response
             )
             logging.debug('Enviei ao cliente mensagem de erro.')
             return None  # Termina conexão.
 
-        file_size = os.path.getsize(abs_path)
-        print(f'Tamanho do arquivo {abs_path}: {bytes2human(file_size)}.')
+        if inline and ranges is None:
+            server_response = inline_response(
+                abs_path,
+                self.server.inline_threshold,
+                codec,
+                level,
+                adaptive,
+                sha256
+            )
+            if server_response is not None:
+                logging.debug('Enviando %s na própria resposta.', abs_path)
+                send_message(
+                    connection=self.request,
+                    message_type=MessageType.DOWNLOAD_RESPONSE,
+                    message=server_response
+                )
+                return None
 
-        def create_and_bind_socket():
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.bind(('localhost', 0))
-            s.listen(1)
-            return s
+        with self.server.resources.admitted(streams) as granted_streams:
+            if not granted_streams:
+                print(f'Servidor cheio: {path} fica para depois.')
+                send_message(
+                    connection=self.request,
+                    message_type=MessageType.DOWNLOAD_RESPONSE,
+                    message=BUSY_RESPONSE
+                )
+                return None
+            if granted_streams < streams:
+                logging.debug(
+                    'Concedidas %d das %d streams pedidas.',
+                    granted_streams,
+                    streams
+                )
+            self.send_download(
+                abs_path,
+                granted_streams,
+                codec,
+                level,
+                adaptive,
+                raw_blocks,
+                ranges,
+                identity,
+                checksum,
+                sha256,
+                schedule
+            )
 
-        # Order sockets by port
-        download_sockets = sorted(
-            [create_and_bind_socket() for _ in range(streams)],
-            key=lambda sock: sock.getsockname()[1]
+    def run_compressing(self, connection, job):
+        """
+        Roda a stream comprimida <job> quando houver vaga para comprimir.
+        """
+        with self.server.resources.compression_slot():
+            job(connection)
+
+    def send_download(
+            self,
+            abs_path: str,
+            streams: int,
+            codec: Optional[str],
+            level: Optional[int],
+            adaptive: bool,
+            raw_blocks: bool,
+            ranges: Optional[List[Tuple[int, int]]],
+            identity: Optional[Dict],
+            checksum: Optional[str],
+            sha256: bool,
+            schedule: str
+    ):
+        """
+        Planeja e envia o download já admitido com <streams> streams (ver
+        download_interaction).
+        """
+        plan = plan_download(
+            abs_path,
+            streams,
+            codec,
+            adaptive,
+            ranges,
+            identity,
+            schedule,
+            alignment=self.server.compressor.block_size
         )
+        file_size = plan.size
+        download_ranges = plan.ranges
+        streams = plan.streams
+        codec = plan.codec
+        scheduler = plan.scheduler
+        print(f'Tamanho do arquivo {abs_path}: {bytes2human(file_size)}.')
+
+        # O hash do arquivo todo é calculado enquanto as partições saem.
+        file_hash = BackgroundFileHash(abs_path) if sha256 else None
+        self.server.compressor.record_access(
+            abs_path, get_codec(codec) if codec is not None else None, level)
 
-        # Particiona tamanho do arquivo em N streams.
-        partition_sizes = get_partition_sizes(file_size, streams)
-        assert sum(partition_sizes) == file_size
         logging.debug(
             'Tamanho das partições: %s',
-            [bytes2human(size) for size in partition_sizes]
+            [bytes2human(size) for _, size in download_ranges]
         )
 
-        free_ram = psutil.virtual_memory().free
-        logging.debug('Memória RAM disponível: %s', bytes2human(free_ram))
-
-
-        # if blocksize is None:
-        # print('Block size: max. partition size.')
-        blocksizes = [free_ram // (2 * streams) for _ in partition_sizes]
-        # else:
-        #     blocksizes = [human2bytes(blocksize) for _ in partition_sizes]
+        # Cada stream vira uma função que roda na thread da conexão de dados
+        # que se apresentar com o token da sessão e o id da stream.
+        jobs = []
+        for i in range(streams):
+            if scheduler is not None:
+                job = functools.partial(
+                    self.send_scheduled_chunks,
+                    stream_id=i,
+                    source_path=abs_path,
+                    scheduler=scheduler,
+                    codec=get_codec(codec) if codec is not None else None,
+                    level=level,
+                    adaptive=adaptive,
+                    checksum=get_checksum(checksum) if checksum is not None else None,
+                    raw_blocks=raw_blocks
+                )
+            else:
+                start_byte, partition_size = download_ranges[i]
+                job = functools.partial(
+                    self.start_download,
+                    partition_id=i,
+                    path=abs_path,
+                    start_byte=start_byte,
+                    partition_size=partition_size,
+                    block_size=self.server.compressor.block_size,
+                    codec=codec,
+                    level=level,
+                    adaptive=adaptive,
+                    checksum=checksum,
+                    raw_blocks=raw_blocks
+                )
+            if codec is not None:
+                job = functools.partial(self.run_compressing, job=job)
+            jobs.append(job)
+        session = self.server.sessions.open(jobs)
 
+        server_response = plan.response(session.token, checksum)
         logging.debug(
-            'Tamanho dos blocos: %s',
-            [bytes2human(size) for size in blocksizes]
+            'Avisando ao cliente sobre as %d streams da sessão.',
+            streams
         )
+        try:
+            send_message(
+                connection=self.request,
+                message_type=MessageType.DOWNLOAD_RESPONSE,
+                message=server_response
+            )
+            abandoned_streams = session.wait()
+        finally:
+            self.server.sessions.close(session)
+        if abandoned_streams:
+            print(f'{abandoned_streams} stream(s) não se conectaram a tempo.')
 
-        # total_blocks_read = math.ceil(
-        #     sum(ps / bs for ps, bs in zip(partition_sizes, blocksizes))
-        # )
-        # print(f'Total blocks read: {total_blocks_read}')
+        if scheduler is not None:
+            finish_times = scheduler.finish_times().values()
+            if finish_times:
+                print(
+                    f'Streams terminaram entre {min(finish_times):.3f} s e '
+                    f'{max(finish_times):.3f} s '
+                    f'(diferença: {max(finish_times) - min(finish_times):.3f} s).')
 
-        process_memory = free_ram // streams
-        logging.debug('Memória por conexão: %s', bytes2human(process_memory))
+        if checksum is not None or file_hash is not None:
+            send_message(
+                connection=self.request,
+                message_type=MessageType.DOWNLOAD_RESULT,
+                message={
+                    'sha256': file_hash.result() if file_hash else None
+                }
+            )
 
-        threads = []
-        start_byte = 0
-        for i in range(streams):
-            block_size = blocksizes[i]
-            partition_size = partition_sizes[i]
-            download_socket = download_sockets[i]
-            thread = threading.Thread(
-                target=self.start_download,
-                args=(
-                    i,
-                    download_socket,
-                    abs_path,
-                    start_byte,
-                    partition_size,
-                    block_size,
-                    compressed
+        print('Fim da conexão com cliente.')
+
+    def send_tree_batches(
+            self,
+            connection,
+            root,
+            entries,
+            batches,
+            codec,
+            level
+    ):
+        """
+        Envia os lotes de arquivos que a fila entregar a esta stream, até
+        ela acabar. Lotes de um segmento só (pedaços de arquivos grandes)
+        saem por sendfile quando não há compressão; os outros são lidos
+        (e comprimidos) inteiros, num envio só para vários arquivos.
+        """
+        download_port = connection.getpeername()[1]
+        total_bytes_sent = 0
+        try:
+            while True:
+                batch = batches.next_batch()
+                if batch is None:
+                    break
+                if codec is None and len(batch) == 1:
+                    # Pedaço de um arquivo grande: sai direto do arquivo.
+                    (segment,) = batch
+                    connection.sendall(pack_batch_header(batch, segment.size))
+                    with open(entry_path(root, entries[segment.index].path), 'rb') as file:
+                        total_bytes_sent += self.send_file_bytes(
+                            connection, file, segment.offset, segment.size, segment.size)
+                else:
+                    payload = compress_batch(root, entries, batch, codec, level)
+                    send_buffers(connection, pack_batch_header(batch, len(payload)), payload)
+                    total_bytes_sent += len(payload)
+            connection.sendall(BATCH_HEADER.pack(0, 0))
+            print(f'{download_port}: Enviei {bytes2human(total_bytes_sent)} em lotes.')
+        except Exception as exc:
+            print(exc)
+        finally:
+            connection.close()
+
+    def directory_interaction(
+            self,
+            path: str,
+            streams: int,
+            codec: Optional[str],
+            level: Optional[int] = None
+    ):
+        """
+        Envia o diretório <path> inteiro: a listagem vai pela conexão de
+        controle e o conteúdo dos arquivos, em lotes (ver packing), pelas
+        streams da sessão.
+        :param path: Caminho do diretório pedido
+        :param streams: Quantidade de conexões
+        :param codec: Codec negociado, ou None
+        :param level: Nível de compressão
+        """
+        abs_path = get_abspath(path)
+        if not os.path.isdir(abs_path):
+            logging.debug('Diretório %s não existe!', abs_path)
+            send_message(
+                self.request, MessageType.DIRECTORY_RESPONSE, MISSING_DIRECTORY_RESPONSE)
+            return None
+
+        with self.server.resources.admitted(streams) as granted_streams:
+            if not granted_streams:
+                print(f'Servidor cheio: {path} fica para depois.')
+                send_message(self.request, MessageType.DIRECTORY_RESPONSE, {
+                    **MISSING_DIRECTORY_RESPONSE,
+                    'retry_after': RETRY_AFTER
+                })
+                return None
+
+            start = time.perf_counter()
+            skipped = []
+            entries = scan_tree(abs_path, skipped=skipped)
+            batches = pack_entries(entries, self.server.compressor.block_size)
+            files, size = tree_size(entries)
+            streams = min(granted_streams, len(batches))
+            listing = split_listing(entries)
+            print(
+                f'{abs_path}: {files} arquivo(s), {bytes2human(size)} em '
+                f'{len(batches)} lote(s) (varredura: {time.perf_counter() - start:.3f} s).')
+
+            batch_queue = BatchQueue(batches)
+            jobs = []
+            for _ in range(streams):
+                job = functools.partial(
+                    self.send_tree_batches,
+                    root=abs_path,
+                    entries=entries,
+                    batches=batch_queue,
+                    codec=get_codec(codec) if codec is not None else None,
+                    level=level
                 )
-            )
-            threads.append(thread)
-            start_byte += partition_size
+                if codec is not None:
+                    job = functools.partial(self.run_compressing, job=job)
+                jobs.append(job)
+            session = self.server.sessions.open(jobs)
+            try:
+                send_message(self.request, MessageType.DIRECTORY_RESPONSE, {
+                    'token': session.token,
+                    'streams': streams,
+                    'codec': codec,
+                    'files': files,
+                    'size': size,
+                    'batches': len(batches),
+                    'listing_messages': len(listing),
+                    'skipped': len(skipped),
+                    'retry_after': None
+                })
+                for items in listing:
+                    send_message(self.request, MessageType.DIRECTORY_RESPONSE, {
+                        'entries': items
+                    })
+                abandoned_streams = session.wait()
+            finally:
+                self.server.sessions.close(session)
+        if abandoned_streams:
+            print(f'{abandoned_streams} stream(s) não se conectaram a tempo.')
+        print(f'Fim do envio de {abs_path} ({time.perf_counter() - start:.3f} s).')
 
-        for thread in threads:
-            thread.start()
+    def tree_interaction(self, path: str, block_size: int):
+        """
+        Responde à comparação remota: manda o formato da árvore de Merkle
+        de <path> e depois os hashes dos nós que o cliente pedir, até ele
+        mandar uma lista vazia.
+        :param path: Caminho do arquivo pedido
+        :param block_size: Tamanho dos blocos das folhas
+        """
+        abs_path = get_abspath(path)
+        if not os.path.isfile(abs_path):
+            logging.debug('Arquivo %s não existe!', abs_path)
+            send_message(self.request, MessageType.TREE_RESPONSE, MISSING_TREE_RESPONSE)
+            return None
 
-        # Para garantir que não exista timeout por parte do cliente,
-        # eu só aviso sobre as portas após criar as threads de download.
-        server_response = {
-            'size': file_size,
-            'ports': [sock.getsockname()[1] for sock in download_sockets]
-        }
-        logging.debug(
-            'Avisando ao cliente sobre as %d conexões criadas.',
-            streams
-        )
-        send_message(
-            connection=self.request,
-            message=server_response
+        # A árvore lê o arquivo inteiro: conta como uma stream.
+        with self.server.resources.admitted(1) as granted_streams:
+            if not granted_streams:
+                print(f'Servidor cheio: comparação de {path} fica para depois.')
+                send_message(self.request, MessageType.TREE_RESPONSE, {
+                    **MISSING_TREE_RESPONSE,
+                    'retry_after': RETRY_AFTER
+                })
+                return None
+
+            block_size = min(max(block_size, MIN_MERKLE_BLOCK_SIZE), MAX_MERKLE_BLOCK_SIZE)
+            tree = self.server.tree_cache.get(abs_path, block_size)
+            send_message(self.request, MessageType.TREE_RESPONSE, {
+                'size': tree.size,
+                'block_size': tree.block_size,
+                'depth': tree.depth,
+                'leaves': len(tree.levels[0])
+            })
+
+            while True:
+                _, request_message = recv_message(
+                    self.request,
+                    expected_type=MessageType.TREE_REQUEST
+                )
+                nodes = request_message['nodes']
+                if not nodes:
+                    break
+                hashes = answer_nodes(tree, nodes)
+                send_message(self.request, MessageType.TREE_RESPONSE, {'hashes': hashes})
+                if hashes is None:
+                    logging.debug('Pedido de nós inválido para %s.', abs_path)
+                    return None
+        logging.debug('Fim da comparação de %s.', abs_path)
+
+    def chunks_interaction(self, path: str):
+        """
+        Manda a lista de pedaços definidos pelo conteúdo de <path> (tamanho
+        e hash de cada um), para o cliente baixar só os que não tem.
+        :param path: Caminho do arquivo pedido
+        """
+        abs_path = get_abspath(path)
+        index = None
+        if os.path.isfile(abs_path):
+            # Montar a lista lê o arquivo inteiro: conta como uma stream.
+            with self.server.resources.admitted(1) as granted_streams:
+                if not granted_streams:
+                    print(f'Servidor cheio: lista de pedaços de {path} fica para depois.')
+                    send_message(self.request, MessageType.CHUNKS_RESPONSE, {
+                        **MISSING_CHUNKS_RESPONSE,
+                        'retry_after': RETRY_AFTER
+                    })
+                    return None
+                file_identity = get_file_identity(abs_path)
+                index = self.server.chunk_indexes.get(abs_path)
+        if index is None or len(index) > MAX_INDEX_CHUNKS:
+            logging.debug('Sem lista de pedaços para %s.', abs_path)
+            send_message(self.request, MessageType.CHUNKS_RESPONSE, MISSING_CHUNKS_RESPONSE)
+            return None
+
+        send_message(self.request, MessageType.CHUNKS_RESPONSE, {
+            'identity': file_identity,
+            **index.to_message()
+        })
+        print(f'Lista de {len(index)} pedaço(s) de {abs_path} enviada.')
+
+    def delta_interaction(
+            self,
+            path: str,
+            block_size: int,
+            weak: bytes,
+            strong: bytes
+    ):
+        """
+        Envia <path> como delta sobre a cópia antiga do cliente: blocos que
+        batem com as assinaturas viram instruções de cópia, o resto vai
+        literal. No fim, manda o SHA-256 do arquivo (DOWNLOAD_RESULT).
+        :param path: Caminho do arquivo pedido
+        :param block_size: Tamanho dos blocos das assinaturas
+        :param weak: Checksums fracos dos blocos do cliente
+        :param strong: Hashes fortes dos blocos do cliente
+        """
+        abs_path = get_abspath(path)
+        if not os.path.isfile(abs_path) or not 0 < block_size <= DELTA_MAX_BLOCK_SIZE:
+            logging.debug('Pedido de delta inválido para %s.', abs_path)
+            send_message(self.request, MessageType.DELTA_RESPONSE, MISSING_DELTA_RESPONSE)
+            return None
+
+        # A busca dos blocos e o hash leem o arquivo inteiro: conta como
+        # uma stream.
+        with self.server.resources.admitted(1) as granted_streams:
+            if not granted_streams:
+                print(f'Servidor cheio: delta de {path} fica para depois.')
+                send_message(self.request, MessageType.DELTA_RESPONSE, {
+                    **MISSING_DELTA_RESPONSE,
+                    'retry_after': RETRY_AFTER
+                })
+                return None
+            self.send_file_delta(abs_path, block_size, weak, strong)
+
+    def send_file_delta(
+            self,
+            abs_path: str,
+            block_size: int,
+            weak: bytes,
+            strong: bytes
+    ):
+        """
+        Manda o delta de <abs_path>, já admitido, e no fim o SHA-256 do
+        arquivo.
+        """
+        file_hash = BackgroundFileHash(abs_path)
+        file_identity = get_file_identity(abs_path)
+        send_message(self.request, MessageType.DELTA_RESPONSE, {
+            'size': file_identity['size'],
+            'identity': file_identity
+        })
+
+        generator = DeltaGenerator(block_size, weak, strong)
+        copied_bytes, literal_bytes = send_delta(
+            self.request,
+            generator.generate(abs_path)
         )
+        send_message(self.request, MessageType.DOWNLOAD_RESULT, {
+            'sha256': file_hash.result()
+        })
+        print(
+            f'Delta de {abs_path}: {bytes2human(literal_bytes)} enviados, '
+            f'{bytes2human(copied_bytes)} reaproveitados pelo cliente.')
 
-        for thread in threads:
-            thread.join()
+    def send_session_chunks(self, connection, pipeline: SessionPipeline, codec, level):
+        """
+        Stream de uma sessão: envia pedaços de qualquer download da sessão,
+        conforme a fila os entregar, até a sessão fechar. Arquivos que não
+        podem ser lidos falham só o seu pedido.
+        """
+        total_bytes_sent = 0
+        try:
+            while True:
+                chunk = pipeline.next_chunk()
+                if chunk is None:
+                    break
+                if codec is None:
+                    try:
+                        file = open(chunk.path, mode='rb')
+                    except OSError as exc:
+                        pipeline.fail(chunk.request, str(exc))
+                        continue
+                    with file:
+                        connection.sendall(REQUEST_CHUNK.pack(
+                            chunk.request, chunk.offset, chunk.size, chunk.size, False))
+                        total_bytes_sent += self.send_file_bytes(
+                            connection, file, chunk.offset, chunk.size, chunk.size)
+                    continue
+                try:
+                    with self.server.resources.compression_slot():
+                        payload, compressed = read_chunk(
+                            chunk.path, chunk.offset, chunk.size, codec, level)
+                except OSError as exc:
+                    pipeline.fail(chunk.request, str(exc))
+                    continue
+                send_buffers(connection, REQUEST_CHUNK.pack(
+                    chunk.request, chunk.offset, chunk.size, len(payload), compressed), payload)
+                total_bytes_sent += len(payload)
+            connection.sendall(REQUEST_CHUNK.pack(0, 0, 0, 0, False))
+            logging.debug('Stream da sessão enviou %s.', bytes2human(total_bytes_sent))
+        except Exception as exc:
+            print(exc)
+        finally:
+            connection.close()
 
-        print('Fim da conexão com cliente.')
+    def serve_session_request(
+            self,
+            pipeline: SessionPipeline,
+            request_message: Dict,
+            codec: Optional[str],
+            level: Optional[int]
+    ):
+        """
+        Responde um pedido da sessão e põe os pedaços do download (se
+        houver) na fila das streams. Roda nas threads da sessão.
+
+        Com sha256, o hash do arquivo é calculado enquanto as streams
+        enviam os pedaços e vai numa segunda resposta ao mesmo pedido.
+        """
+        request_id = request_message['id']
+        try:
+            response, abs_path, ranges = answer_session_request(
+                request_message,
+                self.server.inline_threshold,
+                codec,
+                level,
+                self.server.compressor.block_size
+            )
+        except (OSError, ValueError, KeyError) as exc:
+            response, abs_path, ranges = {'error': str(exc)}, None, []
+        pipeline.reply(request_id, response)
+        if not ranges:
+            return None
+        pipeline.add_download(request_id, abs_path, ranges)
+        if request_message.get('sha256', False):
+            try:
+                file_sha256 = sha256_file(abs_path)
+            except OSError as exc:
+                pipeline.fail(request_id, str(exc))
+                return None
+            if not pipeline.failed(request_id):
+                pipeline.reply(request_id, {'sha256': file_sha256})
+
+    def session_interaction(
+            self,
+            streams: int,
+            codec: Optional[str],
+            level: Optional[int] = None
+    ):
+        """
+        Sessão persistente (ver pipeline.PipelinedClient): a conexão de
+        controle recebe pedidos até o cliente fechá-la, atendidos ao mesmo
+        tempo por SESSION_WORKERS threads, e as <streams> streams de dados
+        ficam abertas levando os pedaços de todos os downloads.
+        :param streams: Quantidade de conexões de dados
+        :param codec: Codec negociado para a sessão, ou None
+        :param level: Nível de compressão
+        """
+        with self.server.resources.admitted(streams) as granted_streams:
+            if not granted_streams:
+                print('Servidor cheio: sessão fica para depois.')
+                send_message(self.request, MessageType.SESSION_READY, {
+                    **MISSING_SESSION_RESPONSE,
+                    'retry_after': RETRY_AFTER
+                })
+                return None
+
+            pipeline = SessionPipeline(self.request)
+            jobs = [
+                functools.partial(
+                    self.send_session_chunks,
+                    pipeline=pipeline,
+                    codec=get_codec(codec) if codec is not None else None,
+                    level=level
+                )
+                for _ in range(granted_streams)
+            ]
+            session = self.server.sessions.open(jobs)
+            requests = 0
+            start = time.perf_counter()
+            try:
+                send_message(self.request, MessageType.SESSION_READY, {
+                    'token': session.token,
+                    'streams': granted_streams,
+                    'codec': codec,
+                    'retry_after': None
+                })
+                with ThreadPoolExecutor(
+                        max_workers=SESSION_WORKERS,
+                        thread_name_prefix='ccp-session'
+                ) as executor:
+                    while True:
+                        try:
+                            _, request_message = recv_message(
+                                self.request,
+                                expected_type=MessageType.SESSION_REQUEST
+                            )
+                        except (OSError, RuntimeError) as exc:
+                            # Inclui o fim normal: o cliente fecha a conexão.
+                            logging.debug('Fim dos pedidos da sessão: %s', exc)
+                            break
+                        executor.submit(
+                            self.serve_session_request,
+                            pipeline,
+                            request_message,
+                            codec,
+                            level
+                        )
+                        requests += 1
+            finally:
+                pipeline.close()
+                abandoned_streams = session.wait()
+                self.server.sessions.close(session)
+        if abandoned_streams:
+            print(f'{abandoned_streams} stream(s) não se conectaram a tempo.')
+        print(f'Sessão com {requests} pedido(s) em {time.perf_counter() - start:.3f} s.')
+
+    def recv_upload_stream(self, connection, target: UploadTarget, codec):
+        """
+        Stream de um upload: escreve no destino os pedaços que chegarem,
+        até o fim da stream. Um erro marca o upload inteiro como falho.
+        """
+        upload_port = connection.getpeername()[1]
+        try:
+            bytes_written = recv_upload_chunks(connection, target, codec)
+            logging.debug('%s: Recebi %s.', upload_port, bytes2human(bytes_written))
+        except Exception as exc:
+            target.fail(str(exc))
+            print(exc)
+        finally:
+            connection.close()
+
+    def upload_interaction(
+            self,
+            path: str,
+            size: Optional[int],
+            streams: int,
+            codec: Optional[str]
+    ):
+        """
+        Recebe o arquivo <path> do cliente: as streams escrevem as faixas
+        em paralelo num arquivo temporário pré-alocado ao lado do destino,
+        e depois do UPLOAD_COMMIT (tamanho final e, opcionalmente,
+        SHA-256) ele é conferido e renomeado para o lugar do destino.
+        Só aceito com --upload-root, e só dentro desse diretório.
+        :param path: Caminho do arquivo no servidor, relativo ao diretório
+            de uploads
+        :param size: Tamanho do arquivo, ou None se o cliente não sabe
+            (entrada padrão)
+        :param streams: Quantidade de conexões
+        :param codec: Codec negociado, ou None
+        """
+        try:
+            abs_path = resolve_upload_path(self.server.upload_root, path)
+        except (OSError, ValueError) as exc:
+            logging.debug('Upload para %s recusado: %s', path, exc)
+            send_message(self.request, MessageType.UPLOAD_RESPONSE, {
+                **MISSING_UPLOAD_RESPONSE,
+                'error': str(exc)
+            })
+            return None
+
+        with self.server.resources.admitted(streams) as granted_streams:
+            if not granted_streams:
+                print(f'Servidor cheio: upload de {path} fica para depois.')
+                send_message(self.request, MessageType.UPLOAD_RESPONSE, {
+                    **MISSING_UPLOAD_RESPONSE,
+                    'retry_after': RETRY_AFTER
+                })
+                return None
+            try:
+                target = UploadTarget(abs_path, size, self.server.max_upload_size)
+            except (OSError, ValueError) as exc:
+                send_message(self.request, MessageType.UPLOAD_RESPONSE, {
+                    **MISSING_UPLOAD_RESPONSE,
+                    'error': str(exc)
+                })
+                return None
+
+            jobs = []
+            for _ in range(granted_streams):
+                job = functools.partial(
+                    self.recv_upload_stream,
+                    target=target,
+                    codec=get_codec(codec) if codec is not None else None
+                )
+                if codec is not None:
+                    job = functools.partial(self.run_compressing, job=job)
+                jobs.append(job)
+            session = self.server.sessions.open(jobs)
+            start = time.perf_counter()
+            try:
+                send_message(self.request, MessageType.UPLOAD_RESPONSE, {
+                    'token': session.token,
+                    'streams': granted_streams,
+                    'codec': codec,
+                    'retry_after': None,
+                    'error': None
+                })
+                abandoned_streams = session.wait()
+                if abandoned_streams:
+                    target.fail(f'{abandoned_streams} stream(s) não se conectaram a tempo.')
+                _, commit_message = recv_message(
+                    self.request,
+                    expected_type=MessageType.UPLOAD_COMMIT
+                )
+                try:
+                    target.commit(
+                        commit_message['size'],
+                        commit_message.get('sha256'),
+                        commit_message.get('mode')
+                    )
+                    result = {'size': commit_message['size'], 'error': None}
+                except (OSError, RuntimeError) as exc:
+                    result = {'size': None, 'error': str(exc)}
+                send_message(self.request, MessageType.UPLOAD_RESULT, result)
+            finally:
+                self.server.sessions.close(session)
+                # Sem commit (erro ou cliente sumiu), o temporário some.
+                target.abort()
+        if result['error'] is not None:
+            print(f'Upload de {abs_path} falhou: {result["error"]}')
+            return None
+        print(
+            f'{abs_path}: {bytes2human(result["size"])} recebidos em '
+            f'{granted_streams} stream(s), {time.perf_counter() - start:.3f} s.')
+
+    def stream_interaction(self, token: str, stream_id: int):
+        """
+        Conexão de dados: roda a stream <stream_id> da sessão <token>.
+        Token ou stream desconhecidos fecham a conexão.
+        """
+        session = self.server.sessions.get(token)
+        job = session.claim(stream_id) if session is not None else None
+        if job is None:
+            logging.debug('Stream %s da sessão %s desconhecida.', stream_id, token)
+            return None
+        try:
+            job(self.request)
+        finally:
+            session.finish(stream_id)
 
     def handle(self):
         logging.debug('Opa!')
-        request_message = recv_message(connection=self.request)
+        try:
+            message_type, request_message = recv_message(connection=self.request)
+        except socket.timeout:
+            logging.debug('%s não mandou nenhum pedido.', self.client_address)
+            return None
         logging.debug('Mensagem recebida do cliente: %s', request_message)
-        path = request_message['path']
-        compressed = request_message['compressed']
-        streams = request_message['streams']
 
-        self.download_interaction(path, streams, compressed)
+        if message_type == MessageType.STREAM_ATTACH:
+            self.stream_interaction(
+                request_message['token'],
+                request_message['stream']
+            )
+            return None
 
+        if message_type == MessageType.TREE_REQUEST:
+            self.tree_interaction(
+                request_message['path'],
+                request_message['block_size']
+            )
+            return None
+        if message_type == MessageType.CHUNKS_REQUEST:
+            self.chunks_interaction(request_message['path'])
+            return None
+        if message_type == MessageType.DELTA_REQUEST:
+            self.delta_interaction(
+                request_message['path'],
+                request_message['block_size'],
+                request_message['weak'],
+                request_message['strong']
+            )
+            return None
+        if message_type == MessageType.DIRECTORY_REQUEST:
+            self.directory_interaction(**directory_options(request_message))
+            return None
+        if message_type == MessageType.SESSION_OPEN:
+            self.session_interaction(**session_options(request_message))
+            return None
+        if message_type == MessageType.UPLOAD_REQUEST:
+            self.upload_interaction(**upload_options(request_message))
+            return None
+        if message_type != MessageType.DOWNLOAD_REQUEST:
+            raise ProtocolError(f'Pedido inesperado: {message_type.name}.')
+
+        self.download_interaction(**download_options(request_message))
 
 def run():
     parser = get_server_parser()
     parsed_args = parser.parse_args(sys.argv[1:])
 
     port = parsed_args.port
+    resources = ResourceManager(
+        max_streams=parsed_args.max_streams,
+        max_memory=(
+            human2bytes(parsed_args.max_memory)
+            if parsed_args.max_memory is not None else None
+        ),
+        max_compressions=parsed_args.max_compressions,
+        max_client_connections=parsed_args.max_client_connections,
+        idle_timeout=parsed_args.idle_timeout or None
+    )
+    cache = None
+    cache_size = human2bytes(parsed_args.cache_size)
+    if cache_size or parsed_args.cache_dir is not None:
+        cache = ChunkCache(
+            max_memory=cache_size,
+            directory=parsed_args.cache_dir,
+            max_disk=human2bytes(parsed_args.cache_disk_size)
+        )
+    compressor = ParallelCompressor(
+        workers=parsed_args.compression_workers,
+        block_size=human2bytes(parsed_args.compression_block_size),
+        memory_budget=resources,
+        cache=cache,
+        flights=FlightGroup(human2bytes(parsed_args.replay_size))
+    )
+    inline_threshold = human2bytes(parsed_args.inline_threshold)
+    upload_root = parsed_args.upload_root
+    if upload_root is not None and not os.path.isdir(upload_root):
+        print(f'Diretório de uploads {upload_root} não existe.')
+        sys.exit(1)
+    max_upload_size = (
+        human2bytes(parsed_args.max_upload_size)
+        if parsed_args.max_upload_size is not None else None
+    )
 
     debug_mode = parsed_args.debug_mode
     if debug_mode:
@@ -347,10 +1720,28 @@ def run():
         )
         logging.debug('Modo de depuração está ativado.')
 
+    if parsed_args.engine == ASYNCIO_ENGINE:
+        from ccp.async_server import run_async_server
+        run_async_server(
+            ('localhost', port),
+            compressor,
+            io_workers=parsed_args.io_workers,
+            resources=resources,
+            inline_threshold=inline_threshold,
+            upload_root=upload_root,
+            max_upload_size=max_upload_size
+        )
+        return None
+
     try:
         file_server = ThreadedFileServer(
             ('localhost', port),
-            ThreadedFileServerRequestHandler
+            ThreadedFileServerRequestHandler,
+            compressor=compressor,
+            resources=resources,
+            inline_threshold=inline_threshold,
+            upload_root=upload_root,
+            max_upload_size=max_upload_size
         )
     except OverflowError:
         print(f'Porta {port} inválida. Ela deve pertencer a [0, 65535].')
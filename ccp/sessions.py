@@ -0,0 +1,96 @@
+import secrets
+import threading
+from typing import Callable, Dict, List, Optional
+
+
+# Tempo máximo (s) para o cliente conectar todas as streams de um pedido.
+STREAM_ATTACH_TIMEOUT = 60.0
+
+
+class TransferSession:
+    """
+    Streams de dados de um pedido, esperando as conexões do cliente.
+    Cada stream é uma função que recebe a conexão e envia a sua parte;
+    ela roda na thread da conexão de dados que se apresentou com o token
+    da sessão e o id da stream.
+    """
+
+    def __init__(self, token: str, jobs: List[Callable[[object], None]]):
+        self.token = token
+        self.__jobs: Dict[int, Callable[[object], None]] = dict(enumerate(jobs))
+        self.__running = set()
+        self.__all_claimed = threading.Event()
+        self.__all_finished = threading.Event()
+        self.__lock = threading.Lock()
+        if not jobs:
+            self.__all_claimed.set()
+            self.__all_finished.set()
+
+    def claim(self, stream_id: int) -> Optional[Callable[[object], None]]:
+        """
+        :return: Função da stream, ou None se o id não existe ou já foi usado
+        """
+        with self.__lock:
+            job = self.__jobs.pop(stream_id, None)
+            if job is not None:
+                self.__running.add(stream_id)
+            if not self.__jobs:
+                self.__all_claimed.set()
+            return job
+
+    def finish(self, stream_id: int):
+        with self.__lock:
+            self.__running.discard(stream_id)
+            if not self.__jobs and not self.__running:
+                self.__all_finished.set()
+
+    def wait(self, attach_timeout: float = STREAM_ATTACH_TIMEOUT) -> int:
+        """
+        Espera todas as streams terminarem. Streams que não se conectarem
+        em <attach_timeout> segundos são descartadas.
+        :return: Quantidade de streams descartadas
+        """
+        abandoned = 0
+        if not self.__all_claimed.wait(attach_timeout):
+            with self.__lock:
+                abandoned = len(self.__jobs)
+                self.__jobs.clear()
+                self.__all_claimed.set()
+                if not self.__running:
+                    self.__all_finished.set()
+        self.__all_finished.wait()
+        return abandoned
+
+
+class SessionRegistry:
+    """
+    Sessões abertas do servidor, por token. Permite que todas as streams
+    de dados cheguem pela porta principal: o token escolhe o pedido.
+    """
+
+    def __init__(self, session_class=TransferSession):
+        """
+        :param session_class: Classe das sessões (token, jobs); o servidor
+            asyncio usa uma que espera as streams sem bloquear o laço
+        """
+        self.__session_class = session_class
+        self.__sessions: Dict[str, TransferSession] = {}
+        self.__lock = threading.Lock()
+
+    def open(self, jobs: List[Callable[[object], None]]) -> TransferSession:
+        session = self.__session_class(secrets.token_hex(16), jobs)
+        with self.__lock:
+            self.__sessions[session.token] = session
+        return session
+
+    def get(self, token: str) -> Optional[TransferSession]:
+        with self.__lock:
+            return self.__sessions.get(token)
+
+    def close(self, session: TransferSession):
+        with self.__lock:
+            self.__sessions.pop(session.token, None)
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__sessions)
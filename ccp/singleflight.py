@@ -0,0 +1,92 @@
+import collections
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable
+
+
+# Bytes de resultados recentes guardados para quem chega logo depois.
+DEFAULT_REPLAY_SIZE = 32 * 2 ** 20
+
+
+class FlightGroup:
+    """
+    Junta trabalhos simultâneos com a mesma chave: o primeiro a pedir uma
+    chave executa o trabalho, e quem pedir a mesma chave enquanto ele está
+    em andamento espera e recebe o mesmo resultado (ou a mesma exceção).
+
+    Os resultados que acabaram de ficar prontos vão para um buffer de
+    replay limitado em bytes (descarta o mais antigo), para que pedidos
+    que chegam logo depois do primeiro, atrás dele no mesmo arquivo,
+    também não repitam o trabalho.
+    """
+
+    def __init__(self, replay_size: int = DEFAULT_REPLAY_SIZE):
+        """
+        :param replay_size: Bytes do buffer de replay (0 desliga o buffer,
+            mas mantém a junção dos trabalhos em andamento)
+        """
+        if replay_size < 0:
+            raise ValueError('Tamanho do buffer de replay não pode ser negativo.')
+        self.replay_size = replay_size
+        self.__flights: Dict[Hashable, Future] = {}
+        self.__replay: Dict[Hashable, bytes] = collections.OrderedDict()
+        self.__replay_bytes = 0
+        self.leaders = 0
+        self.followers = 0
+        self.__lock = threading.Lock()
+
+    def run(self, key: Hashable, function: Callable[..., bytes], *args) -> bytes:
+        """
+        :param key: Chave do trabalho (deve identificar o resultado)
+        :param function: Trabalho, executado só se ninguém estiver com a
+            mesma chave em andamento nem ela estiver no buffer de replay
+        :param args: Argumentos de <function>
+        :return: Resultado de <function>, de quem o executou
+        """
+        with self.__lock:
+            result = self.__replay.get(key)
+            if result is not None:
+                self.__replay.move_to_end(key)
+                self.followers += 1
+                return result
+            future = self.__flights.get(key)
+            leader = future is None
+            if leader:
+                future = self.__flights[key] = Future()
+                self.leaders += 1
+            else:
+                self.followers += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = function(*args)
+        except BaseException as exc:
+            with self.__lock:
+                del self.__flights[key]
+            future.set_exception(exc)
+            raise
+        with self.__lock:
+            del self.__flights[key]
+            self.__remember(key, result)
+        future.set_result(result)
+        return result
+
+    def __remember(self, key: Hashable, result: bytes):
+        size = len(result)
+        if not size or size > self.replay_size or key in self.__replay:
+            return None
+        self.__replay[key] = result
+        self.__replay_bytes += size
+        while self.__replay_bytes > self.replay_size:
+            _, old_result = self.__replay.popitem(last=False)
+            self.__replay_bytes -= len(old_result)
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            return {
+                'leaders': self.leaders,
+                'followers': self.followers,
+                'in_flight': len(self.__flights),
+                'replay': self.__replay_bytes
+            }
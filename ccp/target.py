@@ -0,0 +1,228 @@
+import hashlib
+import os
+import threading
+from typing import Dict
+
+from ccp.compression import Codec, get_codec
+from ccp.messaging import ProtocolError
+
+
+def preallocate(path: str, size: int) -> int:
+    """
+    Cria (ou reaproveita) o arquivo-destino e reserva <size> bytes em
+    disco, para que cada stream escreva direto na sua posição.
+    :param path: Caminho do arquivo-destino
+    :param size: Tamanho final do arquivo
+    :return: Descritor do arquivo aberto para escrita
+    """
+    flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    fd = os.open(path, flags, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        if size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                # Sistemas de arquivos sem fallocate (ex.: alguns NFS):
+                # o ftruncate já deixou o arquivo do tamanho certo.
+                pass
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+class TargetFile:
+    """
+    Arquivo-destino pré-alocado, escrito em paralelo por várias streams,
+    cada uma na sua faixa de bytes (os.pwrite).
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self.__fd = preallocate(path, size)
+        self.__lock = threading.Lock()
+
+    def pwrite(self, data, offset: int) -> int:
+        view = memoryview(data)
+        total_bytes_written = 0
+        while total_bytes_written < len(view):
+            position = offset + total_bytes_written
+            if hasattr(os, 'pwrite'):
+                bytes_written = os.pwrite(self.__fd, view[total_bytes_written:], position)
+            else:
+                with self.__lock:
+                    os.lseek(self.__fd, position, os.SEEK_SET)
+                    bytes_written = os.write(self.__fd, view[total_bytes_written:])
+            total_bytes_written += bytes_written
+        return total_bytes_written
+
+    def writer(self, offset: int, size: int, on_write=None) -> 'RangeWriter':
+        return RangeWriter(self, offset, size, on_write)
+
+    def chunk_writer(self, codec: Codec = None, on_write=None) -> 'ChunkWriter':
+        return ChunkWriter(self, codec, on_write)
+
+    def close(self):
+        os.close(self.__fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RangeWriter:
+    """
+    Objeto com write() que escreve sequencialmente numa faixa do
+    arquivo-destino, usado no lugar do arquivo .partN.
+    """
+
+    def __init__(self, target: TargetFile, offset: int, size: int, on_write=None):
+        self.target = target
+        self.start_byte = offset
+        self.size = size
+        self.position = offset
+        # Chamada com (byte inicial, tamanho) de cada escrita.
+        self.on_write = on_write
+
+    def write(self, data) -> int:
+        if self.position + len(data) > self.start_byte + self.size:
+            raise RuntimeError(
+                f'Faixa [{self.start_byte}, {self.start_byte + self.size}) '
+                f'recebeu bytes demais.')
+        bytes_written = self.target.pwrite(data, self.position)
+        if self.on_write is not None:
+            self.on_write(self.position, bytes_written)
+        self.position += bytes_written
+        return bytes_written
+
+    def skip(self, n_bytes: int):
+        """
+        Pula <n_bytes> sem escrevê-los (ex.: pedaço corrompido). A faixa
+        pulada não é registrada em on_write, então continua faltando.
+        """
+        if self.position + n_bytes > self.start_byte + self.size:
+            raise RuntimeError(
+                f'Faixa [{self.start_byte}, {self.start_byte + self.size}) '
+                f'recebeu bytes demais.')
+        self.position += n_bytes
+
+    def raw_writer(self) -> 'RangeWriter':
+        return self
+
+    @property
+    def bytes_written(self) -> int:
+        return self.position - self.start_byte
+
+    def close(self):
+        if self.bytes_written != self.size:
+            raise RuntimeError(
+                f'Faixa [{self.start_byte}, {self.start_byte + self.size}) '
+                f'ficou incompleta: {self.bytes_written} de {self.size} bytes.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+
+
+class DecodingWriter:
+    """
+    Descomprime o que recebe em write() e repassa ao escritor interno,
+    para gravar partições comprimidas já descomprimidas no destino.
+    """
+
+    def __init__(self, codec: Codec, writer):
+        self.__decoder = codec.stream_decoder()
+        self.__writer = writer
+
+    def write(self, data) -> int:
+        for decompressed_bytes in self.__decoder.feed(data):
+            self.__writer.write(decompressed_bytes)
+        return len(data)
+
+    def skip(self, n_bytes: int):
+        """
+        Pula <n_bytes> descomprimidos. Só é válido entre membros do codec,
+        que é como os pedaços verificados chegam.
+        """
+        self.__writer.skip(n_bytes)
+
+    def raw_writer(self):
+        """
+        Escritor interno, para um bloco que veio sem compressão. Só é
+        válido entre membros do codec.
+        """
+        self.__decoder.finish()
+        return self.__writer
+
+    def close(self):
+        self.__decoder.finish()
+        self.__writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+
+
+class ChunkWriter:
+    """
+    Escreve pedaços que chegam fora de ordem, cada um com o seu byte
+    inicial (streams com agendamento dinâmico). Pedaços comprimidos são
+    membros completos do codec e são descomprimidos sozinhos; pedaços
+    incompressíveis vêm sem compressão (raw).
+    """
+
+    def __init__(self, target: TargetFile, codec: Codec = None, on_write=None):
+        self.target = target
+        self.codec = codec
+        # Chamada com (byte inicial, tamanho) de cada pedaço escrito.
+        self.on_write = on_write
+
+    def write_chunk(self, offset: int, size: int, payload, raw: bool = False):
+        data = self.codec.decompress(payload) if self.codec is not None and not raw else payload
+        if len(data) != size:
+            raise RuntimeError(
+                f'Pedaço no byte {offset} tem {len(data)} bytes em vez de {size}.')
+        if offset + size > self.target.size:
+            raise RuntimeError(f'Pedaço no byte {offset} passa do fim do arquivo.')
+        self.target.pwrite(data, offset)
+        if self.on_write is not None:
+            self.on_write(offset, size)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def save_inline(local_path: str, download_response: Dict) -> str:
+    """
+    Escreve o arquivo pequeno que veio inteiro no DOWNLOAD_RESPONSE, sem
+    streams de dados nem arquivos temporários.
+    :param local_path: Caminho do arquivo local
+    :param download_response: Resposta do servidor, com 'inline'
+    :return: SHA-256 do conteúdo escrito (hexadecimal)
+    """
+    payload = download_response['inline']
+    codec = download_response.get('codec')
+    if codec is not None:
+        payload = get_codec(codec).decompress(payload)
+    if len(payload) != download_response['size']:
+        raise ProtocolError(
+            f'Conteúdo de {len(payload)} bytes em vez de {download_response["size"]}.')
+    with open(local_path, 'wb') as file:
+        file.write(payload)
+    return hashlib.sha256(payload).hexdigest()
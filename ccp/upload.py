@@ -0,0 +1,382 @@
+import errno
+import hashlib
+import logging
+import os
+import queue
+import secrets
+import shutil
+import socket
+import struct
+import threading
+from typing import BinaryIO, Callable, Optional, Tuple
+
+from ccp.addressing import validate_path
+from ccp.compression import ParallelCompressor
+from ccp.integrity import sha256_file
+from ccp.messaging import MAX_MESSAGE_SIZE, ProtocolError, recv_exactly
+from ccp.target import TargetFile
+
+
+# Caminho local que faz o cliente enviar a entrada padrão.
+STDIN_PATH = '-'
+
+# Cabeçalho de cada pedaço nas streams de um upload: byte inicial e
+# tamanho da faixa original, tamanho do conteúdo enviado e se ele está
+# comprimido. Um pedaço vazio marca o fim da stream.
+UPLOAD_CHUNK = struct.Struct('!QII?')
+
+# Extensão do arquivo temporário, ao lado do destino, que recebe as faixas.
+UPLOAD_EXTENSION = '.ccp-upload'
+
+# Blocos lidos da entrada padrão esperando uma stream livre, por stream.
+STDIN_BLOCKS_PER_STREAM = 2
+
+
+def upload_temp_path(abs_path: str) -> str:
+    """
+    :return: Caminho temporário único, no mesmo diretório de <abs_path>
+        (o os.replace final não pode atravessar sistemas de arquivos)
+    """
+    directory, name = os.path.split(str(abs_path))
+    return os.path.join(directory, f'.{name}.{secrets.token_hex(4)}{UPLOAD_EXTENSION}')
+
+
+def resolve_upload_path(upload_root: Optional[str], path: str) -> str:
+    """
+    Caminho final de um upload: <path> relativo a <upload_root> (ou
+    absoluto), mas sempre dentro dela depois de resolver '..' e links.
+    :param upload_root: Diretório que recebe uploads, ou None se o
+        servidor não os aceita
+    :param path: Caminho pedido pelo cliente
+    :return: Caminho absoluto, já resolvido
+    """
+    if upload_root is None:
+        raise PermissionError('Servidor não aceita uploads (veja --upload-root).')
+    root = os.path.realpath(upload_root)
+    abs_path = validate_path(os.path.join(root, path))
+    directory, name = os.path.split(abs_path)
+    real_path = os.path.join(os.path.realpath(directory), name)
+    if real_path == root or os.path.commonpath([root, real_path]) != root:
+        raise PermissionError(f'Caminho "{path}" fora do diretório de uploads.')
+    return real_path
+
+
+def check_upload_size(directory: str, size: Optional[int], max_size: Optional[int] = None):
+    """
+    Recusa uploads que passam do limite do servidor ou do espaço livre,
+    antes de pré-alocar o arquivo.
+    :param directory: Diretório do destino
+    :param size: Tamanho anunciado pelo cliente, ou None
+    :param max_size: Maior upload aceito, ou None
+    """
+    if size is None:
+        return None
+    if size < 0:
+        raise ValueError(f'Tamanho inválido: {size}.')
+    if max_size is not None and size > max_size:
+        raise OSError(
+            errno.EFBIG, f'Upload de {size} bytes passa do limite de {max_size} bytes.')
+    free = shutil.disk_usage(directory).free
+    if size > free:
+        raise OSError(
+            errno.ENOSPC, f'Upload de {size} bytes não cabe nos {free} bytes livres.')
+
+
+class UploadTarget:
+    """
+    Destino de um upload no servidor: um arquivo temporário pré-alocado
+    (quando o tamanho é conhecido) que as streams escrevem em paralelo,
+    cada pedaço no seu byte. Só em commit() ele é conferido e renomeado
+    para o caminho final; até lá o arquivo antigo continua intacto.
+    """
+
+    def __init__(
+            self,
+            abs_path: str,
+            size: Optional[int],
+            max_size: Optional[int] = None
+    ):
+        """
+        :param abs_path: Caminho final do arquivo
+        :param size: Tamanho anunciado pelo cliente, ou None (entrada
+            padrão): o arquivo cresce conforme os pedaços chegam
+        :param max_size: Maior upload aceito, ou None
+        """
+        self.path = str(abs_path)
+        check_upload_size(os.path.dirname(self.path), size, max_size)
+        self.size = size
+        self.max_size = max_size
+        self.temp_path = upload_temp_path(abs_path)
+        self.__target = TargetFile(self.temp_path, size or 0)
+        self.__lock = threading.Lock()
+        self.__bytes_received = 0
+        self.__error = None
+        self.__closed = False
+
+    @property
+    def bytes_received(self) -> int:
+        with self.__lock:
+            return self.__bytes_received
+
+    def write_chunk(self, offset: int, size: int, payload, codec=None) -> int:
+        """
+        :param offset: Byte inicial da faixa
+        :param size: Tamanho da faixa original
+        :param payload: Conteúdo recebido
+        :param codec: Codec do conteúdo, ou None se ele não está comprimido
+        :return: Bytes escritos
+        """
+        if self.size is not None and offset + size > self.size:
+            raise ProtocolError(
+                f'Faixa [{offset}, {offset + size}) fora do arquivo de {self.size} bytes.')
+        if self.max_size is not None and offset + size > self.max_size:
+            raise ProtocolError(
+                f'Faixa [{offset}, {offset + size}) passa do limite de {self.max_size} bytes.')
+        if codec is not None:
+            payload = codec.decompress(payload)
+        if len(payload) != size:
+            raise ProtocolError(f'Pedaço no byte {offset} veio com {len(payload)} bytes.')
+        bytes_written = self.__target.pwrite(payload, offset)
+        with self.__lock:
+            self.__bytes_received += bytes_written
+        return bytes_written
+
+    def fail(self, error: str):
+        with self.__lock:
+            if self.__error is None:
+                self.__error = error
+
+    def commit(self, size: int, sha256: Optional[str] = None, mode: Optional[int] = None):
+        """
+        Confere o arquivo recebido e o põe no lugar do destino (os.replace
+        é atômico: quem abre o destino vê o arquivo antigo ou o novo).
+        :param size: Tamanho final informado pelo cliente no fim do envio
+        :param sha256: SHA-256 do cliente, conferido se não for None
+        :param mode: Permissões do arquivo do cliente, ou None (só os
+            bits rwx: setuid, setgid e sticky são descartados)
+        """
+        with self.__lock:
+            error, bytes_received = self.__error, self.__bytes_received
+        if error is not None:
+            raise RuntimeError(error)
+        if self.size is not None and size != self.size:
+            raise ProtocolError(f'Tamanho final {size} difere do anunciado ({self.size}).')
+        if bytes_received != size:
+            raise RuntimeError(f'Recebi {bytes_received} de {size} bytes.')
+        self.close()
+        if sha256 is not None and sha256_file(self.temp_path) != sha256:
+            raise RuntimeError('SHA-256 do arquivo recebido não bate com o do cliente.')
+        if mode is not None:
+            os.chmod(self.temp_path, mode & 0o777)
+        os.replace(self.temp_path, self.path)
+
+    def close(self):
+        if not self.__closed:
+            self.__closed = True
+            self.__target.close()
+
+    def abort(self):
+        """
+        Descarta o arquivo temporário (upload incompleto ou recusado).
+        """
+        self.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def recv_upload_chunk_header(connection: socket.socket) -> Tuple[int, int, int, bool]:
+    """
+    :return: (byte inicial, tamanho, tamanho do conteúdo, comprimido);
+        tamanho 0 no fim da stream
+    """
+    header = UPLOAD_CHUNK.unpack(recv_exactly(connection, UPLOAD_CHUNK.size))
+    check_upload_chunk_header(header)
+    return header
+
+
+def check_upload_chunk_header(header: Tuple[int, int, int, bool]):
+    _, size, payload_size, _ = header
+    if max(size, payload_size) > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f'Pedaço grande demais: {max(size, payload_size)} bytes.')
+
+
+def recv_upload_chunks(connection: socket.socket, target: UploadTarget, codec=None) -> int:
+    """
+    Recebe os pedaços de uma stream de upload e os escreve no destino.
+    :param connection: Conexão de dados
+    :param target: Destino do upload
+    :param codec: Codec negociado, ou None
+    :return: Bytes escritos
+    """
+    total_bytes_written = 0
+    while True:
+        offset, size, payload_size, compressed = recv_upload_chunk_header(connection)
+        if not size:
+            return total_bytes_written
+        if compressed and codec is None:
+            raise ProtocolError('Pedaço comprimido sem codec negociado.')
+        payload = recv_exactly(connection, payload_size)
+        total_bytes_written += target.write_chunk(
+            offset, size, payload, codec if compressed else None)
+
+
+def send_upload_range(
+        connection: socket.socket,
+        file: BinaryIO,
+        start_byte: int,
+        size: int,
+        compressor: ParallelCompressor,
+        codec=None,
+        level: Optional[int] = None,
+        adaptive: bool = False,
+        on_progress: Optional[Callable[[int], object]] = None
+) -> int:
+    """
+    Envia a faixa [start_byte, start_byte + size) de <file> em pedaços do
+    tamanho dos blocos do compressor. Com codec, os blocos são lidos e
+    comprimidos em paralelo pelo compressor (compartilhado pelas
+    streams); sem codec, cada pedaço sai direto do arquivo (sendfile).
+    :return: Bytes enviados
+    """
+    total_bytes_sent = 0
+    if codec is None:
+        for offset in range(start_byte, start_byte + size, compressor.block_size):
+            chunk_size = min(compressor.block_size, start_byte + size - offset)
+            connection.sendall(UPLOAD_CHUNK.pack(offset, chunk_size, chunk_size, False))
+            bytes_sent = connection.sendfile(file, offset, chunk_size)
+            if bytes_sent != chunk_size:
+                raise RuntimeError(
+                    f'Li {bytes_sent} bytes em vez de {chunk_size} no byte {offset}.')
+            total_bytes_sent += bytes_sent
+            if on_progress is not None:
+                on_progress(chunk_size)
+    else:
+        blocks = compressor.process_range(
+            file, start_byte, size, codec, level, adaptive, raw_blocks=True)
+        for block in blocks:
+            connection.sendall(UPLOAD_CHUNK.pack(
+                block.offset, block.size, len(block.payload), not block.raw))
+            connection.sendall(block.payload)
+            total_bytes_sent += len(block.payload)
+            if on_progress is not None:
+                on_progress(block.size)
+    connection.sendall(UPLOAD_CHUNK.pack(0, 0, 0, False))
+    return total_bytes_sent
+
+
+class StdinReader:
+    """
+    Lê um fluxo de tamanho desconhecido (a entrada padrão) em blocos
+    numerados pelo byte inicial, numa thread só, e os entrega às streams
+    conforme elas ficam livres. Cada stream comprime os blocos que pegar,
+    então a compressão roda em paralelo enquanto a leitura é sequencial.
+    O SHA-256 do fluxo é calculado durante a leitura.
+    """
+
+    def __init__(self, stream: BinaryIO, block_size: int, streams: int):
+        self.stream = stream
+        self.block_size = block_size
+        self.streams = streams
+        self.size = 0
+        self.error = None
+        self.__hash = hashlib.sha256()
+        self.__blocks = queue.Queue(maxsize=STDIN_BLOCKS_PER_STREAM * streams)
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(
+            target=self.__run,
+            name='ccp-stdin',
+            daemon=True
+        )
+        self.__thread.start()
+
+    def __put(self, item) -> bool:
+        while not self.__stopped.is_set():
+            try:
+                self.__blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __run(self):
+        try:
+            while True:
+                data = self.stream.read(self.block_size)
+                if not data:
+                    break
+                self.__hash.update(data)
+                if not self.__put((self.size, data)):
+                    return
+                self.size += len(data)
+        except Exception as exc:
+            logging.debug('Leitura da entrada falhou: %s', exc)
+            self.error = exc
+        finally:
+            # Um fim por stream, atrás dos blocos que ainda estão na fila.
+            for _ in range(self.streams):
+                if not self.__put(None):
+                    break
+
+    def next_block(self) -> Optional[Tuple[int, bytes]]:
+        """
+        :return: (byte inicial, conteúdo), ou None no fim do fluxo (ou
+            depois de stop())
+        """
+        while True:
+            try:
+                return self.__blocks.get(timeout=0.1)
+            except queue.Empty:
+                if self.__stopped.is_set():
+                    return None
+
+    def stop(self):
+        """
+        Para a leitura (uma stream falhou) sem esperar o fim do fluxo.
+        """
+        self.__stopped.set()
+
+    def result(self) -> Tuple[int, str]:
+        """
+        Espera o fim da leitura.
+        :return: (tamanho do fluxo, SHA-256)
+        """
+        self.__thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.size, self.__hash.hexdigest()
+
+
+def send_stdin_blocks(
+        connection: socket.socket,
+        reader: StdinReader,
+        codec=None,
+        level: Optional[int] = None,
+        on_progress: Optional[Callable[[int], object]] = None
+) -> int:
+    """
+    Envia os blocos da entrada que o <reader> entregar a esta stream,
+    comprimidos só quando isso os diminui.
+    :return: Bytes enviados
+    """
+    total_bytes_sent = 0
+    try:
+        while True:
+            block = reader.next_block()
+            if block is None:
+                break
+            offset, data = block
+            payload, compressed = data, False
+            if codec is not None:
+                compressed_payload = codec.compress(data, level)
+                if len(compressed_payload) < len(data):
+                    payload, compressed = compressed_payload, True
+            connection.sendall(UPLOAD_CHUNK.pack(offset, len(data), len(payload), compressed))
+            connection.sendall(payload)
+            total_bytes_sent += len(payload)
+            if on_progress is not None:
+                on_progress(len(data))
+    except BaseException:
+        reader.stop()
+        raise
+    connection.sendall(UPLOAD_CHUNK.pack(0, 0, 0, False))
+    return total_bytes_sent
@@ -28,6 +28,12 @@ setuptools.setup(
         'coloredlogs',
         'psutil',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'xxhash': ['xxhash'],
+        'numpy': ['numpy'],
+    },
     entry_points={
         'console_scripts': [
             'ccp=ccp.client:run',
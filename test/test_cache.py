@@ -0,0 +1,114 @@
+import os
+import tempfile
+import types
+import unittest
+
+from ccp.cache import CHUNK_EXTENSION, CHUNK_SUBDIRECTORY, ChunkCache, release_mapped
+
+
+def file_info(size=1000, mtime_ns=1, inode=7):
+    return types.SimpleNamespace(st_dev=1, st_ino=inode, st_size=size, st_mtime_ns=mtime_ns)
+
+
+def block_key(identity, offset=0, size=100):
+    return identity, offset, size, 'zlib', 6, False
+
+
+class ChunkCacheTest(unittest.TestCase):
+
+    def test_put_and_get(self):
+        cache = ChunkCache(max_memory=1000)
+        key = block_key(cache.identify(file_info()))
+        self.assertIsNone(cache.get(key))
+        cache.put(key, b'compressed')
+        self.assertEqual(cache.get(key), b'compressed')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_changed_file_drops_old_blocks(self):
+        cache = ChunkCache(max_memory=1000)
+        old_key = block_key(cache.identify(file_info(mtime_ns=1)))
+        cache.put(old_key, b'old')
+        other_key = block_key(cache.identify(file_info(inode=8)))
+        cache.put(other_key, b'other')
+
+        new_key = block_key(cache.identify(file_info(mtime_ns=2)))
+        self.assertIsNone(cache.get(old_key))
+        self.assertIsNone(cache.get(new_key))
+        self.assertEqual(cache.get(other_key), b'other')
+        self.assertEqual(cache.stats()['memory'], len(b'other'))
+
+    def test_blocks_of_invalidated_version_are_not_stored(self):
+        cache = ChunkCache(max_memory=1000)
+        old_key = block_key(cache.identify(file_info(size=10)))
+        cache.identify(file_info(size=20))
+        # Compressão da versão antiga que terminou depois da mudança.
+        cache.put(old_key, b'late')
+        self.assertIsNone(cache.get(old_key))
+        self.assertEqual(cache.stats()['chunks'], 0)
+
+    def test_least_recently_used_block_leaves_first(self):
+        cache = ChunkCache(max_memory=10)
+        identity = cache.identify(file_info())
+        first, second, third = (block_key(identity, offset) for offset in (0, 100, 200))
+        cache.put(first, b'aaaa')
+        cache.put(second, b'bbbb')
+        cache.get(first)
+        cache.put(third, b'cccc')
+        self.assertEqual(cache.get(first), b'aaaa')
+        self.assertIsNone(cache.get(second))
+        self.assertEqual(cache.get(third), b'cccc')
+        self.assertLessEqual(cache.stats()['memory'], 10)
+
+    def test_disk_blocks_are_removed_when_file_changes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            chunk_directory = os.path.join(directory, CHUNK_SUBDIRECTORY)
+            os.makedirs(chunk_directory)
+            stale_path = os.path.join(chunk_directory, 'previous' + CHUNK_EXTENSION)
+            open(stale_path, 'wb').close()
+            # Arquivo de outro dono no mesmo diretório (ex.: ChunkStore).
+            foreign_path = os.path.join(directory, 'other' + CHUNK_EXTENSION)
+            open(foreign_path, 'wb').close()
+            cache = ChunkCache(max_memory=0, directory=directory, max_disk=1000)
+            self.assertFalse(os.path.exists(stale_path))
+            self.assertTrue(os.path.exists(foreign_path))
+
+            key = block_key(cache.identify(file_info(mtime_ns=1)))
+            cache.put(key, b'on disk')
+            self.assertEqual(bytes(cache.get(key)), b'on disk')
+            self.assertEqual(len(os.listdir(chunk_directory)), 1)
+
+            cache.identify(file_info(mtime_ns=2))
+            self.assertIsNone(cache.get(key))
+            self.assertEqual(os.listdir(chunk_directory), [])
+
+    def test_mapped_block_is_closed_after_release(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ChunkCache(max_memory=0, directory=directory, max_disk=1000)
+            key = block_key(cache.identify(file_info()))
+            cache.put(key, b'on disk')
+            payload = cache.get(key)
+            file_map = payload.obj
+            release_mapped(payload)
+            self.assertTrue(file_map.closed)
+            # Blocos em memória não são afetados.
+            release_mapped(b'in memory')
+
+    def test_prewarm_is_requested_once_per_version(self):
+        cache = ChunkCache(max_memory=10000, prewarm_accesses=2)
+        identity = cache.identify(file_info())
+        self.assertFalse(cache.record_access(identity, 'zlib', 6))
+        self.assertTrue(cache.record_access(identity, 'zlib', 6))
+        self.assertFalse(cache.record_access(identity, 'zlib', 6))
+
+        changed = cache.identify(file_info(mtime_ns=2))
+        self.assertFalse(cache.record_access(changed, 'zlib', 6))
+        self.assertTrue(cache.record_access(changed, 'zlib', 6))
+
+    def test_files_larger_than_cache_are_not_prewarmed(self):
+        cache = ChunkCache(max_memory=100, prewarm_accesses=1)
+        identity = cache.identify(file_info(size=1000))
+        self.assertFalse(cache.record_access(identity, 'zlib', 6))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import random
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+from ccp import chunking
+from ccp.chunking import (
+    CDC_MAX_SIZE,
+    CDC_MIN_SIZE,
+    CHUNK_DIGEST_SIZE,
+    ChunkIndex,
+    find_cut_points,
+    gear_candidates
+)
+
+
+def random_bytes(size, seed=1):
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+class FindCutPointsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as file:
+            file.write(data)
+        return path
+
+    def test_chunks_respect_size_limits(self):
+        data = random_bytes(4 * 2 ** 20)
+        cut_points = find_cut_points(self.write('data', data))
+        self.assertEqual(cut_points[-1], len(data))
+        sizes = [end - start for start, end in zip([0] + cut_points, cut_points)]
+        for size in sizes[:-1]:
+            self.assertGreaterEqual(size, CDC_MIN_SIZE)
+            self.assertLessEqual(size, CDC_MAX_SIZE)
+
+    def test_cuts_do_not_depend_on_scan_segments(self):
+        path = self.write('data', random_bytes(2 * 2 ** 20))
+        expected = find_cut_points(path)
+        for segment_size in (4096, 100 * 2 ** 10 + 7):
+            with self.subTest(segment_size=segment_size):
+                with mock.patch.object(chunking, 'SCAN_SEGMENT_SIZE', segment_size):
+                    self.assertEqual(find_cut_points(path), expected)
+
+    def test_insertion_only_changes_nearby_chunks(self):
+        data = random_bytes(4 * 2 ** 20)
+        position = len(data) // 3
+        edited = data[:position] + random_bytes(1000, seed=2) + data[position:]
+        before = ChunkIndex.build(self.write('before', data))
+        after = ChunkIndex.build(self.write('after', edited))
+
+        before_digests = {digest for _, _, digest in before.chunks()}
+        changed = [digest for _, _, digest in after.chunks() if digest not in before_digests]
+        self.assertLessEqual(len(changed), 3)
+        self.assertGreater(len(after), 10)
+
+    def test_empty_and_tiny_files(self):
+        self.assertEqual(find_cut_points(self.write('empty', b'')), [])
+        self.assertEqual(find_cut_points(self.write('tiny', b'abc')), [3])
+
+    def test_numpy_and_fallback_agree(self):
+        if chunking.np is None:
+            self.skipTest('sem NumPy')
+        data = random_bytes(300 * 2 ** 10)
+        expected = gear_candidates(data, 31, 18, 14)
+        with mock.patch.object(chunking, 'np', None):
+            self.assertEqual(gear_candidates(data, 31, 18, 14), expected)
+
+
+class ChunkIndexFromMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sizes = [10, 20, 30]
+        self.message = {
+            'size': 60,
+            'sizes': struct.pack('!3I', *self.sizes),
+            'digests': bytes(range(3 * CHUNK_DIGEST_SIZE))
+        }
+
+    def test_round_trip(self):
+        index = ChunkIndex.from_message(self.message)
+        self.assertEqual(index.sizes, self.sizes)
+        self.assertEqual(index.to_message(), self.message)
+        self.assertEqual(
+            [(offset, size) for offset, size, _ in index.chunks()],
+            [(0, 10), (10, 20), (30, 30)])
+
+    def test_built_index_round_trips(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'data')
+            with open(path, 'wb') as file:
+                file.write(random_bytes(2 ** 20))
+            index = ChunkIndex.build(path)
+        copy = ChunkIndex.from_message(index.to_message())
+        self.assertEqual(
+            (copy.size, copy.sizes, copy.digests), (index.size, index.sizes, index.digests))
+
+    def test_invalid_lists_are_refused(self):
+        invalid = {
+            'tamanho errado': {**self.message, 'size': 61},
+            'hash faltando': {**self.message, 'digests': self.message['digests'][:-1]},
+            'tamanhos truncados': {**self.message, 'sizes': self.message['sizes'][:-1]},
+            'pedaço vazio': {
+                **self.message,
+                'size': 30,
+                'sizes': struct.pack('!3I', 10, 0, 20)
+            }
+        }
+        for case, message in invalid.items():
+            with self.subTest(case=case):
+                with self.assertRaises(ValueError):
+                    ChunkIndex.from_message(message)
+
+
+if __name__ == '__main__':
+    unittest.main()
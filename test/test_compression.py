@@ -0,0 +1,95 @@
+import os
+import random
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from ccp.compression import ParallelCompressor, get_codec
+from ccp.messaging import ProtocolError, recv_frame_to_file, send_end_frame, send_frame
+from ccp.target import DecodingWriter, TargetFile
+
+
+BLOCK_SIZE = 64 * 2 ** 10
+
+
+def random_bytes(size, seed=1):
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+class AdaptiveRawBlocksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.compressor = ParallelCompressor(workers=2, block_size=BLOCK_SIZE)
+        # Um bloco de texto repetido e dois de dados aleatórios (JPEG, cifrados).
+        self.data = b'texto repetido ' * (BLOCK_SIZE // 15 + 1)
+        self.data = self.data[:BLOCK_SIZE] + random_bytes(2 * BLOCK_SIZE)
+        self.path = os.path.join(self.directory.name, 'source')
+        with open(self.path, 'wb') as file:
+            file.write(self.data)
+
+    def tearDown(self):
+        self.compressor.shutdown()
+        self.directory.cleanup()
+
+    def blocks(self, codec, raw_blocks):
+        with open(self.path, 'rb') as file:
+            return list(self.compressor.process_range(
+                file, 0, len(self.data), codec, adaptive=True, raw_blocks=raw_blocks))
+
+    def test_incompressible_blocks_skip_the_codec(self):
+        codec = get_codec('bz2')
+        with mock.patch.object(codec, 'compress', wraps=codec.compress) as compress:
+            blocks = self.blocks(codec, raw_blocks=True)
+
+        self.assertEqual([block.raw for block in blocks], [False, True, True])
+        self.assertEqual(compress.call_count, 1)
+        for block in blocks[1:]:
+            self.assertEqual(block.payload, self.data[block.offset:block.offset + block.size])
+        self.assertEqual(
+            codec.decompress(blocks[0].payload), self.data[:BLOCK_SIZE])
+
+    def test_without_raw_blocks_output_stays_valid_for_codec(self):
+        codec = get_codec('lzma')
+        blocks = self.blocks(codec, raw_blocks=False)
+        self.assertFalse(any(block.raw for block in blocks))
+        self.assertEqual(
+            codec.decompress(b''.join(block.payload for block in blocks)), self.data)
+
+    def test_raw_frames_are_written_as_they_came(self):
+        codec = get_codec('bz2')
+        blocks = self.blocks(codec, raw_blocks=True)
+        sender, receiver = socket.socketpair()
+        self.addCleanup(sender.close)
+        self.addCleanup(receiver.close)
+
+        def send():
+            for block in blocks:
+                send_frame(sender, block.payload, block.raw)
+            send_end_frame(sender)
+
+        thread = threading.Thread(target=send)
+        thread.start()
+        target_path = os.path.join(self.directory.name, 'target')
+        with TargetFile(target_path, len(self.data)) as target:
+            with DecodingWriter(codec, target.writer(0, len(self.data))) as writer:
+                while recv_frame_to_file(receiver, writer):
+                    pass
+        thread.join()
+        with open(target_path, 'rb') as file:
+            self.assertEqual(file.read(), self.data)
+
+    def test_raw_frame_into_compressed_partition_is_refused(self):
+        sender, receiver = socket.socketpair()
+        self.addCleanup(sender.close)
+        self.addCleanup(receiver.close)
+        send_frame(sender, b'raw', raw=True)
+        with open(os.path.join(self.directory.name, 'source.part0'), 'wb') as file:
+            with self.assertRaises(ProtocolError):
+                recv_frame_to_file(receiver, file)
+
+
+if __name__ == '__main__':
+    unittest.main()
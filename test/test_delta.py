@@ -0,0 +1,86 @@
+import os
+import random
+import tempfile
+import unittest
+
+from ccp.delta import (
+    OP_COPY,
+    DeltaGenerator,
+    compute_signatures,
+    np,
+    rolling_checksums,
+    weak_checksum
+)
+
+
+BLOCK_SIZE = 4096
+
+
+def random_bytes(size, seed=1):
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+@unittest.skipIf(np is None, 'NumPy não está instalado')
+class RollingChecksumsTest(unittest.TestCase):
+
+    def test_matches_weak_checksum_of_each_window(self):
+        # Bytes altos e janela grande fazem as somas darem a volta em 2^16.
+        data = bytes([255]) * 3 * BLOCK_SIZE + random_bytes(3 * BLOCK_SIZE)
+        array = np.frombuffer(data, dtype=np.uint8)
+        start, stop = 100, len(data) - BLOCK_SIZE + 1
+        weak = rolling_checksums(array, start, stop, BLOCK_SIZE)
+        for position in range(start, stop, 331):
+            self.assertEqual(
+                int(weak[position - start]),
+                weak_checksum(data[position:position + BLOCK_SIZE]))
+
+
+class DeltaGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as file:
+            file.write(data)
+        return path
+
+    def rebuild(self, old, new):
+        """
+        :return: (arquivo reconstruído com as instruções, bytes copiados)
+        """
+        old_path = self.write('old', old)
+        generator = DeltaGenerator(BLOCK_SIZE, *compute_signatures(old_path, BLOCK_SIZE))
+        rebuilt = []
+        copied_bytes = 0
+        for instruction in generator.generate(self.write('new', new)):
+            if instruction.op == OP_COPY:
+                rebuilt.append(old[instruction.offset:instruction.offset + instruction.size])
+                copied_bytes += instruction.size
+            else:
+                rebuilt.append(bytes(instruction.payload))
+        return b''.join(rebuilt), copied_bytes
+
+    def test_insertions_reuse_the_shifted_blocks(self):
+        old = random_bytes(40 * BLOCK_SIZE)
+        new = b'inicio' + old[:10 * BLOCK_SIZE] + b'meio' * 100 + old[10 * BLOCK_SIZE:]
+        rebuilt, copied_bytes = self.rebuild(old, new)
+        self.assertEqual(rebuilt, new)
+        if np is not None:
+            self.assertEqual(copied_bytes, len(old))
+
+    def test_repeated_blocks_skip_positions_inside_matches(self):
+        # Toda posição da parte zerada é candidata; as que caem dentro de
+        # um bloco já casado não podem virar outra cópia.
+        old = bytes(20 * BLOCK_SIZE) + random_bytes(4 * BLOCK_SIZE)
+        new = b'x' * 100 + old + b'fim'
+        rebuilt, copied_bytes = self.rebuild(old, new)
+        self.assertEqual(rebuilt, new)
+        if np is not None:
+            self.assertEqual(copied_bytes, len(old))
+
+
+if __name__ == '__main__':
+    unittest.main()
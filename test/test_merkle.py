@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+
+from ccp.merkle import MAX_TREE_NODES, MIN_MERKLE_BLOCK_SIZE, MerkleTree, answer_nodes
+
+
+class AnswerNodesTest(unittest.TestCase):
+
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'data')
+            with open(path, 'wb') as file:
+                file.write(bytes(range(256)) * (5 * MIN_MERKLE_BLOCK_SIZE // 256))
+            self.tree = MerkleTree.build(path, MIN_MERKLE_BLOCK_SIZE)
+
+    def test_existing_nodes_are_answered(self):
+        self.assertEqual(self.tree.depth, 4)
+        self.assertEqual(
+            answer_nodes(self.tree, [[0, 4], [3, 0]]),
+            [self.tree.levels[0][4], self.tree.root])
+
+    def test_nodes_outside_the_tree_are_none(self):
+        # O cliente com o arquivo maior pede nós que só a árvore dele tem.
+        self.assertEqual(answer_nodes(self.tree, [[0, 5], [1, 10], [4, 0]]), [None] * 3)
+
+    def test_invalid_requests_are_refused(self):
+        invalid = {
+            'nível negativo': [[-1, 0]],
+            'índice negativo': [[0, -1]],
+            'nó malformado': [[0]],
+            'tipo errado': [['0', 0]],
+            'lista malformada': {'0': 0},
+            'nós demais': [[0, 0]] * (MAX_TREE_NODES + 1)
+        }
+        for case, nodes in invalid.items():
+            with self.subTest(case=case):
+                self.assertIsNone(answer_nodes(self.tree, nodes))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+import stat
+import tempfile
+import unittest
+
+from ccp.messaging import ProtocolError
+from ccp.packing import (
+    Segment,
+    TreeEntry,
+    TreeWriter,
+    entry_path,
+    pack_entries,
+    read_batch,
+    scan_tree,
+    segments_size
+)
+
+
+FILE_MODE = stat.S_IFREG | 0o644
+DIRECTORY_MODE = stat.S_IFDIR | 0o755
+LINK_MODE = stat.S_IFLNK | 0o777
+
+
+def file_entry(path, size):
+    return TreeEntry(path, size, FILE_MODE, 0)
+
+
+class PackEntriesTest(unittest.TestCase):
+
+    def test_small_files_share_a_batch(self):
+        entries = [file_entry('a', 10), file_entry('b', 20), file_entry('c', 30)]
+        batches = pack_entries(entries, 100)
+        self.assertEqual(batches, [[
+            Segment(0, 0, 10), Segment(1, 0, 20), Segment(2, 0, 30)
+        ]])
+
+    def test_large_file_is_split_between_batches(self):
+        entries = [file_entry('a', 10), file_entry('big', 250)]
+        batches = pack_entries(entries, 100)
+        self.assertEqual(batches, [
+            [Segment(0, 0, 10), Segment(1, 0, 90)],
+            [Segment(1, 90, 100)],
+            [Segment(1, 190, 60)]
+        ])
+        self.assertTrue(all(segments_size(batch) <= 100 for batch in batches))
+
+    def test_directories_links_and_empty_files_are_not_packed(self):
+        entries = [
+            TreeEntry('d', 0, DIRECTORY_MODE, 0),
+            file_entry('d/empty', 0),
+            TreeEntry('d/link', 0, LINK_MODE, 0, 'empty'),
+            file_entry('d/x', 5)
+        ]
+        self.assertEqual(pack_entries(entries, 100), [[Segment(3, 0, 5)]])
+
+    def test_every_byte_is_packed_once(self):
+        entries = [file_entry(str(i), i * 37 % 101) for i in range(50)]
+        covered = {}
+        for batch in pack_entries(entries, 64):
+            for segment in batch:
+                covered.setdefault(segment.index, []).append(segment)
+        for index, entry in enumerate(entries):
+            offset = 0
+            for segment in covered.get(index, []):
+                self.assertEqual(segment.offset, offset)
+                offset += segment.size
+            self.assertEqual(offset, entry.size)
+
+
+class EntryPathTest(unittest.TestCase):
+
+    def test_relative_path_is_joined_to_root(self):
+        root = os.path.join('tmp', 'root')
+        self.assertEqual(
+            entry_path(root, 'a/b/c.txt'), os.path.join(root, 'a', 'b', 'c.txt'))
+
+    def test_paths_leaving_root_are_refused(self):
+        for relative in ('', '/etc/passwd', '../x', 'a/../../x', 'a//b', './a', 'a/.'):
+            with self.subTest(relative=relative):
+                with self.assertRaises(ProtocolError):
+                    entry_path('root', relative)
+
+    def test_system_separator_inside_a_name_is_refused(self):
+        with self.assertRaises(ProtocolError):
+            entry_path('root', f'a{os.sep}..{os.sep}..')
+
+
+class TreeWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.directory.name, 'dst')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_segment_index_out_of_listing_is_a_protocol_error(self):
+        writer = TreeWriter(self.root, [file_entry('a', 3)])
+        writer.prepare()
+        with self.assertRaises(ProtocolError):
+            writer.write_batch([Segment(1, 0, 3)], b'abc')
+
+    def test_segment_past_end_of_file_is_a_protocol_error(self):
+        writer = TreeWriter(self.root, [file_entry('a', 3)])
+        writer.prepare()
+        with self.assertRaises(ProtocolError):
+            writer.write_batch([Segment(0, 2, 3)], b'abc')
+
+    def test_entries_inside_a_link_are_refused(self):
+        entries = [
+            TreeEntry('evil', 0, LINK_MODE, 0, '/etc'),
+            file_entry('evil/passwd', 3)
+        ]
+        with self.assertRaises(ProtocolError):
+            TreeWriter(self.root, entries)
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'sem links simbólicos')
+    def test_tree_with_links_round_trips(self):
+        source = os.path.join(self.directory.name, 'src')
+        os.makedirs(os.path.join(source, 'sub'))
+        with open(os.path.join(source, 'sub', 'data'), 'wb') as file:
+            file.write(b'x' * 1000)
+        try:
+            os.symlink(os.path.join('sub', 'data'), os.path.join(source, 'link'))
+        except OSError:
+            self.skipTest('sem permissão para criar links')
+
+        entries = scan_tree(source)
+        writer = TreeWriter(self.root, entries)
+        writer.prepare()
+        for batch in pack_entries(entries, 300):
+            writer.write_batch(batch, read_batch(source, entries, batch))
+        writer.finish()
+
+        self.assertEqual(writer.failed_links, [])
+        self.assertEqual(
+            os.readlink(os.path.join(self.root, 'link')), os.path.join('sub', 'data'))
+        with open(os.path.join(self.root, 'link'), 'rb') as file:
+            self.assertEqual(file.read(), b'x' * 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
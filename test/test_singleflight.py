@@ -0,0 +1,93 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from ccp.singleflight import FlightGroup
+
+
+class FlightGroupTest(unittest.TestCase):
+
+    def test_concurrent_calls_share_one_run(self):
+        flights = FlightGroup(replay_size=0)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return b'result'
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            leader = executor.submit(flights.run, 'key', work)
+            self.assertTrue(started.wait(5))
+            followers = [executor.submit(flights.run, 'key', work) for _ in range(3)]
+            while flights.stats()['followers'] < 3:
+                time.sleep(0.001)
+            release.set()
+            results = [leader.result()] + [future.result() for future in followers]
+
+        self.assertEqual(results, [b'result'] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((flights.leaders, flights.followers), (1, 3))
+        self.assertEqual(flights.stats()['in_flight'], 0)
+
+    def test_followers_get_the_leader_exception(self):
+        flights = FlightGroup(replay_size=0)
+        started = threading.Event()
+        release = threading.Event()
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise OSError('disco')
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(flights.run, 'key', fail)
+            self.assertTrue(started.wait(5))
+            follower = executor.submit(flights.run, 'key', fail)
+            while flights.stats()['followers'] < 1:
+                time.sleep(0.001)
+            release.set()
+            for future in (leader, follower):
+                with self.assertRaises(OSError):
+                    future.result()
+
+        # A falha não fica guardada: o próximo pedido tenta de novo.
+        self.assertEqual(flights.run('key', lambda: b'ok'), b'ok')
+
+    def test_recent_results_are_replayed(self):
+        flights = FlightGroup(replay_size=100)
+        calls = []
+
+        def work(value):
+            calls.append(value)
+            return value
+
+        self.assertEqual(flights.run('key', work, b'first'), b'first')
+        self.assertEqual(flights.run('key', work, b'second'), b'first')
+        self.assertEqual(calls, [b'first'])
+
+    def test_replay_buffer_is_bounded_in_bytes(self):
+        flights = FlightGroup(replay_size=10)
+        for key in range(3):
+            flights.run(key, lambda: b'12345')
+        self.assertEqual(flights.stats()['replay'], 10)
+        # A chave mais antiga saiu do buffer e roda de novo.
+        self.assertEqual(flights.run(0, lambda: b'again'), b'again')
+        self.assertEqual(flights.run(2, lambda: b'again'), b'12345')
+
+    def test_results_larger_than_buffer_are_not_kept(self):
+        flights = FlightGroup(replay_size=4)
+        flights.run('key', lambda: b'too large')
+        self.assertEqual(flights.stats()['replay'], 0)
+
+    def test_negative_replay_size_is_refused(self):
+        with self.assertRaises(ValueError):
+            FlightGroup(replay_size=-1)
+
+
+if __name__ == '__main__':
+    unittest.main()
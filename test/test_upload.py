@@ -0,0 +1,148 @@
+import hashlib
+import os
+import stat
+import tempfile
+import unittest
+
+from ccp.messaging import ProtocolError
+from ccp.upload import UPLOAD_EXTENSION, UploadTarget, resolve_upload_path
+
+
+class UploadTargetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'file')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def leftovers(self):
+        return [
+            name for name in os.listdir(self.directory.name)
+            if name.endswith(UPLOAD_EXTENSION)
+        ]
+
+    def upload(self, data, size, chunk_size=4):
+        target = UploadTarget(self.path, size)
+        # Fora de ordem, como chegam de streams diferentes.
+        for offset in reversed(range(0, len(data), chunk_size)):
+            chunk = data[offset:offset + chunk_size]
+            target.write_chunk(offset, len(chunk), chunk)
+        return target
+
+    def test_commit_replaces_destination(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'old content, longer than the new one')
+        data = b'0123456789abcdef!'
+        target = self.upload(data, len(data))
+        target.commit(len(data), hashlib.sha256(data).hexdigest(), 0o640)
+        with open(self.path, 'rb') as file:
+            self.assertEqual(file.read(), data)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_commit_of_unknown_size(self):
+        data = b'stdin' * 10
+        target = self.upload(data, None)
+        target.commit(len(data))
+        with open(self.path, 'rb') as file:
+            self.assertEqual(file.read(), data)
+
+    def test_commit_drops_special_mode_bits(self):
+        target = self.upload(b'data', 4)
+        target.commit(4, mode=stat.S_ISUID | stat.S_ISGID | 0o755)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o755)
+
+    def test_missing_bytes_keep_old_file(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'old')
+        target = UploadTarget(self.path, 8)
+        target.write_chunk(0, 4, b'half')
+        with self.assertRaises(RuntimeError):
+            target.commit(8)
+        target.abort()
+        with open(self.path, 'rb') as file:
+            self.assertEqual(file.read(), b'old')
+        self.assertEqual(self.leftovers(), [])
+
+    def test_wrong_sha256_is_refused(self):
+        target = self.upload(b'data', 4)
+        with self.assertRaises(RuntimeError):
+            target.commit(4, hashlib.sha256(b'other').hexdigest())
+        target.abort()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_final_size_must_match_announced(self):
+        target = self.upload(b'data', 4)
+        with self.assertRaises(ProtocolError):
+            target.commit(5)
+        target.abort()
+
+    def test_failed_stream_fails_commit(self):
+        target = self.upload(b'data', 4)
+        target.fail('stream caiu')
+        with self.assertRaisesRegex(RuntimeError, 'stream caiu'):
+            target.commit(4)
+        target.abort()
+
+    def test_chunk_outside_file_is_refused(self):
+        target = UploadTarget(self.path, 4)
+        with self.assertRaises(ProtocolError):
+            target.write_chunk(2, 4, b'data')
+        target.abort()
+
+    def test_size_above_limit_is_refused_before_allocation(self):
+        with self.assertRaises(OSError):
+            UploadTarget(self.path, 100, max_size=10)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_unknown_size_stops_at_limit(self):
+        target = UploadTarget(self.path, None, max_size=6)
+        target.write_chunk(0, 4, b'data')
+        with self.assertRaises(ProtocolError):
+            target.write_chunk(4, 4, b'more')
+        target.abort()
+
+
+class ResolveUploadPathTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = os.path.realpath(self.directory.name)
+        os.mkdir(os.path.join(self.root, 'sub'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_uploads_are_refused_without_root(self):
+        with self.assertRaises(PermissionError):
+            resolve_upload_path(None, 'file')
+
+    def test_paths_are_resolved_under_root(self):
+        self.assertEqual(
+            resolve_upload_path(self.root, 'sub/file'), os.path.join(self.root, 'sub', 'file'))
+        self.assertEqual(
+            resolve_upload_path(self.root, os.path.join(self.root, 'file')),
+            os.path.join(self.root, 'file'))
+
+    def test_paths_outside_root_are_refused(self):
+        for path in ('../file', 'sub/../../file', '/tmp/file'):
+            with self.subTest(path=path):
+                with self.assertRaises(PermissionError):
+                    resolve_upload_path(self.root, path)
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'sem links simbólicos')
+    def test_link_leaving_root_is_refused(self):
+        outside = tempfile.TemporaryDirectory()
+        self.addCleanup(outside.cleanup)
+        try:
+            os.symlink(outside.name, os.path.join(self.root, 'link'))
+        except OSError:
+            self.skipTest('sem permissão para criar links')
+        with self.assertRaises(PermissionError):
+            resolve_upload_path(self.root, 'link/file')
+
+
+if __name__ == '__main__':
+    unittest.main()